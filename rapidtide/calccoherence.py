@@ -115,8 +115,7 @@ def coherencepass(
                     )
 
                 except Exception as e:
-                    print("error!", e)
-                    break
+                    outQ.put(tide_multiproc.WorkerFailure(val, e))
 
         data_out = tide_multiproc.run_multiproc(
             coherence_consumer,
@@ -22,6 +22,10 @@
 #
 #
 #
+import glob
+import hashlib
+import json
+import os
 import sys
 
 import numpy as np
@@ -29,48 +33,73 @@ import numpy as np
 import rapidtide.filter as tide_filt
 import rapidtide.miscmath as tide_math
 import rapidtide.multiproc as tide_multiproc
+import rapidtide.stats as tide_stats
 import rapidtide.util as tide_util
 
+# the permutations are made, correlated and fit in batches of this many
+NULLBATCHSIZE = 250
 
-# note: rawtimecourse has been filtered, but NOT windowed
-def _procOneNullCorrelationx(
-    normalizedreftc,
-    rawtcfft_r,
-    rawtcfft_ang,
-    Fs,
-    theCorrelator,
-    thefitter,
-    despeckle_thresh=5.0,
-    fixdelay=False,
-    fixeddelayvalue=0.0,
-    permutationmethod="shuffle",
-    disablethresholds=False,
-    rt_floatset=np.float64,
-    rt_floattype="float64",
-):
+# with a stopping tolerance, this many permutations are done between checks
+NULLSTOPROUND = 1000
+
+# change this if the null distribution calculation changes, to invalidate old cache entries
+NULLCACHEVERSION = 1
 
-    # make a shuffled copy of the regressors
+
+def _permutedblock(
+    normalizedreftc, rawtcfft_r, rawtcfft_ang, startidx, endidx, seed, permutationmethod="shuffle"
+):
+    # make permutations startidx to endidx - 1 of the regressor, one per row.  Each permutation
+    # has its own random stream, seeded by the run seed and its index, so the null distribution
+    # depends only on the seed, and not on how the permutations are divided between workers.
+    numperms = endidx - startidx
     if permutationmethod == "shuffle":
-        permutedtc = np.random.permutation(normalizedreftc)
+        permutedblock = np.zeros((numperms, len(normalizedreftc)), dtype=normalizedreftc.dtype)
+        for i in range(numperms):
+            permutedblock[i, :] = np.random.default_rng([seed, startidx + i]).permutation(
+                normalizedreftc
+            )
     elif permutationmethod == "phaserandom":
-        permutedtc = tide_filt.ifftfrompolar(rawtcfft_r, np.random.permutation(rawtcfft_ang))
+        angleblock = np.zeros((numperms, len(rawtcfft_ang)), dtype=rawtcfft_ang.dtype)
+        for i in range(numperms):
+            angleblock[i, :] = np.random.default_rng([seed, startidx + i]).permutation(
+                rawtcfft_ang
+            )
+        permutedblock = tide_filt.ifftfrompolar(rawtcfft_r, angleblock)
     else:
         print("illegal shuffling method")
         sys.exit()
+    return permutedblock
 
-    # apply the appropriate filter
-    # permutedtc = theCorrelator.ncprefilter.apply(Fs, permutedtc)
-
-    # crosscorrelate with original
-    thexcorr_y, thexcorr_x, dummy = theCorrelator.run(permutedtc)
 
-    # fit the correlation
-    thefitter.setcorrtimeaxis(thexcorr_x)
-    (maxindex, maxlag, maxval, maxsigma, maskval, failreason, peakstart, peakend,) = thefitter.fit(
-        thexcorr_y
+# note: rawtimecourse has been filtered, but NOT windowed
+def _procNullBlockCorrelationx(blockstate, startbatch, endbatch):
+    # correlate batches startbatch to endbatch - 1 of permutations with the original in one
+    # set of FFTs, fit all the peaks at once, and send back the peak values
+    startidx = startbatch * NULLBATCHSIZE
+    endidx = min(endbatch * NULLBATCHSIZE, blockstate["numestreps"])
+    permutedblock = _permutedblock(
+        blockstate["normalizedreftc"],
+        blockstate["rawtcfft_r"],
+        blockstate["rawtcfft_ang"],
+        startidx,
+        endidx,
+        blockstate["seed"],
+        permutationmethod=blockstate["permutationmethod"],
     )
-
-    return maxval
+    thexcorrs, thexcorr_x, dummy = blockstate["theCorrelator"].run_block(permutedblock)
+    blockstate["thefitter"].setcorrtimeaxis(thexcorr_x)
+    (
+        maxindex,
+        maxlag,
+        maxval,
+        maxsigma,
+        maskval,
+        failreason,
+        peakstart,
+        peakend,
+    ) = blockstate["thefitter"].fit_block(thexcorrs)
+    return list(maxval)
 
 
 def getNullDistributionDatax(
@@ -87,12 +116,25 @@ def getNullDistributionDatax(
     showprogressbar=True,
     chunksize=1000,
     permutationmethod="shuffle",
+    blockmode=False,
+    pool=None,
+    seed=None,
+    stoptol=None,
+    stoppercentiles=(0.95, 0.99, 0.995),
+    twotail=False,
+    nozero=False,
+    thedict=None,
+    dictvarname="null",
     rt_floatset=np.float64,
     rt_floattype="float64",
 ):
     r"""Calculate a set of null correlations to determine the distribution of correlation values.  This can
     be used to find the spurious correlation threshold
 
+    The permutations are made, correlated and fit a block at a time.  Each permutation draws
+    from its own random stream, seeded from seed and its index, so for a given seed the result
+    does not depend on nprocs, chunksize or the dispatch method.
+
     Parameters
     ----------
     rawtimecourse : 1D numpy array
@@ -117,9 +159,23 @@ def getNullDistributionDatax(
     posbins: int
         The upper edge of the search range for correlation peaks, in number of bins above corrorigin
 
+    seed: int, optional
+        The seed for the permutations.  If None, a random one is used.
+
+    stoptol: float, optional
+        If set, numestreps is the most null correlations to calculate.  They are calculated
+        in rounds, and once the bootstrap 95% confidence intervals of the stoppercentiles
+        thresholds (as sigFromDistributionData would find them with twotail and nozero) are
+        all narrower than stoptol, no more are calculated.  The final number and interval
+        widths are put in thedict (if given) as dictvarname + "_numreps" and "_ciwidths".
+
     """
 
-    inputshape = np.asarray([numestreps])
+    numbatches = (numestreps + NULLBATCHSIZE - 1) // NULLBATCHSIZE
+    inputshape = np.asarray([numbatches])
+    batchesperchunk = max(1, chunksize // NULLBATCHSIZE)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
     normalizedreftc = theCorrelator.ncprefilter.apply(
         Fs,
         tide_math.corrnormalize(
@@ -127,89 +183,121 @@ def getNullDistributionDatax(
         ),
     )
     rawtcfft_r, rawtcfft_ang = tide_filt.polarfft(normalizedreftc)
-    if nprocs > 1 or alwaysmultiproc:
-        # define the consumer function here so it inherits most of the arguments
-        def nullCorrelation_consumer(inQ, outQ):
-            while True:
-                try:
-                    # get a new message
-                    val = inQ.get()
-
-                    # this is the 'TERM' signal
-                    if val is None:
-                        break
-
-                    # process and send the data
-                    outQ.put(
-                        _procOneNullCorrelationx(
-                            normalizedreftc,
-                            rawtcfft_r,
-                            rawtcfft_ang,
-                            Fs,
-                            theCorrelator,
-                            thefitter,
-                            despeckle_thresh=despeckle_thresh,
-                            fixdelay=fixdelay,
-                            fixeddelayvalue=fixeddelayvalue,
-                            permutationmethod=permutationmethod,
-                            rt_floatset=rt_floatset,
-                            rt_floattype=rt_floattype,
-                        )
-                    )
-
-                except Exception as e:
-                    print("error!", e)
+    blockstate = {
+        "normalizedreftc": normalizedreftc,
+        "rawtcfft_r": rawtcfft_r,
+        "rawtcfft_ang": rawtcfft_ang,
+        "theCorrelator": theCorrelator,
+        "thefitter": thefitter,
+        "permutationmethod": permutationmethod,
+        "seed": seed,
+        "numestreps": numestreps,
+    }
+    # define the consumer function here so it inherits most of the arguments
+    def nullCorrelation_consumer(inQ, outQ):
+        while True:
+            try:
+                # get a new message
+                val = inQ.get()
+
+                # this is the 'TERM' signal
+                if val is None:
                     break
 
-        data_out = tide_multiproc.run_multiproc(
-            nullCorrelation_consumer,
-            inputshape,
-            None,
-            nprocs=nprocs,
-            showprogressbar=showprogressbar,
-            chunksize=chunksize,
-        )
+                # process and send the data
+                outQ.put([val, _procNullBlockCorrelationx(blockstate, val, val + 1)])
 
-        # unpack the data
-        corrlist = np.asarray(data_out, dtype=rt_floattype)
+            except Exception as e:
+                outQ.put(tide_multiproc.WorkerFailure(val, e))
+
+    # with stoptol, do the batches a round at a time, checking the thresholds after each
+    if stoptol is None:
+        batchesperround = numbatches
     else:
-        corrlist = np.zeros((numestreps), dtype=rt_floattype)
-
-        for i in range(0, numestreps):
-            # make a shuffled copy of the regressors
-            if permutationmethod == "shuffle":
-                permutedtc = np.random.permutation(normalizedreftc)
-            elif permutationmethod == "phaserandom":
-                permutedtc = tide_filt.ifftfrompolar(
-                    rawtcfft_r, np.random.permutation(rawtcfft_ang)
+        batchesperround = max(1, NULLSTOPROUND // NULLBATCHSIZE)
+        thefracs = np.asarray(stoppercentiles)
+        if twotail:
+            thefracs = 1.0 - (1.0 - thefracs) / 2.0
+    corrlist = np.zeros((numestreps), dtype=rt_floattype)
+    numdone = 0
+    for firstbatch in range(0, numbatches, batchesperround):
+        lastbatch = min(firstbatch + batchesperround, numbatches)
+        if lastbatch - firstbatch < numbatches:
+            batchmask = np.zeros(numbatches, dtype=np.float64)
+            batchmask[firstbatch:lastbatch] = 1.0
+        else:
+            batchmask = None
+        if (nprocs > 1 or alwaysmultiproc) and (blockmode or pool is not None):
+            if pool is not None:
+                data_out = pool.run_blocks(
+                    _procNullBlockCorrelationx,
+                    blockstate,
+                    inputshape,
+                    batchmask,
+                    showprogressbar=showprogressbar,
+                    blocksize=batchesperchunk,
                 )
             else:
-                print("illegal shuffling method")
-                sys.exit()
-
-            # crosscorrelate with original, fit, and return the maximum value, and add it to the list
-            thexcorr = _procOneNullCorrelationx(
-                normalizedreftc,
-                rawtcfft_r,
-                rawtcfft_ang,
-                Fs,
-                theCorrelator,
-                thefitter,
-                despeckle_thresh=despeckle_thresh,
-                fixdelay=fixdelay,
-                fixeddelayvalue=fixeddelayvalue,
-                permutationmethod=permutationmethod,
-                rt_floatset=rt_floatset,
-                rt_floattype=rt_floattype,
+                data_out = tide_multiproc.run_multiproc_blocks(
+                    _procNullBlockCorrelationx,
+                    blockstate,
+                    inputshape,
+                    batchmask,
+                    nprocs=nprocs,
+                    showprogressbar=showprogressbar,
+                    blocksize=batchesperchunk,
+                )
+
+            # unpack the data
+            for startbatch, endbatch, maxvals in data_out:
+                startidx = startbatch * NULLBATCHSIZE
+                corrlist[startidx : startidx + len(maxvals)] = maxvals
+        elif nprocs > 1 or alwaysmultiproc:
+            data_out = tide_multiproc.run_multiproc(
+                nullCorrelation_consumer,
+                inputshape,
+                batchmask,
+                nprocs=nprocs,
+                showprogressbar=showprogressbar,
+                chunksize=chunksize,
             )
-            corrlist[i] = thexcorr
 
-            # progress
-            if showprogressbar:
-                tide_util.progressbar(i + 1, numestreps, label="Percent complete")
+            # unpack the data, putting each permutation back in its place
+            for thebatch, maxvals in data_out:
+                startidx = thebatch * NULLBATCHSIZE
+                corrlist[startidx : startidx + len(maxvals)] = maxvals
+        else:
+            # crosscorrelate a block of shuffled copies of the regressor with the original,
+            # fit, and add the maximum values to the list
+            for startbatch in range(firstbatch, lastbatch, batchesperchunk):
+                endbatch = min(startbatch + batchesperchunk, lastbatch)
+                maxvals = _procNullBlockCorrelationx(blockstate, startbatch, endbatch)
+                startidx = startbatch * NULLBATCHSIZE
+                corrlist[startidx : startidx + len(maxvals)] = maxvals
 
-        # jump to line after progress bar
-        print()
+                # progress
+                if showprogressbar:
+                    tide_util.progressbar(endbatch, numbatches, label="Percent complete")
+
+            # jump to line after progress bar
+            print()
+
+        numdone = min(lastbatch * NULLBATCHSIZE, numestreps)
+        if stoptol is not None:
+            lowervals, uppervals = tide_stats.getfracvalcis(
+                corrlist[:numdone], thefracs, nozero=nozero, seed=[seed, numdone]
+            )
+            ciwidths = uppervals - lowervals
+            print(
+                f"threshold confidence interval widths after {numdone} null correlations:",
+                ciwidths,
+            )
+            if thedict is not None:
+                thedict[dictvarname + "_numreps"] = numdone
+                thedict[dictvarname + "_ciwidths"] = [float(thewidth) for thewidth in ciwidths]
+            if np.max(ciwidths) <= stoptol:
+                break
+    corrlist = corrlist[:numdone]
 
     # return the distribution data
     numnonzero = len(np.where(corrlist != 0.0)[0])
@@ -219,3 +307,126 @@ def getNullDistributionDatax(
         )
     )
     return corrlist
+
+
+def nullcachekey(
+    theCorrelator, thefitter, numestreps, permutationmethod="shuffle", seed=None, **settings
+):
+    """Make the key for a null distribution in the on-disk cache.
+
+    The key is a hash of everything the null distribution depends on - the reference regressor
+    that has been set in theCorrelator, the prefilter, the correlation and lag settings, the
+    peak fitter settings, and the permutation settings.  Anything else the cached values depend
+    on (the significance histogram settings, for example) should be passed in settings.
+
+    Returns
+    -------
+    thekey : str
+    """
+    thefilter = theCorrelator.ncprefilter
+    thedescription = {
+        "version": NULLCACHEVERSION,
+        "Fs": theCorrelator.Fs,
+        "filtertype": thefilter.gettype(),
+        "filterfreqs": thefilter.getfreqs(),
+        "transferfunc": thefilter.transferfunc,
+        "padtime": thefilter.getpadtime(),
+        "detrendorder": theCorrelator.detrendorder,
+        "windowfunc": theCorrelator.windowfunc,
+        "corrweighting": theCorrelator.corrweighting,
+        "corrpadding": theCorrelator.corrpadding,
+        "lagmininpts": theCorrelator.lagmininpts,
+        "lagmaxinpts": theCorrelator.lagmaxinpts,
+        "numestreps": numestreps,
+        "permutationmethod": permutationmethod,
+        "seed": seed,
+    }
+    for theattribute in [
+        "functype",
+        "peakfittype",
+        "lagmin",
+        "lagmax",
+        "absmaxsigma",
+        "absminsigma",
+        "hardlimit",
+        "bipolar",
+        "lthreshval",
+        "uthreshval",
+        "zerooutbadfit",
+        "searchfrac",
+        "lagmod",
+        "enforcethresh",
+        "useguess",
+        "maxguess",
+    ]:
+        thedescription["fitter_" + theattribute] = getattr(thefitter, theattribute)
+    thedescription.update(settings)
+    thehash = hashlib.sha256(json.dumps(thedescription, sort_keys=True, default=str).encode())
+    thereftc = np.ascontiguousarray(theCorrelator.reftc)
+    thehash.update(str(thereftc.dtype).encode())
+    thehash.update(thereftc.tobytes())
+    return thehash.hexdigest()
+
+
+def readnullcache(cachedir, thekey):
+    """Get the arrays stored under thekey in the null cache in cachedir.
+
+    Returns
+    -------
+    thearrays : dict or None
+        The arrays, or None if there is no (readable) entry for thekey
+    """
+    thefilename = os.path.join(cachedir, thekey + ".npz")
+    try:
+        with np.load(thefilename) as thefile:
+            thearrays = {thename: thefile[thename] for thename in thefile.files}
+    except (OSError, ValueError):
+        return None
+
+    # mark the entry as recently used
+    try:
+        os.utime(thefilename)
+    except OSError:
+        pass
+    return thearrays
+
+
+def writenullcache(cachedir, thekey, maxsize=1000.0, **thearrays):
+    """Store arrays under thekey in the null cache in cachedir.
+
+    The entries that were least recently used are then removed until the cache takes up no
+    more than maxsize megabytes (the new entry is always kept).  Entries that are None are not
+    stored.
+    """
+    os.makedirs(cachedir, exist_ok=True)
+    thefilename = os.path.join(cachedir, thekey + ".npz")
+
+    # write to a temporary file and move it into place, so that other runs sharing the cache
+    # never see a partial entry
+    tempname = f"{thefilename}.{os.getpid()}.tmp"
+    thearrays = {
+        thename: thearray for thename, thearray in thearrays.items() if thearray is not None
+    }
+    with open(tempname, "wb") as thefile:
+        np.savez(thefile, **thearrays)
+    os.replace(tempname, thefilename)
+
+    # evict the least recently used entries
+    theentries = []
+    for theentry in glob.glob(os.path.join(cachedir, "*.npz")):
+        try:
+            thestat = os.stat(theentry)
+        except OSError:
+            continue
+        theentries.append((thestat.st_mtime, thestat.st_size, theentry))
+    theentries.sort()
+    totalsize = sum(theentry[1] for theentry in theentries)
+    for themtime, thesize, theentry in theentries:
+        if totalsize <= maxsize * 1024 * 1024:
+            break
+        if theentry != thefilename:
+            try:
+                os.remove(theentry)
+            except OSError:
+                pass
+            totalsize -= thesize
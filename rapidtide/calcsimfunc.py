@@ -35,6 +35,9 @@ import rapidtide.util as tide_util
 warnings.simplefilter(action="ignore", category=FutureWarning)
 LGR = logging.getLogger("GENERAL")
 
+# how many voxels share each lagged correlation when the lag windows are narrowed
+LAGGROUPSIZE = 64
+
 
 def _procOneVoxelCorrelation(
     vox,
@@ -45,18 +48,153 @@ def _procOneVoxelCorrelation(
     os_fmri_x,
     oversampfactor=1,
     interptype="univariate",
+    theoversampler=None,
+    prepcache=None,
+    prepcachevalid=False,
     rt_floatset=np.float64,
     rt_floattype="float64",
 ):
+    if prepcachevalid:
+        # the voxel has already been prepped - the mean was saved when the cache was filled
+        thexcorr_y, thexcorr_x, theglobalmax = theCorrelator.run(prepcache[vox, :], prepped=True)
+        return vox, None, thexcorr_y, thexcorr_x, theglobalmax
+
     if oversampfactor >= 1:
-        thetc[:] = tide_resample.doresample(fmri_x, fmritc, os_fmri_x, method=interptype)
+        if theoversampler is not None:
+            thetc[:] = theoversampler.apply(fmritc)
+        else:
+            thetc[:] = tide_resample.doresample(fmri_x, fmritc, os_fmri_x, method=interptype)
     else:
         thetc[:] = fmritc
-    thexcorr_y, thexcorr_x, theglobalmax = theCorrelator.run(thetc)
+    if prepcache is not None:
+        prepcache[vox, :] = theCorrelator.preptc(thetc)
+        thexcorr_y, thexcorr_x, theglobalmax = theCorrelator.run(prepcache[vox, :], prepped=True)
+    else:
+        thexcorr_y, thexcorr_x, theglobalmax = theCorrelator.run(thetc)
 
     return vox, np.mean(thetc), thexcorr_y, thexcorr_x, theglobalmax
 
 
+def _windowedcorrelation(theCorrelator, prepslab, lagwindows, corrslab):
+    # correlate each (prepped) voxel over just its own window of lags.  The voxels are put in
+    # order of their windows and done in groups, each group calculating the lags that any of
+    # its members need, then everything outside each voxel's own window is zeroed, so the
+    # result does not depend on how the voxels were grouped.
+    numvoxels = prepslab.shape[0]
+    order = np.argsort(lagwindows[:, 0] + lagwindows[:, 1], kind="stable")
+    trimstart = theCorrelator.similarityfuncorigin - theCorrelator.lagmininpts
+    theglobalmaxes = np.zeros(numvoxels, dtype=np.int64)
+    for groupstart in range(0, numvoxels, LAGGROUPSIZE):
+        therows = order[groupstart : groupstart + LAGGROUPSIZE]
+        thecorr, thecorrscale, dummy = theCorrelator.run_block(
+            prepslab[therows, :],
+            prepped=True,
+            lagrange=(np.min(lagwindows[therows, 0]), np.max(lagwindows[therows, 1])),
+        )
+        lagindices = np.arange(thecorr.shape[1])
+        outside = (lagindices < lagwindows[therows, 0][:, None]) | (
+            lagindices >= lagwindows[therows, 1][:, None]
+        )
+        thecorr[outside] = 0.0
+        corrslab[therows, :] = thecorr
+        theglobalmaxes[therows] = (
+            np.argmax(np.where(outside, -np.inf, thecorr), axis=1) + trimstart
+        )
+    return theglobalmaxes, thecorrscale
+
+
+def _procVoxelSlabCorrelation(
+    startvox,
+    endvox,
+    theCorrelator,
+    fmri_x,
+    fmridata,
+    os_fmri_x,
+    corrout,
+    meanval,
+    oversampfactor=1,
+    interptype="univariate",
+    theoversampler=None,
+    prepcache=None,
+    prepcachevalid=False,
+    lagwindows=None,
+    rt_floatset=np.float64,
+    rt_floattype="float64",
+):
+    # correlate a contiguous slab of voxels with the reference in one batch
+    if prepcachevalid:
+        if lagwindows is not None:
+            theglobalmaxes, thecorrscale = _windowedcorrelation(
+                theCorrelator,
+                prepcache[startvox:endvox, :],
+                lagwindows[startvox:endvox, :],
+                corrout[startvox:endvox, :],
+            )
+            return theglobalmaxes.tolist(), thecorrscale
+        corrout[startvox:endvox, :], thecorrscale, theglobalmaxes = theCorrelator.run_block(
+            prepcache[startvox:endvox, :], prepped=True
+        )
+        return theglobalmaxes.tolist(), thecorrscale
+
+    theslab = np.zeros((endvox - startvox, len(os_fmri_x)), dtype=rt_floattype)
+    if oversampfactor >= 1 and theoversampler is not None:
+        theslab[:, :] = theoversampler.apply(fmridata[startvox:endvox, :])
+    else:
+        for vox in range(startvox, endvox):
+            if oversampfactor >= 1:
+                theslab[vox - startvox, :] = tide_resample.doresample(
+                    fmri_x, fmridata[vox, :], os_fmri_x, method=interptype
+                )
+            else:
+                theslab[vox - startvox, :] = fmridata[vox, :]
+    meanval[startvox:endvox] = np.mean(theslab, axis=1)
+    if lagwindows is not None:
+        if prepcache is not None:
+            prepcache[startvox:endvox, :] = theCorrelator.prepblock(theslab)
+            theprepslab = prepcache[startvox:endvox, :]
+        else:
+            theprepslab = theCorrelator.prepblock(theslab)
+        theglobalmaxes, thecorrscale = _windowedcorrelation(
+            theCorrelator,
+            theprepslab,
+            lagwindows[startvox:endvox, :],
+            corrout[startvox:endvox, :],
+        )
+    elif prepcache is not None:
+        prepcache[startvox:endvox, :] = theCorrelator.prepblock(theslab)
+        corrout[startvox:endvox, :], thecorrscale, theglobalmaxes = theCorrelator.run_block(
+            prepcache[startvox:endvox, :], prepped=True
+        )
+    else:
+        corrout[startvox:endvox, :], thecorrscale, theglobalmaxes = theCorrelator.run_block(
+            theslab
+        )
+    return theglobalmaxes.tolist(), thecorrscale
+
+
+def _procVoxelBlockCorrelation(blockstate, startvox, endvox):
+    # correlate a contiguous range of voxels, writing directly into the (shared) output arrays
+    globalmaxes, thecorrscale = _procVoxelSlabCorrelation(
+        startvox,
+        endvox,
+        blockstate["theCorrelator"],
+        blockstate["fmri_x"],
+        blockstate["fmridata"],
+        blockstate["os_fmri_x"],
+        blockstate["corrout"],
+        blockstate["meanval"],
+        oversampfactor=blockstate["oversampfactor"],
+        interptype=blockstate["interptype"],
+        theoversampler=blockstate["theoversampler"],
+        prepcache=blockstate["prepcache"],
+        prepcachevalid=blockstate["prepcachevalid"],
+        lagwindows=blockstate["lagwindows"],
+        rt_floatset=blockstate["rt_floatset"],
+        rt_floattype=blockstate["rt_floattype"],
+    )
+    return endvox - startvox, globalmaxes, thecorrscale
+
+
 def correlationpass(
     fmridata,
     referencetc,
@@ -73,6 +211,11 @@ def correlationpass(
     interptype="univariate",
     showprogressbar=True,
     chunksize=1000,
+    blockmode=False,
+    pool=None,
+    prepcache=None,
+    prepcachevalid=False,
+    lagwindows=None,
     rt_floatset=np.float64,
     rt_floattype="float64",
 ):
@@ -95,6 +238,19 @@ def correlationpass(
     interptype
     showprogressbar
     chunksize
+    blockmode - if True, workers process contiguous voxel ranges and write directly into corrout
+        and meanval, which must be in shared memory
+    pool - a persistent tide_multiproc.WorkerPool to use for multiprocessing (implies blockmode)
+    prepcache - optional array, the size of fmridata with os_fmri_x timepoints, to hold the
+        resampled, filtered, normalized and windowed voxel timecourses (Correlator only).
+        It must be shared (or memory mapped) if there are multiple processes.
+    prepcachevalid - if True, prepcache was filled by an earlier call with the same data, so
+        the voxels are correlated directly from it, and meanval is left as it is
+    lagwindows - optional (number of voxels, 2) int array (see warmstartwindows).  If given,
+        voxel i is only correlated over indices lagwindows[i, 0] to lagwindows[i, 1] - 1 of the
+        trimmed similarity function, and corrout is zero outside that.  This only speeds up
+        the slab (serial and block) paths - the per voxel queue calculates every lag and
+        then zeros the ones outside the window.
     rt_floatset
     rt_floattype
 
@@ -110,7 +266,64 @@ def correlationpass(
     reportstep = 1000
     thetc = np.zeros(np.shape(os_fmri_x), dtype=rt_floattype)
     theglobalmaxlist = []
-    if nprocs > 1 or alwaysmultiproc:
+    failedvoxels = []
+    if oversampfactor >= 1 and not prepcachevalid:
+        # the same interpolation is applied to every voxel, so work out the operator once
+        theoversampler = tide_resample.getinterpolationoperator(
+            fmri_x, os_fmri_x, method=interptype
+        )
+    else:
+        theoversampler = None
+    if (nprocs > 1 or alwaysmultiproc) and (blockmode or pool is not None):
+        blockstate = {
+            "theCorrelator": theCorrelator,
+            "fmri_x": fmri_x,
+            "fmridata": fmridata,
+            "os_fmri_x": os_fmri_x,
+            "corrout": corrout,
+            "meanval": meanval,
+            "oversampfactor": oversampfactor,
+            "interptype": interptype,
+            "theoversampler": theoversampler,
+            "prepcache": prepcache,
+            "prepcachevalid": prepcachevalid,
+            "lagwindows": lagwindows,
+            "rt_floatset": rt_floatset,
+            "rt_floattype": rt_floattype,
+        }
+        if pool is not None:
+            sharedkeys = ["fmridata", "corrout", "meanval"]
+            if prepcache is not None:
+                sharedkeys.append("prepcache")
+            data_out = pool.run_blocks(
+                _procVoxelBlockCorrelation,
+                blockstate,
+                inputshape,
+                None,
+                showprogressbar=showprogressbar,
+                blocksize=chunksize,
+                sharedkeys=sharedkeys,
+            )
+        else:
+            data_out = tide_multiproc.run_multiproc_blocks(
+                _procVoxelBlockCorrelation,
+                blockstate,
+                inputshape,
+                None,
+                nprocs=nprocs,
+                showprogressbar=showprogressbar,
+                blocksize=chunksize,
+            )
+
+        # tally the status records
+        volumetotal = 0
+        for startvox, endvox, status in data_out:
+            volumetotal += status[0]
+            theglobalmaxlist += status[1]
+            thecorrscale = status[2]
+        del data_out
+        failedvoxels = tide_multiproc.getfaileditems()
+    elif nprocs > 1 or alwaysmultiproc:
         # define the consumer function here so it inherits most of the arguments
         def correlation_consumer(inQ, outQ):
             while True:
@@ -133,14 +346,16 @@ def correlationpass(
                             os_fmri_x,
                             oversampfactor=oversampfactor,
                             interptype=interptype,
+                            theoversampler=theoversampler,
+                            prepcache=prepcache,
+                            prepcachevalid=prepcachevalid,
                             rt_floatset=rt_floatset,
                             rt_floattype=rt_floattype,
                         )
                     )
 
                 except Exception as e:
-                    print("error!", e)
-                    break
+                    outQ.put(tide_multiproc.WorkerFailure(val, e))
 
         data_out = tide_multiproc.run_multiproc(
             correlation_consumer,
@@ -155,40 +370,217 @@ def correlationpass(
         volumetotal = 0
         for voxel in data_out:
             # corrmask[voxel[0]] = 1
-            meanval[voxel[0]] = voxel[1]
+            if voxel[1] is not None:
+                meanval[voxel[0]] = voxel[1]
             corrout[voxel[0], :] = voxel[2]
             thecorrscale = voxel[3]
-            theglobalmaxlist.append(voxel[4] + 0)
+            if lagwindows is None:
+                theglobalmaxlist.append(voxel[4] + 0)
+            else:
+                start, end = lagwindows[voxel[0], :]
+                corrout[voxel[0], :start] = 0.0
+                corrout[voxel[0], end:] = 0.0
+                theglobalmaxlist.append(
+                    np.argmax(corrout[voxel[0], start:end])
+                    + start
+                    + theCorrelator.similarityfuncorigin
+                    - theCorrelator.lagmininpts
+                )
             volumetotal += 1
         del data_out
+        failedvoxels = tide_multiproc.getfaileditems()
     else:
-        for vox in range(0, inputshape[0]):
-            if (vox % reportstep == 0 or vox == inputshape[0] - 1) and showprogressbar:
-                tide_util.progressbar(vox + 1, inputshape[0], label="Percent complete")
-            (
-                dummy,
-                meanval[vox],
-                corrout[vox, :],
-                thecorrscale,
-                theglobalmax,
-            ) = _procOneVoxelCorrelation(
-                vox,
-                thetc,
+        # work through the voxels a slab at a time, so the FFTs are done in batches
+        for startvox in range(0, inputshape[0], chunksize):
+            endvox = min(startvox + chunksize, inputshape[0])
+            if showprogressbar:
+                tide_util.progressbar(endvox, inputshape[0], label="Percent complete")
+            theglobalmaxes, thecorrscale = _procVoxelSlabCorrelation(
+                startvox,
+                endvox,
                 theCorrelator,
                 fmri_x,
-                fmridata[vox, :],
+                fmridata,
                 os_fmri_x,
+                corrout,
+                meanval,
                 oversampfactor=oversampfactor,
                 interptype=interptype,
+                theoversampler=theoversampler,
+                prepcache=prepcache,
+                prepcachevalid=prepcachevalid,
+                lagwindows=lagwindows,
                 rt_floatset=rt_floatset,
                 rt_floattype=rt_floattype,
             )
-            theglobalmaxlist.append(theglobalmax + 0)
-            volumetotal += 1
+            theglobalmaxlist += theglobalmaxes
+            volumetotal += endvox - startvox
     LGR.info(f"\nCorrelation performed on {volumetotal} voxels")
+    if len(failedvoxels) > 0:
+        # voxels that could not be processed get an empty similarity function
+        corrout[failedvoxels, :] = 0.0
+        meanval[failedvoxels] = 0.0
+        if prepcache is not None and not prepcachevalid:
+            prepcache[failedvoxels, :] = 0.0
+        LGR.warning(f"Correlation failed in {len(failedvoxels)} voxels")
 
     # garbage collect
     collected = gc.collect()
     LGR.info(f"Garbage collector: collected {collected} objects.")
 
     return volumetotal, theglobalmaxlist, thecorrscale
+
+
+def warmstartwindows(lagtimes, lagsigma, lagmask, corrscale, minhalfwidth=3.0, numsigma=2.0):
+    """Work out the range of lags to search for each voxel, given the fit from the last pass.
+
+    Parameters
+    ----------
+    lagtimes, lagsigma, lagmask : 1D arrays
+        The lag, peak width and fit mask of each voxel from the previous pass
+    corrscale : 1D array
+        The lag of each point of the (trimmed) similarity function
+    minhalfwidth : float, optional
+        The smallest distance, in seconds, to search on either side of the last lag
+    numsigma : float, optional
+        Search at least this many peak widths on either side of the last lag
+
+    Returns
+    -------
+    lagwindows : 2D int array
+        For each voxel, the first and one past the last index of corrscale to search.  Voxels
+        whose last fit failed are searched over the full range.
+    """
+    binwidth = corrscale[1] - corrscale[0]
+    halfwidth = np.maximum(minhalfwidth, numsigma * np.fabs(lagsigma))
+    lagwindows = np.zeros((len(lagtimes), 2), dtype=np.int64)
+    lagwindows[:, 0] = np.floor((lagtimes - halfwidth - corrscale[0]) / binwidth)
+    lagwindows[:, 1] = np.ceil((lagtimes + halfwidth - corrscale[0]) / binwidth) + 1
+    lagwindows[lagmask == 0, 0] = 0
+    lagwindows[lagmask == 0, 1] = len(corrscale)
+    return np.clip(lagwindows, 0, len(corrscale))
+
+
+def warmstartfallbacks(
+    lagwindows,
+    lagtimes,
+    lagmask,
+    corrscale,
+    lagstrengths=None,
+    lastlagstrengths=None,
+    corrout=None,
+    bipolar=False,
+    minstrengthfrac=0.75,
+    searchfrac=0.5,
+):
+    """Find the voxels whose search window was narrowed, but whose fit in the window can't be
+    trusted, so they need to be redone over the full range.  That is, the fit failed or landed
+    on (or past) the edge of the window, or the peak found has the wrong sign, is much weaker
+    than the one found on the previous pass, or doesn't fall off before the edge of the window
+    (so it may be cut short, or be the shoulder of a bigger peak outside the window).
+
+    Parameters
+    ----------
+    lagwindows : 2D int array
+        The search windows (see warmstartwindows)
+    lagtimes, lagmask : 1D arrays
+        The lag and fit mask of each voxel from this pass
+    corrscale : 1D array
+        The lag of each point of the (trimmed) similarity function
+    lagstrengths : 1D array, optional
+        The peak strength of each voxel from this pass
+    lastlagstrengths : 1D array, optional
+        The peak strength of each voxel from the previous pass
+    corrout : 2D array, optional
+        The (windowed) similarity functions from this pass
+    bipolar : bool, optional
+        If False, a negative peak strength means the window missed the peak
+    minstrengthfrac : float, optional
+        Redo voxels whose peak strength falls below this fraction of the last one
+    searchfrac : float, optional
+        Redo voxels whose similarity function is above this fraction of the peak strength at
+        a narrowed edge of the window
+
+    Returns
+    -------
+    fallbacks : 1D int array
+        The indices of the voxels to redo
+    """
+    binwidth = corrscale[1] - corrscale[0]
+    narrowed = (lagwindows[:, 0] > 0) | (lagwindows[:, 1] < len(corrscale))
+    lagindex = np.round((lagtimes - corrscale[0]) / binwidth)
+    onedge = (lagindex <= lagwindows[:, 0]) | (lagindex >= lagwindows[:, 1] - 1)
+    atlimit = ((lagindex <= lagwindows[:, 0]) & (lagwindows[:, 0] == 0)) | (
+        (lagindex >= lagwindows[:, 1] - 1) & (lagwindows[:, 1] == len(corrscale))
+    )
+    suspect = (lagmask == 0) | (onedge & ~atlimit)
+    if lagstrengths is not None:
+        if not bipolar:
+            suspect |= lagstrengths <= 0.0
+        if lastlagstrengths is not None:
+            suspect |= np.fabs(lagstrengths) < minstrengthfrac * np.fabs(lastlagstrengths)
+        if corrout is not None:
+            voxels = np.arange(len(lagwindows))
+            lastindex = len(corrscale) - 1
+            for theedge, thelimit in [(lagwindows[:, 0], 0), (lagwindows[:, 1] - 1, lastindex)]:
+                edgevals = np.sign(lagstrengths) * corrout[voxels, np.clip(theedge, 0, lastindex)]
+                suspect |= (theedge != thelimit) & (edgevals > searchfrac * np.fabs(lagstrengths))
+    return np.where(narrowed & suspect)[0]
+
+
+def correlatevoxels(
+    voxels,
+    fmridata,
+    referencetc,
+    theCorrelator,
+    fmri_x,
+    os_fmri_x,
+    lagmininpts,
+    lagmaxinpts,
+    corrout,
+    oversampfactor=1,
+    interptype="univariate",
+    prepcache=None,
+    prepcachevalid=False,
+    lagwindows=None,
+    rt_floatset=np.float64,
+    rt_floattype="float64",
+):
+    """Recalculate the full range similarity functions of a few voxels, in this process.
+
+    The arguments are the same as for correlationpass - the rows of corrout listed in voxels
+    are replaced.  prepcache is only used if it is valid.  If lagwindows is given, the
+    windows of the voxels are set to the full range.
+    """
+    if len(voxels) == 0:
+        return 0
+    if lagwindows is not None:
+        lagwindows[voxels, 0] = 0
+        lagwindows[voxels, 1] = corrout.shape[1]
+    subcorrout = np.zeros((len(voxels), corrout.shape[1]), dtype=corrout.dtype)
+    submeanval = np.zeros(len(voxels), dtype=rt_floattype)
+    if prepcache is not None and prepcachevalid:
+        subprepcache = prepcache[voxels, :]
+    else:
+        subprepcache = None
+    volumetotal, dummy, dummy = correlationpass(
+        fmridata[voxels, :],
+        referencetc,
+        theCorrelator,
+        fmri_x,
+        os_fmri_x,
+        lagmininpts,
+        lagmaxinpts,
+        subcorrout,
+        submeanval,
+        nprocs=1,
+        oversampfactor=oversampfactor,
+        interptype=interptype,
+        showprogressbar=False,
+        prepcache=subprepcache,
+        prepcachevalid=subprepcache is not None,
+        rt_floatset=rt_floatset,
+        rt_floattype=rt_floattype,
+    )
+    corrout[voxels, :] = subcorrout
+    return volumetotal
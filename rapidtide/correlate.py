@@ -23,25 +23,24 @@ import logging
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pyfftw
-import pyfftw.interfaces.scipy_fftpack as fftpack
 import scipy as sp
 from numba import jit
-from numpy.fft import irfftn, rfftn
 from scipy import signal
 from sklearn.metrics import mutual_info_score
 
+import rapidtide.fftbackend as tide_fft
 import rapidtide.fit as tide_fit
 import rapidtide.miscmath as tide_math
 import rapidtide.resample as tide_resample
 import rapidtide.util as tide_util
 
-pyfftw.interfaces.cache.enable()
 LGR = logging.getLogger("GENERAL")
 
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
 MAXLINES = 10000000
+# the largest number of points cross_mutual_info bins in one go
+MAXMIPOINTS = 2 ** 22
 donotbeaggressive = True
 donotusenumba = True
 
@@ -399,6 +398,162 @@ def mutual_info_2d(x, y, sigma=1, bins=(256, 256), fast=False, normalized=True,
     return mi
 
 
+def _mibinindices(thedata, binstart, binend, numbins):
+    # the histogram bin of each point, binned as in the fast path of mutual_info_2d: points
+    # outside [binstart, binend) are flagged as invalid and left out of the histogram
+    valid = (thedata >= binstart) & (thedata < binend)
+    binindices = ((thedata - binstart) / (binend - binstart) * numbins).astype(np.int_)
+    binindices[~valid] = 0
+    return binindices, valid
+
+
+def _histogramrange(thedata):
+    # the outer bin edges np.histogram2d would choose for each row of thedata
+    binstart = np.min(thedata, axis=-1, keepdims=True)
+    binend = np.max(thedata, axis=-1, keepdims=True)
+    flat = binstart == binend
+    binstart[flat] -= 0.5
+    binend[flat] += 0.5
+    return binstart, binend
+
+
+def laggedjointhistograms(xindices, xvalid, yindices, yvalid, lags, numxbins, numybins):
+    """Calculate the joint histograms of two binned series at a set of lags with one bincount.
+
+    At lag i, x[k + i] is paired with y[k] (for i < 0, x[k] is paired with y[k - i]), as in
+    cross_mutual_info.
+
+    Parameters
+    ----------
+    xindices : int array
+        Bin indices of the first series, or of a block of them, one per row
+    xvalid : bool array
+        Which points of xindices fall inside the histogram
+    yindices : 1D int array
+        Bin indices of the second series
+    yvalid : 1D bool array
+        Which points of yindices fall inside the histogram
+    lags : int array
+        The lags to calculate.  Either 1D, used for every row, or 2D with one row of lags
+        per row of xindices
+    numxbins, numybins : int
+        The number of bins for each series
+
+    Returns
+    -------
+    jh : int array
+        The joint histograms, with shape xindices.shape[:-1] + (numlags, numybins, numxbins)
+    """
+    xlen = np.shape(xindices)[-1]
+    ylen = len(yindices)
+    xblock = np.reshape(xindices, (-1, xlen))
+    xvalidblock = np.reshape(xvalid, (-1, xlen))
+    numrows = xblock.shape[0]
+    lags = np.asarray(lags, dtype=np.int_)
+    numlags = lags.shape[-1]
+    lagblock = np.broadcast_to(lags.reshape((-1, numlags)), (numrows, numlags))
+
+    # the positions in x and y that are paired at each lag, and whether they overlap
+    offsets = np.arange(np.min((xlen, ylen)))
+    xpos = offsets + np.maximum(lagblock, 0)[:, :, None]
+    ypos = offsets + np.maximum(-lagblock, 0)[:, :, None]
+    inrange = (xpos < xlen) & (ypos < ylen)
+    xpos[~inrange] = 0
+    ypos[~inrange] = 0
+    rows = np.arange(numrows)[:, None, None]
+    inrange &= xvalidblock[rows, xpos] & yvalid[ypos]
+
+    # fold the (row, lag) index and both bin indices into one histogram index
+    histnum = np.arange(numrows * numlags).reshape((numrows, numlags, 1))
+    combined = (histnum * numybins + yindices[ypos]) * numxbins + xblock[rows, xpos]
+    jh = np.bincount(combined[inrange], minlength=numrows * numlags * numybins * numxbins)
+    return jh.reshape(np.shape(xindices)[:-1] + (numlags, numybins, numxbins))
+
+
+def mutual_info_from_histograms(jh, sigma=1, normalized=True, EPS=1.0e-6):
+    """Compute (normalized) mutual information from a stack of joint histograms.
+
+    Each histogram (the last two axes of jh) is smoothed and reduced exactly as in
+    mutual_info_2d.  Note that jh is smoothed in place.
+
+    Parameters
+    ----------
+    jh : array
+        The joint histograms
+    sigma : float, optional
+        Sigma for Gaussian smoothing of the joint histograms.  Default = 1.
+    normalized : bool, optional
+        If True, calculate the normalized mutual information.  Default = True.
+    EPS : float, optional
+        Default = 1.0e-6.
+
+    Returns
+    -------
+    mi : array
+        The similarity measure for each histogram, with shape jh.shape[:-2]
+    """
+    # smooth each histogram, but not across histograms
+    thesigmas = [0.0] * (jh.ndim - 2) + [sigma, sigma]
+    sp.ndimage.gaussian_filter(jh, sigma=thesigmas, mode="constant", output=jh)
+
+    # compute marginal histograms
+    jh = jh + EPS
+    jh /= np.sum(jh, axis=(-2, -1), keepdims=True)
+    s1 = np.sum(jh, axis=-2)
+    s2 = np.sum(jh, axis=-1)
+    HX = -np.sum(s1 * np.log(s1), axis=-1)
+    HY = -np.sum(s2 * np.log(s2), axis=-1)
+    HXcommaY = -np.sum(jh * np.log(jh), axis=(-2, -1))
+
+    if normalized:
+        return (HX + HY) / (HXcommaY) - 1.0
+    else:
+        return -(HXcommaY - HX - HY)
+
+
+def _laggedmutualinfo(
+    xindices, xvalid, yindices, yvalid, lags, numxbins, numybins, sigma=0.25, normalized=True
+):
+    # mutual information of each row of xindices with yindices at each lag, with the joint
+    # histograms built in as few bincounts as MAXMIPOINTS allows
+    numrows, xlen = np.shape(xindices)
+    lags = np.asarray(lags, dtype=np.int_)
+    numlags = lags.shape[-1]
+    lagblock = np.broadcast_to(lags.reshape((-1, numlags)), (numrows, numlags))
+    thecost = np.min((xlen, len(yindices))) + numxbins * numybins
+    lagsperchunk = int(np.clip(MAXMIPOINTS // thecost, 1, numlags))
+    rowsperchunk = int(np.clip(MAXMIPOINTS // (thecost * lagsperchunk), 1, numrows))
+    themi = np.zeros((numrows, numlags), dtype=np.float64)
+    for rowstart in range(0, numrows, rowsperchunk):
+        rowend = np.min((rowstart + rowsperchunk, numrows))
+        for lagstart in range(0, numlags, lagsperchunk):
+            lagend = np.min((lagstart + lagsperchunk, numlags))
+            jh = laggedjointhistograms(
+                xindices[rowstart:rowend, :],
+                xvalid[rowstart:rowend, :],
+                yindices,
+                yvalid,
+                lagblock[rowstart:rowend, lagstart:lagend],
+                numxbins,
+                numybins,
+            )
+            themi[rowstart:rowend, lagstart:lagend] = mutual_info_from_histograms(
+                jh, sigma=sigma, normalized=normalized
+            )
+    return themi
+
+
+def _milags(negsteps, possteps, xlen, ylen):
+    # convert the requested lag range into the first and last lag for cross_mutual_info
+    if (negsteps == -1) or (negsteps > ylen - 1):
+        negsteps = -ylen + 1
+    else:
+        negsteps = -negsteps
+    if (possteps == -1) or (possteps > xlen - 1):
+        possteps = xlen - 1
+    return negsteps, possteps
+
+
 @conditionaljit()
 def cross_mutual_info(
     x,
@@ -476,14 +631,7 @@ def cross_mutual_info(
         bins2d = (bins, bins)
         fast = False
 
-    if (negsteps == -1) or (negsteps > len(normy) - 1):
-        negsteps = -len(normy) + 1
-    else:
-        negsteps = -negsteps
-    if (possteps == -1) or (possteps > len(normx) - 1):
-        possteps = len(normx) - 1
-    else:
-        possteps = possteps
+    negsteps, possteps = _milags(negsteps, possteps, len(normx), len(normy))
     if locs is None:
         thexmi_y = np.zeros((-negsteps + possteps + 1))
         LGR.debug(f"negsteps, possteps, len(thexmi_y): {negsteps} {possteps} {len(thexmi_y)}")
@@ -491,34 +639,50 @@ def cross_mutual_info(
     else:
         thexmi_y = np.zeros((len(locs)), dtype=np.float64)
         irange = np.asarray(locs)
-    destloc = -1
-    for i in irange:
-        if locs is None:
-            destloc = i - negsteps
-        else:
-            destloc += 1
-        if i < 0:
-            thexmi_y[destloc] = mutual_info_2d(
-                normx[: i + len(normy)],
-                normy[-i:],
-                bins=bins2d,
-                normalized=norm,
-                fast=fast,
-                sigma=sigma,
-            )
-        elif i == 0:
-            thexmi_y[destloc] = mutual_info_2d(
-                normx, normy, bins=bins2d, normalized=norm, fast=fast, sigma=sigma,
-            )
-        else:
-            thexmi_y[destloc] = mutual_info_2d(
-                normx[i:],
-                normy[: len(normy) - i],
-                bins=bins2d,
-                normalized=norm,
-                fast=fast,
-                sigma=sigma,
-            )
+    if fast:
+        # bin each series once and build the joint histograms for all the lags together
+        xindices, xvalid = _mibinindices(normx, bins2d[0][0], bins2d[0][-1], len(bins2d[0]) - 1)
+        yindices, yvalid = _mibinindices(normy, bins2d[1][0], bins2d[1][-1], len(bins2d[1]) - 1)
+        thexmi_y[:] = _laggedmutualinfo(
+            xindices.reshape((1, -1)),
+            xvalid.reshape((1, -1)),
+            yindices,
+            yvalid,
+            np.asarray(irange),
+            len(bins2d[0]) - 1,
+            len(bins2d[1]) - 1,
+            sigma=sigma,
+            normalized=norm,
+        )[0, :]
+    else:
+        destloc = -1
+        for i in irange:
+            if locs is None:
+                destloc = i - negsteps
+            else:
+                destloc += 1
+            if i < 0:
+                thexmi_y[destloc] = mutual_info_2d(
+                    normx[: i + len(normy)],
+                    normy[-i:],
+                    bins=bins2d,
+                    normalized=norm,
+                    fast=fast,
+                    sigma=sigma,
+                )
+            elif i == 0:
+                thexmi_y[destloc] = mutual_info_2d(
+                    normx, normy, bins=bins2d, normalized=norm, fast=fast, sigma=sigma,
+                )
+            else:
+                thexmi_y[destloc] = mutual_info_2d(
+                    normx[i:],
+                    normy[: len(normy) - i],
+                    bins=bins2d,
+                    normalized=norm,
+                    fast=fast,
+                    sigma=sigma,
+                )
 
     if madnorm:
         thexmi_y = tide_math.madnormalize(thexmi_y)
@@ -537,6 +701,105 @@ def cross_mutual_info(
         return thexmi_y
 
 
+def cross_mutual_info_block(
+    xblock,
+    y,
+    returnaxis=False,
+    negsteps=-1,
+    possteps=-1,
+    locs=None,
+    Fs=1.0,
+    norm=True,
+    madnorm=False,
+    windowfunc="None",
+    bins=-1,
+    sigma=0.25,
+):
+    """Calculate cross-mutual information between each row of a 2D array and a 1D array.
+
+    Each row gives the same result as cross_mutual_info with prebin and fast set, but the
+    rows are normalized and binned together, and their joint histograms for all the lags are
+    built with as few bincounts as possible.
+
+    Parameters
+    ----------
+    xblock : 2D array
+        first variables, one per row
+    y : 1D array
+        second variable
+    returnaxis : bool
+        set to True to return the time axis
+    negsteps: int
+    possteps: int
+    locs : array
+        a set of offsets at which to calculate the cross mutual information.  Either 1D, used
+        for every row, or 2D, with one row of offsets for each row of xblock
+    Fs=1.0,
+    norm : bool
+        calculate normalized MI at each offset
+    madnorm : bool
+        set to True to normalize each cross MI waveform by it's median average deviate
+    windowfunc : str
+        name of the window function to apply to input vectors prior to MI calculation
+    bins : int
+        number of bins in each dimension of the 2D histogram.  Set to -1 to set automatically
+    sigma : float
+        histogram smoothing kernel
+
+    Returns
+    -------
+    if returnaxis is True:
+        thexmi_x : array
+            the set of offsets at which cross mutual information is calcuated
+        thexmi_y : 2D array
+            the cross mutual information values for each row
+        len(thexmi_x): int
+            the number of cross mutual information values returned
+    else:
+        thexmi_y : 2D array
+            the cross mutual information values for each row
+    """
+    normx = tide_math.corrnormalizeblock(xblock, detrendorder=1, windowfunc=windowfunc)
+    normy = tide_math.corrnormalize(y, detrendorder=1, windowfunc=windowfunc)
+    xlen = normx.shape[1]
+
+    # see if we are using the default number of bins
+    if bins < 1:
+        bins = int(np.sqrt(xlen / 5))
+        LGR.debug(f"cross_mutual_info_block: bins set to {bins}")
+
+    # bin each series over its own range, as np.histogram2d would
+    xstart, xend = _histogramrange(normx)
+    ystart, yend = _histogramrange(normy)
+    xindices, xvalid = _mibinindices(normx, xstart, xend, bins)
+    yindices, yvalid = _mibinindices(normy, ystart, yend, bins)
+
+    negsteps, possteps = _milags(negsteps, possteps, xlen, len(normy))
+    if locs is None:
+        irange = np.arange(negsteps, possteps + 1)
+    else:
+        irange = np.asarray(locs)
+    thexmi_y = _laggedmutualinfo(
+        xindices, xvalid, yindices, yvalid, irange, bins, bins, sigma=sigma, normalized=norm
+    )
+
+    if madnorm:
+        for i in range(thexmi_y.shape[0]):
+            thexmi_y[i, :] = tide_math.madnormalize(thexmi_y[i, :])
+
+    if returnaxis:
+        if locs is None:
+            thexmi_x = (
+                np.linspace(0.0, len(irange) / Fs, num=len(irange), endpoint=False)
+                + negsteps / Fs
+            )
+            return thexmi_x, thexmi_y, negsteps + 1
+        else:
+            return irange, thexmi_y, irange.shape[-1]
+    else:
+        return thexmi_y
+
+
 def mutual_info_to_r(themi, d=1):
     """Convert mutual information to Pearson product-moment correlation."""
     return np.power(1.0 - np.exp(-2.0 * themi / d), -0.5)
@@ -720,7 +983,7 @@ def arbcorr(
         matchedinput2 = input2
     norm1 = tide_math.corrnormalize(matchedinput1, detrendorder=1, windowfunc=windowfunc)
     norm2 = tide_math.corrnormalize(matchedinput2, detrendorder=1, windowfunc=windowfunc)
-    thexcorr_y = signal.fftconvolve(norm1, norm2[::-1], mode="full")
+    thexcorr_y = _fftconvolve(norm1, norm2[::-1])
     thexcorr_x = (
         np.linspace(0.0, len(thexcorr_y) / corrFs, num=len(thexcorr_y), endpoint=False)
         - (len(norm1) // 2 + len(norm2) // 2) / corrFs
@@ -773,11 +1036,15 @@ def faststcorrelate(
 
     acorrfft1 = thestft1 * np.conj(thestft1)
     acorrfft2 = thestft2 * np.conj(thestft2)
-    acorr1 = np.roll(fftpack.ifft(acorrfft1, axis=0).real, nperseg // 2, axis=0)[nperseg // 2, :]
-    acorr2 = np.roll(fftpack.ifft(acorrfft2, axis=0).real, nperseg // 2, axis=0)[nperseg // 2, :]
+    acorr1 = np.roll(tide_fft.ifft(acorrfft1, axis=0).real, nperseg // 2, axis=0)[
+        nperseg // 2, :
+    ]
+    acorr2 = np.roll(tide_fft.ifft(acorrfft2, axis=0).real, nperseg // 2, axis=0)[
+        nperseg // 2, :
+    ]
     normfacs = np.sqrt(acorr1 * acorr2)
     product = thestft1 * np.conj(thestft2)
-    stcorr = np.roll(fftpack.ifft(product, axis=0).real, nperseg // 2, axis=0)
+    stcorr = np.roll(tide_fft.ifft(product, axis=0).real, nperseg // 2, axis=0)
     for i in range(len(normfacs)):
         stcorr[:, i] /= normfacs[i]
 
@@ -815,12 +1082,13 @@ def fastcorrelate(
     len1 = len(input1)
     len2 = len(input2)
     outlen = len1 + len2 - 1
+    padtype = np.result_type(np.asarray(input1).dtype, np.asarray(input2).dtype, np.float32)
     if zeropadding < 0:
         # autopad
         newlen1 = len1 * 2
         newlen2 = len2 * 2
-        paddedinput1 = np.zeros((newlen1), dtype=float)
-        paddedinput2 = np.zeros((newlen2), dtype=float)
+        paddedinput1 = np.zeros((newlen1), dtype=padtype)
+        paddedinput2 = np.zeros((newlen2), dtype=padtype)
         paddedinput1[0:len1] = input1
         paddedinput2[0:len2] = input2
         startpt = (len1 + len2) // 2
@@ -828,8 +1096,8 @@ def fastcorrelate(
         # explicit pad
         newlen1 = len1 + zeropadding
         newlen2 = len2 + zeropadding
-        paddedinput1 = np.zeros((newlen1), dtype=float)
-        paddedinput2 = np.zeros((newlen2), dtype=float)
+        paddedinput1 = np.zeros((newlen1), dtype=padtype)
+        paddedinput2 = np.zeros((newlen2), dtype=padtype)
         paddedinput1[0:len1] = input1
         paddedinput2[0:len2] = input2
         startpt = zeropadding
@@ -844,9 +1112,7 @@ def fastcorrelate(
     if usefft:
         # Do an array flipped convolution, which is a correlation.
         if weighting == "None":
-            return signal.fftconvolve(paddedinput1, paddedinput2[::-1], mode="full")[
-                startpt : startpt + outlen
-            ]
+            return _fftconvolve(paddedinput1, paddedinput2[::-1])[startpt : startpt + outlen]
         else:
             return convolve_weighted_fft(
                 paddedinput1,
@@ -859,6 +1125,185 @@ def fastcorrelate(
         return np.correlate(paddedinput1, paddedinput2, mode="full")
 
 
+def _fastcorrelatesizes(len1, len2, zeropadding):
+    # the padded input lengths and the start of the output, as used by fastcorrelate
+    if zeropadding < 0:
+        return len1 * 2, len2 * 2, (len1 + len2) // 2
+    elif zeropadding > 0:
+        return len1 + zeropadding, len2 + zeropadding, zeropadding
+    else:
+        return len1, len2, 0
+
+
+def blockcorrelateplan(input2, zeropadding=0, weighting="None"):
+    """Precompute everything about the reference timecourse that blockcorrelate needs.
+
+    The spectrum of the (padded, reversed) reference is calculated once here, rather than
+    once for every timecourse correlated against it.
+
+    Parameters
+    ----------
+    input2 : 1D array
+        The reference timecourse.
+    zeropadding : int
+        As for fastcorrelate.
+    weighting : str
+        As for fastcorrelate.
+
+    Returns
+    -------
+    theplan : dict
+    """
+    len2 = len(input2)
+    paddedlen1, paddedlen2, startpt = _fastcorrelatesizes(len2, len2, zeropadding)
+    fullsize = paddedlen1 + paddedlen2 - 1
+    paddedinput2 = np.zeros(
+        (paddedlen2), dtype=np.result_type(np.asarray(input2).dtype, np.float32)
+    )
+    paddedinput2[0:len2] = input2
+    if weighting == "None":
+        # match _fftconvolve
+        fftlen = tide_fft.next_fast_len(fullsize, True)
+        refspectrum = tide_fft.rfft(paddedinput2[::-1], fftlen)
+    else:
+        # match convolve_weighted_fft
+        fftlen = int(2 ** np.ceil(np.log2(fullsize)))
+        refspectrum = tide_fft.rfft(paddedinput2[::-1], fftlen)
+    return {
+        "inputlen": len2,
+        "fftlen": fftlen,
+        "fullsize": fullsize,
+        "startpt": startpt,
+        "outlen": 2 * len2 - 1,
+        "weighting": weighting,
+        "refspectrum": refspectrum,
+    }
+
+
+def blockcorrelate(inputblock, theplan):
+    """Correlate every row of a 2D array with a reference timecourse.
+
+    Gives the same result as calling fastcorrelate(row, input2, usefft=True, ...) on each
+    row, but transforms the whole block at once, using the reference spectrum from
+    blockcorrelateplan.
+
+    Parameters
+    ----------
+    inputblock : 2D array
+        One timecourse per row, the same length as the reference.
+    theplan : dict
+        The output of blockcorrelateplan.
+
+    Returns
+    -------
+    corrblock : 2D array
+        One correlation function per row.
+    """
+    if inputblock.shape[1] != theplan["inputlen"]:
+        raise ValueError("blockcorrelate: timecourses do not match the reference length")
+    fftlen = theplan["fftlen"]
+    fftblock = tide_fft.rfft(inputblock, fftlen, axis=1)
+    # match the precision of the data
+    refspectrum = theplan["refspectrum"].astype(
+        np.result_type(fftblock.dtype, np.complex64), copy=False
+    )
+    if theplan["weighting"] == "None":
+        ret = tide_fft.irfft(fftblock * refspectrum, fftlen, axis=1)
+        ret = ret[:, : theplan["fullsize"]]
+    else:
+        # apply the weighting in the frequency domain, then restore each row's original maximum
+        theorigmax = np.max(
+            np.absolute(
+                tide_fft.irfft(fftblock * refspectrum, fftlen, axis=1)[:, : theplan["fullsize"]]
+            ),
+            axis=1,
+            keepdims=True,
+        )
+        ret = tide_fft.irfft(
+            gccproduct(fftblock, refspectrum, theplan["weighting"]), fftlen, axis=1
+        )[:, : theplan["fullsize"]]
+        ret *= theorigmax / np.max(np.absolute(ret), axis=1, keepdims=True)
+    return ret[:, theplan["startpt"] : theplan["startpt"] + theplan["outlen"]]
+
+
+def laggedcorrelateplan(input2, minshift, maxshift):
+    """Make the lagged reference matrix laggedcorrelate needs.
+
+    Row i of the matrix is the reference delayed by minshift + i points, so multiplying a
+    block of timecourses by its transpose gives the (unweighted) correlation at just those
+    shifts.
+
+    Parameters
+    ----------
+    input2 : 1D array
+        The reference timecourse.
+    minshift, maxshift : int
+        The range of shifts to calculate (inclusive).  Shift s is element s + len(input2) - 1
+        of the full correlation function returned by fastcorrelate.
+
+    Returns
+    -------
+    theplan : dict
+    """
+    len2 = len(input2)
+    shifts = np.arange(minshift, maxshift + 1)
+    laggedref = np.zeros(
+        (len(shifts), len2), dtype=np.result_type(np.asarray(input2).dtype, np.float32)
+    )
+    for i, theshift in enumerate(shifts):
+        if 0 <= theshift < len2:
+            laggedref[i, theshift:] = input2[: len2 - theshift]
+        elif -len2 < theshift < 0:
+            laggedref[i, : len2 + theshift] = input2[-theshift:]
+    return {
+        "inputlen": len2,
+        "minshift": minshift,
+        "maxshift": maxshift,
+        "laggedref": laggedref,
+    }
+
+
+def laggedcorrelate(inputblock, theplan, shiftrange=None):
+    """Correlate every row of a 2D array with a reference timecourse, over a limited range
+    of shifts, with a single matrix multiply.
+
+    Parameters
+    ----------
+    inputblock : 2D array
+        One timecourse per row, the same length as the reference.
+    theplan : dict
+        The output of laggedcorrelateplan.
+    shiftrange : tuple of ints, optional
+        If given, only calculate the planned shifts from shiftrange[0] up to (but not
+        including) shiftrange[1], counted from the first planned shift.
+
+    Returns
+    -------
+    corrblock : 2D array
+        One correlation function (over the planned shifts) per row.
+    """
+    if inputblock.shape[1] != theplan["inputlen"]:
+        raise ValueError("laggedcorrelate: timecourses do not match the reference length")
+    if shiftrange is None:
+        laggedref = theplan["laggedref"]
+    else:
+        laggedref = theplan["laggedref"][shiftrange[0] : shiftrange[1], :]
+    return inputblock @ laggedref.T.astype(
+        np.result_type(inputblock.dtype, np.float32), copy=False
+    )
+
+
+def directcorrelationischeaper(inputlen, numlags, fftlen):
+    """Decide whether correlating over numlags shifts with laggedcorrelate will be faster
+    than calculating the full correlation with FFTs of length fftlen.
+
+    A batched matrix multiply does about 25 multiply-adds in the time a forward plus
+    inverse FFT does one butterfly, so the direct method wins unless the lag range covers
+    a large part of the timecourse.
+    """
+    return numlags * inputlen < 25.0 * fftlen * np.log2(fftlen)
+
+
 def _centered(arr, newsize):
     """Return the center newsize portion of the array.
 
@@ -904,6 +1349,16 @@ def _check_valid_mode_shapes(shape1, shape2):
             )
 
 
+def _fftconvolve(in1, in2):
+    # the full linear convolution of two real vectors, as signal.fftconvolve calculates it,
+    # but using the selected fft backend
+    fullsize = len(in1) + len(in2) - 1
+    fftlen = tide_fft.next_fast_len(fullsize, True)
+    return tide_fft.irfft(tide_fft.rfft(in1, fftlen) * tide_fft.rfft(in2, fftlen), fftlen)[
+        :fullsize
+    ]
+
+
 def convolve_weighted_fft(in1, in2, mode="full", weighting="None", displayplots=False):
     """Convolve two N-dimensional arrays using FFT.
 
@@ -961,22 +1416,24 @@ def convolve_weighted_fft(in1, in2, mode="full", weighting="None", displayplots=
     fsize = 2 ** np.ceil(np.log2(size)).astype(int)
     fslice = tuple([slice(0, int(sz)) for sz in size])
     if not complex_result:
-        fft1 = rfftn(in1, fsize)
-        fft2 = rfftn(in2, fsize)
-        theorigmax = np.max(np.absolute(irfftn(gccproduct(fft1, fft2, "None"), fsize)[fslice]))
-        ret = irfftn(gccproduct(fft1, fft2, weighting, displayplots=displayplots), fsize)[
-            fslice
-        ].copy()
-        ret = irfftn(gccproduct(fft1, fft2, weighting, displayplots=displayplots), fsize)[
-            fslice
-        ].copy()
+        fft1 = tide_fft.rfftn(in1, fsize)
+        fft2 = tide_fft.rfftn(in2, fsize)
+        theorigmax = np.max(
+            np.absolute(tide_fft.irfftn(gccproduct(fft1, fft2, "None"), fsize)[fslice])
+        )
+        ret = tide_fft.irfftn(
+            gccproduct(fft1, fft2, weighting, displayplots=displayplots), fsize
+        )[fslice].copy()
+        ret = tide_fft.irfftn(
+            gccproduct(fft1, fft2, weighting, displayplots=displayplots), fsize
+        )[fslice].copy()
         ret = ret.real
         ret *= theorigmax / np.max(np.absolute(ret))
     else:
-        fft1 = fftpack.fftn(in1, fsize)
-        fft2 = fftpack.fftn(in2, fsize)
-        theorigmax = np.max(np.absolute(fftpack.ifftn(gccproduct(fft1, fft2, "None"))[fslice]))
-        ret = fftpack.ifftn(gccproduct(fft1, fft2, weighting, displayplots=displayplots))[
+        fft1 = tide_fft.fftn(in1, fsize)
+        fft2 = tide_fft.fftn(in2, fsize)
+        theorigmax = np.max(np.absolute(tide_fft.ifftn(gccproduct(fft1, fft2, "None"))[fslice]))
+        ret = tide_fft.ifftn(gccproduct(fft1, fft2, weighting, displayplots=displayplots))[
             fslice
         ].copy()
         ret *= theorigmax / np.max(np.absolute(ret))
@@ -1033,13 +1490,14 @@ def gccproduct(fft1, fft2, weighting, threshfrac=0.1, displayplots=False):
         plt.plot(xvec, abs(denom))
         plt.show()
 
-    # now apply it while preserving the max
-    theorigmax = np.max(np.absolute(denom))
+    # now apply it while preserving the max (separately for each row of 2D input)
+    theorigmax = np.max(np.absolute(denom), axis=-1, keepdims=True)
     thresh = theorigmax * threshfrac
-    if thresh > 0.0:
-        with np.errstate(invalid="ignore", divide="ignore"):
-            return np.nan_to_num(
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(
+            thresh > 0.0,
+            np.nan_to_num(
                 np.where(np.absolute(denom) > thresh, product / denom, np.float64(0.0))
-            )
-    else:
-        return 0.0 * product
+            ),
+            0.0 * product,
+        )
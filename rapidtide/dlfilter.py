@@ -28,12 +28,9 @@ import sys
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
-import pyfftw
-import pyfftw.interfaces.scipy_fftpack as fftpack
 from statsmodels.robust.scale import mad
 
-pyfftw.interfaces.cache.enable()
-
+import rapidtide.fftbackend as tide_fft
 import rapidtide.io as tide_io
 
 LGR = logging.getLogger("GENERAL")
@@ -1095,7 +1092,7 @@ def filtscale(
     data, scalefac=1.0, reverse=False, hybrid=False, lognormalize=True, epsilon=1e-10, numorders=6,
 ):
     if not reverse:
-        specvals = fftpack.fft(data)
+        specvals = tide_fft.fft(data)
         if lognormalize:
             themag = np.log(np.absolute(specvals) + epsilon)
             scalefac = np.max(themag)
@@ -1120,7 +1117,7 @@ def filtscale(
             else:
                 themag = data[:, 0] * scalefac
             specvals = themag * np.exp(1.0j * thephase)
-            return fftpack.ifft(specvals).real
+            return tide_fft.ifft(specvals).real
 
 
 def tobadpts(name):
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2021 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""The FFTs used by rapidtide, so the implementation can be chosen in one place.
+
+The functions here take the same arguments as their scipy.fft counterparts.  The backend
+is one of:
+
+    "scipy"  - scipy.fft, threaded with its workers argument (the default)
+    "pyfftw" - pyFFTW's scipy.fft interface with its plan cache turned on, so repeated
+               transforms of the same size and type reuse their FFTW plans
+    "numpy"  - numpy.fft (single threaded)
+"""
+import sys
+
+import numpy as np
+import scipy.fft as sp_fft
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft as pyfftw_fft
+
+    pyfftwexists = True
+except ImportError:
+    pyfftwexists = False
+
+BACKENDS = ["scipy", "pyfftw", "numpy"]
+
+# how long (in seconds) unused pyfftw plans are kept
+PLANKEEPALIVE = 300.0
+
+_backend = "scipy"
+_workers = None
+
+
+def setbackend(thebackend):
+    """Choose the FFT implementation ("scipy", "pyfftw", or "numpy").
+
+    If pyfftw is requested but not installed, scipy is used instead.
+    """
+    global _backend
+    if thebackend not in BACKENDS:
+        print("setbackend: illegal fft backend", thebackend, "- must be one of", BACKENDS)
+        sys.exit()
+    if thebackend == "pyfftw":
+        if not pyfftwexists:
+            print("pyfftw is not installed - using scipy for FFTs")
+            thebackend = "scipy"
+        else:
+            pyfftw.interfaces.cache.enable()
+            pyfftw.interfaces.cache.set_keepalive_time(PLANKEEPALIVE)
+    _backend = thebackend
+
+
+def getbackend():
+    return _backend
+
+
+def setworkers(numworkers):
+    """Set the number of threads each transform may use (None means the backend default)."""
+    global _workers
+    if numworkers is None:
+        _workers = None
+    else:
+        _workers = max(1, int(numworkers))
+    if pyfftwexists and _workers is not None:
+        pyfftw.config.NUM_THREADS = _workers
+
+
+def getworkers():
+    return _workers
+
+
+def next_fast_len(target, real=False):
+    """The smallest length >= target that the backends transform efficiently."""
+    return sp_fft.next_fast_len(int(target), real)
+
+
+def _dispatch(funcname, *args, **kwargs):
+    if _backend == "numpy":
+        return getattr(np.fft, funcname)(*args, **kwargs)
+    elif _backend == "pyfftw":
+        return getattr(pyfftw_fft, funcname)(*args, workers=_workers, **kwargs)
+    else:
+        return getattr(sp_fft, funcname)(*args, workers=_workers, **kwargs)
+
+
+def fft(x, n=None, axis=-1):
+    return _dispatch("fft", x, n=n, axis=axis)
+
+
+def ifft(x, n=None, axis=-1):
+    return _dispatch("ifft", x, n=n, axis=axis)
+
+
+def rfft(x, n=None, axis=-1):
+    return _dispatch("rfft", x, n=n, axis=axis)
+
+
+def irfft(x, n=None, axis=-1):
+    return _dispatch("irfft", x, n=n, axis=axis)
+
+
+def fftn(x, s=None, axes=None):
+    return _dispatch("fftn", x, s=s, axes=axes)
+
+
+def ifftn(x, s=None, axes=None):
+    return _dispatch("ifftn", x, s=s, axes=axes)
+
+
+def rfftn(x, s=None, axes=None):
+    return _dispatch("rfftn", x, s=s, axes=axes)
+
+
+def irfftn(x, s=None, axes=None):
+    return _dispatch("irfftn", x, s=s, axes=axes)
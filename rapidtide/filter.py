@@ -28,13 +28,12 @@ import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pyfftw
 from numba import jit
-from scipy import fftpack, ndimage, signal
+from scipy import ndimage, signal
 from scipy.signal import savgol_filter
 
-fftpack = pyfftw.interfaces.scipy_fftpack
-pyfftw.interfaces.cache.enable()
+import rapidtide.fftbackend as tide_fft
+
 
 # ---------------------------------------- Global constants -------------------------------------------
 donotusenumba = True
@@ -75,12 +74,12 @@ def padvec(inputdata, padlen=20, cyclic=False):
 
     Parameters
     ----------
-    inputdata : 1D array
-        An array of any numerical type.
+    inputdata : 1D or 2D array
+        An array of any numerical type.  2D arrays are padded along the last axis.
         :param inputdata:
 
     padlen : int, optional
-        The number of points to remove from each end.  Default is 20.
+        The number of points to add to each end.  Default is 20.
         :param padlen:
 
     cyclic : bool, optional
@@ -93,22 +92,25 @@ def padvec(inputdata, padlen=20, cyclic=False):
         The input data, with padlen reflected points added to each end
 
     """
-    if padlen > len(inputdata):
+    if padlen > np.shape(inputdata)[-1]:
         print(
             "ERROR: padlen (",
             padlen,
             ") is greater than input data length (",
-            len(inputdata),
+            np.shape(inputdata)[-1],
             ")",
         )
         sys.exit()
 
     if padlen > 0:
         if cyclic:
-            return np.concatenate((inputdata[-padlen:], inputdata, inputdata[0:padlen]))
+            return np.concatenate(
+                (inputdata[..., -padlen:], inputdata, inputdata[..., 0:padlen]), axis=-1
+            )
         else:
+            flipped = inputdata[..., ::-1]
             return np.concatenate(
-                (inputdata[::-1][-padlen:], inputdata, inputdata[::-1][0:padlen])
+                (flipped[..., -padlen:], inputdata, flipped[..., 0:padlen]), axis=-1
             )
     else:
         return inputdata
@@ -120,8 +122,8 @@ def unpadvec(inputdata, padlen=20):
 
     Parameters
     ----------
-    inputdata : 1D array
-        An array of any numerical type.
+    inputdata : 1D or 2D array
+        An array of any numerical type.  2D arrays are unpadded along the last axis.
         :param inputdata:
     padlen : int, optional
         The number of points to remove from each end.  Default is 20.
@@ -135,7 +137,7 @@ def unpadvec(inputdata, padlen=20):
 
     """
     if padlen > 0:
-        return inputdata[padlen:-padlen]
+        return inputdata[..., padlen:-padlen]
     else:
         return inputdata
 
@@ -370,8 +372,8 @@ def transferfuncfilt(inputdata, transferfunc):
     filtereddata : 1D float array
         Filtered input data
     """
-    inputdata_trans = transferfunc * fftpack.fft(inputdata)
-    return fftpack.ifft(inputdata_trans).real
+    inputdata_trans = transferfunc * tide_fft.fft(inputdata)
+    return tide_fft.ifft(inputdata_trans).real
 
 
 # - fft brickwall filters
@@ -448,10 +450,10 @@ def dolpfftfilt(Fs, upperpass, inputdata, padlen=20, cyclic=False, debug=False):
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = getlpfftfunc(Fs, upperpass, padinputdata, debug=debug)
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 @conditionaljit()
@@ -491,10 +493,10 @@ def dohpfftfilt(Fs, lowerpass, inputdata, padlen=20, cyclic=False, debug=False):
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = 1.0 - getlpfftfunc(Fs, lowerpass, padinputdata, debug=debug)
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 @conditionaljit()
@@ -538,12 +540,12 @@ def dobpfftfilt(Fs, lowerpass, upperpass, inputdata, padlen=20, cyclic=False, de
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = getlpfftfunc(Fs, upperpass, padinputdata, debug=debug) * (
         1.0 - getlpfftfunc(Fs, lowerpass, padinputdata, debug=debug)
     )
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 # - fft trapezoidal filters
@@ -726,7 +728,7 @@ def dolptransfuncfilt(
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = getlptransfunc(
         Fs, padinputdata, upperpass=upperpass, upperstop=upperstop, type=type
     )
@@ -741,7 +743,7 @@ def dolptransfuncfilt(
         plt.plot(freqaxis, transferfunc)
         plt.show()
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 @conditionaljit()
@@ -796,7 +798,7 @@ def dohptransfuncfilt(
     if lowerstop is None:
         lowerstop = lowerpass * (1.0 / 1.05)
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = getlptransfunc(
         Fs, padinputdata, upperpass=lowerstop, upperstop=lowerpass, type=type
     )
@@ -811,7 +813,7 @@ def dohptransfuncfilt(
         plt.plot(freqaxis, transferfunc)
         plt.show()
     inputdata_trans *= 1.0 - transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 @conditionaljit()
@@ -868,7 +870,7 @@ def dobptransfuncfilt(
     if lowerstop is None:
         lowerstop = lowerpass * (1.0 / 1.05)
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = getlptransfunc(
         Fs, padinputdata, upperpass=upperpass, upperstop=upperstop, type=type, debug=False,
     ) * gethptransfunc(Fs, padinputdata, lowerstop=lowerstop, lowerpass=lowerpass, type=type)
@@ -887,7 +889,7 @@ def dobptransfuncfilt(
         plt.plot(freqaxis, transferfunc)
         plt.show()
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 @conditionaljit()
@@ -931,10 +933,10 @@ def dolptrapfftfilt(Fs, upperpass, upperstop, inputdata, padlen=20, cyclic=False
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = getlptrapfftfunc(Fs, upperpass, upperstop, padinputdata, debug=debug)
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 @conditionaljit()
@@ -978,10 +980,10 @@ def dohptrapfftfilt(Fs, lowerstop, lowerpass, inputdata, padlen=20, cyclic=False
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     transferfunc = 1.0 - getlptrapfftfunc(Fs, lowerstop, lowerpass, padinputdata, debug=debug)
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 @conditionaljit()
@@ -1043,7 +1045,7 @@ def dobptrapfftfilt(
         The filtered data
     """
     padinputdata = padvec(inputdata, padlen=padlen, cyclic=cyclic)
-    inputdata_trans = fftpack.fft(padinputdata)
+    inputdata_trans = tide_fft.fft(padinputdata)
     if debug:
         print(
             "Fs=",
@@ -1061,7 +1063,7 @@ def dobptrapfftfilt(
         1.0 - getlptrapfftfunc(Fs, lowerstop, lowerpass, padinputdata, debug=debug)
     )
     inputdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(inputdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(inputdata_trans).real, padlen=padlen)
 
 
 # Simple example of Wiener deconvolution in Python.
@@ -1073,9 +1075,9 @@ def wiener_deconvolution(signal, kernel, lambd):
     kernel = np.hstack(
         (kernel, np.zeros(len(signal) - len(kernel)))
     )  # zero pad the kernel to same length
-    H = fftpack.fft(kernel)
+    H = tide_fft.fft(kernel)
     deconvolved = np.roll(
-        np.real(fftpack.ifft(fftpack.fft(signal) * np.conj(H) / (H * np.conj(H) + lambd ** 2))),
+        np.real(tide_fft.ifft(tide_fft.fft(signal) * np.conj(H) / (H * np.conj(H) + lambd ** 2))),
         int(len(signal) // 2),
     )
     return deconvolved
@@ -1095,7 +1097,7 @@ def pspec(inputdata):
         The power spectrum of the input signal.
 
     """
-    S = fftpack.fft(inputdata)
+    S = tide_fft.fft(inputdata)
     return np.sqrt(S * np.conj(S))
 
 
@@ -1139,11 +1141,11 @@ def spectrum(inputdata, Fs=1.0, mode="power", trim=True):
         :param mode:
     """
     if trim:
-        specvals = fftpack.fft(inputdata)[0 : len(inputdata) // 2]
+        specvals = tide_fft.fft(inputdata)[0 : len(inputdata) // 2]
         maxfreq = Fs / 2.0
         specaxis = np.linspace(0.0, maxfreq, len(specvals), endpoint=False)
     else:
-        specvals = fftpack.fft(inputdata)
+        specvals = tide_fft.fft(inputdata)
         maxfreq = Fs
         specaxis = np.linspace(0.0, maxfreq, len(specvals), endpoint=False)
     if mode == "real":
@@ -1269,10 +1271,10 @@ def csdfilter(obsdata, commondata, padlen=20, cyclic=False, debug=False):
     """
     padobsdata = padvec(obsdata, padlen=padlen, cyclic=cyclic)
     padcommondata = padvec(commondata, padlen=padlen, cyclic=cyclic)
-    obsdata_trans = fftpack.fft(padobsdata)
-    transferfunc = np.sqrt(np.abs(fftpack.fft(padobsdata) * np.conj(fftpack.fft(padcommondata))))
+    obsdata_trans = tide_fft.fft(padobsdata)
+    transferfunc = np.sqrt(np.abs(tide_fft.fft(padobsdata) * np.conj(tide_fft.fft(padcommondata))))
     obsdata_trans *= transferfunc
-    return unpadvec(fftpack.ifft(obsdata_trans).real, padlen=padlen)
+    return unpadvec(tide_fft.ifft(obsdata_trans).real, padlen=padlen)
 
 
 @conditionaljit()
@@ -1484,6 +1486,8 @@ class NoncausalFilter:
             Return the current end pad time.
         setfreqs(lowerstop, lowerpass, upperpass, upperstop)
             Set the frequency parameters of the 'arb' and 'arb_stop' filter.
+        apply(Fs, data)
+            Filter a timecourse, or every row of a 2D array of timecourses.
         """
         self.filtertype = filtertype
         self.species = "human"
@@ -1510,6 +1514,7 @@ class NoncausalFilter:
         self.padtime = padtime
         self.cyclic = cyclic
         self.debug = debug
+        self.filtercache = {}
 
         self.VLF_UPPERPASS = 0.009
         self.VLF_UPPERSTOP = self.VLF_UPPERPASS * (1.0 + self.transitionfrac)
@@ -1644,12 +1649,12 @@ class NoncausalFilter:
         ----------
         Fs : float
             Sample frequency
-        data : 1D float array
-            The data to filter
+        data : 1D or 2D float array
+            The data to filter.  A 2D array is filtered along the last (time) axis.
 
         Returns
         -------
-        filtereddata : 1D float array
+        filtereddata : 1D or 2D float array
             The filtered data
         """
         # if filterband is None, just return the data
@@ -1658,7 +1663,7 @@ class NoncausalFilter:
 
         # do some bounds checking
         nyquistlimit = 0.5 * Fs
-        lowestfreq = 2.0 * Fs / np.shape(data)[0]
+        lowestfreq = 2.0 * Fs / np.shape(data)[-1]
 
         # first see if entire range is out of bounds
         if self.lowerpass >= nyquistlimit:
@@ -1741,7 +1746,7 @@ class NoncausalFilter:
                 sys.exit()
 
         if self.padtime < 0.0:
-            padlen = int(len(data) // 2)
+            padlen = int(np.shape(data)[-1] // 2)
         else:
             padlen = int(self.padtime * Fs)
         if self.debug:
@@ -1759,18 +1764,14 @@ class NoncausalFilter:
         if self.filtertype == "None":
             return data
         elif self.filtertype == "ringstop":
-            return arb_pass(
+            return self._arbpass(
                 Fs,
                 data,
                 0.0,
                 0.0,
                 Fs / 4.0,
                 1.1 * Fs / 4.0,
-                transferfunc=self.transferfunc,
-                butterorder=self.butterworthorder,
-                padlen=padlen,
-                cyclic=self.cyclic,
-                debug=self.debug,
+                padlen,
             )
         elif (
             self.filtertype == "vlf"
@@ -1779,18 +1780,14 @@ class NoncausalFilter:
             or self.filtertype == "resp"
             or self.filtertype == "cardiac"
         ):
-            return arb_pass(
+            return self._arbpass(
                 Fs,
                 data,
                 self.lowerstop,
                 self.lowerpass,
                 self.upperpass,
                 self.upperstop,
-                transferfunc=self.transferfunc,
-                butterorder=self.butterworthorder,
-                padlen=padlen,
-                cyclic=self.cyclic,
-                debug=self.debug,
+                padlen,
             )
         elif (
             self.filtertype == "vlf_stop"
@@ -1799,61 +1796,128 @@ class NoncausalFilter:
             or self.filtertype == "resp_stop"
             or self.filtertype == "cardiac_stop"
         ):
-            return data - arb_pass(
+            return data - self._arbpass(
                 Fs,
                 data,
                 self.lowerstop,
                 self.lowerpass,
                 self.upperpass,
                 self.upperstop,
-                transferfunc=self.transferfunc,
-                butterorder=self.butterworthorder,
-                padlen=padlen,
-                cyclic=self.cyclic,
-                debug=self.debug,
+                padlen,
             )
         elif self.filtertype == "arb":
-            return arb_pass(
+            return self._arbpass(
                 Fs,
                 data,
                 self.arb_lowerstop,
                 self.arb_lowerpass,
                 self.arb_upperpass,
                 self.arb_upperstop,
-                transferfunc=self.transferfunc,
-                butterorder=self.butterworthorder,
-                padlen=padlen,
-                cyclic=self.cyclic,
-                debug=self.debug,
+                padlen,
             )
         elif self.filtertype == "arb_stop":
-            return data - arb_pass(
+            return data - self._arbpass(
                 Fs,
                 data,
                 self.arb_lowerstop,
                 self.arb_lowerpass,
                 self.arb_upperpass,
                 self.arb_upperstop,
-                transferfunc=self.transferfunc,
-                butterorder=self.butterworthorder,
-                padlen=padlen,
-                cyclic=self.cyclic,
-                debug=self.debug,
+                padlen,
             )
         else:
             print("bad filter type")
             sys.exit()
 
+    def _getfilter(self, Fs, paddedlen, lowerstop, lowerpass, upperpass, upperstop):
+        # transfer functions and butterworth coefficients only depend on these, so build them
+        # once and reuse them for every timecourse of the same length
+        thekey = (
+            Fs,
+            paddedlen,
+            self.transferfunc,
+            self.butterworthorder,
+            lowerstop,
+            lowerpass,
+            upperpass,
+            upperstop,
+        )
+        try:
+            return self.filtercache[thekey]
+        except KeyError:
+            pass
+        if len(self.filtercache) >= 16:
+            self.filtercache.clear()
+
+        if self.transferfunc == "butterworth":
+            thefilter = []
+            if not ((upperpass >= Fs / 2.0) or (upperpass <= 0.0)) or (lowerpass <= 0.0):
+                thefilter.append(
+                    signal.butter(self.butterworthorder, 2.0 * min(upperpass, Fs / 2.0) / Fs)
+                )
+            if lowerpass > 0.0:
+                thefilter.append(
+                    signal.butter(self.butterworthorder, 2.0 * lowerpass / Fs, "highpass")
+                )
+        else:
+            # these are the same transfer functions arb_pass would use for this band
+            dummy = np.zeros(paddedlen, dtype=np.float64)
+            if lowerpass <= 0.0:
+                thefilter = getlptransfunc(
+                    Fs, dummy, upperpass=upperpass, upperstop=upperstop, type=self.transferfunc
+                )
+            elif (upperpass >= Fs / 2.0) or (upperpass <= 0.0):
+                thefilter = 1.0 - getlptransfunc(
+                    Fs, dummy, upperpass=lowerstop, upperstop=lowerpass, type=self.transferfunc
+                )
+            else:
+                thefilter = getlptransfunc(
+                    Fs, dummy, upperpass=upperpass, upperstop=upperstop, type=self.transferfunc
+                ) * gethptransfunc(
+                    Fs, dummy, lowerstop=lowerstop, lowerpass=lowerpass, type=self.transferfunc
+                )
+        self.filtercache[thekey] = thefilter
+        return thefilter
+
+    def _arbpass(self, Fs, data, lowerstop, lowerpass, upperpass, upperstop, padlen):
+        # equivalent to arb_pass, but works on every row of a 2D array in one call, and keeps
+        # single precision data in single precision
+        outtype = np.result_type(np.asarray(data).dtype, np.float32)
+        if padlen > 0:
+            paddedlen = np.shape(data)[-1] + 2 * padlen
+        else:
+            paddedlen = np.shape(data)[-1]
+        thefilter = self._getfilter(Fs, paddedlen, lowerstop, lowerpass, upperpass, upperstop)
+        if self.transferfunc == "butterworth":
+            filtereddata = data
+            for b, a in thefilter:
+                filtereddata = unpadvec(
+                    signal.filtfilt(
+                        b, a, padvec(filtereddata, padlen=padlen, cyclic=False), axis=-1
+                    ).real,
+                    padlen=padlen,
+                )
+            return filtereddata.astype(outtype)
+        else:
+            inputdata_trans = tide_fft.fft(
+                padvec(data, padlen=padlen, cyclic=self.cyclic), axis=-1
+            )
+            inputdata_trans *= thefilter
+            return unpadvec(
+                tide_fft.ifft(inputdata_trans, axis=-1).real.astype(outtype, copy=False),
+                padlen=padlen,
+            )
+
 
 # --------------------------- FFT helper functions ---------------------------------------------
 def polarfft(inputdata):
-    complexxform = fftpack.fft(inputdata)
+    complexxform = tide_fft.fft(inputdata)
     return np.abs(complexxform), np.angle(complexxform)
 
 
 def ifftfrompolar(r, theta):
     complexxform = r * np.exp(1j * theta)
-    return fftpack.ifft(complexxform).real
+    return tide_fft.ifft(complexxform).real
 
 
 # --------------------------- Window functions -------------------------------------------------
@@ -398,6 +398,73 @@ def detrend(inputdata, order=1, demean=False):
     return inputdata - thefittc
 
 
+detrendbases = {}
+
+
+def getdetrendbasis(length, order=1):
+    r"""Returns the polynomial basis used by detrendblock for timecourses of a given length.
+    Once calculated, bases are cached for speed.
+
+    Parameters
+    ----------
+    length : int
+        The number of timepoints
+    order : int, optional
+        The polynomial order.  Default is 1.
+
+    Returns
+    -------
+    thebasis : 2D float array
+        Legendre polynomials of order 0 to order, one per column, over the timecourse
+    theprojector : 2D float array
+        The pseudoinverse of thebasis - multiplying a timecourse by its transpose gives the
+        least squares fit coefficients
+    thecenter : 1D float array
+        The value of each polynomial at the center of the timecourse
+    """
+    try:
+        return detrendbases[(length, order)]
+    except KeyError:
+        # same centered time axis as detrend, scaled to [-1, 1) to keep the basis well conditioned
+        thetimepoints = (np.arange(0.0, length, 1.0) - length / 2.0) / (length / 2.0)
+        thebasis = np.polynomial.legendre.legvander(thetimepoints, order)
+        theprojector = np.linalg.pinv(thebasis)
+        thecenter = np.polynomial.legendre.legvander(np.array([0.0]), order)[0, :]
+        detrendbases[(length, order)] = (thebasis, theprojector, thecenter)
+        return detrendbases[(length, order)]
+
+
+def detrendblock(inputdata, order=1, demean=False):
+    r"""Removes a polynomial trend from each row of a 2D array (or from a 1D array) by
+    projecting out a cached polynomial basis.  Gives the same result as calling detrend on
+    each row.
+
+    Parameters
+    ----------
+    inputdata : 1D or 2D float array
+        The data to detrend.  2D arrays are detrended along the last (time) axis.
+    order : int, optional
+        The polynomial order of the trend.  Default is 1.
+    demean : bool, optional
+        If True, remove the mean as well as the trend.  Default is False.
+
+    Returns
+    -------
+    detrendeddata : 1D or 2D float array
+        The detrended data
+    """
+    thebasis, theprojector, thecenter = getdetrendbasis(np.shape(inputdata)[-1], order=order)
+
+    # do the arithmetic in the precision of the data (but at least single precision)
+    thetype = np.result_type(np.asarray(inputdata).dtype, np.float32)
+    thecoffs = inputdata @ theprojector.T.astype(thetype, copy=False)
+    detrendeddata = inputdata - thecoffs @ thebasis.T.astype(thetype, copy=False)
+    if not demean:
+        # put back the constant term of the fit, as detrend does
+        detrendeddata += (thecoffs @ thecenter.astype(thetype, copy=False))[..., np.newaxis]
+    return detrendeddata
+
+
 @conditionaljit()
 def findfirstabove(theyvals, thevalue):
     """
@@ -1414,6 +1481,262 @@ def gaussfit(height, loc, width, xvals, yvals):
     return plsq[0], plsq[1], plsq[2]
 
 
+def gaussfitblock(heights, locs, widths, xvals, yvals, valid=None, maxiter=1000, tol=1.49012e-8):
+    """Fit a gaussian to each row of yvals at once, with a batched Levenberg-Marquardt fit.
+
+    Each row is fit as gaussfit would fit it (least squares, starting from the given height,
+    location and width), but all the rows that are still converging take their steps together.
+
+    Parameters
+    ----------
+    heights, locs, widths : 1D arrays
+        The initial parameters for each row
+    xvals : 2D array
+        The x values of each row
+    yvals : 2D array
+        The y values of each row
+    valid : 2D bool array, optional
+        Which points of each row to fit (all of them if None)
+    maxiter : int, optional
+        The maximum number of iterations
+    tol : float, optional
+        A row has converged when a step changes its residual sum of squares, or its
+        parameters, by a relative amount less than this (the leastsq default)
+
+    Returns
+    -------
+    heights, locs, widths : 1D arrays
+        The fit parameters for each row
+    """
+    xvals = np.asarray(xvals, dtype=np.float64)
+    yvals = np.asarray(yvals, dtype=np.float64)
+    if valid is None:
+        weights = np.ones_like(yvals)
+    else:
+        weights = np.where(valid, 1.0, 0.0)
+    xvals = np.where(weights > 0.0, xvals, 0.0)
+    yvals = np.where(weights > 0.0, yvals, 0.0)
+    p = np.stack((heights, locs, widths), axis=1).astype(np.float64)
+    numrows = p.shape[0]
+
+    def _residuals(thep, therows):
+        thediff = xvals[therows] - thep[:, 1:2]
+        theexp = np.exp(-(thediff ** 2) / (2.0 * thep[:, 2:3] * thep[:, 2:3]))
+        return (yvals[therows] - thep[:, 0:1] * theexp) * weights[therows], thediff, theexp
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        resid, thediff, theexp = _residuals(p, np.arange(numrows))
+        cost = np.sum(resid * resid, axis=1)
+        damping = np.full(numrows, 1.0e-3)
+        dampinggrowth = np.full(numrows, 2.0)
+        scale = np.ones((numrows, 3), dtype=np.float64)
+        active = np.isfinite(cost) & np.all(np.isfinite(p), axis=1)
+        for i in range(maxiter):
+            therows = np.nonzero(active)[0]
+            if len(therows) == 0:
+                break
+            thep = p[therows]
+            theweights = weights[therows]
+
+            # the jacobian of the model for each row
+            thejac = np.empty(thediff[therows].shape + (3,), dtype=np.float64)
+            thejac[:, :, 0] = theexp[therows] * theweights
+            thejac[:, :, 1] = (
+                thep[:, 0:1] * theexp[therows] * thediff[therows] / (thep[:, 2:3] ** 2)
+            ) * theweights
+            thejac[:, :, 2] = (
+                thep[:, 0:1] * theexp[therows] * thediff[therows] ** 2 / (thep[:, 2:3] ** 3)
+            ) * theweights
+            jtj = np.einsum("nmi,nmj->nij", thejac, thejac)
+            jtr = np.einsum("nmi,nm->ni", thejac, resid[therows])
+
+            # like MINPACK, never let the scaling of a parameter shrink
+            scale[therows] = np.fmax(scale[therows], np.diagonal(jtj, axis1=1, axis2=2))
+            thedamping = damping[therows, None] * scale[therows]
+            themat = jtj + thedamping[:, :, None] * np.eye(3)
+            bad = ~(np.all(np.isfinite(themat), axis=(1, 2)) & np.all(np.isfinite(jtr), axis=1))
+            themat[bad] = np.eye(3)
+            thedet = np.linalg.det(themat)
+            bad |= ~(np.isfinite(thedet) & (thedet != 0.0))
+            themat[bad] = np.eye(3)
+            jtr[bad] = 0.0
+            thestep = np.linalg.solve(themat, jtr[:, :, None])[:, :, 0]
+
+            # keep the steps that help, and adjust the damping (Nielsen's rule)
+            newp = thep + thestep
+            newresid, newdiff, newexp = _residuals(newp, therows)
+            newcost = np.sum(newresid * newresid, axis=1)
+            predicted = np.sum(thestep * (thedamping * thestep + jtr), axis=1)
+            gain = (cost[therows] - newcost) / predicted
+            improved = ~bad & (newcost < cost[therows]) & (predicted > 0.0)
+            costchange = np.fabs(cost[therows] - newcost) <= tol * cost[therows]
+            stepchange = np.sqrt(np.sum(thestep * thestep, axis=1)) <= tol * (
+                np.sqrt(np.sum(thep * thep, axis=1)) + tol
+            )
+            converged = improved & (costchange | stepchange)
+
+            goodrows = therows[improved]
+            p[goodrows] = newp[improved]
+            resid[goodrows] = newresid[improved]
+            thediff[goodrows] = newdiff[improved]
+            theexp[goodrows] = newexp[improved]
+            cost[goodrows] = newcost[improved]
+            damping[goodrows] *= np.maximum(1.0 / 3.0, 1.0 - (2.0 * gain[improved] - 1.0) ** 3)
+            dampinggrowth[goodrows] = 2.0
+            badrows = therows[~improved]
+            damping[badrows] *= dampinggrowth[badrows]
+            dampinggrowth[badrows] *= 2.0
+            active[therows[converged | bad]] = False
+            active &= (damping < 1.0e16) & (cost > 0.0)
+    return p[:, 0], p[:, 1], p[:, 2]
+
+
+@conditionaljit()
+def _gaussloginit(xvals, yvals):
+    # closed form gaussian estimate from a parabola fit to log(y), weighting each point by
+    # y**2 so the noisy tails count for less (Caruana's method, as modified by Guo)
+    goodpoints = yvals > 0.0
+    if np.sum(goodpoints) < 3:
+        return 0.0, 0.0, 0.0, False
+    xgood = xvals[goodpoints]
+    ygood = yvals[goodpoints]
+    xmean = np.mean(xgood)
+    thebasis = np.ones((len(xgood), 3), dtype=np.float64)
+    thebasis[:, 1] = xgood - xmean
+    thebasis[:, 2] = thebasis[:, 1] * thebasis[:, 1]
+    weightedbasis = thebasis * (ygood * ygood).reshape((-1, 1))
+    themat = weightedbasis.T @ thebasis
+    thevec = weightedbasis.T @ np.log(ygood)
+    if np.abs(np.linalg.det(themat)) < 1.0e-300:
+        return 0.0, 0.0, 0.0, False
+    a, b, c = np.linalg.solve(themat, thevec)
+    if not (c < 0.0):
+        return 0.0, 0.0, 0.0, False
+    width = np.sqrt(-1.0 / (2.0 * c))
+    loc = -b / (2.0 * c)
+    height = np.exp(a - b * b / (4.0 * c))
+    return height, loc + xmean, width, True
+
+
+@conditionaljit()
+def _gausscost(xvals, yvals, height, loc, width):
+    theresid = yvals - height * np.exp(-((xvals - loc) ** 2) / (2.0 * width * width))
+    return np.sum(theresid * theresid)
+
+
+@conditionaljit()
+def _gaussfitlm(xvals, yvals, p0, lowerbounds, upperbounds, maxiter, tol):
+    # bounded Levenberg-Marquardt fit of a gaussian (height, loc, width) to yvals, with
+    # MINPACK style parameter scaling and Nielsen's damping update.  Steps that would leave
+    # the bounds are clipped back onto them.
+    p = np.minimum(np.maximum(p0, lowerbounds), upperbounds)
+    thejac = np.zeros((len(xvals), 3), dtype=np.float64)
+    scale = np.ones(3, dtype=np.float64)
+    damping = 1.0e-3
+    dampinggrowth = 2.0
+    cost = _gausscost(xvals, yvals, p[0], p[1], p[2])
+    for iteration in range(maxiter):
+        thediff = xvals - p[1]
+        theexp = np.exp(-(thediff * thediff) / (2.0 * p[2] * p[2]))
+        resid = yvals - p[0] * theexp
+        thejac[:, 0] = theexp
+        thejac[:, 1] = p[0] * theexp * thediff / (p[2] * p[2])
+        thejac[:, 2] = p[0] * theexp * thediff * thediff / (p[2] * p[2] * p[2])
+        jtj = thejac.T @ thejac
+        jtr = thejac.T @ resid
+        scale = np.maximum(scale, np.diag(jtj))
+        themat = jtj + np.diag(damping * scale)
+        if not np.all(np.isfinite(themat)) or np.abs(np.linalg.det(themat)) < 1.0e-300:
+            break
+        thestep = np.linalg.solve(themat, jtr)
+        newp = np.minimum(np.maximum(p + thestep, lowerbounds), upperbounds)
+        thestep = newp - p
+        newcost = _gausscost(xvals, yvals, newp[0], newp[1], newp[2])
+        predicted = np.sum(thestep * (damping * scale * thestep + jtr))
+        if (newcost < cost) and (predicted > 0.0):
+            gain = (cost - newcost) / predicted
+            converged = (cost - newcost <= tol * cost) or (
+                np.sqrt(np.sum(thestep * thestep)) <= tol * (np.sqrt(np.sum(p * p)) + tol)
+            )
+            p = newp
+            cost = newcost
+            damping *= max(1.0 / 3.0, 1.0 - (2.0 * gain - 1.0) ** 3)
+            dampinggrowth = 2.0
+            if converged or cost == 0.0:
+                break
+        else:
+            damping *= dampinggrowth
+            dampinggrowth *= 2.0
+            if damping > 1.0e16:
+                break
+    return p[0], p[1], p[2]
+
+
+def gaussfitlm(
+    xvals,
+    yvals,
+    height=None,
+    loc=None,
+    width=None,
+    loclims=None,
+    widthlims=None,
+    maxiter=200,
+    tol=1.49012e-8,
+):
+    """Fit a gaussian to yvals with a bounded Levenberg-Marquardt fit.
+
+    The starting point comes from a parabola fit to log(yvals) over the positive points,
+    unless that fails (in which case the given height, loc and width are used).
+
+    Parameters
+    ----------
+    xvals, yvals : 1D arrays
+        The points to fit
+    height, loc, width : float, optional
+        The fallback starting parameters.  If not given, they are taken from the maximum of
+        yvals and the span of xvals.
+    loclims, widthlims : tuple of floats, optional
+        The (lower, upper) limits on the location and width of the gaussian.  By default the
+        location may be anywhere within one span of xvals of the points, and the width may be
+        up to ten spans.
+    maxiter : int, optional
+        The maximum number of iterations
+    tol : float, optional
+        The fit has converged when a step changes the residual sum of squares, or the
+        parameters, by a relative amount less than this (the leastsq default)
+
+    Returns
+    -------
+    height, loc, width : float
+        The fit parameters
+    """
+    xvals = np.ascontiguousarray(xvals, dtype=np.float64)
+    yvals = np.ascontiguousarray(yvals, dtype=np.float64)
+    thespan = xvals[-1] - xvals[0]
+    if height is None:
+        height = yvals.max()
+    if loc is None:
+        loc = xvals[np.argmax(yvals)]
+    if width is None:
+        width = thespan / 2.355
+    if loclims is None:
+        loclims = (xvals[0] - thespan, xvals[-1] + thespan)
+    if widthlims is None:
+        widthlims = (1.0e-3 * thespan / len(xvals), 10.0 * thespan)
+    initheight, initloc, initwidth, success = _gaussloginit(xvals, yvals)
+    if success and np.isfinite(initheight):
+        height, loc, width = initheight, initloc, initwidth
+    return _gaussfitlm(
+        xvals,
+        yvals,
+        np.array([height, loc, width], dtype=np.float64),
+        np.array([-np.inf, loclims[0], widthlims[0]], dtype=np.float64),
+        np.array([np.inf, loclims[1], widthlims[1]], dtype=np.float64),
+        maxiter,
+        tol,
+    )
+
+
 def gram_schmidt(theregressors, debug=False):
     if debug:
         print("gram_schmidt, input dimensions:", theregressors.shape)
@@ -1481,14 +1804,16 @@ def mlregress(x, y, intercept=True):
                 "x and y must have have the same number of samples (%d and %d)" % (nx, n)
             )
 
+    # solve in the precision of the data (but at least single precision)
+    thetype = np.result_type(x.dtype, y.dtype, np.float32)
     if intercept is True:
-        xc = np.vstack((np.ones(n), x))
+        xc = np.vstack((np.ones(n, dtype=thetype), x)).astype(thetype, copy=False)
         beta = np.ones(p + 1)
     else:
-        xc = x
+        xc = x.astype(thetype, copy=False)
         beta = np.ones(p)
 
-    solution = np.linalg.lstsq(np.mat(xc).T, np.mat(y).T, rcond=-1)
+    solution = np.linalg.lstsq(xc.T, y.astype(thetype, copy=False).reshape((n, 1)), rcond=-1)
 
     # Computation of the coefficient of determination.
     Rx = np.atleast_2d(np.corrcoef(x, rowvar=1))
@@ -1554,6 +1879,59 @@ def getpeaks(xvals, yvals, xrange=None, bipolar=False, display=False):
     return procpeaks
 
 
+def getpeaksblock(xvals, yblock, xrange=None, bipolar=False):
+    """Find the peaks of each row of yblock, as getpeaks does for a single function.
+
+    The local maxima (and minima, if bipolar) of all the rows are found at once.  Rows with
+    repeated adjacent values (where find_peaks looks for flat topped peaks) or non-finite
+    values are passed to getpeaks.
+
+    Returns
+    -------
+    peaklists : list
+        The getpeaks result for each row of yblock
+    """
+    yblock = np.asarray(yblock)
+    if xrange is None:
+        lagmin = xvals[0]
+        lagmax = xvals[-1]
+    else:
+        lagmin = xrange[0]
+        lagmax = xrange[1]
+    inrange = (lagmin <= xvals) & (xvals <= lagmax)
+    originloc = tide_util.valtoindex(xvals, 0.0, discrete=False)
+    offsets = [tide_util.valtoindex(xvals, thex, discrete=False) - originloc for thex in xvals]
+
+    # strict local maxima, with find_peaks' height=0 threshold
+    interior = yblock[:, 1:-1]
+    posmask = np.zeros(yblock.shape, dtype=bool)
+    posmask[:, 1:-1] = (interior > yblock[:, :-2]) & (interior > yblock[:, 2:])
+    posmask &= inrange
+    if bipolar:
+        posmask &= yblock >= 0.0
+        negmask = np.zeros(yblock.shape, dtype=bool)
+        negmask[:, 1:-1] = (interior < yblock[:, :-2]) & (interior < yblock[:, 2:])
+        negmask &= inrange & (yblock <= 0.0)
+    else:
+        posmask &= yblock > 0.0
+    slowrows = np.any(np.diff(yblock, axis=1) == 0.0, axis=1) | ~np.all(
+        np.isfinite(yblock), axis=1
+    )
+
+    peaklists = []
+    for i in range(yblock.shape[0]):
+        if slowrows[i]:
+            peaklists.append(getpeaks(xvals, yblock[i, :], xrange=xrange, bipolar=bipolar))
+            continue
+        peaks = np.nonzero(posmask[i, :])[0]
+        if bipolar:
+            peaks = np.concatenate((peaks, np.nonzero(negmask[i, :])[0]))
+        peaklists.append(
+            [[xvals[thepeak], yblock[i, thepeak], offsets[thepeak]] for thepeak in peaks]
+        )
+    return peaklists
+
+
 def parabfit(x_axis, y_axis, peakloc, points):
     """
 
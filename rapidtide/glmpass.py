@@ -47,6 +47,83 @@ def _procOneItemGLM(vox, theevs, thedata, rt_floatset=np.float64, rt_floattype="
     )
 
 
+def _procItemBlockGLM(blockstate, startidx, endidx):
+    # fit a contiguous range of voxels (or timepoints), writing directly into the (shared)
+    # output arrays
+    themask = blockstate["themask"]
+    theevs = blockstate["theevs"]
+    fmri_data = blockstate["fmri_data"]
+    blocktotal = 0
+    for idx in range(startidx, endidx):
+        if (themask is not None) and (themask[idx] == 0):
+            continue
+        if blockstate["procbyvoxel"]:
+            (
+                dummy,
+                blockstate["meanvalue"][idx],
+                blockstate["rvalue"][idx],
+                blockstate["r2value"][idx],
+                blockstate["fitcoeff"][idx],
+                blockstate["fitNorm"][idx],
+                blockstate["datatoremove"][idx, :],
+                blockstate["filtereddata"][idx, :],
+            ) = _procOneItemGLM(
+                idx,
+                theevs[idx, :],
+                fmri_data[idx, :],
+                rt_floatset=blockstate["rt_floatset"],
+                rt_floattype=blockstate["rt_floattype"],
+            )
+        else:
+            (
+                dummy,
+                blockstate["meanvalue"][idx],
+                blockstate["rvalue"][idx],
+                blockstate["r2value"][idx],
+                blockstate["fitcoeff"][idx],
+                blockstate["fitNorm"][idx],
+                blockstate["datatoremove"][:, idx],
+                blockstate["filtereddata"][:, idx],
+            ) = _procOneItemGLM(
+                idx,
+                theevs[:, idx],
+                fmri_data[:, idx],
+                rt_floatset=blockstate["rt_floatset"],
+                rt_floattype=blockstate["rt_floattype"],
+            )
+        blocktotal += 1
+    return blocktotal
+
+
+def _clearfailedGLM(
+    faileditems,
+    procbyvoxel,
+    fmri_data,
+    meanvalue,
+    rvalue,
+    r2value,
+    fitcoeff,
+    fitNorm,
+    datatoremove,
+    filtereddata,
+):
+    # items that could not be processed are passed through unfiltered
+    if len(faileditems) == 0:
+        return
+    print(f"glmpass: could not process {len(faileditems)} items - passing them through")
+    meanvalue[faileditems] = 0.0
+    rvalue[faileditems] = 0.0
+    r2value[faileditems] = 0.0
+    fitcoeff[faileditems] = 0.0
+    fitNorm[faileditems] = 0.0
+    if procbyvoxel:
+        datatoremove[faileditems, :] = 0.0
+        filtereddata[faileditems, :] = fmri_data[faileditems, :]
+    else:
+        datatoremove[:, faileditems] = 0.0
+        filtereddata[:, faileditems] = fmri_data[:, faileditems]
+
+
 def glmpass(
     numprocitems,
     fmri_data,
@@ -65,6 +142,8 @@ def glmpass(
     procbyvoxel=True,
     showprogressbar=True,
     mp_chunksize=1000,
+    blockmode=False,
+    pool=None,
     rt_floatset=np.float64,
     rt_floattype="float64",
 ):
@@ -82,7 +161,73 @@ def glmpass(
             themask = np.where(meanim > threshval, 1, 0)
         else:
             themask = np.where(stdim > threshval, 1, 0)
-    if (
+    if (nprocs > 1 or alwaysmultiproc) and (blockmode or pool is not None):
+        blockstate = {
+            "themask": themask,
+            "procbyvoxel": procbyvoxel,
+            "theevs": theevs,
+            "fmri_data": fmri_data,
+            "meanvalue": meanvalue,
+            "rvalue": rvalue,
+            "r2value": r2value,
+            "fitcoeff": fitcoeff,
+            "fitNorm": fitNorm,
+            "datatoremove": datatoremove,
+            "filtereddata": filtereddata,
+            "rt_floatset": rt_floatset,
+            "rt_floattype": rt_floattype,
+        }
+        if pool is not None:
+            data_out = pool.run_blocks(
+                _procItemBlockGLM,
+                blockstate,
+                inputshape,
+                themask,
+                procbyvoxel=procbyvoxel,
+                showprogressbar=showprogressbar,
+                blocksize=mp_chunksize,
+                sharedkeys=[
+                    "theevs",
+                    "fmri_data",
+                    "meanvalue",
+                    "rvalue",
+                    "r2value",
+                    "fitcoeff",
+                    "fitNorm",
+                    "datatoremove",
+                    "filtereddata",
+                ],
+            )
+        else:
+            data_out = tide_multiproc.run_multiproc_blocks(
+                _procItemBlockGLM,
+                blockstate,
+                inputshape,
+                themask,
+                nprocs=nprocs,
+                procbyvoxel=procbyvoxel,
+                showprogressbar=showprogressbar,
+                blocksize=mp_chunksize,
+            )
+
+        # tally the status records
+        itemstotal = 0
+        for startidx, endidx, blocktotal in data_out:
+            itemstotal += blocktotal
+        del data_out
+        _clearfailedGLM(
+            tide_multiproc.getfaileditems(),
+            procbyvoxel,
+            fmri_data,
+            meanvalue,
+            rvalue,
+            r2value,
+            fitcoeff,
+            fitNorm,
+            datatoremove,
+            filtereddata,
+        )
+    elif (
         nprocs > 1 or alwaysmultiproc
     ):  # temporary workaround until I figure out why nprocs > 1 is failing
         # define the consumer function here so it inherits most of the arguments
@@ -119,8 +264,7 @@ def glmpass(
                         )
 
                 except Exception as e:
-                    print("error!", e)
-                    break
+                    outQ.put(tide_multiproc.WorkerFailure(val, e))
 
         data_out = tide_multiproc.run_multiproc(
             GLM_consumer,
@@ -156,6 +300,18 @@ def glmpass(
                 itemstotal += 1
 
         del data_out
+        _clearfailedGLM(
+            tide_multiproc.getfaileditems(),
+            procbyvoxel,
+            fmri_data,
+            meanvalue,
+            rvalue,
+            r2value,
+            fitcoeff,
+            fitNorm,
+            datatoremove,
+            filtereddata,
+        )
     else:
         itemstotal = 0
         if procbyvoxel:
@@ -245,8 +401,7 @@ def motionregress(
         if motionhp is None:
             motionhp = 0.0
         mothpfilt.setfreqs(0.9 * motionhp, motionhp, motionlp, np.min([0.5 / tr, motionlp * 1.1]))
-        for i in range(motionregressors.shape[0]):
-            motionregressors[i, :] = mothpfilt.apply(1.0 / tr, motionregressors[i, :])
+        motionregressors = mothpfilt.apply(1.0 / tr, motionregressors)
     if orthogonalize:
         motionregressors = tide_fit.gram_schmidt(motionregressors)
         initregressors = len(motionregressorlabels)
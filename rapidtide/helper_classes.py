@@ -190,6 +190,15 @@ class SimilarityFunctionator:
             )
         return thenormtc
 
+    def prepblock(self, data2d):
+        # prep a block of timecourses, one per row, as preptc would - all rows at once
+        filteredblock = self.ncprefilter.apply(self.Fs, data2d)
+        if self.negativegradient:
+            filteredblock = -np.gradient(filteredblock, axis=1)
+        return tide_math.corrnormalizeblock(
+            filteredblock, detrendorder=self.detrendorder, windowfunc=self.windowfunc
+        )
+
     def trim(self, vector):
         return vector[
             self.similarityfuncorigin
@@ -197,6 +206,16 @@ class SimilarityFunctionator:
             + self.lagmaxinpts
         ]
 
+    def run_block(self, data2d, trim=True):
+        # generic version - calculate the similarity function for each row in turn
+        thesimfuncs = []
+        theglobalmaxes = []
+        for i in range(np.shape(data2d)[0]):
+            thesimfunc, thetimeaxis, theglobalmax = self.run(data2d[i, :], trim=trim)
+            thesimfuncs.append(thesimfunc)
+            theglobalmaxes.append(theglobalmax)
+        return np.asarray(thesimfuncs), thetimeaxis, np.asarray(theglobalmaxes)
+
     def getfunction(self, trim=True):
         if self.datavalid:
             if trim:
@@ -361,17 +380,131 @@ class MutualInformationator(SimilarityFunctionator):
         else:
             return self.thesimfunc, self.timeaxis, self.theglobalmax
 
+    def run_block(self, data2d, locs=None, trim=True):
+        """Calculate the cross mutual information of each row of data2d with the reference.
+
+        The rows are prepped together, and their joint histograms at every lag are built in
+        one pass by tide_corr.cross_mutual_info_block, rather than one voxel at a time.
+
+        If locs is given (1D, or 2D with a row of offsets for each row of data2d), only the
+        values at those offsets are calculated, and they are all that is returned, as in run.
+
+        Returns
+        -------
+        thesimfuncs : 2D array
+            The similarity function for each row
+        timeaxis : 1D array
+            The time axis of the similarity functions
+        theglobalmaxes : 1D int array
+            The index of the maximum of each (untrimmed) similarity function
+        """
+        if np.shape(data2d)[1] != len(self.reftc):
+            print(
+                "timecourses are of different sizes:",
+                np.shape(data2d)[1],
+                "!=",
+                len(self.reftc),
+                "- exiting",
+            )
+            sys.exit()
+
+        preptestblock = self.prepblock(data2d)
+        if locs is not None:
+            return tide_corr.cross_mutual_info_block(
+                preptestblock,
+                self.prepreftc,
+                norm=self.norm,
+                locs=locs,
+                madnorm=self.madnorm,
+                sigma=self.sigma,
+                bins=self.bins,
+            )
+
+        if trim:
+            negsteps, possteps = self.lagmininpts, self.lagmaxinpts
+        else:
+            negsteps, possteps = -1, -1
+        self.timeaxis, thesimfuncs, dummy = tide_corr.cross_mutual_info_block(
+            preptestblock,
+            self.prepreftc,
+            norm=self.norm,
+            negsteps=negsteps,
+            possteps=possteps,
+            madnorm=self.madnorm,
+            returnaxis=True,
+            Fs=self.Fs,
+            sigma=self.sigma,
+            bins=self.bins,
+        )
+        self.timeaxisvalid = True
+
+        if self.smoothingtime > 0.0:
+            thesimfuncs = self.smoothingfilter.apply(self.Fs, thesimfuncs)
+
+        self.similarityfunclen = thesimfuncs.shape[1]
+        if trim:
+            self.similarityfuncorigin = self.lagmininpts + 1
+        else:
+            self.similarityfuncorigin = self.similarityfunclen // 2 + 1
+        theglobalmaxes = np.argmax(thesimfuncs, axis=1)
+
+        if trim:
+            return (
+                thesimfuncs[
+                    :,
+                    self.similarityfuncorigin
+                    - self.lagmininpts : self.similarityfuncorigin
+                    + self.lagmaxinpts,
+                ],
+                self.trim(self.timeaxis),
+                theglobalmaxes,
+            )
+        else:
+            return thesimfuncs, self.timeaxis, theglobalmaxes
+
 
 class Correlator(SimilarityFunctionator):
-    def __init__(self, windowfunc="hamming", corrweighting="None", corrpadding=0, *args, **kwargs):
+    def __init__(
+        self,
+        windowfunc="hamming",
+        corrweighting="None",
+        corrpadding=0,
+        lagmethod="auto",
+        *args,
+        **kwargs,
+    ):
         self.windowfunc = windowfunc
         self.corrweighting = corrweighting
         self.corrpadding = corrpadding
+        self.lagplan = None
+        self.setlagmethod(lagmethod)
         super(Correlator, self).__init__(*args, **kwargs)
 
     def setlimits(self, lagmininpts, lagmaxinpts):
         self.lagmininpts = lagmininpts
         self.lagmaxinpts = lagmaxinpts
+        self.lagplan = None
+
+    def setlagmethod(self, lagmethod):
+        # how run_block calculates trimmed correlations: "fft" calculates every lag, "direct"
+        # multiplies by a matrix of lagged references to get only the lags in the search
+        # range, and "auto" picks whichever is cheaper.  "direct" only applies to unweighted
+        # correlations, and the global maxima it returns are within the search range.
+        if lagmethod not in ["auto", "fft", "direct"]:
+            print("illegal lag method", lagmethod, "- exiting")
+            sys.exit()
+        self.lagmethod = lagmethod
+
+    def uselaggedcorrelation(self, numlags=None):
+        if self.corrweighting != "None" or self.lagmethod == "fft":
+            return False
+        if self.lagmethod == "direct":
+            return True
+        if numlags is None:
+            numlags = self.lagmininpts + self.lagmaxinpts
+        return tide_corr.directcorrelationischeaper(
+            len(self.reftc), numlags, self.refplan["fftlen"]
+        )
 
     def setreftc(self, reftc, offset=0.0):
         self.reftc = reftc + 0.0
@@ -379,6 +512,12 @@ class Correlator(SimilarityFunctionator):
         self.similarityfunclen = len(self.reftc) * 2 - 1
         self.similarityfuncorigin = self.similarityfunclen // 2 + 1
 
+        # the reference spectrum only needs to be calculated once for run_block
+        self.refplan = tide_corr.blockcorrelateplan(
+            self.prepreftc, zeropadding=self.corrpadding, weighting=self.corrweighting
+        )
+        self.lagplan = None
+
         # make the reference time axis
         self.timeaxis = (
             np.arange(0.0, self.similarityfunclen) * (1.0 / self.Fs)
@@ -387,7 +526,7 @@ class Correlator(SimilarityFunctionator):
         self.timeaxisvalid = True
         self.datavalid = False
 
-    def run(self, thetc, trim=True):
+    def run(self, thetc, trim=True, prepped=False):
         if len(thetc) != len(self.reftc):
             print(
                 "timecourses are of different sizes:",
@@ -399,7 +538,10 @@ class Correlator(SimilarityFunctionator):
             sys.exit()
 
         self.testtc = thetc
-        self.preptesttc = self.preptc(self.testtc)
+        if prepped:
+            self.preptesttc = thetc
+        else:
+            self.preptesttc = self.preptc(self.testtc)
 
         # now actually do the correlation
         self.thesimfunc = tide_corr.fastcorrelate(
@@ -426,6 +568,101 @@ class Correlator(SimilarityFunctionator):
         else:
             return self.thesimfunc, self.timeaxis, self.theglobalmax
 
+    def run_block(self, data2d, trim=True, prepped=False, lagrange=None):
+        """Correlate a block of timecourses (one per row) with the reference.
+
+        Each row is prepped as in run (unless prepped is True, in which case the rows have
+        already been through prepblock), then the whole block is correlated in one set of
+        FFTs against the reference spectrum calculated in setreftc, or, if only the search
+        range is wanted and it is cheaper (see setlagmethod), with one multiplication by a
+        matrix of lagged copies of the reference.
+
+        If lagrange is given (with trim), it is a (start, end) range of indices into the
+        trimmed similarity function, and only those lags are calculated - the rest are zero.
+
+        Returns
+        -------
+        thesimfuncs : 2D array
+            The similarity function for each row
+        timeaxis : 1D array
+            The time axis of the similarity functions
+        theglobalmaxes : 1D int array
+            The index of the maximum of each (untrimmed) similarity function (of the
+            search range, if the lagged method was used)
+        """
+        if np.shape(data2d)[1] != len(self.reftc):
+            print(
+                "timecourses are of different sizes:",
+                np.shape(data2d)[1],
+                "!=",
+                len(self.reftc),
+                "- exiting",
+            )
+            sys.exit()
+
+        if prepped:
+            preptestblock = data2d
+        else:
+            preptestblock = self.prepblock(data2d)
+
+        trimstart = self.similarityfuncorigin - self.lagmininpts
+        if trim and lagrange is not None:
+            rangestart, rangeend = lagrange
+            numlags = rangeend - rangestart
+        else:
+            rangestart = 0
+            numlags = self.lagmininpts + self.lagmaxinpts
+        if trim and self.uselaggedcorrelation(numlags=numlags):
+            # only calculate the lags we are going to keep
+            if self.lagplan is None:
+                minshift = trimstart - (len(self.reftc) - 1)
+                self.lagplan = tide_corr.laggedcorrelateplan(
+                    self.prepreftc, minshift, minshift + self.lagmininpts + self.lagmaxinpts - 1
+                )
+            if lagrange is None:
+                thesimfuncs = tide_corr.laggedcorrelate(preptestblock, self.lagplan)
+            else:
+                thesimfuncs = np.zeros(
+                    (preptestblock.shape[0], self.lagmininpts + self.lagmaxinpts),
+                    dtype=np.result_type(preptestblock.dtype, np.float32),
+                )
+                thesimfuncs[:, rangestart : rangestart + numlags] = tide_corr.laggedcorrelate(
+                    preptestblock, self.lagplan, shiftrange=lagrange
+                )
+            return (
+                thesimfuncs,
+                self.trim(self.timeaxis),
+                np.argmax(thesimfuncs[:, rangestart : rangestart + numlags], axis=1)
+                + trimstart
+                + rangestart,
+            )
+
+        thesimfuncs = tide_corr.blockcorrelate(preptestblock, self.refplan)
+        theglobalmaxes = np.argmax(thesimfuncs, axis=1)
+
+        if trim:
+            thesimfuncs = thesimfuncs[
+                :,
+                self.similarityfuncorigin
+                - self.lagmininpts : self.similarityfuncorigin
+                + self.lagmaxinpts,
+            ]
+            if lagrange is not None:
+                thesimfuncs[:, : lagrange[0]] = 0.0
+                thesimfuncs[:, lagrange[1] :] = 0.0
+                theglobalmaxes = (
+                    np.argmax(thesimfuncs[:, lagrange[0] : lagrange[1]], axis=1)
+                    + trimstart
+                    + lagrange[0]
+                )
+            return (
+                thesimfuncs,
+                self.trim(self.timeaxis),
+                theglobalmaxes,
+            )
+        else:
+            return thesimfuncs, self.timeaxis, theglobalmaxes
+
 
 class Coherer:
     reftc = None
@@ -645,6 +882,9 @@ class SimilarityFunctionFitter:
         | FML_FITLAGHIGH
     )
 
+    # the voxel could not be processed at all (the worker raised an exception or died)
+    FML_WORKERFAIL = np.uint32(0x4000)
+
     def __init__(
         self,
         corrtimeaxis=None,
@@ -743,27 +983,8 @@ class SimilarityFunctionFitter:
         -------
 
         """
-        lowerlim = 0
-        upperlim = len(self.corrtimeaxis) - 1
-        done = False
-        while not done:
-            flipfac = 1.0
-            done = True
-            maxindex = (np.argmax(corrfunc[lowerlim:upperlim]) + lowerlim).astype("int32")
-            if self.bipolar:
-                minindex = (np.argmax(-corrfunc[lowerlim:upperlim]) + lowerlim).astype("int32")
-                if np.fabs(corrfunc[minindex]) > np.fabs(corrfunc[maxindex]):
-                    maxindex = minindex
-                    flipfac = -1.0
-            if upperlim == lowerlim:
-                done = True
-            if maxindex == 0:
-                lowerlim += 1
-                done = False
-            if maxindex == upperlim:
-                upperlim -= 1
-                done = False
-        return maxindex, flipfac
+        maxindex, flipfac = self._maxindex_noedge_block(corrfunc[None, :])
+        return maxindex[0], flipfac[0]
 
     def setfunctype(self, functype):
         self.functype = functype
@@ -893,57 +1114,17 @@ class SimilarityFunctionFitter:
             print("baseline, baselinedev:", baseline, baselinedev)
 
         # then calculate the width of the peak
-        if self.peakfittype == "fastquad" or self.peakfittype == "COM":
-            peakstart = np.max([1, maxindex - 2])
-            peakend = np.min([len(self.corrtimeaxis) - 2, maxindex + 2])
-        else:
-            thegrad = np.gradient(corrfunc).astype(
-                "float64"
-            )  # the gradient of the correlation function
-            if (self.functype == "correlation") or (self.functype == "hybrid"):
-                if self.peakfittype == "quad":
-                    peakpoints = np.where(
-                        corrfunc > maxval_init - 0.05, 1, 0
-                    )  # mask for places where correlation exceeds searchfrac*maxval_init
-                else:
-                    peakpoints = np.where(
-                        corrfunc > self.searchfrac * maxval_init, 1, 0
-                    )  # mask for places where correlation exceeds searchfrac*maxval_init
-            else:
-                # for mutual information, there is a flattish, nonzero baseline, so we want the difference from that.
-                peakpoints = np.where(
-                    corrfunc > (baseline + self.searchfrac * (maxval_init - baseline)), 1, 0,
-                )
-
-            peakpoints[0] = 0
-            peakpoints[-1] = 0
-            peakstart = np.max([1, maxindex - 1])
-            peakend = np.min([len(self.corrtimeaxis) - 2, maxindex + 1])
-            if self.debug:
-                print("initial peakstart, peakend:", peakstart, peakend)
-            if self.functype == "mutualinfo":
-                while peakpoints[peakend + 1] == 1:
-                    peakend += 1
-                while peakpoints[peakstart - 1] == 1:
-                    peakstart -= 1
-            else:
-                while thegrad[peakend + 1] <= 0.0 and peakpoints[peakend + 1] == 1:
-                    peakend += 1
-                while thegrad[peakstart - 1] >= 0.0 and peakpoints[peakstart - 1] == 1:
-                    peakstart -= 1
-            if self.debug:
-                print("final peakstart, peakend:", peakstart, peakend)
-
-            # deal with flat peak top
-            while (
-                peakend < (len(self.corrtimeaxis) - 3)
-                and corrfunc[peakend] == corrfunc[peakend - 1]
-            ):
-                peakend += 1
-            while peakstart > 2 and corrfunc[peakstart] == corrfunc[peakstart + 1]:
-                peakstart -= 1
+        peakstart, peakend = self._peakrange_block(
+            corrfunc[None, :],
+            np.atleast_1d(maxindex),
+            np.atleast_1d(maxval_init),
+            np.atleast_1d(baseline),
+        )
+        peakstart = peakstart[0]
+        peakend = peakend[0]
+        if self.peakfittype != "fastquad" and self.peakfittype != "COM":
             if self.debug:
-                print("peakstart, peakend after flattop correction:", peakstart, peakend)
+                print("peakstart, peakend:", peakstart, peakend)
                 print("\n")
                 for i in range(peakstart, peakend + 1):
                     print(self.corrtimeaxis[i], corrfunc[i])
@@ -958,71 +1139,25 @@ class SimilarityFunctionFitter:
                 )
                 plt.show()
 
-            # This is calculated from first principles, but it's always big by a factor or ~1.4.
-            #     Which makes me think I dropped a factor if sqrt(2).  So fix that with a final division
-            maxsigma_init = np.float64(
-                ((peakend - peakstart + 1) * binwidth / (2.0 * np.sqrt(-np.log(self.searchfrac))))
-                / np.sqrt(2.0)
-            )
+            # now check the values for errors
+            theinits = [np.atleast_1d(np.float64(x)) for x in (maxlag_init, maxval_init)]
+            thefailreason = np.atleast_1d(failreason)
+            maxsigma_init = self._initchecks_block(
+                theinits[0],
+                theinits[1],
+                np.atleast_1d(peakstart),
+                np.atleast_1d(peakend),
+                np.atleast_1d(baseline),
+                np.atleast_1d(baselinedev),
+                thefailreason,
+            )[0]
+            maxlag_init = theinits[0][0]
+            maxval_init = theinits[1][0]
+            failreason = thefailreason[0]
             if self.debug:
                 print("maxsigma_init:", maxsigma_init)
-
-            # now check the values for errors
-            if self.hardlimit:
-                rangeextension = 0.0
-            else:
-                rangeextension = (self.lagmax - self.lagmin) * 0.75
-            if not (
-                (self.lagmin - rangeextension - binwidth)
-                <= maxlag_init
-                <= (self.lagmax + rangeextension + binwidth)
-            ):
-                if maxlag_init <= (self.lagmin - rangeextension - binwidth):
-                    failreason |= self.FML_INITLAGLOW
-                    maxlag_init = self.lagmin - rangeextension - binwidth
-                else:
-                    failreason |= self.FML_INITLAGHIGH
-                    maxlag_init = self.lagmax + rangeextension + binwidth
-                if self.debug:
-                    print("bad initial")
-            if maxsigma_init > self.absmaxsigma:
-                failreason |= self.FML_INITWIDTHHIGH
-                maxsigma_init = self.absmaxsigma
-                if self.debug:
-                    print("bad initial width - too high")
-            if peakend - peakstart < 2:
-                failreason |= self.FML_INITWIDTHLOW
-                maxsigma_init = np.float64(
-                    ((2 + 1) * binwidth / (2.0 * np.sqrt(-np.log(self.searchfrac)))) / np.sqrt(2.0)
-                )
-                if self.debug:
-                    print("bad initial width - too low")
-            if (self.functype == "correlation") or (self.functype == "hybrid"):
-                if not (self.lthreshval <= maxval_init <= self.uthreshval) and self.enforcethresh:
-                    failreason |= self.FML_INITAMPLOW
-                    if self.debug:
-                        print(
-                            "bad initial amp:", maxval_init, "is less than", self.lthreshval,
-                        )
-                if maxval_init < 0.0:
-                    failreason |= self.FML_INITAMPLOW
-                    maxval_init = 0.0
-                    if self.debug:
-                        print("bad initial amp:", maxval_init, "is less than 0.0")
-                if maxval_init > 1.0:
-                    failreason |= self.FML_INITAMPHIGH
-                    maxval_init = 1.0
-                    if self.debug:
-                        print("bad initial amp:", maxval_init, "is greater than 1.0")
-            else:
-                # somewhat different rules for mutual information peaks
-                if ((maxval_init - baseline) < self.lthreshval * baselinedev) or (
-                    maxval_init < baseline
-                ):
-                    failreason |= self.FML_INITAMPLOW
-                    maxval_init = 0.0
-                    if self.debug:
-                        print("bad initial amp:", maxval_init, "is less than 0.0")
+                if failreason != self.FML_NOERROR:
+                    print("bad initial values:", self.diagnosefail(failreason))
             if (failreason != self.FML_NOERROR) and self.zerooutbadfit:
                 maxval = np.float64(0.0)
                 maxlag = np.float64(0.0)
@@ -1061,6 +1196,30 @@ class SimilarityFunctionFitter:
                     maxsigma = np.float64(0.0)
                 if self.debug:
                     print("fit output array:", [maxval, maxlag, maxsigma])
+            elif self.peakfittype == "gausslm":
+                X = self.corrtimeaxis[peakstart : peakend + 1] - baseline
+                data = corrfunc[peakstart : peakend + 1]
+                # do a bounded least squares fit over the top of the peak.  The
+                # bounds lie just outside the allowed lags and widths, so a fit that runs into
+                # one still fails the checks below.
+                if len(X) >= 3:
+                    fitheight, maxlag, maxsigma = tide_fit.gaussfitlm(
+                        X,
+                        data,
+                        height=maxval_init,
+                        loc=maxlag_init,
+                        width=maxsigma_init,
+                        loclims=(self.lagmin - binwidth, self.lagmax + binwidth),
+                        widthlims=(0.5 * self.absminsigma, 2.0 * self.absmaxsigma),
+                    )
+                    maxval = fitheight + baseline
+                    maxlag = np.fmod((1.0 * maxlag), self.lagmod)
+                else:
+                    maxval = np.float64(0.0)
+                    maxlag = np.float64(0.0)
+                    maxsigma = np.float64(0.0)
+                if self.debug:
+                    print("fit output array:", [maxval, maxlag, maxsigma])
             elif self.peakfittype == "fastgauss":
                 X = self.corrtimeaxis[peakstart : peakend + 1] - baseline
                 data = corrfunc[peakstart : peakend + 1]
@@ -1109,75 +1268,22 @@ class SimilarityFunctionFitter:
                 print("illegal peak refinement type")
 
             # check for errors in fit
-            fitfail = False
-            if self.bipolar:
-                lowestcorrcoeff = -1.0
-            else:
-                lowestcorrcoeff = 0.0
-            if (self.functype == "correlation") or (self.functype == "hybrid"):
-                if maxval < lowestcorrcoeff:
-                    failreason |= self.FML_FITAMPLOW
-                    maxval = lowestcorrcoeff
-                    if self.debug:
-                        print("bad fit amp: maxval is lower than lower limit")
-                    fitfail = True
-                if np.abs(maxval) > 1.0:
-                    if not self.allowhighfitamps:
-                        failreason |= self.FML_FITAMPHIGH
-                        if self.debug:
-                            print(
-                                "bad fit amp: magnitude of", maxval, "is greater than 1.0",
-                            )
-                        fitfail = True
-                    maxval = 1.0 * np.sign(maxval)
-            else:
-                # different rules for mutual information peaks
-                if ((maxval - baseline) < self.lthreshval * baselinedev) or (maxval < baseline):
-                    failreason |= self.FML_FITAMPLOW
-                    if self.debug:
-                        if (maxval - baseline) < self.lthreshval * baselinedev:
-                            print(
-                                "FITAMPLOW: maxval - baseline:",
-                                maxval - baseline,
-                                " < lthreshval * baselinedev:",
-                                self.lthreshval * baselinedev,
-                            )
-                        if maxval < baseline:
-                            print("FITAMPLOW: maxval < baseline:", maxval, baseline)
-                    maxval_init = 0.0
-                    if self.debug:
-                        print("bad fit amp: maxval is lower than lower limit")
-            if (self.lagmin > maxlag) or (maxlag > self.lagmax):
-                if self.debug:
-                    print("bad lag after refinement")
-                if self.lagmin > maxlag:
-                    failreason |= self.FML_FITLAGLOW
-                    maxlag = self.lagmin
-                else:
-                    failreason |= self.FML_FITLAGHIGH
-                    maxlag = self.lagmax
-                fitfail = True
-            if maxsigma > self.absmaxsigma:
-                failreason |= self.FML_FITWIDTHHIGH
-                if self.debug:
-                    print("bad width after refinement:", maxsigma, ">", self.absmaxsigma)
-                maxsigma = self.absmaxsigma
-                fitfail = True
-            if maxsigma < self.absminsigma:
-                failreason |= self.FML_FITWIDTHLOW
-                if self.debug:
-                    print("bad width after refinement:", maxsigma, "<", self.absminsigma)
-                maxsigma = self.absminsigma
-                fitfail = True
+            thefit = [np.atleast_1d(np.float64(x)) for x in (maxval, maxlag, maxsigma)]
+            thefailreason = np.atleast_1d(failreason)
+            fitfail = self._fitchecks_block(
+                thefit[0],
+                thefit[1],
+                thefit[2],
+                np.atleast_1d(baseline),
+                np.atleast_1d(baselinedev),
+                thefailreason,
+            )[0]
+            maxval, maxlag, maxsigma = (x[0] for x in thefit)
+            failreason = thefailreason[0]
             if fitfail:
                 if self.debug:
-                    print("fit fail")
-                if self.zerooutbadfit:
-                    maxval = np.float64(0.0)
-                    maxlag = np.float64(0.0)
-                    maxsigma = np.float64(0.0)
+                    print("fit fail:", self.diagnosefail(failreason))
                 maskval = np.uint16(0)
-            # print(maxlag_init, maxlag, maxval_init, maxval, maxsigma_init, maxsigma, maskval, failreason, fitfail)
         else:
             maxval = np.float64(maxval_init)
             maxlag = np.float64(np.fmod(maxlag_init, self.lagmod))
@@ -1222,6 +1328,352 @@ class SimilarityFunctionFitter:
             peakend,
         )
 
+    def _maxindex_noedge_block(self, corrfuncs):
+        # _maxindex_noedge for each row of corrfuncs
+        numrows, thelen = corrfuncs.shape
+        maxindex = np.zeros(numrows, dtype="int32")
+        flipfac = np.ones(numrows, dtype=np.float64)
+        rows = np.arange(numrows)
+        lowerlim = np.zeros(numrows, dtype=int)
+        todo = np.ones(numrows, dtype=bool)
+        while np.any(todo):
+            thesearch = np.where(
+                np.arange(thelen) >= lowerlim[todo, None], corrfuncs[todo, :], -np.inf
+            )[:, : thelen - 1]
+            maxindex[todo] = np.argmax(thesearch, axis=1)
+            flipfac[todo] = 1.0
+            if self.bipolar:
+                thesearch = np.where(
+                    np.arange(thelen) >= lowerlim[todo, None], -corrfuncs[todo, :], -np.inf
+                )[:, : thelen - 1]
+                minindex = np.argmax(thesearch, axis=1)
+                flip = np.fabs(corrfuncs[rows[todo], minindex]) > np.fabs(
+                    corrfuncs[rows[todo], maxindex[todo]]
+                )
+                maxindex[rows[todo][flip]] = minindex[flip]
+                flipfac[rows[todo][flip]] = -1.0
+            todo &= (maxindex == 0) & (lowerlim < thelen - 2)
+            lowerlim[todo] += 1
+        return maxindex, flipfac
+
+    def _peakrange_block(self, corrfuncs, maxindex, maxval_init, baseline):
+        # the first and last points of the peak in each row of corrfuncs.  For the gaussian and
+        # quadratic fits, walk out from the peak while the function keeps falling and stays
+        # above the search threshold.
+        numrows, thelen = corrfuncs.shape
+        if self.peakfittype == "fastquad" or self.peakfittype == "COM":
+            return np.maximum(1, maxindex - 2), np.minimum(thelen - 2, maxindex + 2)
+        rows = np.arange(numrows)
+        thegrad = np.gradient(corrfuncs, axis=1).astype("float64")
+        if (self.functype == "correlation") or (self.functype == "hybrid"):
+            if self.peakfittype == "quad":
+                peakpoints = corrfuncs > maxval_init[:, None] - 0.05
+            else:
+                peakpoints = corrfuncs > self.searchfrac * maxval_init[:, None]
+        else:
+            # for mutual information, there is a flattish, nonzero baseline, so we want the
+            # difference from that.
+            thethresh = baseline + self.searchfrac * (maxval_init - baseline)
+            peakpoints = corrfuncs > thethresh[:, None]
+        peakpoints[:, 0] = False
+        peakpoints[:, -1] = False
+        peakstart = np.maximum(1, maxindex - 1)
+        peakend = np.minimum(thelen - 2, maxindex + 1)
+        if self.functype == "mutualinfo":
+            endok = peakpoints
+            startok = peakpoints
+        else:
+            endok = (thegrad <= 0.0) & peakpoints
+            startok = (thegrad >= 0.0) & peakpoints
+        indices = np.arange(thelen)
+        peakend = np.argmax(~endok & (indices > peakend[:, None]), axis=1) - 1
+        startstop = (~startok & (indices < peakstart[:, None]))[:, ::-1]
+        peakstart = thelen - np.argmax(startstop, axis=1)
+
+        # deal with flat peak tops
+        flatend = corrfuncs[rows, peakend] == corrfuncs[rows, peakend - 1]
+        flatstart = corrfuncs[rows, peakstart] == corrfuncs[rows, peakstart + 1]
+        for i in np.nonzero(flatend | flatstart)[0]:
+            while (
+                peakend[i] < (thelen - 3)
+                and corrfuncs[i, peakend[i]] == corrfuncs[i, peakend[i] - 1]
+            ):
+                peakend[i] += 1
+            while (
+                peakstart[i] > 2 and corrfuncs[i, peakstart[i]] == corrfuncs[i, peakstart[i] + 1]
+            ):
+                peakstart[i] -= 1
+        return peakstart, peakend
+
+    def _initchecks_block(
+        self, maxlag_init, maxval_init, peakstart, peakend, baseline, baselinedev, failreason
+    ):
+        # check the initial guesses for each row, clipping maxlag_init and maxval_init and
+        # setting failreason in place.  Returns the initial peak widths.
+        # This is calculated from first principles, but it's always big by a factor or ~1.4.
+        #     Which makes me think I dropped a factor if sqrt(2).  So fix that with a final
+        #     division
+        binwidth = self.corrtimeaxis[1] - self.corrtimeaxis[0]
+        maxsigma_init = (
+            (peakend - peakstart + 1) * binwidth / (2.0 * np.sqrt(-np.log(self.searchfrac)))
+        ) / np.sqrt(2.0)
+        if self.hardlimit:
+            rangeextension = 0.0
+        else:
+            rangeextension = (self.lagmax - self.lagmin) * 0.75
+        lowerlaglim = self.lagmin - rangeextension - binwidth
+        upperlaglim = self.lagmax + rangeextension + binwidth
+        outofrange = ~((lowerlaglim <= maxlag_init) & (maxlag_init <= upperlaglim))
+        lagtoolow = outofrange & (maxlag_init <= lowerlaglim)
+        lagtoohigh = outofrange & ~lagtoolow
+        failreason[lagtoolow] |= self.FML_INITLAGLOW
+        maxlag_init[lagtoolow] = lowerlaglim
+        failreason[lagtoohigh] |= self.FML_INITLAGHIGH
+        maxlag_init[lagtoohigh] = upperlaglim
+        toowide = maxsigma_init > self.absmaxsigma
+        failreason[toowide] |= self.FML_INITWIDTHHIGH
+        maxsigma_init[toowide] = self.absmaxsigma
+        toonarrow = peakend - peakstart < 2
+        failreason[toonarrow] |= self.FML_INITWIDTHLOW
+        maxsigma_init[toonarrow] = (
+            (2 + 1) * binwidth / (2.0 * np.sqrt(-np.log(self.searchfrac)))
+        ) / np.sqrt(2.0)
+        if (self.functype == "correlation") or (self.functype == "hybrid"):
+            if self.enforcethresh:
+                outofthresh = ~(
+                    (self.lthreshval <= maxval_init) & (maxval_init <= self.uthreshval)
+                )
+                failreason[outofthresh] |= self.FML_INITAMPLOW
+            toolow = maxval_init < 0.0
+            failreason[toolow] |= self.FML_INITAMPLOW
+            maxval_init[toolow] = 0.0
+            toohigh = maxval_init > 1.0
+            failreason[toohigh] |= self.FML_INITAMPHIGH
+            maxval_init[toohigh] = 1.0
+        else:
+            # somewhat different rules for mutual information peaks
+            toolow = ((maxval_init - baseline) < self.lthreshval * baselinedev) | (
+                maxval_init < baseline
+            )
+            failreason[toolow] |= self.FML_INITAMPLOW
+            maxval_init[toolow] = 0.0
+        return maxsigma_init
+
+    def _fitchecks_block(self, maxval, maxlag, maxsigma, baseline, baselinedev, failreason):
+        # check the fit results for each row, clipping (or zeroing) the bad ones and setting
+        # failreason in place.  Returns which fits failed.
+        fitfail = np.zeros(len(maxval), dtype=bool)
+        if self.bipolar:
+            lowestcorrcoeff = -1.0
+        else:
+            lowestcorrcoeff = 0.0
+        if (self.functype == "correlation") or (self.functype == "hybrid"):
+            toolow = maxval < lowestcorrcoeff
+            failreason[toolow] |= self.FML_FITAMPLOW
+            maxval[toolow] = lowestcorrcoeff
+            fitfail |= toolow
+            toohigh = np.abs(maxval) > 1.0
+            if not self.allowhighfitamps:
+                failreason[toohigh] |= self.FML_FITAMPHIGH
+                fitfail |= toohigh
+            maxval[toohigh] = 1.0 * np.sign(maxval[toohigh])
+        else:
+            # different rules for mutual information peaks
+            toolow = ((maxval - baseline) < self.lthreshval * baselinedev) | (maxval < baseline)
+            failreason[toolow] |= self.FML_FITAMPLOW
+        lagtoolow = self.lagmin > maxlag
+        lagtoohigh = ~lagtoolow & (maxlag > self.lagmax)
+        failreason[lagtoolow] |= self.FML_FITLAGLOW
+        maxlag[lagtoolow] = self.lagmin
+        failreason[lagtoohigh] |= self.FML_FITLAGHIGH
+        maxlag[lagtoohigh] = self.lagmax
+        fitfail |= lagtoolow | lagtoohigh
+        toowide = maxsigma > self.absmaxsigma
+        failreason[toowide] |= self.FML_FITWIDTHHIGH
+        maxsigma[toowide] = self.absmaxsigma
+        toonarrow = maxsigma < self.absminsigma
+        failreason[toonarrow] |= self.FML_FITWIDTHLOW
+        maxsigma[toonarrow] = self.absminsigma
+        fitfail |= toowide | toonarrow
+        if self.zerooutbadfit:
+            maxval[fitfail] = 0.0
+            maxlag[fitfail] = 0.0
+            maxsigma[fitfail] = 0.0
+        return fitfail
+
+    def fit_block(self, incorrfuncs, maxguesses=None):
+        """Fit a block of similarity functions, one per row, as fit does for a single one.
+
+        For the "fastquad", "COM", "gauss" and "gausslm" peak fit types, the peak search and
+        peak width are found for all the rows at once, as is the refinement (the "gauss" fits
+        with tide_fit.gaussfitblock, the "gausslm" fits row by row).  Other peak fit
+        types, and debugging, fit one row at a time.
+
+        Parameters
+        ----------
+        incorrfuncs : 2D array
+            The similarity functions, one per row
+        maxguesses : 1D array, optional
+            If given, the initial lag guess for each row, used as setguess(True, maxguess)
+            would use it.  Otherwise the useguess and maxguess settings apply to every row.
+
+        Returns
+        -------
+        maxindex, maxlag, maxval, maxsigma, maskval, failreason, peakstart, peakend : 1D arrays
+            The values fit returns, for each row
+        """
+        numrows = np.shape(incorrfuncs)[0]
+        if (
+            self.peakfittype not in ["fastquad", "COM", "gauss", "gausslm"]
+            or self.debug
+            or self.displayplots
+        ):
+            # do it the slow way
+            savedguess = (self.useguess, self.maxguess)
+            theresults = []
+            for i in range(numrows):
+                if maxguesses is not None:
+                    self.setguess(True, maxguess=maxguesses[i])
+                theresults.append(self.fit(incorrfuncs[i, :]))
+            self.setguess(*savedguess)
+            thecols = list(zip(*theresults))
+            return tuple(np.asarray(thecol) for thecol in thecols)
+
+        # check to make sure xcorr_x and xcorr_y match
+        if self.corrtimeaxis is None:
+            print("Correlation time axis is not defined - exiting")
+            sys.exit()
+        if len(self.corrtimeaxis) != np.shape(incorrfuncs)[1]:
+            print(
+                "Correlation time axis and values do not match in length (",
+                len(self.corrtimeaxis),
+                "!=",
+                np.shape(incorrfuncs)[1],
+                "- exiting",
+            )
+            sys.exit()
+        failreason = np.zeros(numrows, dtype=np.uint32)
+        maskval = np.ones(numrows, dtype=np.uint16)
+        binwidth = self.corrtimeaxis[1] - self.corrtimeaxis[0]
+        thelen = len(self.corrtimeaxis)
+        rows = np.arange(numrows)
+
+        # find the maximum value and its location
+        corrfuncs = incorrfuncs + 0.0
+        if maxguesses is not None or self.useguess:
+            if maxguesses is None:
+                maxguesses = np.full(numrows, self.maxguess)
+            # valtoindex, for every row
+            limval = np.maximum(
+                self.corrtimeaxis[0], np.minimum(self.corrtimeaxis[-1], maxguesses)
+            )
+            maxindex = np.round((limval - self.corrtimeaxis[0]) / binwidth, 0).astype("int32")
+            flipfac = np.where(corrfuncs[rows, maxindex] < 0.0, -1.0, 1.0)
+        else:
+            maxindex, flipfac = self._maxindex_noedge_block(corrfuncs)
+        corrfuncs *= flipfac[:, None].astype(corrfuncs.dtype)
+        maxlag_init = (1.0 * self.corrtimeaxis[maxindex]).astype("float64")
+        maxval_init = corrfuncs[rows, maxindex].astype("float64")
+
+        # set the baseline and baselinedev levels
+        if (self.functype == "correlation") or (self.functype == "hybrid"):
+            baseline = np.zeros(numrows, dtype=np.float64)
+            baselinedev = np.zeros(numrows, dtype=np.float64)
+        else:
+            # for mutual information, there is a nonzero baseline, so we want the difference
+            baseline = np.median(corrfuncs, axis=1)
+            baselinedev = mad(corrfuncs, axis=1)
+
+        # then calculate the width of the peak
+        peakstart, peakend = self._peakrange_block(corrfuncs, maxindex, maxval_init, baseline)
+        if self.peakfittype != "fastquad" and self.peakfittype != "COM":
+            # now check the values for errors
+            maxsigma_init = self._initchecks_block(
+                maxlag_init, maxval_init, peakstart, peakend, baseline, baselinedev, failreason
+            )
+
+        # gather the points of each peak
+        peakwidth = np.max(peakend - peakstart) + 1
+        peakindices = peakstart[:, None] + np.arange(peakwidth)
+        inpeak = peakindices <= peakend[:, None]
+        peakindices = np.where(inpeak, peakindices, peakstart[:, None])
+        X = np.where(inpeak, self.corrtimeaxis[peakindices] - baseline[:, None], 0.0)
+        data = np.where(inpeak, corrfuncs[rows[:, None], peakindices], 0.0)
+
+        # refine
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.peakfittype == "COM":
+                maxval = maxval_init
+                maxlag = np.sum(X * data, axis=1) / np.sum(data, axis=1)
+                maxsigma = np.full(numrows, 10.0)
+            elif self.peakfittype == "gauss":
+                # do a least squares fit over the top of each peak
+                fitheight, fitloc, fitwidth = tide_fit.gaussfitblock(
+                    maxval_init, maxlag_init, maxsigma_init, X, data, valid=inpeak
+                )
+                maxval = fitheight + baseline
+                maxlag = np.fmod((1.0 * fitloc), self.lagmod)
+                maxsigma = fitwidth
+                # leastsq can't fit fewer points than parameters
+                toofew = peakend - peakstart + 1 < 3
+                maxval[toofew] = 0.0
+                maxlag[toofew] = 0.0
+                maxsigma[toofew] = 0.0
+            elif self.peakfittype == "gausslm":
+                # gaussfitlm fits one peak, so do one row at a time
+                maxval = np.zeros(numrows, dtype=np.float64)
+                maxlag = np.zeros(numrows, dtype=np.float64)
+                maxsigma = np.zeros(numrows, dtype=np.float64)
+                for i in np.nonzero(peakend - peakstart + 1 >= 3)[0]:
+                    thispeak = slice(0, peakend[i] - peakstart[i] + 1)
+                    maxval[i], maxlag[i], maxsigma[i] = tide_fit.gaussfitlm(
+                        X[i, thispeak],
+                        data[i, thispeak],
+                        height=maxval_init[i],
+                        loc=maxlag_init[i],
+                        width=maxsigma_init[i],
+                        loclims=(self.lagmin - binwidth, self.lagmax + binwidth),
+                        widthlims=(0.5 * self.absminsigma, 2.0 * self.absmaxsigma),
+                    )
+                maxval += baseline
+                maxlag = np.fmod(maxlag, self.lagmod)
+            else:
+                # tide_fit.refinepeak_quad, for every row
+                atedge = maxindex > thelen - 2
+                safeindex = np.where(atedge, 1, maxindex)
+                alpha = corrfuncs[rows, safeindex - 1]
+                beta = corrfuncs[rows, safeindex]
+                gamma = corrfuncs[rows, safeindex + 1]
+                binsize = self.corrtimeaxis[safeindex + 1] - self.corrtimeaxis[safeindex]
+                offsetbins = 0.5 * (alpha - gamma) / (alpha - 2.0 * beta + gamma)
+                maxlag = self.corrtimeaxis[safeindex] + offsetbins * binsize
+                maxval = beta - 0.25 * (alpha - gamma) * offsetbins
+                a = np.square(self.corrtimeaxis[safeindex - 1] - maxlag) / (alpha - maxval)
+                maxsigma = np.sqrt(np.fabs(a) / 2.0)
+                maxlag[atedge] = 0.0
+                maxval[atedge] = 0.0
+                maxsigma[atedge] = 0.0
+        maxlag = maxlag.astype(np.float64)
+        maxval = maxval.astype(np.float64)
+        maxsigma = maxsigma.astype(np.float64)
+
+        # check for errors in fit
+        fitfail = self._fitchecks_block(
+            maxval, maxlag, maxsigma, baseline, baselinedev, failreason
+        )
+        maskval[fitfail] = 0
+
+        return (
+            maxindex,
+            maxlag,
+            flipfac * maxval,
+            maxsigma,
+            maskval,
+            failreason,
+            peakstart,
+            peakend,
+        )
+
 
 class FrequencyTracker:
     freqs = None
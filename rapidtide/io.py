@@ -30,13 +30,15 @@ import pandas as pd
 
 
 # ---------------------------------------- NIFTI file manipulation ---------------------------
-def readfromnifti(inputfile):
+def readfromnifti(inputfile, dtype=np.float64):
     r"""Open a nifti file and read in the various important parts
 
     Parameters
     ----------
     inputfile : str
         The name of the nifti file.
+    dtype : numpy float type, optional
+        The precision to return the data in.  Default is np.float64.
 
     Returns
     -------
@@ -56,7 +58,7 @@ def readfromnifti(inputfile):
     else:
         raise FileNotFoundError(f"nifti file {inputfile} does not exist")
     nim = nib.load(inputfilename)
-    nim_data = nim.get_fdata()
+    nim_data = nim.get_fdata(dtype=dtype)
     nim_hdr = nim.header.copy()
     thedims = nim_hdr["dim"].copy()
     thesizes = nim_hdr["pixdim"].copy()
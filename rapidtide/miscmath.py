@@ -21,16 +21,13 @@
 #
 import matplotlib.pyplot as plt
 import numpy as np
-import pyfftw
 from numba import jit
-from scipy import fftpack
 from statsmodels.robust import mad
 
+import rapidtide.fftbackend as tide_fft
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
 
-fftpack = pyfftw.interfaces.scipy_fftpack
-pyfftw.interfaces.cache.enable()
 
 # ---------------------------------------- Global constants -------------------------------------------
 defaultbutterorder = 6
@@ -105,7 +102,7 @@ def polarfft(invec, samplerate):
         thevec = invec[:-1]
     else:
         thevec = invec
-    spec = fftpack.fft(tide_filt.hamming(np.shape(thevec)[0]) * thevec)[
+    spec = tide_fft.fft(tide_filt.hamming(np.shape(thevec)[0]) * thevec)[
         0 : np.shape(thevec)[0] // 2
     ]
     magspec = abs(spec)
@@ -137,10 +134,10 @@ def complex_cepstrum(x):
         unwrapped -= np.pi * ndelay[..., None] * np.arange(samples) / center
         return unwrapped, ndelay
 
-    spectrum = fftpack.fft(x)
+    spectrum = tide_fft.fft(x)
     unwrapped_phase, ndelay = _unwrap(np.angle(spectrum))
     log_spectrum = np.log(np.abs(spectrum)) + 1j * unwrapped_phase
-    ceps = fftpack.ifft(log_spectrum).real
+    ceps = tide_fft.ifft(log_spectrum).real
 
     return ceps, ndelay
 
@@ -157,7 +154,7 @@ def real_cepstrum(x):
 
     """
     # adapted from https://github.com/python-acoustics/python-acoustics/blob/master/acoustics/cepstrum.py
-    return fftpack.ifft(np.log(np.abs(fftpack.fft(x)))).real
+    return tide_fft.ifft(np.log(np.abs(tide_fft.fft(x)))).real
 
 
 # --------------------------- miscellaneous math functions -------------------------------------------------
@@ -375,20 +372,63 @@ def corrnormalize(thedata, detrendorder=1, windowfunc="hamming"):
     Returns
     -------
 
+    """
+    return corrnormalizeblock(
+        np.asarray(thedata)[np.newaxis, :], detrendorder=detrendorder, windowfunc=windowfunc
+    )[0, :]
+
+
+def stdnormalizeblock(datablock):
+    """Normalize each row of a 2D array to zero mean and unit standard deviation
+    (rows with zero standard deviation are only demeaned), as stdnormalize does for a vector.
+
+    Parameters
+    ----------
+    datablock : 2D float array
+
+    Returns
+    -------
+    normblock : 2D float array
+    """
+    demeaned = datablock - np.mean(datablock, axis=1)[:, np.newaxis]
+    sigstd = np.std(demeaned, axis=1)
+    sigstd[sigstd <= 0.0] = 1.0
+    return demeaned / sigstd[:, np.newaxis]
+
+
+def corrnormalizeblock(datablock, detrendorder=1, windowfunc="hamming"):
+    """Prepare each row of a 2D array for correlation in one pass - detrend, normalize,
+    window, and scale, exactly as corrnormalize does for a single timecourse.
+
+    Parameters
+    ----------
+    datablock : 2D float array
+        The timecourses, one per row
+    detrendorder : int, optional
+        Order of the polynomial trend to remove.  0 only removes the mean.  Default is 1.
+    windowfunc : str, optional
+        Window to apply ("None" for no window).  Default is "hamming".
+
+    Returns
+    -------
+    normblock : 2D float array
     """
     # detrend first
     if detrendorder > 0:
-        intervec = stdnormalize(tide_fit.detrend(thedata, order=detrendorder, demean=True))
+        intervec = stdnormalizeblock(
+            tide_fit.detrendblock(datablock, order=detrendorder, demean=True)
+        )
     else:
-        intervec = stdnormalize(thedata)
+        intervec = stdnormalizeblock(datablock)
 
     # then window
     if windowfunc != "None":
-        return stdnormalize(
-            tide_filt.windowfunction(np.shape(thedata)[0], type=windowfunc) * intervec
-        ) / np.sqrt(np.shape(thedata)[0])
+        thewindow = tide_filt.windowfunction(np.shape(datablock)[1], type=windowfunc).astype(
+            intervec.dtype, copy=False
+        )
+        return stdnormalizeblock(thewindow * intervec) / np.sqrt(np.shape(datablock)[1])
     else:
-        return stdnormalize(intervec) / np.sqrt(np.shape(thedata)[0])
+        return stdnormalizeblock(intervec) / np.sqrt(np.shape(datablock)[1])
 
 
 def rms(vector):
@@ -22,72 +22,622 @@
 #
 #
 #
+import atexit
+import mmap
 import multiprocessing as mp
+import multiprocessing.connection as mp_connection
+import os
 import sys
 import threading as thread
-from platform import python_version
+import time
+import traceback
+from collections import deque
+
+import numpy as np
+import threadpoolctl
 
 try:
     import queue as thrQueue
 except ImportError:
     import Queue as thrQueue
 
+try:
+    from multiprocessing import shared_memory
+
+    sharedmemoryexists = True
+except ImportError:
+    sharedmemoryexists = False
+
+import rapidtide.fftbackend as tide_fft
 import rapidtide.util as tide_util
 
+# how worker processes use the cpus (see configureworkers)
+_workerthreads = None
+_pincpus = False
+
+
+def _cgroupcpulimit():
+    # the cpu quota imposed by a container, if there is one (cgroup v2, then v1)
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as thefile:
+            quota, period = thefile.read().split()[:2]
+        if quota != "max":
+            return float(quota) / float(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as thefile:
+            quota = float(thefile.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as thefile:
+            period = float(thefile.read())
+        if quota > 0.0 and period > 0.0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _usablecpulist():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(mp.cpu_count()))
+
+
+def availablecpus():
+    """Return the number of cpus this process can actually use, taking the cpu affinity mask
+    and any cgroup (container) cpu quota into account, rather than the number of cpus in the
+    machine."""
+    numcpus = len(_usablecpulist())
+    quota = _cgroupcpulimit()
+    if quota is not None:
+        numcpus = min(numcpus, max(1, int(quota)))
+    return numcpus
+
 
 def maxcpus():
-    return mp.cpu_count() - 1
+    return max(1, availablecpus() - 1)
+
+
+def setthreadlimits(numthreads):
+    """Limit the BLAS/OpenMP thread pools and the FFT threads used in this process."""
+    numthreads = max(1, int(numthreads))
+    threadpoolctl.threadpool_limits(limits=numthreads)
+    tide_fft.setworkers(numthreads)
+
+
+def getfftworkers():
+    """The number of threads FFTs in this process should use (for the workers argument of
+    scipy.fft).  None means no limit has been set."""
+    return tide_fft.getworkers()
+
+
+def configureworkers(threadsperworker=None, pincpus=False):
+    """Set how worker processes share the cpus.
+
+    Parameters
+    ----------
+    threadsperworker : int or None, optional
+        The number of BLAS/OpenMP and FFT threads each worker process may use.  If None, the
+        available cpus are divided evenly between the workers of each stage, so N workers
+        doing linear algebra or FFTs don't each start a full set of threads.
+    pincpus : bool, optional
+        Pin each worker process to its own share of the available cpus.
+    """
+    global _workerthreads, _pincpus
+    _workerthreads = threadsperworker
+    _pincpus = pincpus
+
+
+def _workerresources(slot, numworkers):
+    # the thread count and (optionally) the cpus for one of numworkers workers
+    cpulist = _usablecpulist()[: availablecpus()]
+    if _workerthreads is None:
+        numthreads = max(1, len(cpulist) // numworkers)
+    else:
+        numthreads = _workerthreads
+    if not _pincpus:
+        return numthreads, None
+    if numworkers >= len(cpulist):
+        return numthreads, [cpulist[slot % len(cpulist)]]
+    cpuspan = len(cpulist) // numworkers
+    return numthreads, cpulist[slot * cpuspan : (slot + 1) * cpuspan]
+
+
+def _startworker(target, args, numthreads, cpus, fftbackend):
+    # runs in the new worker process before it starts on its queue
+    tide_fft.setbackend(fftbackend)
+    if cpus is not None:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError):
+            pass
+    setthreadlimits(numthreads)
+    target(*args)
+
+
+# utilization records for every multiprocessing stage run in this process
+_stagestats = []
+
+# how many failures to describe in detail for each stage
+_MAXFAILREPORTS = 10
+
+
+def getstagestats():
+    """Return a list of dicts describing each multiprocessing stage that has been run (name,
+    number of workers, items, blocks, wall time, and - when it can be measured - the
+    fraction of the available worker time spent doing work)."""
+    return list(_stagestats)
+
+
+def getfaileditems():
+    """Return the indices of the items that could not be processed in the most recent
+    multiprocessing stage (because they raised an exception, or repeatedly killed the worker
+    processing them)."""
+    if len(_stagestats) == 0:
+        return []
+    return list(_stagestats[-1]["failed"])
+
+
+def _recordstage(
+    stagename, numworkers, numitems, numblocks, walltime, busytime=None, failed=None, restarts=0
+):
+    thestats = {
+        "stage": stagename,
+        "workers": int(numworkers),
+        "items": int(numitems),
+        "blocks": int(numblocks),
+        "walltime": float(walltime),
+        "restarts": int(restarts),
+    }
+    if failed is None:
+        thestats["failed"] = []
+    else:
+        thestats["failed"] = sorted([int(item) for item in failed])
+    if busytime is not None and walltime > 0.0 and numworkers > 0:
+        thestats["utilization"] = float(busytime / (numworkers * walltime))
+        print(
+            f"{stagename}: {numitems} items in {numblocks} blocks, {walltime:.2f}s, "
+            f"{100.0 * thestats['utilization']:.1f}% worker utilization"
+        )
+    else:
+        thestats["utilization"] = None
+    if len(thestats["failed"]) > 0 or restarts > 0:
+        print(
+            f"{stagename}: {len(thestats['failed'])} items failed, "
+            f"{restarts} worker processes restarted"
+        )
+    _stagestats.append(thestats)
+
+
+class WorkerFailure:
+    """Sent back by a consumer in place of a result when processing an item raises an
+    exception, so that the item can be recorded as failed and the worker can carry on."""
+
+    def __init__(self, item, exception):
+        self.item = item
+        self.message = f"{type(exception).__name__}: {exception}"
+        self.traceback = traceback.format_exc()
+
+
+def _reportfailure(stagename, numfailed, item, message):
+    if numfailed <= _MAXFAILREPORTS:
+        print(f"{stagename}: item {item} failed - {message}")
+    if numfailed == _MAXFAILREPORTS:
+        print(f"{stagename}: further failures will not be reported individually")
 
 
 def _process_data(data_in, inQ, outQ, showprogressbar=True, reportstep=1000, chunksize=10000):
-    # send pos/data to workers
+    # keep up to chunksize items in flight, topping the input queue back up as each result
+    # comes in, so there is never a point where the workers have to wait for the queue to drain
     data_out = []
+    failed = []
     totalnum = len(data_in)
-    numchunks = int(totalnum // chunksize)
-    remainder = totalnum - numchunks * chunksize
     if showprogressbar:
         tide_util.progressbar(0, totalnum, label="Percent complete")
 
-    # process all of the complete chunks
-    for thechunk in range(numchunks):
-        # queue the chunk
-        for i, dat in enumerate(data_in[thechunk * chunksize : (thechunk + 1) * chunksize]):
-            inQ.put(dat)
-        offset = thechunk * chunksize
-
-        # retrieve the chunk
-        numreturned = 0
-        while True:
-            ret = outQ.get()
-            if ret is not None:
-                data_out.append(ret)
-            numreturned += 1
-            if (((numreturned + offset + 1) % reportstep) == 0) and showprogressbar:
-                tide_util.progressbar(numreturned + offset + 1, totalnum, label="Percent complete")
-            if numreturned > chunksize - 1:
-                break
+    numsent = 0
+    while numsent < min(chunksize, totalnum):
+        inQ.put(data_in[numsent])
+        numsent += 1
 
-    # queue the remainder
-    for i, dat in enumerate(data_in[numchunks * chunksize : numchunks * chunksize + remainder]):
-        inQ.put(dat)
     numreturned = 0
-    offset = numchunks * chunksize
-
-    # retrieve the remainder
-    while True:
+    while numreturned < totalnum:
         ret = outQ.get()
-        if ret is not None:
+        if isinstance(ret, WorkerFailure):
+            failed.append(ret.item)
+            _reportfailure("run_multithread", len(failed), ret.item, ret.message)
+        elif ret is not None:
             data_out.append(ret)
         numreturned += 1
-        if (((numreturned + offset + 1) % reportstep) == 0) and showprogressbar:
-            tide_util.progressbar(numreturned + offset + 1, totalnum, label="Percent complete")
-        if numreturned > remainder - 1:
-            break
+        if numsent < totalnum:
+            inQ.put(data_in[numsent])
+            numsent += 1
+        if ((numreturned % reportstep) == 0) and showprogressbar:
+            tide_util.progressbar(numreturned, totalnum, label="Percent complete")
     if showprogressbar:
         tide_util.progressbar(totalnum, totalnum, label="Percent complete")
     print()
 
-    return data_out
+    return data_out, failed
+
+
+# the start method for worker processes (see setstartmethod)
+_startmethod = "fork"
+
+# if True, allocate shared arrays in named shared memory segments even when forking
+_usenamedshared = False
+
+# named shared memory segments created by this process, with their (address, size) in
+# memory, and the ones a worker has attached to
+_namedsegments = {}
+_segmentaddresses = {}
+_attachedsegments = {}
+
+
+def setstartmethod(startmethod, namedshared=False):
+    """Set how worker processes are started ("fork", "forkserver", or "spawn"), and whether
+    shared arrays should be put in named shared memory segments.  Anything other than fork
+    requires named segments, since the workers don't inherit the parent's memory, and
+    run_multiproc then runs its consumers in this process, since they can't be sent to the
+    workers."""
+    global _startmethod, _usenamedshared
+    if startmethod not in mp.get_all_start_methods():
+        print(f"setstartmethod: fatal error - start method {startmethod} is not available")
+        sys.exit()
+    if (startmethod != "fork" or namedshared) and not sharedmemoryexists:
+        print("setstartmethod: fatal error - named shared memory requires python 3.8 or later")
+        sys.exit()
+    _startmethod = startmethod
+    _usenamedshared = namedshared or (startmethod != "fork")
+
+
+def getstartmethod():
+    return _startmethod
+
+
+def usenamedshared():
+    """True if shared arrays should be allocated with allocnamedshared."""
+    return _usenamedshared
+
+
+def allocnamedshared(theshape, thetype):
+    """Allocate a zeroed numpy array in a named shared memory segment.
+
+    Arrays allocated this way, and any views of them, are sent to worker processes by
+    segment name, offset, shape and dtype, and the workers attach to the same memory, so
+    the data is never pickled or copied no matter how the workers were started.
+
+    Returns
+    -------
+    outarray : ndarray
+        The array.
+    thesegment : SharedMemory
+        The segment holding it.
+    """
+    thedtype = np.dtype(thetype)
+    thesize = int(np.prod(theshape)) * thedtype.itemsize
+    thesegment = shared_memory.SharedMemory(create=True, size=max(thesize, 1))
+    outarray = np.ndarray(theshape, dtype=thedtype, buffer=thesegment.buf)
+    _namedsegments[thesegment.name] = thesegment
+    _segmentaddresses[thesegment.name] = (outarray.__array_interface__["data"][0], thesize)
+    return outarray, thesegment
+
+
+def releasenamedshared():
+    """Remove all of the named shared memory segments made by this process.  Arrays that
+    are still in use stay valid, but can no longer be attached to by new workers."""
+    for name, thesegment in _namedsegments.items():
+        try:
+            thesegment.unlink()
+        except FileNotFoundError:
+            pass
+    _namedsegments.clear()
+    _segmentaddresses.clear()
+
+
+atexit.register(releasenamedshared)
+
+
+class _NamedArrayRef:
+    # stands in for an array in a named shared memory segment when it is sent to a worker
+    def __init__(self, name, offset, thearray):
+        self.name = name
+        self.offset = offset
+        self.shape = thearray.shape
+        self.dtype = thearray.dtype
+        self.strides = thearray.strides
+
+    def attach(self):
+        if self.name in _namedsegments:
+            thesegment = _namedsegments[self.name]
+        elif self.name in _attachedsegments:
+            thesegment = _attachedsegments[self.name]
+        else:
+            thesegment = shared_memory.SharedMemory(name=self.name)
+            _attachedsegments[self.name] = thesegment
+        return np.ndarray(
+            self.shape,
+            dtype=self.dtype,
+            buffer=thesegment.buf,
+            offset=self.offset,
+            strides=self.strides,
+        )
+
+
+class _MemmapRef:
+    # stands in for (a view of) a memory mapped file when it is sent to a worker
+    def __init__(self, filename, offset, thearray):
+        self.filename = filename
+        self.offset = offset
+        self.shape = thearray.shape
+        self.dtype = thearray.dtype
+        self.strides = thearray.strides
+
+    def attach(self):
+        if self.filename not in _attachedmemmaps:
+            _attachedmemmaps[self.filename] = np.memmap(self.filename, dtype=np.uint8, mode="r+")
+        return np.ndarray(
+            self.shape,
+            dtype=self.dtype,
+            buffer=_attachedmemmaps[self.filename],
+            offset=self.offset,
+            strides=self.strides,
+        )
+
+
+_attachedmemmaps = {}
+
+
+def _memmapref(thearray):
+    # return a reference to thearray if it is backed by a writable memory mapped file
+    themap = getattr(thearray, "_mmap", None)
+    if themap is None or thearray.filename is None or thearray.mode not in ["r+", "w+"]:
+        return None
+    mapaddress = np.frombuffer(themap, dtype=np.uint8).__array_interface__["data"][0]
+    mapstart = thearray.offset - thearray.offset % mmap.ALLOCATIONGRANULARITY
+    address = thearray.__array_interface__["data"][0]
+    return _MemmapRef(thearray.filename, mapstart + address - mapaddress, thearray)
+
+
+def _namedref(thearray):
+    # return a reference to thearray if it lives in one of our named segments, or in a
+    # memory mapped file
+    if isinstance(thearray, np.memmap):
+        return _memmapref(thearray)
+    if not isinstance(thearray, np.ndarray) or len(_segmentaddresses) == 0:
+        return None
+    address = thearray.__array_interface__["data"][0]
+    for name, (segaddress, segsize) in _segmentaddresses.items():
+        if segaddress <= address < segaddress + max(segsize, 1):
+            return _NamedArrayRef(name, address - segaddress, thearray)
+    return None
+
+
+def _encodestate(blockstate, stagename):
+    # replace the arrays in named segments with references to them
+    encodedstate = {}
+    for key, value in blockstate.items():
+        theref = _namedref(value)
+        if theref is not None:
+            encodedstate[key] = theref
+        else:
+            if _startmethod != "fork" and isinstance(value, np.ndarray) and value.nbytes > 2**20:
+                print(
+                    f"{stagename}: warning - {key} is not in named shared memory, so it will be "
+                    "copied to every worker (and any results written to it will be lost)"
+                )
+            encodedstate[key] = value
+    return encodedstate
+
+
+def _decodestate(encodedstate, sharedarrays=None):
+    # the inverse of _encodestate (plus any arrays inherited from a WorkerPool)
+    blockstate = {}
+    for key, value in encodedstate.items():
+        if isinstance(value, (_NamedArrayRef, _MemmapRef)):
+            blockstate[key] = value.attach()
+        elif isinstance(value, _SharedRef):
+            blockstate[key] = sharedarrays[value.name]
+        else:
+            blockstate[key] = value
+    return blockstate
+
+
+def _getcontext(startmethod=None):
+    if startmethod is None:
+        startmethod = _startmethod
+    return mp.get_context(startmethod)
+
+
+class _PipeQueue:
+    # gives the worker's end of its pipe the get/put interface that the consumers expect
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self):
+        return self.conn.recv()
+
+    def put(self, obj):
+        self.conn.send(obj)
+
+
+class _Supervisor:
+    """Run units of work on a set of worker processes, replacing any worker that dies.
+
+    Each worker talks to the parent over its own pipe, so the parent always knows exactly
+    which units a worker is holding, and a worker that dies (segfault, killed by the OOM
+    killer, ...) can't leave a shared queue locked.  When a worker dies it is restarted and
+    the units it was holding are resubmitted.  The unit it was working on is split up if
+    possible, and otherwise retried up to maxretries times before being reported as failed,
+    so a single bad item can't take down or hang the whole run.
+    """
+
+    def __init__(self, workerspec, nprocs, maxretries=2, startmethod=None):
+        # workerspec(workerQ) returns the (target, args) to start a worker with
+        self.workerspec = workerspec
+        self.startmethod = startmethod
+        self.nprocs = nprocs
+        self.maxretries = maxretries
+        self.startmessages = []
+        self.procs = [None] * nprocs
+        self.conns = [None] * nprocs
+        self.numrestarts = 0
+        for slot in range(nprocs):
+            self._spawn(slot)
+
+    def _spawn(self, slot):
+        ctx = _getcontext(self.startmethod)
+        parentconn, childconn = ctx.Pipe()
+        target, args = self.workerspec(_PipeQueue(childconn))
+        numthreads, cpus = _workerresources(slot, self.nprocs)
+        self.procs[slot] = ctx.Process(
+            target=_startworker, args=(target, args, numthreads, cpus, tide_fft.getbackend())
+        )
+        self.procs[slot].start()
+        childconn.close()
+        self.conns[slot] = parentconn
+        for themessage in self.startmessages:
+            self._send(slot, themessage)
+
+    def _send(self, slot, themessage):
+        try:
+            self.conns[slot].send(themessage)
+            return True
+        except OSError:
+            # the worker is gone - this will be picked up in run
+            return False
+
+    def _restart(self, slot):
+        self.procs[slot].join(timeout=1.0)
+        self.conns[slot].close()
+        self.numrestarts += 1
+        self._spawn(slot)
+
+    def broadcast(self, themessage):
+        """Send a message to every worker, and to any worker that is started later."""
+        self.startmessages = [themessage]
+        for slot in range(self.nprocs):
+            self._send(slot, themessage)
+
+    def run(self, nextunit, makemessage, onresult, onfailure, splitunit=None, prefetch=2):
+        """Process units until nextunit() returns None and everything has come back.
+
+        Each unit is sent to a worker as makemessage(unit), and the reply is passed to
+        onresult(unit, reply).  Units that fail are split into smaller units with
+        splitunit(unit) if it returns more than one, and otherwise passed to
+        onfailure(unit, message).
+        """
+        pending = deque()
+        inflight = [deque() for slot in range(self.nprocs)]
+        retries = {}
+        deathsinarow = 0
+
+        def fill(slot):
+            while len(inflight[slot]) < prefetch:
+                if len(pending) > 0:
+                    unit = pending.popleft()
+                else:
+                    unit = nextunit()
+                    if unit is None:
+                        return
+                if not self._send(slot, makemessage(unit)):
+                    pending.appendleft(unit)
+                    return
+                inflight[slot].append(unit)
+
+        def split(unit):
+            if splitunit is None:
+                return [unit]
+            return splitunit(unit)
+
+        for slot in range(self.nprocs):
+            fill(slot)
+        while max([len(theunits) for theunits in inflight]) > 0 or len(pending) > 0:
+            mp_connection.wait(self.conns + [proc.sentinel for proc in self.procs])
+            for slot in range(self.nprocs):
+                # collect everything this worker has sent back
+                died = False
+                while self.conns[slot].poll():
+                    try:
+                        ret = self.conns[slot].recv()
+                    except (EOFError, OSError):
+                        died = True
+                        break
+                    if len(inflight[slot]) == 0:
+                        continue
+                    unit = inflight[slot].popleft()
+                    deathsinarow = 0
+                    if isinstance(ret, WorkerFailure):
+                        parts = split(unit)
+                        if len(parts) > 1:
+                            pending.extend(parts)
+                        else:
+                            onfailure(unit, ret.message)
+                    else:
+                        onresult(unit, ret)
+
+                # if it died, replace it and resubmit what it was holding
+                if died or not self.procs[slot].is_alive():
+                    exitcode = self.procs[slot].exitcode
+                    lost = inflight[slot]
+                    inflight[slot] = deque()
+                    if len(lost) > 0:
+                        suspect = lost.popleft()
+                        pending.extendleft(reversed(lost))
+                        parts = split(suspect)
+                        if len(parts) > 1:
+                            pending.extendleft(reversed(parts))
+                        else:
+                            retries[suspect] = retries.get(suspect, 0) + 1
+                            if retries[suspect] > self.maxretries:
+                                onfailure(suspect, f"worker died (exit code {exitcode})")
+                                deathsinarow = 0
+                            else:
+                                pending.appendleft(suspect)
+                    deathsinarow += 1
+                    if deathsinarow > 5 * self.nprocs * (self.maxretries + 1):
+                        print(
+                            "_Supervisor: fatal error - worker processes are dying without "
+                            "completing any work"
+                        )
+                        self.shutdown()
+                        sys.exit()
+                    self._restart(slot)
+            for slot in range(self.nprocs):
+                fill(slot)
+
+    def shutdown(self):
+        """Stop all of the workers."""
+        for slot in range(self.nprocs):
+            if self.conns[slot] is not None:
+                self._send(slot, None)
+        for proc in self.procs:
+            if proc is not None:
+                proc.join(timeout=5.0)
+                if proc.is_alive():
+                    proc.terminate()
+                    proc.join()
+        for conn in self.conns:
+            if conn is not None:
+                conn.close()
+        self.procs = [None] * self.nprocs
+        self.conns = [None] * self.nprocs
+
+
+class _ListQueue:
+    # hands a list of items to a consumer running in this process, followed by the 'TERM'
+    # signal, and passes whatever it sends back to onresult
+    def __init__(self, items, onresult):
+        self.items = deque(items)
+        self.items.append(None)
+        self.onresult = onresult
+
+    def get(self):
+        return self.items.popleft()
+
+    def put(self, obj):
+        self.onresult(obj)
 
 
 def run_multiproc(
@@ -98,22 +648,196 @@ def run_multiproc(
     procbyvoxel=True,
     showprogressbar=True,
     chunksize=1000,
+    reportstep=1000,
 ):
-    # initialize the workers and the queues
-    n_workers = nprocs
-    versioninfo = python_version().split(".")
-    if (versioninfo[0] == "3") and (versioninfo[1] >= "8"):
-        ctx = mp.get_context("fork")
-        inQ = ctx.Queue()
-        outQ = ctx.Queue()
-        workers = [ctx.Process(target=consumerfunc, args=(inQ, outQ)) for i in range(n_workers)]
+    # pack the data
+    numitems, procunit = _checkmask(inputshape, maskarray, procbyvoxel, "run_multiproc")
+    data_in = []
+    for d in range(numitems):
+        if maskarray is None:
+            data_in.append(d)
+        elif maskarray[d] > 0.5:
+            data_in.append(d)
+
+    # the consumers here are closures, which can only be handed to worker processes by
+    # forking.  If the start method is not fork, forking anyway would bring back the problems
+    # it was chosen to avoid, so the consumer is run in this process instead.
+    if _startmethod == "fork":
+        n_workers = nprocs
     else:
-        inQ = mp.Queue()
-        outQ = mp.Queue()
-        workers = [mp.Process(target=consumerfunc, args=(inQ, outQ)) for i in range(n_workers)]
-    for i, w in enumerate(workers):
-        w.start()
+        n_workers = 1
+        print(
+            f"{consumerfunc.__name__}: closures can't be run with the {_startmethod} start "
+            "method - running in a single process (use block dispatch to run in parallel)"
+        )
+    print("processing", len(data_in), procunit + " with", n_workers, "processes")
+
+    starttime = time.time()
+    totalnum = len(data_in)
+    data_out = []
+    failed = []
+
+    def onresult(item, ret):
+        if ret is not None:
+            data_out.append(ret)
+        numdone = len(data_out) + len(failed)
+        if showprogressbar and (numdone % reportstep == 0):
+            tide_util.progressbar(numdone, totalnum, label="Percent complete")
+
+    def onfailure(item, message):
+        failed.append(item)
+        _reportfailure(consumerfunc.__name__, len(failed), item, message)
+
+    if showprogressbar:
+        tide_util.progressbar(0, totalnum, label="Percent complete")
+    if _startmethod == "fork":
+        # start the workers, each with its own pipe, and send the items out, keeping a few in
+        # flight for each worker
+        thesupervisor = _Supervisor(
+            lambda workerQ: (consumerfunc, (workerQ, workerQ)), n_workers, startmethod="fork"
+        )
+        theitems = iter(data_in)
+        thesupervisor.run(
+            lambda: next(theitems, None),
+            lambda item: item,
+            onresult,
+            onfailure,
+            prefetch=max(1, min(chunksize, 8)),
+        )
+        numrestarts = thesupervisor.numrestarts
+
+        # shut down workers
+        thesupervisor.shutdown()
+    else:
+
+        def oninprocessresult(ret):
+            if isinstance(ret, WorkerFailure):
+                onfailure(ret.item, ret.message)
+            else:
+                onresult(None, ret)
+
+        thequeue = _ListQueue(data_in, oninprocessresult)
+        consumerfunc(thequeue, thequeue)
+        numrestarts = 0
+    if showprogressbar:
+        tide_util.progressbar(totalnum, totalnum, label="Percent complete")
+    print()
+    _recordstage(
+        consumerfunc.__name__,
+        n_workers,
+        totalnum,
+        totalnum,
+        time.time() - starttime,
+        failed=failed,
+        restarts=numrestarts,
+    )
+
+    return data_out
 
+
+def _block_consumer(blockfunc, encodedstate, inQ, outQ):
+    blockstate = _decodestate(encodedstate)
+    while True:
+        try:
+            # get a new message
+            val = inQ.get()
+
+            # this is the 'TERM' signal
+            if val is None:
+                break
+
+            # process the block and send back the (small) status record and how long it took
+            starttime = time.time()
+            status = blockfunc(blockstate, val[0], val[1])
+            outQ.put((status, time.time() - starttime))
+
+        except Exception as e:
+            outQ.put(WorkerFailure(val, e))
+
+
+class BlockScheduler:
+    """Hand out contiguous blocks of work, sizing them on the fly.
+
+    Block sizes are chosen so that each block takes about targettime seconds, based on the
+    running average of the per-item processing time reported back by the workers.  Blocks
+    also never contain more than 1/(2 * nprocs) of the work that is left, so they shrink
+    towards the end of a stage and the workers finish together, rather than the whole stage
+    waiting on one worker that picked up a big block of slow items.
+    """
+
+    def __init__(
+        self,
+        numitems,
+        maskarray=None,
+        nprocs=1,
+        maxblocksize=1000,
+        initialblocksize=8,
+        targettime=0.25,
+    ):
+        self.numitems = numitems
+        if maskarray is None:
+            self.validlocs = None
+            self.numvalid = numitems
+        else:
+            self.validlocs = np.where(np.asarray(maskarray) > 0.5)[0]
+            self.numvalid = len(self.validlocs)
+        self.nprocs = max(nprocs, 1)
+        self.maxblocksize = max(int(maxblocksize), 1)
+        self.initialblocksize = max(int(initialblocksize), 1)
+        self.targettime = targettime
+        self.peritemtime = None
+        self.nextvalid = 0
+
+    def _blocklen(self):
+        remaining = self.numvalid - self.nextvalid
+        thelen = int(np.ceil(remaining / (2 * self.nprocs)))
+        if self.peritemtime is None:
+            thelen = min(thelen, self.initialblocksize)
+        elif self.peritemtime > 0.0:
+            thelen = min(thelen, int(self.targettime / self.peritemtime))
+        return max(1, min(thelen, self.maxblocksize))
+
+    def nextblock(self):
+        """Return the next (startidx, endidx) block, or None if everything has been handed out."""
+        if self.nextvalid >= self.numvalid:
+            return None
+        first = self.nextvalid
+        last = first + self._blocklen()
+        self.nextvalid = last
+        if self.validlocs is None:
+            return first, last
+        else:
+            return int(self.validlocs[first]), int(self.validlocs[last - 1]) + 1
+
+    def validitems(self, startidx, endidx):
+        """The indices of the unmasked items in a block."""
+        if self.validlocs is None:
+            return list(range(startidx, endidx))
+        else:
+            first = np.searchsorted(self.validlocs, startidx)
+            last = np.searchsorted(self.validlocs, endidx)
+            return [int(theloc) for theloc in self.validlocs[first:last]]
+
+    def numvalidin(self, startidx, endidx):
+        """The number of unmasked items in a block."""
+        if self.validlocs is None:
+            return endidx - startidx
+        else:
+            return int(
+                np.searchsorted(self.validlocs, endidx) - np.searchsorted(self.validlocs, startidx)
+            )
+
+    def update(self, numitems, elapsed):
+        """Fold the timing of a finished block into the per-item time estimate."""
+        if numitems > 0:
+            thistime = elapsed / numitems
+            if self.peritemtime is None:
+                self.peritemtime = thistime
+            else:
+                self.peritemtime = 0.7 * self.peritemtime + 0.3 * thistime
+
+
+def _checkmask(inputshape, maskarray, procbyvoxel, caller):
     if procbyvoxel:
         indexaxis = 0
         procunit = "voxels"
@@ -125,32 +849,296 @@ def run_multiproc(
     if maskarray is not None:
         if inputshape[indexaxis] != len(maskarray):
             print(
-                "run_multiproc: fatal error - maskarray dimension does not equal index axis dimension"
+                f"{caller}: fatal error - maskarray dimension does not equal index axis dimension"
             )
             sys.exit()
+    return inputshape[indexaxis], procunit
 
-    # pack the data and send to workers
-    data_in = []
-    for d in range(inputshape[indexaxis]):
-        if maskarray is None:
-            data_in.append(d)
-        elif maskarray[d] > 0.5:
-            data_in.append(d)
-    print("processing", len(data_in), procunit + " with", n_workers, "processes")
-    data_out = _process_data(
-        data_in, inQ, outQ, showprogressbar=showprogressbar, chunksize=chunksize
+
+def _runscheduled(
+    scheduler, thesupervisor, makemessage, stagename, showprogressbar=True,
+):
+    # keep every worker fed (two blocks each) until everything has come back
+    starttime = time.time()
+    startrestarts = thesupervisor.numrestarts
+    data_out = []
+    failed = []
+    tally = {"blocks": 0, "done": 0, "busytime": 0.0}
+    if showprogressbar:
+        tide_util.progressbar(0, scheduler.numvalid, label="Percent complete")
+
+    def onresult(theblock, ret):
+        status, elapsed = ret
+        itemsinblock = scheduler.numvalidin(theblock[0], theblock[1])
+        scheduler.update(itemsinblock, elapsed)
+        data_out.append((theblock[0], theblock[1], status))
+        tally["blocks"] += 1
+        tally["done"] += itemsinblock
+        tally["busytime"] += elapsed
+        if showprogressbar:
+            tide_util.progressbar(tally["done"], scheduler.numvalid, label="Percent complete")
+
+    def onfailure(theblock, message):
+        # failed blocks are broken up until the failure is pinned down to single items
+        failed.append(theblock[0])
+        _reportfailure(stagename, len(failed), theblock[0], message)
+
+    def splitblock(theblock):
+        return [(theitem, theitem + 1) for theitem in scheduler.validitems(*theblock)]
+
+    thesupervisor.run(
+        scheduler.nextblock, makemessage, onresult, onfailure, splitunit=splitblock, prefetch=2,
+    )
+    print()
+    _recordstage(
+        stagename,
+        thesupervisor.nprocs,
+        tally["done"],
+        tally["blocks"],
+        time.time() - starttime,
+        busytime=tally["busytime"],
+        failed=failed,
+        restarts=thesupervisor.numrestarts - startrestarts,
+    )
+    data_out.sort(key=lambda x: x[0])
+    return data_out
+
+
+def run_multiproc_blocks(
+    blockfunc,
+    blockstate,
+    inputshape,
+    maskarray,
+    nprocs=1,
+    procbyvoxel=True,
+    showprogressbar=True,
+    blocksize=1000,
+):
+    """Dispatch contiguous index ranges to worker processes.
+
+    Unlike run_multiproc, which sends one index at a time and ships every result back
+    to the parent, each worker here receives a (startidx, endidx) range, does all of the
+    work for that range, and writes its results directly into output arrays that must live
+    in shared memory (e.g. allocated with allocshared).  Only a small status record comes
+    back for each block.  Block sizes are set adaptively by a BlockScheduler.
+
+    If a block raises an exception, or kills the worker processing it, it is split into
+    single items and resubmitted, so that only the items that actually fail are lost.  These
+    are not included in data_out, and can be retrieved with getfaileditems().
+
+    Parameters
+    ----------
+    blockfunc : function
+        Called as blockfunc(blockstate, startidx, endidx) in the worker.  It must handle
+        masking itself, and should return something small (counts, flags, etc.).
+    blockstate : dict
+        Everything blockfunc needs to do its work (input and output arrays, fitters, etc.).
+    inputshape : tuple
+        Shape of the data being processed.
+    maskarray : 1D array or None
+        Mask along the index axis.  Masked out items are skipped when making blocks.
+    nprocs : int, optional
+        Number of worker processes.
+    procbyvoxel : bool, optional
+        If True, index along axis 0 (voxels), otherwise along axis 1 (timepoints).
+    showprogressbar : bool, optional
+        Show a progress bar.
+    blocksize : int, optional
+        Maximum number of items per block.
+
+    Returns
+    -------
+    data_out : list of tuples
+        (startidx, endidx, status) for every block processed, sorted by startidx.
+    """
+    numitems, procunit = _checkmask(inputshape, maskarray, procbyvoxel, "run_multiproc_blocks")
+    thescheduler = BlockScheduler(
+        numitems, maskarray=maskarray, nprocs=nprocs, maxblocksize=blocksize
+    )
+
+    # initialize the workers
+    encodedstate = _encodestate(blockstate, blockfunc.__name__)
+    thesupervisor = _Supervisor(
+        lambda workerQ: (_block_consumer, (blockfunc, encodedstate, workerQ, workerQ)), nprocs
+    )
+
+    print("processing", thescheduler.numvalid, procunit, "with", nprocs, "processes")
+    data_out = _runscheduled(
+        thescheduler,
+        thesupervisor,
+        lambda theblock: theblock,
+        blockfunc.__name__,
+        showprogressbar=showprogressbar,
     )
 
     # shut down workers
-    for i in range(n_workers):
-        inQ.put(None)
-    for w in workers:
-        w.terminate()
-        w.join()
+    thesupervisor.shutdown()
 
     return data_out
 
 
+class _SharedRef:
+    # stands in for a registered shared array when the block state is sent to the workers
+    def __init__(self, name):
+        self.name = name
+
+
+def _pool_worker(sharedarrays, inQ, outQ):
+    blockstate = {}
+    while True:
+        try:
+            # get a new message
+            val = inQ.get()
+
+            # this is the 'TERM' signal
+            if val is None:
+                break
+
+            # a new block state - attach to (or look up) the shared arrays it refers to
+            if val[0] == "state":
+                blockstate = _decodestate(val[1], sharedarrays=sharedarrays)
+                continue
+
+            # process the block and send back the (small) status record and how long it took
+            dummy, blockfunc, startidx, endidx = val
+            starttime = time.time()
+            status = blockfunc(blockstate, startidx, endidx)
+            outQ.put((status, time.time() - starttime))
+
+        except Exception as e:
+            outQ.put(WorkerFailure(val, e))
+
+
+class WorkerPool:
+    """A set of worker processes that is started once and reused by every stage of a run.
+
+    The workers are forked when the pool is first used, so they inherit every array that
+    has been registered with the pool.  Registered arrays must be in shared memory - they
+    are never copied, and the workers write their results directly into them.  Everything
+    else a stage needs (the reference regressor, the correlator, the fitter, ...) is sent
+    to the workers as a block state at the start of each stage, so the workers pick up
+    per-pass changes without being respawned.  Workers that die are replaced (and given
+    the current block state) without disturbing the rest of the pool.
+
+    Block functions have the same form as for run_multiproc_blocks, and must be defined at
+    module level so they can be sent to the workers.
+    """
+
+    def __init__(self, nprocs, sharedarrays=None):
+        self.nprocs = nprocs
+        self.sharedarrays = {}
+        if sharedarrays is not None:
+            self.sharedarrays.update(sharedarrays)
+        self.supervisor = None
+        self.stale = True
+        self.numstarts = 0
+        self.numstages = 0
+        self.numrestarts = 0
+
+    def register(self, **sharedarrays):
+        """Add shared arrays to the pool.  The workers are restarted on the next stage so
+        they can see them."""
+        self.sharedarrays.update(sharedarrays)
+        self.stale = True
+
+    def _findshared(self, thearray):
+        if not isinstance(thearray, np.ndarray):
+            return None
+        for name, sharedarray in self.sharedarrays.items():
+            if (
+                thearray.__array_interface__["data"][0]
+                == sharedarray.__array_interface__["data"][0]
+                and thearray.shape == sharedarray.shape
+                and thearray.dtype == sharedarray.dtype
+            ):
+                return name
+        return None
+
+    def canshare(self, *thearrays):
+        """Return True if all of the arrays are registered with the pool, or are in named
+        shared memory."""
+        for thearray in thearrays:
+            if self._findshared(thearray) is None and _namedref(thearray) is None:
+                return False
+        return True
+
+    def _start(self):
+        self.shutdown()
+        if _startmethod == "fork":
+            inherited = self.sharedarrays
+        else:
+            # the workers can't inherit anything, so everything has to be in named segments
+            inherited = {}
+        self.supervisor = _Supervisor(
+            lambda workerQ: (_pool_worker, (inherited, workerQ, workerQ)), self.nprocs
+        )
+        self.stale = False
+        self.numstarts += 1
+
+    def setstate(self, blockstate):
+        """Send a new block state to all of the workers."""
+        if self.stale:
+            self._start()
+        encodedstate = _encodestate(blockstate, "WorkerPool")
+        if _startmethod == "fork":
+            for key, value in encodedstate.items():
+                name = self._findshared(value)
+                if name is not None:
+                    encodedstate[key] = _SharedRef(name)
+        self.supervisor.broadcast(("state", encodedstate))
+
+    def run_blocks(
+        self,
+        blockfunc,
+        blockstate,
+        inputshape,
+        maskarray,
+        procbyvoxel=True,
+        showprogressbar=True,
+        blocksize=1000,
+        sharedkeys=None,
+    ):
+        """Process a stage on the pool.  Arguments and return value are the same as
+        run_multiproc_blocks (without nprocs).  sharedkeys lists the entries of blockstate
+        that are (large) shared arrays - any that are not already registered with the pool
+        are registered before the stage runs."""
+        numitems, procunit = _checkmask(
+            inputshape, maskarray, procbyvoxel, "WorkerPool.run_blocks"
+        )
+        thescheduler = BlockScheduler(
+            numitems, maskarray=maskarray, nprocs=self.nprocs, maxblocksize=blocksize
+        )
+        if sharedkeys is not None:
+            newarrays = {}
+            for key in sharedkeys:
+                if not self.canshare(blockstate[key]):
+                    newarrays[key] = blockstate[key]
+            if len(newarrays) > 0:
+                self.register(**newarrays)
+        self.setstate(blockstate)
+        print(
+            "processing", thescheduler.numvalid, procunit, "with", self.nprocs, "pooled processes",
+        )
+        self.numstages += 1
+        startrestarts = self.supervisor.numrestarts
+        data_out = _runscheduled(
+            thescheduler,
+            self.supervisor,
+            lambda theblock: ("block", blockfunc, theblock[0], theblock[1]),
+            blockfunc.__name__,
+            showprogressbar=showprogressbar,
+        )
+        self.numrestarts += self.supervisor.numrestarts - startrestarts
+        return data_out
+
+    def shutdown(self):
+        """Stop all of the workers."""
+        if self.supervisor is not None:
+            self.supervisor.shutdown()
+            self.supervisor = None
+        self.stale = True
+
+
 def run_multithread(
     consumerfunc,
     inputshape,
@@ -191,9 +1179,18 @@ def run_multithread(
         elif maskarray[d] > 0:
             data_in.append(d)
     print("processing", len(data_in), procunit + " with", n_workers, "threads")
-    data_out = _process_data(
+    starttime = time.time()
+    data_out, failed = _process_data(
         data_in, inQ, outQ, showprogressbar=showprogressbar, chunksize=chunksize
     )
+    _recordstage(
+        consumerfunc.__name__,
+        n_workers,
+        len(data_in),
+        len(data_in),
+        time.time() - starttime,
+        failed=failed,
+    )
 
     # shut down workers
     for i in range(n_workers):
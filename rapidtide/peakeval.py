@@ -48,10 +48,14 @@ def _procOneVoxelPeaks(
     oversampfactor=1,
     sort=True,
     interptype="univariate",
+    theoversampler=None,
 ):
 
     if oversampfactor >= 1:
-        thetc[:] = tide_resample.doresample(fmri_x, fmritc, os_fmri_x, method=interptype)
+        if theoversampler is not None:
+            thetc[:] = theoversampler.apply(fmritc)
+        else:
+            thetc[:] = tide_resample.doresample(fmri_x, fmritc, os_fmri_x, method=interptype)
     else:
         thetc[:] = fmritc
     thepeaks = tide_fit.getpeaks(xcorr_x, thexcorr, bipolar=bipolar, display=False)
@@ -67,6 +71,78 @@ def _procOneVoxelPeaks(
     return vox, hybridpeaks
 
 
+def _procVoxelSlabPeaks(
+    startvox,
+    endvox,
+    theMutualInformationator,
+    fmri_x,
+    fmridata,
+    os_fmri_x,
+    xcorr_x,
+    corrdata,
+    bipolar=False,
+    oversampfactor=1,
+    sort=True,
+    interptype="univariate",
+    theoversampler=None,
+    rt_floattype="float64",
+):
+    # evaluate the peaks for a contiguous slab of voxels in one batch
+    peaklists = tide_fit.getpeaksblock(xcorr_x, corrdata[startvox:endvox, :], bipolar=bipolar)
+    theslab = np.zeros((endvox - startvox, len(os_fmri_x)), dtype=rt_floattype)
+    if oversampfactor >= 1 and theoversampler is not None:
+        theslab[:, :] = theoversampler.apply(fmridata[startvox:endvox, :])
+    else:
+        for vox in range(startvox, endvox):
+            if oversampfactor >= 1:
+                theslab[vox - startvox, :] = tide_resample.doresample(
+                    fmri_x, fmridata[vox, :], os_fmri_x, method=interptype
+                )
+            else:
+                theslab[vox - startvox, :] = fmridata[vox, :]
+
+    # voxels with the same number of peaks have their MI values calculated together
+    numpeaks = np.asarray([len(thepeaks) for thepeaks in peaklists], dtype=int)
+    theMIs = [[] for thepeaks in peaklists]
+    for thenumpeaks in np.unique(numpeaks[numpeaks > 0]):
+        therows = np.nonzero(numpeaks == thenumpeaks)[0]
+        thelocs = np.asarray(
+            [[int(round(thepeak[2], 0)) for thepeak in peaklists[i]] for i in therows]
+        )
+        MIblock = theMutualInformationator.run_block(theslab[therows, :], locs=thelocs)
+        for j, i in enumerate(therows):
+            theMIs[i] = MIblock[j, :]
+
+    blockdict = {}
+    for i, thepeaks in enumerate(peaklists):
+        hybridpeaks = []
+        for j in range(len(thepeaks)):
+            hybridpeaks.append([thepeaks[j][0], thepeaks[j][1], theMIs[i][j]])
+        if sort:
+            hybridpeaks.sort(key=lambda x: x[2], reverse=True)
+        blockdict[str(startvox + i)] = hybridpeaks
+    return blockdict
+
+
+def _procVoxelBlockPeaks(blockstate, startvox, endvox):
+    # evaluate the peaks for a contiguous range of voxels
+    return _procVoxelSlabPeaks(
+        startvox,
+        endvox,
+        blockstate["theMutualInformationator"],
+        blockstate["fmri_x"],
+        blockstate["fmridata"],
+        blockstate["os_fmri_x"],
+        blockstate["xcorr_x"],
+        blockstate["corrdata"],
+        bipolar=blockstate["bipolar"],
+        oversampfactor=blockstate["oversampfactor"],
+        interptype=blockstate["interptype"],
+        theoversampler=blockstate["theoversampler"],
+        rt_floattype=blockstate["rt_floattype"],
+    )
+
+
 def peakevalpass(
     fmridata,
     referencetc,
@@ -82,6 +158,8 @@ def peakevalpass(
     interptype="univariate",
     showprogressbar=True,
     chunksize=1000,
+    blockmode=False,
+    pool=None,
     rt_floatset=np.float64,
     rt_floattype="float64",
 ):
@@ -103,6 +181,8 @@ def peakevalpass(
     interptype
     showprogressbar
     chunksize
+    blockmode
+    pool
     rt_floatset
     rt_floattype
 
@@ -115,9 +195,58 @@ def peakevalpass(
 
     inputshape = np.shape(fmridata)
     volumetotal = 0
-    reportstep = 1000
     thetc = np.zeros(np.shape(os_fmri_x), dtype=rt_floattype)
-    if nprocs > 1 or alwaysmultiproc:
+    if oversampfactor >= 1:
+        theoversampler = tide_resample.getinterpolationoperator(
+            fmri_x, os_fmri_x, method=interptype
+        )
+    else:
+        theoversampler = None
+    if (nprocs > 1 or alwaysmultiproc) and (blockmode or pool is not None):
+        blockstate = {
+            "theMutualInformationator": theMutualInformationator,
+            "fmri_x": fmri_x,
+            "fmridata": fmridata,
+            "os_fmri_x": os_fmri_x,
+            "xcorr_x": xcorr_x,
+            "corrdata": corrdata,
+            "bipolar": bipolar,
+            "oversampfactor": oversampfactor,
+            "interptype": interptype,
+            "theoversampler": theoversampler,
+            "rt_floattype": rt_floattype,
+        }
+        if pool is not None:
+            data_out = pool.run_blocks(
+                _procVoxelBlockPeaks,
+                blockstate,
+                inputshape,
+                None,
+                showprogressbar=showprogressbar,
+                blocksize=chunksize,
+                sharedkeys=["fmridata", "corrdata"],
+            )
+        else:
+            data_out = tide_multiproc.run_multiproc_blocks(
+                _procVoxelBlockPeaks,
+                blockstate,
+                inputshape,
+                None,
+                nprocs=nprocs,
+                showprogressbar=showprogressbar,
+                blocksize=chunksize,
+            )
+
+        # merge the per-block peak lists
+        volumetotal = 0
+        for startvox, endvox, blockdict in data_out:
+            peakdict.update(blockdict)
+            volumetotal += len(blockdict)
+        del data_out
+        for vox in tide_multiproc.getfaileditems():
+            # no peaks could be evaluated for this voxel
+            peakdict[str(vox)] = []
+    elif nprocs > 1 or alwaysmultiproc:
         # define the consumer function here so it inherits most of the arguments
         def correlation_consumer(inQ, outQ):
             while True:
@@ -143,12 +272,12 @@ def peakevalpass(
                             bipolar=bipolar,
                             oversampfactor=oversampfactor,
                             interptype=interptype,
+                            theoversampler=theoversampler,
                         )
                     )
 
                 except Exception as e:
-                    print("error!", e)
-                    break
+                    outQ.put(tide_multiproc.WorkerFailure(val, e))
 
         data_out = tide_multiproc.run_multiproc(
             correlation_consumer,
@@ -165,24 +294,33 @@ def peakevalpass(
             peakdict[str(voxel[0])] = voxel[1]
             volumetotal += 1
         del data_out
+        for vox in tide_multiproc.getfaileditems():
+            # no peaks could be evaluated for this voxel
+            peakdict[str(vox)] = []
     else:
-        for vox in range(0, inputshape[0]):
-            if (vox % reportstep == 0 or vox == inputshape[0] - 1) and showprogressbar:
-                tide_util.progressbar(vox + 1, inputshape[0], label="Percent complete")
-            dummy, peakdict[str(vox)] = _procOneVoxelPeaks(
-                vox,
-                thetc,
-                theMutualInformationator,
-                fmri_x,
-                fmridata[vox, :],
-                os_fmri_x,
-                xcorr_x,
-                corrdata[vox, :],
-                bipolar=bipolar,
-                oversampfactor=oversampfactor,
-                interptype=interptype,
+        # work through the voxels a slab at a time, so the peaks are evaluated in batches
+        for startvox in range(0, inputshape[0], chunksize):
+            endvox = min(startvox + chunksize, inputshape[0])
+            if showprogressbar:
+                tide_util.progressbar(endvox, inputshape[0], label="Percent complete")
+            peakdict.update(
+                _procVoxelSlabPeaks(
+                    startvox,
+                    endvox,
+                    theMutualInformationator,
+                    fmri_x,
+                    fmridata,
+                    os_fmri_x,
+                    xcorr_x,
+                    corrdata,
+                    bipolar=bipolar,
+                    oversampfactor=oversampfactor,
+                    interptype=interptype,
+                    theoversampler=theoversampler,
+                    rt_floattype=rt_floattype,
+                )
             )
-            volumetotal += 1
+            volumetotal += endvox - startvox
     print("\nPeak evaluation performed on " + str(volumetotal) + " voxels")
 
     # garbage collect
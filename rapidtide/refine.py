@@ -27,8 +27,8 @@ import sys
 
 import numpy as np
 from scipy.signal import welch
+from scipy.special import gammaln
 from scipy.stats.stats import pearsonr
-from sklearn.decomposition import PCA, FastICA
 
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
@@ -40,6 +40,268 @@ import rapidtide.stats as tide_stats
 import rapidtide.util as tide_util
 
 
+# the most points to pull out of a data array at once when working through its rows in blocks
+MAXBLOCKPOINTS = 4000000
+
+
+def _rowblocks(therows, rowlen):
+    # split a list of rows into blocks that are small enough to copy
+    rowsperblock = int(np.max([MAXBLOCKPOINTS // rowlen, 1]))
+    for startidx in range(0, len(therows), rowsperblock):
+        yield startidx, therows[startidx : startidx + rowsperblock]
+
+
+def sumrows(thedata, therows, signs=None):
+    r"""Sums the selected rows of a 2D array, a block of rows at a time, so that the selection
+    is never copied out of the array all at once.
+
+    Parameters
+    ----------
+    thedata : 2D float array
+        The data, one timecourse per row
+    therows : 1D int array
+        The rows to sum
+    signs : 1D float array, optional
+        A multiplier for each selected row (to flip the sign of anticorrelated voxels, for
+        example).  Default is None.
+
+    Returns
+    -------
+    thesum : 1D float array
+    """
+    thesum = np.zeros(np.shape(thedata)[1], dtype=np.float64)
+    for startidx, blockrows in _rowblocks(therows, np.shape(thedata)[1]):
+        if signs is None:
+            thesum += np.sum(thedata[blockrows, :], axis=0)
+        else:
+            thesum += signs[startidx : startidx + len(blockrows)] @ thedata[blockrows, :]
+    return thesum
+
+
+def _mledimension(spectrum, numsamples):
+    # Minka's choice of the number of principal components ("Automatic Choice of Dimensionality
+    # for PCA", NIPS 2000), from the covariance eigenvalues in descending order - the same
+    # estimate as PCA(n_components="mle") in sklearn
+    eps = 1e-15
+    numfeatures = len(spectrum)
+    loglike = np.full(numfeatures, -np.inf)
+    for rank in range(1, numfeatures):
+        if spectrum[rank - 1] < eps:
+            continue
+        kept = np.arange(rank)
+        pu = -rank * np.log(2.0) + np.sum(
+            gammaln((numfeatures - kept) / 2.0) - np.log(np.pi) * (numfeatures - kept) / 2.0
+        )
+        pl = -np.sum(np.log(spectrum[:rank])) * numsamples / 2.0
+        v = np.max([eps, np.sum(spectrum[rank:]) / (numfeatures - rank)])
+        pv = -np.log(v) * numsamples * (numfeatures - rank) / 2.0
+        m = numfeatures * rank - rank * (rank + 1.0) / 2.0
+        pp = np.log(2.0 * np.pi) * (m + rank) / 2.0
+        thespectrum = spectrum + 0.0
+        thespectrum[rank:] = v
+        pairs = np.arange(numfeatures)[None, :] > kept[:, None]
+        theterms = (
+            (spectrum[:rank, None] - spectrum[None, :])
+            * (1.0 / thespectrum[None, :] - 1.0 / thespectrum[:rank, None])
+        )[pairs]
+        pa = np.sum(np.log(theterms)) + len(theterms) * np.log(numsamples)
+        loglike[rank] = pu + pl + pv + pp - pa / 2.0 - rank * np.log(numsamples) / 2.0
+    return np.argmax(loglike)
+
+
+def blockpca(thedata, therows, pcacomponents, signs=None, demeanrows=False, debug=False):
+    r"""Principal component analysis of the selected rows of a 2D array.  The covariance of
+    the timepoints is accumulated a block of rows at a time, so the memory needed depends on
+    the length of the timecourses, not the number of rows, and the selection is never copied
+    out of the array all at once.
+
+    By default the rows are the samples, and are centered by subtracting the mean row, as
+    PCA().fit(thedata[therows, :]) does.  If demeanrows is True, the mean of each row is
+    subtracted instead - the timepoints are then the samples, as in
+    PCA().fit(thedata[therows, :].T), and the components are the time courses of its scores.
+    Either way the components are unit vectors in time.
+
+    Parameters
+    ----------
+    thedata : 2D float array
+        The data, one timecourse per row
+    therows : 1D int array
+        The rows to analyze
+    pcacomponents : int, float, or "mle"
+        The components to keep, as for sklearn's PCA - a number of components, the fraction
+        of the variance to explain, or "mle" to choose the number automatically
+    signs : 1D float array, optional
+        A multiplier for each selected row.  Default is None.
+    demeanrows : bool, optional
+        Remove the mean of each row rather than the mean row.  Default is False.
+    debug : bool, optional
+        Print debugging information.  Default is False.
+
+    Returns
+    -------
+    thecomponents : 2D float array
+        The retained components, one per row
+    thesingularvalues : 1D float array
+        The singular values of the centered data for the retained components
+    explainedvarianceratio : 1D float array
+        The fraction of the variance explained by every component
+    themean : 1D float array
+        The mean of the (sign adjusted) rows
+    """
+    numrows = len(therows)
+    rowlen = np.shape(thedata)[1]
+    if signs is None:
+        signs = np.ones(numrows, dtype=np.float64)
+
+    # first find the mean, then accumulate the covariance about it
+    themean = sumrows(thedata, therows, signs=signs) / numrows
+    thecov = np.zeros((rowlen, rowlen), dtype=np.float64)
+    for startidx, blockrows in _rowblocks(therows, rowlen):
+        theblock = np.asarray(thedata[blockrows, :], dtype=np.float64)
+        theblock *= signs[startidx : startidx + len(blockrows), None]
+        if demeanrows:
+            theblock -= np.mean(theblock, axis=1)[:, None]
+        else:
+            theblock -= themean[None, :]
+        thecov += theblock.T @ theblock
+    theeigenvalues, theeigenvectors = np.linalg.eigh(thecov)
+    theeigenvalues = np.clip(theeigenvalues[::-1], 0.0, None)
+    theeigenvectors = theeigenvectors[:, ::-1]
+    totalvariance = np.sum(theeigenvalues)
+    if totalvariance > 0.0:
+        explainedvarianceratio = theeigenvalues / totalvariance
+    else:
+        explainedvarianceratio = theeigenvalues * 0.0
+
+    # choose the number of components the way sklearn does
+    if demeanrows:
+        numsamples, numfeatures = rowlen, numrows
+    else:
+        numsamples, numfeatures = numrows, rowlen
+    maxcomponents = np.min([numsamples, numfeatures])
+    if pcacomponents == "mle":
+        if numsamples < numfeatures:
+            raise ValueError("mle estimation requires at least as many samples as features")
+        numcomponents = _mledimension(theeigenvalues / (numsamples - 1), numsamples)
+    elif 0.0 < pcacomponents < 1.0:
+        numcomponents = (
+            np.searchsorted(np.cumsum(explainedvarianceratio), pcacomponents, side="right") + 1
+        )
+    elif pcacomponents >= 1:
+        numcomponents = int(pcacomponents)
+    else:
+        raise ValueError(f"illegal value for pcacomponents: {pcacomponents}")
+    if not (1 <= numcomponents <= maxcomponents):
+        raise ValueError(f"cannot keep {numcomponents} components of {maxcomponents}")
+    if debug:
+        print(f"blockpca: {numrows} rows, keeping {numcomponents} components")
+    return (
+        theeigenvectors[:, :numcomponents].T,
+        np.sqrt(theeigenvalues[:numcomponents]),
+        explainedvarianceratio,
+        themean,
+    )
+
+
+def stratifiedorder(lagtimes, lagstrengths, seed=None, numlagbins=10, numstrengthbins=4):
+    r"""Puts voxels in a random order in which every leading section is a stratified sample
+    - the voxels are split into bins of lag and correlation strength, and each bin is spread
+    evenly through the ordering.  Taking the first N voxels of the ordering therefore gives a
+    sample with close to the same distribution of lags and strengths as the whole set, and
+    larger samples contain the smaller ones.
+
+    Parameters
+    ----------
+    lagtimes : 1D float array
+        The lag of each voxel
+    lagstrengths : 1D float array
+        The correlation strength of each voxel
+    seed : int or list of ints, optional
+        The seed for the random number generator.  Default is None.
+    numlagbins : int, optional
+        The number of (equally populated) lag bins.  Default is 10.
+    numstrengthbins : int, optional
+        The number of (equally populated) strength bins within each lag bin.  Default is 4.
+
+    Returns
+    -------
+    theorder : 1D int array
+        The indices of the voxels, in sampling order
+    """
+    rng = np.random.default_rng(seed)
+    strata = np.zeros(len(lagtimes), dtype=np.int64)
+    for thevals, numbins in [(lagtimes, numlagbins), (lagstrengths, numstrengthbins)]:
+        theedges = np.quantile(thevals, np.linspace(0.0, 1.0, numbins + 1)[1:-1])
+        strata = strata * numbins + np.searchsorted(theedges, thevals, side="right")
+
+    # give the members of each stratum evenly spaced keys in [0, 1), in a random order and with
+    # a random offset, and sort on the keys
+    thekeys = np.zeros(len(lagtimes), dtype=np.float64)
+    for thestratum in np.unique(strata):
+        themembers = np.where(strata == thestratum)[0]
+        thekeys[rng.permutation(themembers)] = (
+            np.arange(len(themembers)) + rng.uniform()
+        ) / len(themembers)
+    return np.argsort(thekeys, kind="stable")
+
+
+def _procVoxelsTimeShift(
+    fmritcs,
+    lagstrengths,
+    R2vals,
+    lagtimes,
+    padtrs,
+    fmritr,
+    refineprenorm="mean",
+    lagmaxthresh=5.0,
+    refineweighting="R",
+    detrendorder=1,
+    offsettime=0.0,
+    psdfilter=False,
+):
+    # normalize, weight, and timeshift a block of voxel timecourses (one per row) together
+    if refineprenorm == "mean":
+        thedivisor = np.mean(fmritcs, axis=1)
+    elif refineprenorm == "var":
+        thedivisor = np.var(fmritcs, axis=1)
+    elif refineprenorm == "std":
+        thedivisor = np.std(fmritcs, axis=1)
+    elif refineprenorm == "invlag":
+        thedivisor = np.where(lagtimes < lagmaxthresh, lagmaxthresh - lagtimes, 0.0)
+    else:
+        thedivisor = np.ones(len(lagtimes), dtype=np.float64)
+    normfac = np.divide(
+        1.0, thedivisor, out=np.zeros(len(lagtimes), dtype=np.float64), where=(thedivisor != 0.0)
+    )
+
+    if refineweighting == "R":
+        thisweight = lagstrengths
+    elif refineweighting == "R2":
+        thisweight = R2vals
+    else:
+        thisweight = np.where(lagstrengths > 0.0, 1.0, -1.0)
+    normtcs = fmritcs * (normfac * thisweight)[:, None]
+    if detrendorder > 0:
+        normtcs = tide_fit.detrendblock(normtcs, order=detrendorder, demean=True)
+    shifttrs = -(-offsettime + lagtimes) / fmritr  # lagtime is in seconds
+    shiftedtcs, shiftedweights = tide_resample.timeshiftblock(normtcs, shifttrs, padtrs)
+    if psdfilter:
+        psds = []
+        for shiftedtc in shiftedtcs:
+            freqs, psd = welch(
+                tide_math.corrnormalize(shiftedtc, True, True),
+                fmritr,
+                scaling="spectrum",
+                window="hamming",
+                return_onesided=False,
+                nperseg=len(shiftedtc),
+            )
+            psds.append(np.sqrt(psd))
+        return shiftedtcs, shiftedweights, psds
+    else:
+        return shiftedtcs, shiftedweights, None
+
+
 def _procOneVoxelTimeShift(
     vox,
     fmritc,
@@ -60,59 +322,206 @@ def _procOneVoxelTimeShift(
     rt_floatset=np.float64,
     rt_floattype="float64",
 ):
-    if refineprenorm == "mean":
-        thedivisor = np.mean(fmritc)
-    elif refineprenorm == "var":
-        thedivisor = np.var(fmritc)
-    elif refineprenorm == "std":
-        thedivisor = np.std(fmritc)
-    elif refineprenorm == "invlag":
-        if lagtime < lagmaxthresh:
-            thedivisor = lagmaxthresh - lagtime
-        else:
-            thedivisor = 0.0
+    shiftedtcs, shiftedweights, psds = _procVoxelsTimeShift(
+        np.asarray(fmritc)[None, :],
+        np.array([lagstrength]),
+        np.array([R2val]),
+        np.array([lagtime]),
+        padtrs,
+        fmritr,
+        refineprenorm=refineprenorm,
+        lagmaxthresh=lagmaxthresh,
+        refineweighting=refineweighting,
+        detrendorder=detrendorder,
+        offsettime=offsettime,
+        psdfilter=psdfilter,
+    )
+    if filterbeforePCA:
+        outtc = theprefilter.apply(fmrifreq, shiftedtcs[0, :])
+        outweights = theprefilter.apply(fmrifreq, shiftedweights[0, :])
     else:
-        thedivisor = 1.0
-    if thedivisor != 0.0:
-        normfac = 1.0 / thedivisor
+        outtc = shiftedtcs[0, :]
+        outweights = shiftedweights[0, :]
+    if psdfilter:
+        return vox, outtc, outweights, psds[0]
     else:
-        normfac = 0.0
+        return vox, outtc, outweights, None
 
-    if refineweighting == "R":
-        thisweight = lagstrength
-    elif refineweighting == "R2":
-        thisweight = R2val
-    else:
-        if lagstrength > 0.0:
-            thisweight = 1.0
-        else:
-            thisweight = -1.0
-    if detrendorder > 0:
-        normtc = tide_fit.detrend(fmritc * normfac * thisweight, order=detrendorder, demean=True)
-    else:
-        normtc = fmritc * normfac * thisweight
-    shifttr = -(-offsettime + lagtime) / fmritr  # lagtime is in seconds
-    [shiftedtc, weights, paddedshiftedtc, paddedweights] = tide_resample.timeshift(
-        normtc, shifttr, padtrs
+
+def _procVoxelBlockTimeShift(blockstate, startvox, endvox):
+    # timeshift a contiguous range of voxels, writing directly into the (shared) output arrays
+    optiondict = blockstate["optiondict"]
+    thevoxels = startvox + np.where(blockstate["shiftmask"][startvox:endvox] > 0.5)[0]
+    if len(thevoxels) == 0:
+        return []
+    shiftedtcs, shiftedweights, blockpsds = _procVoxelsTimeShift(
+        blockstate["fmridata"][thevoxels, :],
+        blockstate["lagstrengths"][thevoxels],
+        blockstate["R2"][thevoxels],
+        blockstate["lagtimes"][thevoxels],
+        blockstate["padtrs"],
+        blockstate["fmritr"],
+        refineprenorm=optiondict["refineprenorm"],
+        lagmaxthresh=optiondict["lagmaxthresh"],
+        refineweighting=optiondict["refineweighting"],
+        detrendorder=optiondict["detrendorder"],
+        offsettime=optiondict["offsettime"],
+        psdfilter=optiondict["psdfilter"],
     )
-    if filterbeforePCA:
-        outtc = theprefilter.apply(fmrifreq, shiftedtc)
-        outweights = theprefilter.apply(fmrifreq, weights)
+    blockstate["shiftedtcs"][thevoxels, :] = shiftedtcs
+    blockstate["weights"][thevoxels, :] = shiftedweights
+    if optiondict["psdfilter"]:
+        return blockpsds
     else:
-        outtc = 1.0 * shiftedtc
-        outweights = 1.0 * weights
-    if psdfilter:
-        freqs, psd = welch(
-            tide_math.corrnormalize(shiftedtc, True, True),
-            fmritr,
-            scaling="spectrum",
-            window="hamming",
-            return_onesided=False,
-            nperseg=len(shiftedtc),
+        return []
+
+
+def _timeshiftvoxels(
+    shiftmask,
+    fmridata,
+    fmritr,
+    shiftedtcs,
+    weights,
+    lagstrengths,
+    lagtimes,
+    R2,
+    theprefilter,
+    optiondict,
+    padtrs=60,
+    pool=None,
+    rt_floatset=np.float64,
+    rt_floattype="float64",
+):
+    # timeshift the voxels in shiftmask into shiftedtcs and weights, returning the number
+    # shifted and the psds (if psdfilter is set)
+    inputshape = np.shape(fmridata)
+    volumetotal = np.sum(shiftmask)
+    if volumetotal == 0:
+        return 0, []
+    blockstate = {
+        "shiftmask": shiftmask,
+        "fmridata": fmridata,
+        "lagstrengths": lagstrengths,
+        "R2": R2,
+        "lagtimes": lagtimes,
+        "padtrs": padtrs,
+        "fmritr": fmritr,
+        "shiftedtcs": shiftedtcs,
+        "weights": weights,
+        "optiondict": optiondict,
+    }
+    if optiondict["nprocs"] > 1 and (optiondict["mp_blockmode"] or pool is not None):
+        if pool is not None:
+            data_out = pool.run_blocks(
+                _procVoxelBlockTimeShift,
+                blockstate,
+                inputshape,
+                shiftmask,
+                showprogressbar=True,
+                blocksize=optiondict["mp_chunksize"],
+                sharedkeys=["fmridata", "shiftedtcs", "weights"],
+            )
+        else:
+            data_out = tide_multiproc.run_multiproc_blocks(
+                _procVoxelBlockTimeShift,
+                blockstate,
+                inputshape,
+                shiftmask,
+                nprocs=optiondict["nprocs"],
+                showprogressbar=True,
+                blocksize=optiondict["mp_chunksize"],
+            )
+
+        # gather the psds, if any
+        psdlist = []
+        for startvox, endvox, blockpsds in data_out:
+            psdlist += blockpsds
+        del data_out
+        failedvoxels = tide_multiproc.getfaileditems()
+        if len(failedvoxels) > 0:
+            # leave the voxels that could not be shifted out of the average
+            print(f"could not timeshift {len(failedvoxels)} voxels - excluding them")
+            shiftedtcs[failedvoxels, :] = 0.0
+            weights[failedvoxels, :] = 0.0
+            volumetotal -= len(failedvoxels)
+
+    elif optiondict["nprocs"] > 1:
+        # define the consumer function here so it inherits most of the arguments
+        def timeshift_consumer(inQ, outQ):
+            while True:
+                try:
+                    # get a new message
+                    val = inQ.get()
+
+                    # this is the 'TERM' signal
+                    if val is None:
+                        break
+
+                    # process and send the data
+                    outQ.put(
+                        _procOneVoxelTimeShift(
+                            val,
+                            fmridata[val, :],
+                            lagstrengths[val],
+                            R2[val],
+                            lagtimes[val],
+                            padtrs,
+                            fmritr,
+                            theprefilter,
+                            optiondict["fmrifreq"],
+                            refineprenorm=optiondict["refineprenorm"],
+                            lagmaxthresh=optiondict["lagmaxthresh"],
+                            refineweighting=optiondict["refineweighting"],
+                            detrendorder=optiondict["detrendorder"],
+                            offsettime=optiondict["offsettime"],
+                            filterbeforePCA=False,
+                            psdfilter=optiondict["psdfilter"],
+                            rt_floatset=rt_floatset,
+                            rt_floattype=rt_floattype,
+                        )
+                    )
+
+                except Exception as e:
+                    outQ.put(tide_multiproc.WorkerFailure(val, e))
+
+        data_out = tide_multiproc.run_multiproc(
+            timeshift_consumer,
+            inputshape,
+            shiftmask,
+            nprocs=optiondict["nprocs"],
+            showprogressbar=True,
+            chunksize=optiondict["mp_chunksize"],
         )
-        return vox, outtc, outweights, np.sqrt(psd)
+
+        # unpack the data
+        psdlist = []
+        for voxel in data_out:
+            shiftedtcs[voxel[0], :] = voxel[1]
+            weights[voxel[0], :] = voxel[2]
+            if optiondict["psdfilter"]:
+                psdlist.append(voxel[3])
+        del data_out
+        failedvoxels = tide_multiproc.getfaileditems()
+        if len(failedvoxels) > 0:
+            # leave the voxels that could not be shifted out of the average
+            print(f"could not timeshift {len(failedvoxels)} voxels - excluding them")
+            shiftedtcs[failedvoxels, :] = 0.0
+            weights[failedvoxels, :] = 0.0
+            volumetotal -= len(failedvoxels)
+
     else:
-        return vox, outtc, outweights, None
+        # timeshift the voxels a chunk at a time
+        psdlist = []
+        for startvox in range(0, inputshape[0], optiondict["mp_chunksize"]):
+            endvox = np.min([startvox + optiondict["mp_chunksize"], inputshape[0]])
+            if optiondict["showprogressbar"]:
+                tide_util.progressbar(
+                    endvox, inputshape[0], label="Percent complete (timeshifting)"
+                )
+            psdlist += _procVoxelBlockTimeShift(blockstate, startvox, endvox)
+        print()
+
+    return volumetotal, psdlist
 
 
 def refineregressor(
@@ -132,6 +541,7 @@ def refineregressor(
     bipolar=False,
     includemask=None,
     excludemask=None,
+    pool=None,
     debug=False,
     rt_floatset=np.float64,
     rt_floattype="float64",
@@ -170,6 +580,8 @@ def refineregressor(
         Mask of voxels to include in refinement.  Default is None (all voxels).
     excludemask : 3D array
         Mask of voxels to exclude from refinement.  Default is None (no voxels).
+    pool : WorkerPool, optional
+        A persistent worker pool to use for the timeshifting.  Default is None.
     debug : bool
         Enable additional debugging output.  Default is False
     rt_floatset : function
@@ -277,103 +689,121 @@ def refineregressor(
         shiftmask = locationmask
     else:
         shiftmask = refinemask
-    volumetotal = np.sum(shiftmask)
-    reportstep = 1000
-
-    # timeshift the valid voxels
-    if optiondict["nprocs"] > 1:
-        # define the consumer function here so it inherits most of the arguments
-        def timeshift_consumer(inQ, outQ):
-            while True:
-                try:
-                    # get a new message
-                    val = inQ.get()
-
-                    # this is the 'TERM' signal
-                    if val is None:
-                        break
 
-                    # process and send the data
-                    outQ.put(
-                        _procOneVoxelTimeShift(
-                            val,
-                            fmridata[val, :],
-                            lagstrengths[val],
-                            R2[val],
-                            lagtimes[val],
-                            padtrs,
-                            fmritr,
-                            theprefilter,
+    if (optiondict["refinesubsample"] is not None) and (
+        optiondict["refinesubsample"] < tide_stats.getmasksize(refinemask)
+    ):
+        # only timeshift a stratified sample of the refine mask - if there is a tolerance, keep
+        # doubling the sample until the regressors from two independent halves of it match
+        candidates = np.where(refinemask > 0)[0]
+        thesampleorder = candidates[
+            stratifiedorder(
+                lagtimes[candidates],
+                np.fabs(lagstrengths[candidates]),
+                seed=[optiondict["refinesubsampleseed"], passnum],
+            )
+        ]
+        if optiondict["cleanrefined"]:
+            # the voxels outside the refine mask are needed for cleaning
+            shiftmask = locationmask * (1 - refinemask)
+        else:
+            shiftmask = refinemask * 0
+        volumetotal, psdlist = _timeshiftvoxels(
+            shiftmask,
+            fmridata,
+            fmritr,
+            shiftedtcs,
+            weights,
+            lagstrengths,
+            lagtimes,
+            R2,
+            theprefilter,
+            optiondict,
+            padtrs=padtrs,
+            pool=pool,
+            rt_floatset=rt_floatset,
+            rt_floattype=rt_floattype,
+        )
+        numsamples = 0
+        newnumsamples = optiondict["refinesubsample"]
+        while True:
+            newmask = shiftmask * 0
+            newmask[thesampleorder[numsamples:newnumsamples]] = 1
+            numsamples = newnumsamples
+            numshifted, newpsds = _timeshiftvoxels(
+                newmask,
+                fmridata,
+                fmritr,
+                shiftedtcs,
+                weights,
+                lagstrengths,
+                lagtimes,
+                R2,
+                theprefilter,
+                optiondict,
+                padtrs=padtrs,
+                pool=pool,
+                rt_floatset=rt_floatset,
+                rt_floattype=rt_floattype,
+            )
+            volumetotal += numshifted
+            psdlist += newpsds
+            shiftmask = shiftmask + newmask
+            if optiondict["refinesubsampletol"] is None or numsamples == len(candidates):
+                break
+            halfregressors = []
+            for thehalf in [thesampleorder[0:numsamples:2], thesampleorder[1:numsamples:2]]:
+                if bipolar:
+                    halfsigns = np.where(lagstrengths[thehalf] < 0.0, -1.0, 1.0)
+                else:
+                    halfsigns = None
+                halfregressors.append(
+                    tide_math.stdnormalize(
+                        theprefilter.apply(
                             optiondict["fmrifreq"],
-                            refineprenorm=optiondict["refineprenorm"],
-                            lagmaxthresh=optiondict["lagmaxthresh"],
-                            refineweighting=optiondict["refineweighting"],
-                            detrendorder=optiondict["detrendorder"],
-                            offsettime=optiondict["offsettime"],
-                            filterbeforePCA=optiondict["filterbeforePCA"],
-                            psdfilter=optiondict["psdfilter"],
-                            rt_floatset=rt_floatset,
-                            rt_floattype=rt_floattype,
+                            sumrows(shiftedtcs, thehalf, signs=halfsigns),
                         )
                     )
-
-                except Exception as e:
-                    print("error!", e)
-                    break
-
-        data_out = tide_multiproc.run_multiproc(
-            timeshift_consumer,
-            inputshape,
+                )
+            halfmse = np.mean(np.square(halfregressors[1] - halfregressors[0]))
+            print(f"MSE between the regressors from two halves of {numsamples} voxels: {halfmse}")
+            optiondict["refinesubsamplemse_pass" + str(passnum)] = halfmse
+            if halfmse <= optiondict["refinesubsampletol"]:
+                break
+            newnumsamples = np.min([2 * numsamples, len(candidates)])
+        refinemask = refinemask * 0
+        refinemask[thesampleorder[:numsamples]] = 1
+        optiondict["refinesubsamplesize_pass" + str(passnum)] = int(numsamples)
+        print(f"using {numsamples} of {len(candidates)} voxels in the refine mask")
+    else:
+        volumetotal, psdlist = _timeshiftvoxels(
             shiftmask,
-            nprocs=optiondict["nprocs"],
-            showprogressbar=True,
-            chunksize=optiondict["mp_chunksize"],
+            fmridata,
+            fmritr,
+            shiftedtcs,
+            weights,
+            lagstrengths,
+            lagtimes,
+            R2,
+            theprefilter,
+            optiondict,
+            padtrs=padtrs,
+            pool=pool,
+            rt_floatset=rt_floatset,
+            rt_floattype=rt_floattype,
         )
 
-        # unpack the data
-        psdlist = []
-        for voxel in data_out:
-            shiftedtcs[voxel[0], :] = voxel[1]
-            weights[voxel[0], :] = voxel[2]
-            if optiondict["psdfilter"]:
-                psdlist.append(voxel[3])
-        del data_out
-
-    else:
-        psdlist = []
-        for vox in range(0, inputshape[0]):
-            if (vox % reportstep == 0 or vox == inputshape[0] - 1) and optiondict[
-                "showprogressbar"
-            ]:
-                tide_util.progressbar(
-                    vox + 1, inputshape[0], label="Percent complete (timeshifting)"
-                )
-            if shiftmask[vox] > 0.5:
-                retvals = _procOneVoxelTimeShift(
-                    vox,
-                    fmridata[vox, :],
-                    lagstrengths[vox],
-                    R2[vox],
-                    lagtimes[vox],
-                    padtrs,
-                    fmritr,
-                    theprefilter,
-                    optiondict["fmrifreq"],
-                    refineprenorm=optiondict["refineprenorm"],
-                    lagmaxthresh=optiondict["lagmaxthresh"],
-                    refineweighting=optiondict["refineweighting"],
-                    detrendorder=optiondict["detrendorder"],
-                    offsettime=optiondict["offsettime"],
-                    filterbeforePCA=optiondict["filterbeforePCA"],
-                    psdfilter=optiondict["psdfilter"],
-                    rt_floatset=rt_floatset,
-                    rt_floattype=rt_floattype,
-                )
-                shiftedtcs[retvals[0], :] = retvals[1]
-                weights[retvals[0], :] = retvals[2]
-                if optiondict["psdfilter"]:
-                    psdlist.append(retvals[3])
-        print()
+    if optiondict["filterbeforePCA"]:
+        # filter the shifted timecourses and weights a chunk of voxels at a time
+        shiftedvoxels = np.where(shiftmask > 0.5)[0]
+        for startidx in range(0, len(shiftedvoxels), optiondict["mp_chunksize"]):
+            thevoxels = shiftedvoxels[startidx : startidx + optiondict["mp_chunksize"]]
+            shiftedtcs[thevoxels, :] = theprefilter.apply(
+                optiondict["fmrifreq"], shiftedtcs[thevoxels, :]
+            )
+            weights[thevoxels, :] = theprefilter.apply(
+                optiondict["fmrifreq"], weights[thevoxels, :]
+            )
 
     if optiondict["psdfilter"]:
         print(len(psdlist))
@@ -385,20 +815,16 @@ def refineregressor(
 
     # now generate the refined timecourse(s)
     validlist = np.where(refinemask > 0)[0]
-    refinevoxels = shiftedtcs[validlist, :]
     if bipolar:
-        for thevoxel in range(len(validlist)):
-            if lagstrengths[validlist][thevoxel] < 0.0:
-                refinevoxels[thevoxel, :] *= -1.0
-    refineweights = weights[validlist]
-    weightsum = np.sum(refineweights, axis=0) / volumetotal
-    averagedata = np.sum(refinevoxels, axis=0) / volumetotal
+        refinesigns = np.where(lagstrengths[validlist] < 0.0, -1.0, 1.0)
+    else:
+        refinesigns = None
+    weightsum = sumrows(weights, validlist) / volumetotal
+    averagedata = sumrows(shiftedtcs, validlist, signs=refinesigns) / volumetotal
     if optiondict["cleanrefined"]:
         invalidlist = np.where((1 - ampmask) > 0)[0]
-        discardvoxels = shiftedtcs[invalidlist]
-        discardweights = weights[invalidlist]
-        discardweightsum = np.sum(discardweights, axis=0) / volumetotal
-        averagediscard = np.sum(discardvoxels, axis=0) / volumetotal
+        discardweightsum = sumrows(weights, invalidlist) / volumetotal
+        averagediscard = sumrows(shiftedtcs, invalidlist) / volumetotal
     if optiondict["dodispersioncalc"]:
         print("splitting regressors by time lag for phase delay estimation")
         laglist = np.arange(
@@ -469,9 +895,17 @@ def refineregressor(
 
     if optiondict["refinetype"] == "ica":
         print("performing ica refinement")
-        thefit = FastICA(n_components=icacomponents).fit(refinevoxels)  # Reconstruct signals
-        print("Using first of ", len(thefit.components_), " components")
-        icadata = thefit.components_[0]
+        try:
+            thecomponents, thesingularvalues, dummy, dummy = blockpca(
+                shiftedtcs, validlist, icacomponents, signs=refinesigns, debug=debug
+            )
+        except ValueError:
+            print("unhandled math exception in ICA refinement - exiting")
+            sys.exit()
+        print("Using first of ", len(thecomponents), " components")
+        # with one component, the FastICA unmixing vector is just the whitened first principal
+        # component (with an arbitrary sign, which is set below)
+        icadata = np.sqrt(len(validlist)) * thecomponents[0] / thesingularvalues[0]
         filteredavg = tide_math.corrnormalize(
             theprefilter.apply(optiondict["fmrifreq"], averagedata),
             detrendorder=optiondict["detrendorder"],
@@ -491,26 +925,32 @@ def refineregressor(
         # using hypercapnic and hyperoxic respiratory challenges". NeuroImage 187, 154?165 (2019).
         print("performing pca refinement with pcacomponents set to", pcacomponents)
         try:
-            thefit = PCA(n_components=pcacomponents).fit(refinevoxels)
+            thecomponents, dummy, explainedvarianceratio, themean = blockpca(
+                shiftedtcs, validlist, pcacomponents, signs=refinesigns, debug=debug
+            )
         except ValueError:
             if pcacomponents == "mle":
                 print("mle estimation failed - falling back to pcacomponents=0.8")
-                thefit = PCA(n_components=0.8).fit(refinevoxels)
+                thecomponents, dummy, explainedvarianceratio, themean = blockpca(
+                    shiftedtcs, validlist, 0.8, signs=refinesigns, debug=debug
+                )
             else:
                 print("unhandled math exception in PCA refinement - exiting")
                 sys.exit()
         print(
             "Using ",
-            len(thefit.components_),
+            len(thecomponents),
             " component(s), accounting for ",
             "{:.2f}% of the variance".format(
-                100.0 * np.cumsum(thefit.explained_variance_ratio_)[len(thefit.components_) - 1]
+                100.0 * np.cumsum(explainedvarianceratio)[len(thecomponents) - 1]
             ),
         )
-        reduceddata = thefit.inverse_transform(thefit.transform(refinevoxels))
+        # this is the average of the voxels reconstructed from the retained components - the
+        # reconstruction only changes how each voxel differs from the mean voxel, so the
+        # average is the mean voxel
+        pcadata = 1.0 * themean
         if debug:
-            print("complex processing: reduceddata.shape =", reduceddata.shape)
-        pcadata = np.mean(reduceddata, axis=0)
+            print("complex processing: pcadata.shape =", pcadata.shape)
         filteredavg = tide_math.corrnormalize(
             theprefilter.apply(optiondict["fmrifreq"], averagedata),
             detrendorder=optiondict["detrendorder"],
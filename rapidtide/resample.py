@@ -23,18 +23,16 @@ import sys
 import time
 
 import numpy as np
-import pyfftw
 import pylab as pl
 import scipy as sp
 from numba import jit
-from scipy import fftpack, signal
+from scipy import signal
 
+import rapidtide.fftbackend as tide_fft
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
 import rapidtide.util as tide_util
 
-fftpack = pyfftw.interfaces.scipy_fftpack
-pyfftw.interfaces.cache.enable()
 
 # this is here until numpy deals with their fft issue
 import warnings
@@ -404,12 +402,65 @@ def doresample(orig_x, orig_y, new_x, method="cubic", padlen=0, antialias=False,
     elif method == "univariate":
         interpolator = sp.interpolate.UnivariateSpline(pad_x, pad_y, k=3, s=0)  # s=0 interpolates
         # return tide_filt.unpadvec(np.float64(interpolator(new_x)), padlen=padlen)
-        return np.float64(interpolator(new_x))
+        return interpolator(new_x).astype(np.result_type(np.asarray(orig_y).dtype, np.float32))
     else:
         print("invalid interpolation method")
         return None
 
 
+class InterpolationOperator:
+    """The linear operator that doresample applies when going from one fixed time axis to
+    another.
+
+    Every doresample method is linear in the data, so the operator is found once, by
+    resampling each unit vector, and then applied to any number of timecourses with a
+    single (sparse) matrix product.  Entries smaller than tol times the largest one are
+    dropped, which leaves a banded matrix, since the influence of each input point on the
+    interpolated curve dies away quickly with distance.
+    """
+
+    def __init__(self, orig_x, new_x, method="univariate", tol=1e-12):
+        self.method = method
+        self.inputlen = len(orig_x)
+        self.outputlen = len(new_x)
+        theoperator = np.zeros((self.outputlen, self.inputlen), dtype=np.float64)
+        unitvec = np.zeros(self.inputlen, dtype=np.float64)
+        for i in range(self.inputlen):
+            unitvec[i] = 1.0
+            theoperator[:, i] = doresample(orig_x, unitvec, new_x, method=method)
+            unitvec[i] = 0.0
+        theoperator[np.fabs(theoperator) < tol * np.max(np.fabs(theoperator))] = 0.0
+        self.operator = sp.sparse.csr_matrix(theoperator)
+        self.operator32 = None
+
+    def apply(self, thedata):
+        """Resample a timecourse, or a 2D array with one timecourse per row."""
+        if np.shape(thedata)[-1] != self.inputlen:
+            raise ValueError("InterpolationOperator: data does not match the original time axis")
+        theoperator = self.operator
+        if np.asarray(thedata).dtype == np.float32:
+            # keep single precision data in single precision
+            if self.operator32 is None:
+                self.operator32 = self.operator.astype(np.float32)
+            theoperator = self.operator32
+        if np.ndim(thedata) == 1:
+            return theoperator @ thedata
+        return (theoperator @ np.transpose(thedata)).T
+
+
+_interpolationoperators = {}
+
+
+def getinterpolationoperator(orig_x, new_x, method="univariate"):
+    """Return an InterpolationOperator from orig_x to new_x, reusing the last one made for
+    the same axes and method."""
+    thekey = (method, np.asarray(orig_x).tobytes(), np.asarray(new_x).tobytes())
+    if thekey not in _interpolationoperators:
+        _interpolationoperators.clear()
+        _interpolationoperators[thekey] = InterpolationOperator(orig_x, new_x, method=method)
+    return _interpolationoperators[thekey]
+
+
 def arbresample(
     inputdata,
     init_freq,
@@ -703,6 +754,18 @@ def calcsliceoffset(sotype, slicenum, numslices, tr, multiband=1):
 
 # NB: a positive value of shifttrs delays the signal, a negative value advances it
 # timeshift using fourier phase multiplication
+def _timeshiftfftlen(thelen, padtrs):
+    # extend the end pad so the transform length is fast (keeping its parity, which the phase
+    # modulation depends on) - the extra points are trimmed off again after shifting
+    thepaddedlen = thelen + 2 * padtrs
+    fftlen = tide_fft.next_fast_len(thepaddedlen)
+    while (fftlen - thepaddedlen) % 2 != 0:
+        fftlen = tide_fft.next_fast_len(fftlen + 1)
+    if fftlen - thepaddedlen + padtrs > thelen:
+        fftlen = thepaddedlen
+    return fftlen
+
+
 def timeshift(inputtc, shifttrs, padtrs, doplot=False, debug=False):
     """
 
@@ -720,40 +783,47 @@ def timeshift(inputtc, shifttrs, padtrs, doplot=False, debug=False):
     # set up useful parameters
     thelen = np.shape(inputtc)[0]
     thepaddedlen = thelen + 2 * padtrs
+    thetype = np.result_type(np.asarray(inputtc).dtype, np.float32)
+
+    fftlen = _timeshiftfftlen(thelen, padtrs)
+    endpadtrs = fftlen - thepaddedlen + padtrs
     if debug:
         print("timesshift: thelen, padtrs, thepaddedlen=", thelen, padtrs, thepaddedlen)
+        print("timesshift: fftlen=", fftlen)
     imag = 1.0j
 
     # initialize variables
-    preshifted_y = np.zeros(
-        thepaddedlen, dtype="float"
-    )  # initialize the working buffer (with pad)
-    weights = np.zeros(thepaddedlen, dtype="float")  # initialize the weight buffer (with pad)
+    preshifted_y = np.zeros(fftlen, dtype=thetype)  # initialize the working buffer (with pad)
+    weights = np.zeros(fftlen, dtype=thetype)  # initialize the weight buffer (with pad)
 
     # now do the math
     preshifted_y[padtrs : padtrs + thelen] = inputtc[:]  # copy initial data into shift buffer
     weights[padtrs : padtrs + thelen] = 1.0  # put in the weight vector
     revtc = inputtc[::-1]  # reflect data around ends to
     preshifted_y[0:padtrs] = revtc[-padtrs:]  # eliminate discontinuities
-    preshifted_y[padtrs + thelen :] = revtc[0:padtrs]
-
-    # finish initializations
-    fftlen = np.shape(preshifted_y)[0]
+    preshifted_y[padtrs + thelen :] = revtc[0:endpadtrs]
 
     # create the phase modulation timecourse
     initargvec = np.arange(0.0, 2.0 * np.pi, 2.0 * np.pi / float(fftlen)) - np.pi
     if len(initargvec) > fftlen:
         initargvec = initargvec[:fftlen]
     argvec = np.roll(initargvec * shifttrs, -int(fftlen // 2))
-    modvec = np.cos(argvec) - imag * np.sin(argvec)
+    modvec = (np.cos(argvec) - imag * np.sin(argvec)).astype(
+        np.result_type(thetype, np.complex64)
+    )
 
     # process the data (fft->modulate->ifft->filter)
-    fftdata = fftpack.fft(preshifted_y)  # do the actual shifting
-    shifted_y = fftpack.ifft(modvec * fftdata).real
+    fftdata = tide_fft.fft(preshifted_y)  # do the actual shifting
+    shifted_y = tide_fft.ifft(modvec * fftdata).real
 
     # process the weights
-    w_fftdata = fftpack.fft(weights)  # do the actual shifting
-    shifted_weights = fftpack.ifft(modvec * w_fftdata).real
+    w_fftdata = tide_fft.fft(weights)  # do the actual shifting
+    shifted_weights = tide_fft.ifft(modvec * w_fftdata).real
+
+    # drop the extra end pad
+    preshifted_y = preshifted_y[:thepaddedlen]
+    shifted_y = shifted_y[:thepaddedlen]
+    shifted_weights = shifted_weights[:thepaddedlen]
 
     if doplot:
         xvec = range(0, thepaddedlen)  # make a ramp vector (with pad)
@@ -782,6 +852,111 @@ def timeshift(inputtc, shifttrs, padtrs, doplot=False, debug=False):
     ]
 
 
+shiftweights = {}
+
+
+def getshiftweights(thelen, padtrs, fracsteps, weightstepsize):
+    r"""Returns the shifted weight vectors used by timeshiftblock for shifts of less than one
+    point.  Once calculated, weight vectors are cached for speed.
+
+    Parameters
+    ----------
+    thelen : int
+        The number of timepoints
+    padtrs : int
+        The number of points of padding at each end
+    fracsteps : 1D int array
+        The shifts, in units of weightstepsize
+    weightstepsize : float
+        The size of a shift step, in points
+
+    Returns
+    -------
+    theweights : 2D float array
+        The (padded) shifted weight vector for each shift, one per row
+    """
+    fftlen = _timeshiftfftlen(thelen, padtrs)
+    try:
+        theweightset = shiftweights[(thelen, padtrs, weightstepsize)]
+    except KeyError:
+        theweightset = shiftweights[(thelen, padtrs, weightstepsize)] = {}
+    missingsteps = [thestep for thestep in set(fracsteps) if thestep not in theweightset]
+    if len(missingsteps) > 0:
+        theweights = np.zeros(fftlen, dtype=np.float64)
+        theweights[padtrs : padtrs + thelen] = 1.0
+        modvecs = np.exp(
+            -1.0j
+            * np.outer(
+                np.array(missingsteps) * weightstepsize,
+                2.0 * np.pi * np.fft.rfftfreq(fftlen),
+            )
+        )
+        shiftedweights = tide_fft.irfft(modvecs * tide_fft.rfft(theweights), n=fftlen, axis=-1)
+        for i, thestep in enumerate(missingsteps):
+            theweightset[thestep] = shiftedweights[i, :]
+    return np.stack([theweightset[thestep] for thestep in fracsteps])
+
+
+def timeshiftblock(inputblock, shifttrs, padtrs, weightstepsize=0.001):
+    r"""Time shifts each row of a 2D array by its own amount.  The data is shifted exactly as
+    timeshift shifts it, but all the rows are transformed together.
+
+    Parameters
+    ----------
+    inputblock : 2D float array
+        The timecourses to shift, one per row
+    shifttrs : 1D float array
+        The shift for each row, in points
+    padtrs : int
+        The number of points of (reflected) padding to add to each end before shifting
+    weightstepsize : float, optional
+        The shifts used for the weight vectors are rounded to a multiple of this (in points)
+        so that the vectors can be cached.  Default is 0.001.
+
+    Returns
+    -------
+    shiftedblock : 2D float array
+        The shifted timecourses
+    shiftedweights : 2D float array
+        The shifted weight vectors
+    """
+    thenumrows, thelen = np.shape(inputblock)
+    thepaddedlen = thelen + 2 * padtrs
+    thetype = np.result_type(np.asarray(inputblock).dtype, np.float32)
+    fftlen = _timeshiftfftlen(thelen, padtrs)
+    endpadtrs = fftlen - thepaddedlen + padtrs
+    shifttrs = np.asarray(shifttrs, dtype=np.float64)
+
+    # pad the data with its reflection around the ends to eliminate discontinuities
+    preshifted = np.zeros((thenumrows, fftlen), dtype=thetype)
+    preshifted[:, padtrs : padtrs + thelen] = inputblock
+    revblock = inputblock[:, ::-1]
+    preshifted[:, 0:padtrs] = revblock[:, thelen - padtrs :]
+    preshifted[:, padtrs + thelen :] = revblock[:, 0:endpadtrs]
+
+    # shift the data
+    modvecs = np.exp(-1.0j * np.outer(shifttrs, 2.0 * np.pi * np.fft.rfftfreq(fftlen))).astype(
+        np.result_type(thetype, np.complex64)
+    )
+    shiftedblock = tide_fft.irfft(modvecs * tide_fft.rfft(preshifted, axis=-1), n=fftlen, axis=-1)
+
+    # the weight vector for a shift is the one for its fractional part, circularly shifted by
+    # the integer part
+    thesteps = np.round(shifttrs / weightstepsize).astype(np.int64)
+    stepsperpoint = int(np.round(1.0 / weightstepsize))
+    intshifts = thesteps // stepsperpoint
+    fracweights = getshiftweights(thelen, padtrs, thesteps % stepsperpoint, weightstepsize)
+    theindices = (np.arange(padtrs, padtrs + thelen)[np.newaxis, :] - intshifts[:, np.newaxis]) % (
+        fftlen
+    )
+    shiftedweights = np.take_along_axis(fracweights, theindices, axis=1)
+
+    return (
+        shiftedblock[:, padtrs : padtrs + thelen].astype(thetype, copy=False),
+        shiftedweights.astype(thetype, copy=False),
+    )
+
+
 def timewarp(orig_x, orig_y, timeoffset, demean=True, method="univariate", debug=False):
     if demean:
         demeanedoffset = timeoffset - np.mean(timeoffset)
@@ -81,35 +81,21 @@ def onesimfuncfit(
     return maxindex, maxlag, maxval, maxsigma, maskval, peakstart, peakend, failreason
 
 
-def _procOneVoxelFitcorr(
-    vox,
+def _fitcorrresults(
     corr_y,
+    maxlag,
+    maxval,
+    maxsigma,
+    maskval,
+    peakstart,
+    peakend,
     lagtcgenerator,
     timeaxis,
     thefitter,
-    disablethresholds=False,
-    despeckle_thresh=5.0,
-    initiallag=None,
     fixdelay=False,
-    fixeddelayvalue=0.0,
     rt_floatset=np.float64,
-    rt_floattype="float64",
 ):
-
-    (maxindex, maxlag, maxval, maxsigma, maskval, peakstart, peakend, failreason,) = onesimfuncfit(
-        corr_y,
-        thefitter,
-        disablethresholds=disablethresholds,
-        despeckle_thresh=despeckle_thresh,
-        fixdelay=fixdelay,
-        fixeddelayvalue=fixeddelayvalue,
-        initiallag=initiallag,
-        rt_floatset=rt_floatset,
-        rt_floattype=rt_floattype,
-    )
-
-    if maxval > 0.3:
-        displayplots = False
+    # turn the fit parameters for one voxel into the values that go in the output arrays
 
     # question - should maxlag be added or subtracted?  As of 10/18, it is subtracted
     #  potential answer - tried adding, results are terrible.
@@ -141,6 +127,69 @@ def _procOneVoxelFitcorr(
             thewindowout = rt_floatset(0.0)
         theR2 = rt_floatset(thestrength * thestrength)
 
+    return (
+        volumetotalinc,
+        thelagtc,
+        thetime,
+        thestrength,
+        thesigma,
+        thegaussout,
+        thewindowout,
+        theR2,
+    )
+
+
+def _procOneVoxelFitcorr(
+    vox,
+    corr_y,
+    lagtcgenerator,
+    timeaxis,
+    thefitter,
+    disablethresholds=False,
+    despeckle_thresh=5.0,
+    initiallag=None,
+    fixdelay=False,
+    fixeddelayvalue=0.0,
+    rt_floatset=np.float64,
+    rt_floattype="float64",
+):
+
+    (maxindex, maxlag, maxval, maxsigma, maskval, peakstart, peakend, failreason,) = onesimfuncfit(
+        corr_y,
+        thefitter,
+        disablethresholds=disablethresholds,
+        despeckle_thresh=despeckle_thresh,
+        fixdelay=fixdelay,
+        fixeddelayvalue=fixeddelayvalue,
+        initiallag=initiallag,
+        rt_floatset=rt_floatset,
+        rt_floattype=rt_floattype,
+    )
+
+    (
+        volumetotalinc,
+        thelagtc,
+        thetime,
+        thestrength,
+        thesigma,
+        thegaussout,
+        thewindowout,
+        theR2,
+    ) = _fitcorrresults(
+        corr_y,
+        maxlag,
+        maxval,
+        maxsigma,
+        maskval,
+        peakstart,
+        peakend,
+        lagtcgenerator,
+        timeaxis,
+        thefitter,
+        fixdelay=fixdelay,
+        rt_floatset=rt_floatset,
+    )
+
     return (
         vox,
         volumetotalinc,
@@ -156,6 +205,126 @@ def _procOneVoxelFitcorr(
     )
 
 
+def _countfails(thefitter, failreason):
+    # tally up the failure modes for one voxel, in the order ampfails, lowlagfails,
+    # highlagfails, lowwidthfails, highwidthfails, initfails, fitfails
+    return np.array(
+        [
+            (
+                thefitter.FML_INITAMPLOW
+                | thefitter.FML_INITAMPHIGH
+                | thefitter.FML_FITAMPLOW
+                | thefitter.FML_FITAMPHIGH
+            )
+            & failreason
+            != 0,
+            (thefitter.FML_INITLAGLOW | thefitter.FML_FITLAGLOW) & failreason != 0,
+            (thefitter.FML_INITLAGHIGH | thefitter.FML_FITLAGHIGH) & failreason != 0,
+            (thefitter.FML_INITWIDTHLOW | thefitter.FML_FITWIDTHLOW) & failreason != 0,
+            (thefitter.FML_INITWIDTHHIGH | thefitter.FML_FITWIDTHHIGH) & failreason != 0,
+            thefitter.FML_INITFAIL & failreason != 0,
+            thefitter.FML_FITFAIL & failreason != 0,
+        ],
+        dtype=np.int64,
+    )
+
+
+def _procVoxelBlockFitcorr(blockstate, startvox, endvox):
+    # fit a contiguous range of voxels, writing directly into the (shared) output arrays
+    blocktotal = 0
+    failcounts = np.zeros(7, dtype=np.int64)
+    thefitter = blockstate["thefitter"]
+    if blockstate["themask"] is None:
+        voxels = np.arange(startvox, endvox)
+    else:
+        voxels = startvox + np.nonzero(blockstate["themask"][startvox:endvox] > 0)[0]
+    if blockstate["initiallags"] is None:
+        thelags = None
+    else:
+        thelags = blockstate["initiallags"][voxels]
+    if len(voxels) == 0:
+        return blocktotal, failcounts
+
+    if blockstate["fixdelay"]:
+        for i, vox in enumerate(voxels):
+            if thelags is None:
+                thislag = None
+            else:
+                thislag = thelags[i]
+            (
+                dummy,
+                volumetotalinc,
+                blockstate["lagtc"][vox, :],
+                blockstate["lagtimes"][vox],
+                blockstate["lagstrengths"][vox],
+                blockstate["lagsigma"][vox],
+                blockstate["gaussout"][vox, :],
+                blockstate["windowout"][vox, :],
+                blockstate["R2"][vox],
+                blockstate["lagmask"][vox],
+                failreason,
+            ) = _procOneVoxelFitcorr(
+                vox,
+                blockstate["corrout"][vox, :],
+                blockstate["lagtcgenerator"],
+                blockstate["timeaxis"],
+                thefitter,
+                disablethresholds=False,
+                despeckle_thresh=blockstate["despeckle_thresh"],
+                initiallag=thislag,
+                fixdelay=blockstate["fixdelay"],
+                fixeddelayvalue=0.0,
+                rt_floatset=blockstate["rt_floatset"],
+                rt_floattype=blockstate["rt_floattype"],
+            )
+            blockstate["failimage"][vox] = failreason & 0xFFFF
+            blocktotal += volumetotalinc
+            failcounts += _countfails(thefitter, failreason)
+        return blocktotal, failcounts
+
+    # fit all the peaks at once, with the same settings onesimfuncfit would use
+    thefitter.setguess(False)
+    thefitter.setlthresh(0.0)
+    (
+        maxindex,
+        maxlag,
+        maxval,
+        maxsigma,
+        maskval,
+        failreason,
+        peakstart,
+        peakend,
+    ) = thefitter.fit_block(blockstate["corrout"][voxels, :], maxguesses=thelags)
+    for i, vox in enumerate(voxels):
+        (
+            volumetotalinc,
+            blockstate["lagtc"][vox, :],
+            blockstate["lagtimes"][vox],
+            blockstate["lagstrengths"][vox],
+            blockstate["lagsigma"][vox],
+            blockstate["gaussout"][vox, :],
+            blockstate["windowout"][vox, :],
+            blockstate["R2"][vox],
+        ) = _fitcorrresults(
+            blockstate["corrout"][vox, :],
+            maxlag[i],
+            maxval[i],
+            maxsigma[i],
+            maskval[i],
+            peakstart[i],
+            peakend[i],
+            blockstate["lagtcgenerator"],
+            blockstate["timeaxis"],
+            thefitter,
+            rt_floatset=blockstate["rt_floatset"],
+        )
+        blockstate["lagmask"][vox] = maskval[i]
+        blockstate["failimage"][vox] = failreason[i] & 0xFFFF
+        blocktotal += volumetotalinc
+        failcounts += _countfails(thefitter, failreason[i])
+    return blocktotal, failcounts
+
+
 def fitcorr(
     lagtcgenerator,
     timeaxis,
@@ -179,9 +348,13 @@ def fitcorr(
     chunksize=1000,
     despeckle_thresh=5.0,
     initiallags=None,
+    voxelmask=None,
+    blockmode=False,
+    pool=None,
     rt_floatset=np.float64,
     rt_floattype="float64",
 ):
+    # voxels with initiallags of -1000000.0 or less, or a voxelmask of 0, are left alone
 
     thefitter.setcorrtimeaxis(corrtimescale)
     inputshape = np.shape(corrout)
@@ -189,7 +362,11 @@ def fitcorr(
         themask = None
     else:
         themask = np.where(initiallags > -1000000.0, 1, 0)
-    reportstep = 1000
+    if voxelmask is not None:
+        if themask is None:
+            themask = np.where(voxelmask > 0, 1, 0)
+        else:
+            themask = np.where(voxelmask > 0, themask, 0)
     (
         volumetotal,
         ampfails,
@@ -203,8 +380,81 @@ def fitcorr(
 
     zerolagtc = rt_floatset(lagtcgenerator.yfromx(timeaxis))
     sliceoffsettime = 0.0
+    failedvoxels = []
 
-    if nprocs > 1 or alwaysmultiproc:
+    blockstate = {
+        "themask": themask,
+        "initiallags": initiallags,
+        "corrout": corrout,
+        "lagtcgenerator": lagtcgenerator,
+        "timeaxis": timeaxis,
+        "thefitter": thefitter,
+        "despeckle_thresh": despeckle_thresh,
+        "fixdelay": fixdelay,
+        "lagtc": lagtc,
+        "lagtimes": lagtimes,
+        "lagstrengths": lagstrengths,
+        "lagsigma": lagsigma,
+        "gaussout": gaussout,
+        "windowout": windowout,
+        "R2": R2,
+        "lagmask": lagmask,
+        "failimage": failimage,
+        "rt_floatset": rt_floatset,
+        "rt_floattype": rt_floattype,
+    }
+
+    if (nprocs > 1 or alwaysmultiproc) and (blockmode or pool is not None):
+        if pool is not None:
+            data_out = pool.run_blocks(
+                _procVoxelBlockFitcorr,
+                blockstate,
+                inputshape,
+                themask,
+                showprogressbar=showprogressbar,
+                blocksize=chunksize,
+                sharedkeys=[
+                    "corrout",
+                    "lagtc",
+                    "lagtimes",
+                    "lagstrengths",
+                    "lagsigma",
+                    "gaussout",
+                    "windowout",
+                    "R2",
+                    "lagmask",
+                    "failimage",
+                ],
+            )
+        else:
+            data_out = tide_multiproc.run_multiproc_blocks(
+                _procVoxelBlockFitcorr,
+                blockstate,
+                inputshape,
+                themask,
+                nprocs=nprocs,
+                showprogressbar=showprogressbar,
+                blocksize=chunksize,
+            )
+
+        # tally the status records
+        volumetotal = 0
+        failcounts = np.zeros(7, dtype=np.int64)
+        for startvox, endvox, status in data_out:
+            volumetotal += status[0]
+            failcounts += status[1]
+        (
+            ampfails,
+            lowlagfails,
+            highlagfails,
+            lowwidthfails,
+            highwidthfails,
+            initfails,
+            fitfails,
+        ) = failcounts
+        del data_out
+        failedvoxels = tide_multiproc.getfaileditems()
+    elif nprocs > 1 or alwaysmultiproc:
         # define the consumer function here so it inherits most of the arguments
         def fitcorr_consumer(inQ, outQ):
             while True:
@@ -238,8 +488,7 @@ def fitcorr(
                         )
                     )
                 except Exception as e:
-                    print("error!", e)
-                    break
+                    outQ.put(tide_multiproc.WorkerFailure(val, e))
 
         data_out = tide_multiproc.run_multiproc(
             fitcorr_consumer,
@@ -284,67 +533,37 @@ def fitcorr(
                 fitfails += 1
 
         del data_out
+        failedvoxels = tide_multiproc.getfaileditems()
     else:
-        for vox in range(0, inputshape[0]):
-            if (vox % reportstep == 0 or vox == inputshape[0] - 1) and showprogressbar:
-                tide_util.progressbar(vox + 1, inputshape[0], label="Percent complete")
-            if themask is None:
-                dothisone = True
-                thislag = None
-            elif themask[vox] > 0:
-                dothisone = True
-                thislag = initiallags[vox]
-            else:
-                dothisone = False
-                thislag = None
-            if dothisone:
-                (
-                    dummy,
-                    volumetotalinc,
-                    lagtc[vox, :],
-                    lagtimes[vox],
-                    lagstrengths[vox],
-                    lagsigma[vox],
-                    gaussout[vox, :],
-                    windowout[vox, :],
-                    R2[vox],
-                    lagmask[vox],
-                    failreason,
-                ) = _procOneVoxelFitcorr(
-                    vox,
-                    corrout[vox, :],
-                    lagtcgenerator,
-                    timeaxis,
-                    thefitter,
-                    disablethresholds=False,
-                    despeckle_thresh=despeckle_thresh,
-                    initiallag=thislag,
-                    fixdelay=fixdelay,
-                    rt_floatset=rt_floatset,
-                    rt_floattype=rt_floattype,
-                )
-                volumetotal += volumetotalinc
-                if (
-                    thefitter.FML_INITAMPLOW
-                    | thefitter.FML_INITAMPHIGH
-                    | thefitter.FML_FITAMPLOW
-                    | thefitter.FML_FITAMPHIGH
-                ) & failreason:
-                    ampfails += 1
-                if (thefitter.FML_INITWIDTHLOW | thefitter.FML_FITWIDTHLOW) & failreason:
-                    lowwidthfails += 1
-                if (thefitter.FML_INITWIDTHHIGH | thefitter.FML_FITWIDTHHIGH) & failreason:
-                    highwidthfails += 1
-                if (thefitter.FML_INITLAGLOW | thefitter.FML_INITLAGHIGH) & failreason:
-                    lowlagfails += 1
-                if (thefitter.FML_INITLAGLOW | thefitter.FML_FITLAGLOW) & failreason:
-                    lowlagfails += 1
-                if (thefitter.FML_INITLAGHIGH | thefitter.FML_FITLAGHIGH) & failreason:
-                    highlagfails += 1
-                if thefitter.FML_INITFAIL & failreason:
-                    initfails += 1
-                if thefitter.FML_FITFAIL & failreason:
-                    fitfails += 1
+        failcounts = np.zeros(7, dtype=np.int64)
+        for startvox in range(0, inputshape[0], chunksize):
+            endvox = min(startvox + chunksize, inputshape[0])
+            if showprogressbar:
+                tide_util.progressbar(endvox, inputshape[0], label="Percent complete")
+            blocktotal, blockfailcounts = _procVoxelBlockFitcorr(blockstate, startvox, endvox)
+            volumetotal += blocktotal
+            failcounts += blockfailcounts
+        (
+            ampfails,
+            lowlagfails,
+            highlagfails,
+            lowwidthfails,
+            highwidthfails,
+            initfails,
+            fitfails,
+        ) = failcounts
+
+    # flag any voxels that could not be processed at all
+    if len(failedvoxels) > 0:
+        lagtc[failedvoxels, :] = 0.0
+        lagtimes[failedvoxels] = 0.0
+        lagstrengths[failedvoxels] = 0.0
+        lagsigma[failedvoxels] = 0.0
+        gaussout[failedvoxels, :] = 0.0
+        windowout[failedvoxels, :] = 0.0
+        R2[failedvoxels] = 0.0
+        lagmask[failedvoxels] = 0
+        failimage[failedvoxels] = thefitter.FML_WORKERFAIL
 
     print("\nCorrelation fitted in " + str(volumetotal) + " voxels")
     print(
@@ -362,6 +581,8 @@ def fitcorr(
         initfails,
         "\n\ttotal fitfails:",
         fitfails,
+        "\n\tworkerfails:",
+        len(failedvoxels),
     )
 
     # garbage collect
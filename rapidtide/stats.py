@@ -295,6 +295,92 @@ def fisher(r):
     return 0.5 * np.log((1 + r) / (1 - r))
 
 
+def effectivedof(thetc):
+    """Estimate the effective number of independent samples in a correlation with thetc.
+
+    This is Bartlett's estimate: the number of points divided by the sum of the squared
+    autocorrelation over all lags.  Since the sample autocorrelation is used, it describes
+    correlation with noise that has the same sample spectrum as thetc (as phase randomized
+    copies of thetc do), and is about half the number of points for white noise.  It can be
+    used as nsamps in tfromr and zfromr.
+
+    Parameters
+    ----------
+    thetc : 1D array
+        The timecourse, as it is correlated (filtered, oversampled, windowed...)
+
+    Returns
+    -------
+    dof : float
+    """
+    thelen = len(thetc)
+    thespectrum = np.abs(np.fft.rfft(thetc - np.mean(thetc), 2 * thelen)) ** 2
+    theacf = np.fft.irfft(thespectrum, 2 * thelen)[:thelen]
+    theacf /= theacf[0]
+    return thelen / (1.0 + 2.0 * np.sum(theacf[1:] ** 2))
+
+
+def autocorrnulldistribution(thetc, Fs, searchwidth, numsamples=10000, twotail=False):
+    """The distribution of the largest null correlation with thetc in a range of lags.
+
+    At each lag, the null correlation is taken to be normal after a Fisher transform, with the
+    degrees of freedom from effectivedof (as in zfromr).  The correlation at neighboring lags
+    is not independent - the number of times the null correlation function is expected to
+    cross a level u in the search range is found from the spectrum of thetc (Rice's formula),
+    and the probability that the maximum exceeds u is then taken to be
+    1 - Phi(u) * exp(-numcrossings * exp(-u**2 / 2)).
+
+    The distribution is returned as numsamples values at evenly spaced quantiles, so it can
+    be used in place of a permutation null distribution (in sigFromDistributionData, for
+    example).
+
+    Parameters
+    ----------
+    thetc : 1D array
+        The reference timecourse, as it is correlated (filtered, oversampled, windowed...)
+    Fs : float
+        The sample frequency of thetc, in Hz
+    searchwidth : float
+        The width of the range of lags searched for the peak, in seconds
+    numsamples : int, optional
+        The number of values to return
+    twotail : bool, optional
+        If True, the largest absolute correlation is used, and the values are returned with
+        alternating signs, as the peaks of a bipolar search would be
+
+    Returns
+    -------
+    thesamples : 1D array
+        The values of the distribution at evenly spaced quantiles
+    dof : float
+        The effective degrees of freedom
+    numcrossings : float
+        The number of upcrossings of the zero level expected in the search range
+    """
+    dof = np.max([effectivedof(thetc), 4.0])
+
+    # the null correlation function has the spectrum of thetc squared - its second spectral
+    # moment gives the rate of level crossings
+    thespectrum = np.abs(np.fft.rfft(thetc - np.mean(thetc), 2 * len(thetc))) ** 4
+    thefreqs = 2.0 * np.pi * np.fft.rfftfreq(2 * len(thetc), 1.0 / Fs)
+    secondmoment = np.sum(thefreqs * thefreqs * thespectrum) / np.sum(thespectrum)
+    numcrossings = searchwidth * np.sqrt(secondmoment) / (2.0 * np.pi)
+
+    # tabulate the distribution of the maximum and invert it
+    zvals = np.linspace(0.0, 12.0, 12001)
+    if twotail:
+        thecdf = (2.0 * sp.stats.norm.cdf(zvals) - 1.0) * np.exp(
+            -2.0 * numcrossings * np.exp(-zvals * zvals / 2.0)
+        )
+    else:
+        thecdf = sp.stats.norm.cdf(zvals) * np.exp(-numcrossings * np.exp(-zvals * zvals / 2.0))
+    thequantiles = (np.arange(numsamples) + 0.5) / numsamples
+    thesamples = np.tanh(np.interp(thequantiles, thecdf, zvals) / np.sqrt(dof - 3.0))
+    if twotail:
+        thesamples[1::2] *= -1.0
+    return thesamples, dof, numcrossings
+
+
 def kurtosisstats(timecourse):
     """
 
@@ -624,6 +710,48 @@ def getfracvals(datamat, thefracs, nozero=False, debug=False):
     return thevals
 
 
+def getfracvalcis(datamat, thefracs, nozero=False, numboot=200, cilevel=0.95, seed=None):
+    """Bootstrap confidence intervals for the values getfracvals returns.
+
+    Parameters
+    ----------
+    datamat
+    thefracs
+    nozero
+    numboot : int, optional
+        The number of bootstrap resamples
+    cilevel : float, optional
+        The confidence level of the intervals
+    seed : optional
+        Seed for the resampling
+
+    Returns
+    -------
+    lowervals, uppervals : 1D arrays
+        The ends of the confidence interval of each value
+    """
+    if nozero:
+        maskmat = np.sort(datamat[np.where(datamat != 0.0)].flatten())
+    else:
+        maskmat = np.sort(datamat.flatten())
+    maxindex = len(maskmat)
+    if maxindex == 0:
+        return np.zeros(len(thefracs)), np.zeros(len(thefracs))
+    fracindices = [
+        np.min([int(np.round(thisfrac * maxindex, 0)), maxindex - 1]) for thisfrac in thefracs
+    ]
+
+    # a resample of sorted data is sorted if its indices are, so the order statistics of each
+    # resample come straight from the sorted indices
+    rng = np.random.default_rng(seed)
+    theindices = np.sort(rng.integers(0, maxindex, size=(numboot, maxindex)), axis=1)
+    bootvals = maskmat[theindices[:, fracindices]]
+    return (
+        np.percentile(bootvals, 50.0 * (1.0 - cilevel), axis=0),
+        np.percentile(bootvals, 100.0 - 50.0 * (1.0 - cilevel), axis=0),
+    )
+
+
 def getfracvalsfromfit_old(histfit, thefracs, numbins=2000, displayplots=False):
     """
 
@@ -20,7 +20,18 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 
-from rapidtide.correlate import fastcorrelate
+import rapidtide.filter as tide_filt
+import rapidtide.helper_classes as tide_classes
+from rapidtide.correlate import (
+    cross_mutual_info,
+    cross_mutual_info_block,
+    directcorrelationischeaper,
+    fastcorrelate,
+    laggedcorrelate,
+    laggedcorrelateplan,
+    mutual_info_2d,
+)
+from rapidtide.miscmath import corrnormalize
 
 
 def test_fastcorrelate(display=False):
@@ -60,8 +71,148 @@ def test_fastcorrelate(display=False):
         weighted_result = fastcorrelate(sig2, sig1, weighting=weighting)
 
 
+def test_blockcorrelate(debug=False):
+    # the batched correlation must match the single voxel correlation exactly
+    Fs = 2.0
+    tclen = 400
+    numvoxels = 17
+    timeaxis = np.arange(tclen) / Fs
+    reftc = np.sin(2.0 * np.pi * 0.05 * timeaxis) + 0.2 * np.random.random(tclen)
+    theblock = np.zeros((numvoxels, tclen), dtype=np.float64)
+    for i in range(numvoxels):
+        theblock[i, :] = np.sin(2.0 * np.pi * 0.05 * (timeaxis - 0.5 * i))
+        theblock[i, :] += 0.2 * np.random.random(tclen)
+    for weighting in ["None", "liang", "eckart", "phat"]:
+        for zeropadding in [0, -1, 20]:
+            theCorrelator = tide_classes.Correlator(
+                Fs=Fs,
+                ncprefilter=tide_filt.NoncausalFilter("lfo"),
+                corrweighting=weighting,
+                corrpadding=zeropadding,
+            )
+            theCorrelator.setlimits(30, 40)
+            theCorrelator.setreftc(reftc)
+            blockcorr, blockaxis, blockmaxes = theCorrelator.run_block(theblock)
+            assert blockcorr.shape == (numvoxels, 70)
+            for i in range(numvoxels):
+                thecorr, theaxis, themax = theCorrelator.run(theblock[i, :])
+                if debug:
+                    print(weighting, zeropadding, i, np.max(np.fabs(thecorr - blockcorr[i, :])))
+                np.testing.assert_allclose(blockcorr[i, :], thecorr, rtol=1e-10, atol=1e-12)
+                np.testing.assert_allclose(blockaxis, theaxis)
+                assert blockmaxes[i] == themax
+
+
+def test_laggedcorrelate(debug=False):
+    # the direct calculation over a range of lags matches the full correlation function
+    tclen = 300
+    reftc = np.random.random(tclen)
+    theblock = np.random.random((5, tclen))
+    for minshift, maxshift in [(-20, 35), (-tclen - 5, tclen + 5), (3, 3)]:
+        theplan = laggedcorrelateplan(reftc, minshift, maxshift)
+        lagcorr = laggedcorrelate(theblock, theplan)
+        assert lagcorr.shape == (5, maxshift - minshift + 1)
+        for i in range(5):
+            fullcorr = np.correlate(theblock[i, :], reftc, mode="full")
+            for j, theshift in enumerate(range(minshift, maxshift + 1)):
+                if -tclen < theshift < tclen:
+                    expected = fullcorr[theshift + tclen - 1]
+                else:
+                    expected = 0.0
+                np.testing.assert_allclose(lagcorr[i, j], expected, rtol=1e-10, atol=1e-10)
+
+    # narrow lag ranges should be done directly, full ones with FFTs
+    assert directcorrelationischeaper(2000, 60, 4000)
+    assert not directcorrelationischeaper(2000, 3999, 4000)
+
+    # the Correlator gives the same answer whichever way it calculates the correlation
+    Fs = 2.0
+    timeaxis = np.arange(tclen) / Fs
+    theCorrelator = tide_classes.Correlator(Fs=Fs, ncprefilter=tide_filt.NoncausalFilter("lfo"))
+    theCorrelator.setlimits(30, 40)
+    theCorrelator.setreftc(np.sin(2.0 * np.pi * 0.05 * timeaxis) + 0.2 * reftc)
+    results = {}
+    for lagmethod in ["fft", "direct"]:
+        theCorrelator.setlagmethod(lagmethod)
+        results[lagmethod] = theCorrelator.run_block(theblock)
+        if debug:
+            print(lagmethod, results[lagmethod][2])
+    np.testing.assert_allclose(results["fft"][0], results["direct"][0], rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(results["fft"][1], results["direct"][1])
+
+
+def test_crossmutualinfo(debug=False):
+    # all the lags at once must match calculating each lag separately
+    tclen = 400
+    Fs = 2.0
+    timeaxis = np.arange(tclen) / Fs
+    reftc = np.sin(2.0 * np.pi * 0.05 * timeaxis) + 0.3 * np.random.random(tclen)
+    theblock = np.zeros((6, tclen), dtype=np.float64)
+    for i in range(theblock.shape[0]):
+        theblock[i, :] = np.sin(2.0 * np.pi * 0.05 * (timeaxis - 0.7 * i))
+        theblock[i, :] += 0.3 * np.random.random(tclen)
+
+    normx = corrnormalize(theblock[0, :], detrendorder=1, windowfunc="None")
+    normy = corrnormalize(reftc, detrendorder=1, windowfunc="None")
+    bins = int(np.sqrt(tclen / 5))
+    jh, bins0, bins1 = np.histogram2d(normx, normy, bins=(bins, bins))
+    for negsteps, possteps in [(30, 40), (-1, -1)]:
+        for norm in [True, False]:
+            thexmi_x, thexmi_y, dummy = cross_mutual_info(
+                theblock[0, :],
+                reftc,
+                negsteps=negsteps,
+                possteps=possteps,
+                norm=norm,
+                returnaxis=True,
+                Fs=Fs,
+            )
+            for j, thelag in enumerate(np.round(thexmi_x * Fs).astype(int)):
+                if thelag < 0:
+                    thepair = (normx[: thelag + tclen], normy[-thelag:])
+                else:
+                    thepair = (normx[thelag:], normy[: tclen - thelag])
+                expected = mutual_info_2d(
+                    thepair[0],
+                    thepair[1],
+                    bins=(bins0, bins1),
+                    normalized=norm,
+                    fast=True,
+                    sigma=0.25,
+                )
+                np.testing.assert_allclose(thexmi_y[j], expected, rtol=1e-12)
+
+    # the batched version matches each row done separately, for lag ranges and lists of lags
+    for theargs in [{"negsteps": 30, "possteps": 40}, {"locs": [-12, 0, 3, 25]}]:
+        blockmi = cross_mutual_info_block(theblock, reftc, **theargs)
+        for i in range(theblock.shape[0]):
+            np.testing.assert_allclose(
+                blockmi[i, :], cross_mutual_info(theblock[i, :], reftc, **theargs), rtol=1e-12
+            )
+
+    # and so does the MutualInformationator
+    theMutualInformationator = tide_classes.MutualInformationator(
+        Fs=Fs, ncprefilter=tide_filt.NoncausalFilter("lfo"), smoothingtime=3.0
+    )
+    theMutualInformationator.setreftc(reftc)
+    theMutualInformationator.setlimits(30, 40)
+    theMutualInformationator.setreftc(reftc)
+    blocksimfuncs, blockaxis, blockmaxes = theMutualInformationator.run_block(theblock)
+    assert blocksimfuncs.shape == (theblock.shape[0], 70)
+    for i in range(theblock.shape[0]):
+        thesimfunc, theaxis, themax = theMutualInformationator.run(theblock[i, :])
+        if debug:
+            print(i, np.max(np.fabs(thesimfunc - blocksimfuncs[i, :])))
+        np.testing.assert_allclose(blocksimfuncs[i, :], thesimfunc, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(blockaxis, theaxis)
+        assert blockmaxes[i] == themax
+
+
 def main():
     test_fastcorrelate(display=True)
+    test_blockcorrelate(debug=True)
+    test_laggedcorrelate(debug=True)
+    test_crossmutualinfo(debug=True)
 
 
 if __name__ == "__main__":
@@ -16,6 +16,8 @@
 #   limitations under the License.
 #
 #
+import os
+
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
@@ -24,9 +26,11 @@ import rapidtide.calcsimfunc as tide_calcsimfunc
 import rapidtide.correlate as tide_corr
 import rapidtide.filter as tide_filt
 import rapidtide.helper_classes as tide_classes
+import rapidtide.multiproc as tide_multiproc
 import rapidtide.resample as tide_resample
 import rapidtide.simfuncfit as tide_simfuncfit
-from rapidtide.tests.utils import mse
+from rapidtide.tests.utils import get_test_temp_path, mse
+from rapidtide.workflows.rapidtide import allocprepcache, allocshared
 
 
 def test_calcsimfunc(debug=False, display=False):
@@ -46,7 +50,7 @@ def test_calcsimfunc(debug=False, display=False):
     ) * (1.0 / oversampfreq)
 
     theinputdata = np.zeros((numvoxels, numtimepoints), dtype=np.float64)
-    meanval = np.zeros((numvoxels), dtype=np.float64)
+    meanval, dummy, dummy = allocshared((numvoxels), np.float64)
 
     testfreq = 0.075
     msethresh = 1e-3
@@ -90,16 +94,17 @@ def test_calcsimfunc(debug=False, display=False):
     searchstart = int(np.round(corrzero + lagmin / tr))
     searchend = int(np.round(corrzero + lagmax / tr))
     numcorrpoints = lagmaxinpts + lagmininpts
-    corrout = np.zeros((numvoxels, numcorrpoints), dtype=np.float64)
-    lagmask = np.zeros((numvoxels), dtype=np.float64)
-    failimage = np.zeros((numvoxels), dtype=np.float64)
-    lagtimes = np.zeros((numvoxels), dtype=np.float64)
-    lagstrengths = np.zeros((numvoxels), dtype=np.float64)
-    lagsigma = np.zeros((numvoxels), dtype=np.float64)
-    gaussout = np.zeros((numvoxels, numcorrpoints), dtype=np.float64)
-    windowout = np.zeros((numvoxels, numcorrpoints), dtype=np.float64)
-    R2 = np.zeros((numvoxels), dtype=np.float64)
-    lagtc = np.zeros((numvoxels, numtimepoints), dtype=np.float64)
+    # the output arrays are in shared memory so the block dispatch workers can write to them
+    corrout, dummy, dummy = allocshared((numvoxels, numcorrpoints), np.float64)
+    lagmask, dummy, dummy = allocshared((numvoxels), np.float64)
+    failimage, dummy, dummy = allocshared((numvoxels), np.float64)
+    lagtimes, dummy, dummy = allocshared((numvoxels), np.float64)
+    lagstrengths, dummy, dummy = allocshared((numvoxels), np.float64)
+    lagsigma, dummy, dummy = allocshared((numvoxels), np.float64)
+    gaussout, dummy, dummy = allocshared((numvoxels, numcorrpoints), np.float64)
+    windowout, dummy, dummy = allocshared((numvoxels, numcorrpoints), np.float64)
+    R2, dummy, dummy = allocshared((numvoxels), np.float64)
+    lagtc, dummy, dummy = allocshared((numvoxels, numtimepoints), np.float64)
 
     optiondict = {
         "numestreps": 10000,
@@ -166,7 +171,34 @@ def test_calcsimfunc(debug=False, display=False):
     dummy, trimmedcorrscale, dummy = theCorrelator.getfunction()
     thefitter.setcorrtimeaxis(trimmedcorrscale)
 
-    for thenprocs in [1, -1]:
+    # a persistent pool that can write into all of the output arrays
+    thepool = tide_multiproc.WorkerPool(
+        2,
+        sharedarrays={
+            "corrout": corrout,
+            "meanval": meanval,
+            "lagmask": lagmask,
+            "failimage": failimage,
+            "lagtimes": lagtimes,
+            "lagstrengths": lagstrengths,
+            "lagsigma": lagsigma,
+            "gaussout": gaussout,
+            "windowout": windowout,
+            "R2": R2,
+            "lagtc": lagtc,
+        },
+    )
+
+    for thenprocs, dispatch in [
+        (1, "queue"), (-1, "queue"), (2, "queue"), (2, "block"), (2, "pool"),
+    ]:
+        blockmode = dispatch == "block"
+        if dispatch == "pool":
+            usepool = thepool
+        else:
+            usepool = None
+        corrout[:, :] = 0.0
+        lagtimes[:] = 0.0
         for i in range(numpasses):
             (
                 voxelsprocessed_cp,
@@ -187,7 +219,11 @@ def test_calcsimfunc(debug=False, display=False):
                 interptype=optiondict["interptype"],
                 showprogressbar=optiondict["showprogressbar"],
                 chunksize=optiondict["mp_chunksize"],
+                blockmode=blockmode,
+                pool=usepool,
             )
+            assert voxelsprocessed_cp == numvoxels
+            assert len(theglobalmaxlist) == numvoxels
 
             if display:
                 plt.figure()
@@ -209,10 +245,12 @@ def test_calcsimfunc(debug=False, display=False):
                 gaussout,
                 windowout,
                 R2,
-                nprocs=optiondict["nprocs"],
+                nprocs=thenprocs,
                 fixdelay=optiondict["fixdelay"],
                 showprogressbar=optiondict["showprogressbar"],
                 chunksize=optiondict["mp_chunksize"],
+                blockmode=blockmode,
+                pool=usepool,
                 despeckle_thresh=optiondict["despeckle_thresh"],
             )
             if display:
@@ -229,7 +267,267 @@ def test_calcsimfunc(debug=False, display=False):
 
             assert mse(voxelshifts, lagtimes) < msethresh
 
+    # the pool workers should have been started once and reused for every stage
+    thepool.shutdown()
+    assert thepool.numstarts == 1
+    assert thepool.numstages == 2 * numpasses
+
+    # the prep cache gives the same answer when it is filled and when it is reused, wherever
+    # it is stored, and however the voxels are dispatched
+    refcorrout = corrout + 0.0
+    cachepool = tide_multiproc.WorkerPool(2, sharedarrays={"corrout": corrout, "meanval": meanval})
+    for maxgb, expectedstorage in [(1.0, "shared"), (0.0, "memmap")]:
+        for thenprocs, dispatch in [(1, "queue"), (2, "queue"), (2, "block"), (2, "pool")]:
+            if dispatch == "pool":
+                usepool = cachepool
+            else:
+                usepool = None
+            prepcache, storage, cachefile = allocprepcache(
+                (numvoxels, len(os_fmri_x)),
+                np.float64,
+                maxgb,
+                shared=True,
+                cachedir=get_test_temp_path(),
+            )
+            assert storage == expectedstorage
+            for prepcachevalid in [False, True]:
+                corrout[:, :] = 0.0
+                meanval[:] = 0.0
+                tide_calcsimfunc.correlationpass(
+                    theinputdata,
+                    sourcedata,
+                    theCorrelator,
+                    init_fmri_x,
+                    os_fmri_x,
+                    lagmininpts,
+                    lagmaxinpts,
+                    corrout,
+                    meanval,
+                    nprocs=thenprocs,
+                    oversampfactor=optiondict["oversampfactor"],
+                    interptype=optiondict["interptype"],
+                    showprogressbar=optiondict["showprogressbar"],
+                    chunksize=optiondict["mp_chunksize"],
+                    blockmode=(dispatch == "block"),
+                    pool=usepool,
+                    prepcache=prepcache,
+                    prepcachevalid=prepcachevalid,
+                )
+                if debug:
+                    print(storage, dispatch, prepcachevalid, np.max(np.fabs(corrout - refcorrout)))
+                assert np.allclose(corrout, refcorrout, rtol=0.0, atol=1e-12)
+                assert np.max(np.fabs(prepcache)) > 0.0
+            del prepcache
+            if cachefile is not None:
+                os.remove(cachefile)
+    cachepool.shutdown()
+
+
+def test_lagwarmstart(debug=False):
+    # a narrowed search must match the full search inside each voxel's window
+    oversampfactor = 2
+    numvoxels = 150
+    numtimepoints = 300
+    tr = 1.0
+    oversampfreq = oversampfactor / tr
+    fmri_x = np.arange(0.0, numtimepoints) * tr
+    os_fmri_x = np.arange(0.0, numtimepoints * oversampfactor) / oversampfreq
+    rng = np.random.default_rng(19)
+    sourcedata = np.sin(2.0 * np.pi * 0.06 * os_fmri_x) + 0.5 * np.sin(
+        2.0 * np.pi * 0.021 * os_fmri_x
+    )
+    voxelshifts = rng.uniform(-5.0, 5.0, numvoxels)
+    theinputdata = np.zeros((numvoxels, numtimepoints), dtype=np.float64)
+    for i in range(numvoxels):
+        theinputdata[i, :] = np.sin(2.0 * np.pi * 0.06 * (fmri_x - voxelshifts[i]))
+        theinputdata[i, :] += 0.5 * np.sin(2.0 * np.pi * 0.021 * (fmri_x - voxelshifts[i]))
+        theinputdata[i, :] += 0.2 * rng.standard_normal(numtimepoints)
+
+    lagmininpts = 30
+    lagmaxinpts = 30
+    theCorrelator = tide_classes.Correlator(
+        Fs=oversampfreq, ncprefilter=tide_filt.NoncausalFilter("lfo")
+    )
+    theCorrelator.setlimits(lagmininpts, lagmaxinpts)
+    theCorrelator.setreftc(sourcedata)
+    dummy, corrscale, dummy = theCorrelator.getfunction()
+    numcorrpoints = lagmininpts + lagmaxinpts
+    meanval, dummy, dummy = allocshared((numvoxels), np.float64)
+
+    fullcorrout = np.zeros((numvoxels, numcorrpoints), dtype=np.float64)
+    dummy, fullmaxlist, dummy = tide_calcsimfunc.correlationpass(
+        theinputdata,
+        sourcedata,
+        theCorrelator,
+        fmri_x,
+        os_fmri_x,
+        lagmininpts,
+        lagmaxinpts,
+        fullcorrout,
+        meanval,
+        oversampfactor=oversampfactor,
+        showprogressbar=False,
+    )
+
+    # windows around a noisy guess at the lag, with a few failed voxels searched everywhere
+    lagmask = np.ones(numvoxels, dtype=np.float64)
+    lagmask[::25] = 0.0
+    lagwindows = tide_calcsimfunc.warmstartwindows(
+        voxelshifts + rng.uniform(-1.0, 1.0, numvoxels),
+        np.full(numvoxels, 1.0),
+        lagmask,
+        corrscale,
+    )
+    assert np.all(lagwindows[lagmask == 0, 0] == 0)
+    assert np.all(lagwindows[lagmask == 0, 1] == numcorrpoints)
+    assert np.all(lagwindows[lagmask > 0, 1] - lagwindows[lagmask > 0, 0] < numcorrpoints // 2)
+
+    for thenprocs, blockmode in [(1, False), (2, False), (2, True)]:
+        corrout, dummy, dummy = allocshared((numvoxels, numcorrpoints), np.float64)
+        corrout[:, :] = 0.0
+        dummy, maxlist, dummy = tide_calcsimfunc.correlationpass(
+            theinputdata,
+            sourcedata,
+            theCorrelator,
+            fmri_x,
+            os_fmri_x,
+            lagmininpts,
+            lagmaxinpts,
+            corrout,
+            meanval,
+            oversampfactor=oversampfactor,
+            showprogressbar=False,
+            nprocs=thenprocs,
+            chunksize=40,
+            blockmode=blockmode,
+            lagwindows=lagwindows,
+        )
+        for i in range(numvoxels):
+            start, end = lagwindows[i, :]
+            if debug:
+                print(thenprocs, blockmode, i, start, end, maxlist[i], fullmaxlist[i])
+            np.testing.assert_allclose(
+                corrout[i, start:end], fullcorrout[i, start:end], atol=1e-12
+            )
+            assert np.all(corrout[i, :start] == 0.0)
+            assert np.all(corrout[i, end:] == 0.0)
+
+    # a lag on the edge of a narrowed window, or a failed fit, means searching again
+    lagtimes = corrscale[(lagwindows[:, 0] + lagwindows[:, 1]) // 2]
+    fitmask = np.ones(numvoxels, dtype=np.float64)
+    lagtimes[1] = corrscale[lagwindows[1, 0]]
+    lagtimes[2] = corrscale[lagwindows[2, 1] - 1]
+    fitmask[3] = 0.0
+    fitmask[25] = 0.0
+    fallbacks = tide_calcsimfunc.warmstartfallbacks(lagwindows, lagtimes, fitmask, corrscale)
+    if debug:
+        print(fallbacks)
+    assert list(fallbacks) == [1, 2, 3]
+
+    # after redoing the fallbacks, the fitted lags should match a full search, even for voxels
+    # whose last lag was on a sidelobe or a trough of the similarity function
+    thefitter = tide_classes.SimilarityFunctionFitter(
+        lagmin=-15.0,
+        lagmax=15.0,
+        absmaxsigma=25.0,
+        absminsigma=0.25,
+        peakfittype="gauss",
+        zerooutbadfit=False,
+        searchfrac=0.5,
+        enforcethresh=True,
+        hardlimit=True,
+    )
+    genlagtc = tide_resample.FastResampler(os_fmri_x, sourcedata)
+    fitresults = {}
+    for thesearch in ["full", "warm"]:
+        fitmask = np.zeros(numvoxels, dtype=np.float64)
+        failreason = np.zeros(numvoxels, dtype=np.float64)
+        lagtimes = np.zeros(numvoxels, dtype=np.float64)
+        lagstrengths = np.zeros(numvoxels, dtype=np.float64)
+        lagsigma = np.zeros(numvoxels, dtype=np.float64)
+        gaussout = np.zeros((numvoxels, numcorrpoints), dtype=np.float64)
+        windowout = np.zeros((numvoxels, numcorrpoints), dtype=np.float64)
+        R2 = np.zeros(numvoxels, dtype=np.float64)
+        lagtc = np.zeros((numvoxels, numtimepoints), dtype=np.float64)
+        if thesearch == "full":
+            corrout = fullcorrout + 0.0
+        else:
+            lastlagtimes = fitresults["full"][0] + 0.0
+            lastlagstrengths = fitresults["full"][1] + 0.0
+            lastlagtimes[::5] += 1.0 / 0.06
+            lastlagtimes[1::5] -= 0.5 / 0.06
+            lastlagtimes[2::5] += 4.0
+            lagwindows = tide_calcsimfunc.warmstartwindows(
+                lastlagtimes, np.full(numvoxels, 1.0), np.ones(numvoxels), corrscale
+            )
+            corrout = np.zeros((numvoxels, numcorrpoints), dtype=np.float64)
+            tide_calcsimfunc.correlationpass(
+                theinputdata,
+                sourcedata,
+                theCorrelator,
+                fmri_x,
+                os_fmri_x,
+                lagmininpts,
+                lagmaxinpts,
+                corrout,
+                meanval,
+                oversampfactor=oversampfactor,
+                showprogressbar=False,
+                lagwindows=lagwindows,
+            )
+        fitargs = [
+            genlagtc,
+            fmri_x,
+            lagtc,
+            corrscale,
+            thefitter,
+            corrout,
+            fitmask,
+            failreason,
+            lagtimes,
+            lagstrengths,
+            lagsigma,
+            gaussout,
+            windowout,
+            R2,
+        ]
+        tide_simfuncfit.fitcorr(*fitargs, showprogressbar=False)
+        if thesearch == "warm":
+            fallbacks = tide_calcsimfunc.warmstartfallbacks(
+                lagwindows,
+                lagtimes,
+                fitmask,
+                corrscale,
+                lagstrengths=lagstrengths,
+                lastlagstrengths=lastlagstrengths,
+                corrout=corrout,
+            )
+            if debug:
+                print(len(fallbacks), "fallbacks:", fallbacks)
+            assert len(fallbacks) < numvoxels
+            tide_calcsimfunc.correlatevoxels(
+                fallbacks,
+                theinputdata,
+                sourcedata,
+                theCorrelator,
+                fmri_x,
+                os_fmri_x,
+                lagmininpts,
+                lagmaxinpts,
+                corrout,
+                oversampfactor=oversampfactor,
+                lagwindows=lagwindows,
+            )
+            fallbackmask = np.zeros(numvoxels, dtype=np.float64)
+            fallbackmask[fallbacks] = 1.0
+            tide_simfuncfit.fitcorr(*fitargs, showprogressbar=False, voxelmask=fallbackmask)
+        fitresults[thesearch] = (lagtimes, lagstrengths, fitmask)
+    np.testing.assert_allclose(fitresults["warm"][0], fitresults["full"][0], atol=1e-8)
+    np.testing.assert_allclose(fitresults["warm"][1], fitresults["full"][1], atol=1e-8)
+    assert np.array_equal(fitresults["warm"][2], fitresults["full"][2])
+
 
 if __name__ == "__main__":
     mpl.use("TkAgg")
     test_calcsimfunc(debug=True, display=True)
+    test_lagwarmstart(debug=True)
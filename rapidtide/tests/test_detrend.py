@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2021 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+import numpy as np
+
+import rapidtide.filter as tide_filt
+import rapidtide.fit as tide_fit
+import rapidtide.miscmath as tide_math
+
+
+def test_detrendblock(debug=False):
+    rng = np.random.default_rng(42)
+    for tclen in [99, 100]:
+        timeaxis = np.linspace(-1.0, 1.0, tclen)
+        datablock = rng.standard_normal((6, tclen)) + 5.0 * timeaxis - 3.0 * timeaxis ** 2 + 10.0
+        for order in [1, 2, 3]:
+            for demean in [True, False]:
+                blockresult = tide_fit.detrendblock(datablock, order=order, demean=demean)
+                for i in range(datablock.shape[0]):
+                    rowresult = tide_fit.detrend(datablock[i, :], order=order, demean=demean)
+                    if debug:
+                        print(tclen, order, demean, np.max(np.fabs(blockresult[i, :] - rowresult)))
+                    np.testing.assert_allclose(blockresult[i, :], rowresult, atol=1e-8)
+
+                # a 1D vector should give the same answer as a row
+                np.testing.assert_allclose(
+                    tide_fit.detrendblock(datablock[0, :], order=order, demean=demean),
+                    blockresult[0, :],
+                    atol=1e-12,
+                )
+
+
+def test_corrnormalizeblock(debug=False):
+    rng = np.random.default_rng(24)
+    tclen = 200
+    datablock = rng.standard_normal((5, tclen)) + np.linspace(0.0, 4.0, tclen)
+    for detrendorder in [0, 1, 3]:
+        for windowfunc in ["hamming", "hann", "None"]:
+            blockresult = tide_math.corrnormalizeblock(
+                datablock, detrendorder=detrendorder, windowfunc=windowfunc
+            )
+            for i in range(datablock.shape[0]):
+                # this is how corrnormalize used to prep a single timecourse
+                if detrendorder > 0:
+                    intervec = tide_math.stdnormalize(
+                        tide_fit.detrend(datablock[i, :], order=detrendorder, demean=True)
+                    )
+                else:
+                    intervec = tide_math.stdnormalize(datablock[i, :])
+                thewindow = tide_filt.windowfunction(tclen, type=windowfunc)
+                rowresult = tide_math.stdnormalize(thewindow * intervec) / np.sqrt(tclen)
+                if debug:
+                    print(detrendorder, windowfunc, np.max(np.fabs(blockresult[i, :] - rowresult)))
+                np.testing.assert_allclose(blockresult[i, :], rowresult, atol=1e-8)
+                np.testing.assert_allclose(
+                    tide_math.corrnormalize(
+                        datablock[i, :], detrendorder=detrendorder, windowfunc=windowfunc
+                    ),
+                    blockresult[i, :],
+                    atol=1e-12,
+                )
+
+    # a flat timecourse must not blow up
+    flatresult = tide_math.corrnormalizeblock(np.ones((2, tclen)), detrendorder=1)
+    assert np.all(np.isfinite(flatresult))
+    assert np.max(np.fabs(flatresult)) < 1.0
+
+
+def main():
+    test_detrendblock(debug=True)
+    test_corrnormalizeblock(debug=True)
+
+
+if __name__ == "__main__":
+    main()
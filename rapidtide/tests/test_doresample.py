@@ -20,7 +20,7 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 
-from rapidtide.resample import doresample
+from rapidtide.resample import InterpolationOperator, doresample, getinterpolationoperator
 from rapidtide.tests.utils import mse
 
 
@@ -82,8 +82,39 @@ def test_doresample(debug=False):
         plt.show()
 
 
+def test_interpolationoperator(debug=False):
+    # the precomputed operator matches doresample, one voxel or a block at a time
+    tr = 0.72
+    oversampfactor = 3
+    numtimepoints = 200
+    fmri_x = np.arange(0.0, numtimepoints) * tr
+    os_fmri_x = np.arange(0.0, numtimepoints * oversampfactor - (oversampfactor - 1)) * (
+        tr / oversampfactor
+    )
+    theblock = np.random.random((10, numtimepoints))
+    for method in ["univariate", "cubic", "quadratic"]:
+        theoperator = InterpolationOperator(fmri_x, os_fmri_x, method=method)
+        if debug:
+            print(method, theoperator.operator.nnz / len(os_fmri_x), "nonzeros per row")
+        assert theoperator.operator.nnz < 0.5 * len(os_fmri_x) * numtimepoints
+        blockresult = theoperator.apply(theblock)
+        assert blockresult.shape == (10, len(os_fmri_x))
+        for i in range(10):
+            thetarget = doresample(fmri_x, theblock[i, :], os_fmri_x, method=method)
+            np.testing.assert_allclose(blockresult[i, :], thetarget, rtol=0.0, atol=1e-9)
+            np.testing.assert_allclose(
+                theoperator.apply(theblock[i, :]), thetarget, rtol=0.0, atol=1e-9
+            )
+
+    # operators are reused for the same axes
+    assert getinterpolationoperator(fmri_x, os_fmri_x) is getinterpolationoperator(
+        fmri_x, os_fmri_x
+    )
+
+
 def main():
     test_doresample(debug=True)
+    test_interpolationoperator(debug=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2021 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+import numpy as np
+
+import rapidtide.correlate as tide_corr
+import rapidtide.fftbackend as tide_fft
+import rapidtide.resample as tide_resample
+
+
+def test_fftbackend(debug=False):
+    rng = np.random.default_rng(7)
+    testvec = rng.standard_normal(331)
+    testblock = rng.standard_normal((4, 250))
+    startbackend = tide_fft.getbackend()
+
+    tide_fft.setbackend("numpy")
+    reffft = tide_fft.fft(testvec)
+    refrfft = tide_fft.rfft(testblock, 500, axis=1)
+    refcorr = tide_corr.fastcorrelate(testvec, testvec[::-1])
+    for thebackend in tide_fft.BACKENDS:
+        tide_fft.setbackend(thebackend)
+        if debug:
+            print(thebackend, tide_fft.getbackend())
+        np.testing.assert_allclose(tide_fft.fft(testvec), reffft, atol=1e-10)
+        np.testing.assert_allclose(tide_fft.ifft(reffft).real, testvec, atol=1e-10)
+        np.testing.assert_allclose(tide_fft.rfft(testblock, 500, axis=1), refrfft, atol=1e-10)
+        np.testing.assert_allclose(
+            tide_fft.irfft(refrfft, 500, axis=1)[:, :250], testblock, atol=1e-10
+        )
+        np.testing.assert_allclose(
+            tide_corr.fastcorrelate(testvec, testvec[::-1]), refcorr, atol=1e-10
+        )
+    tide_fft.setbackend(startbackend)
+
+    # fast lengths only have small prime factors
+    for thelen in [331, 1000, 1021, 4097]:
+        fastlen = tide_fft.next_fast_len(thelen)
+        assert fastlen >= thelen
+        for thefactor in [2, 3, 5, 7, 11]:
+            while fastlen % thefactor == 0:
+                fastlen //= thefactor
+        assert fastlen == 1
+
+
+def test_timeshiftfastlen(debug=False):
+    # padding out to a fast length must not move the shifted data (neither of these padded
+    # lengths is fast)
+    rng = np.random.default_rng(8)
+    for thelen in [418, 562]:
+        timecourse = np.convolve(rng.standard_normal(thelen), np.hanning(15), mode="same")
+        for shift in [-12, 5]:
+            shifted, weights, paddedshifted, paddedweights = tide_resample.timeshift(
+                timecourse, 1.0 * shift, 40
+            )
+            assert len(paddedshifted) == thelen + 80
+            assert len(paddedweights) == thelen + 80
+            if shift > 0:
+                np.testing.assert_allclose(shifted[shift:], timecourse[:-shift], atol=1e-8)
+            else:
+                np.testing.assert_allclose(shifted[:shift], timecourse[-shift:], atol=1e-8)
+
+
+def main():
+    test_fftbackend(debug=True)
+    test_timeshiftfastlen(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -244,7 +244,39 @@ def test_filterprops(display=False):
     eval_filterprops(sampletime=0.1, tclengthinsecs=1000.0, numruns=10, display=display)
 
 
+def test_filterblock(debug=False):
+    # filtering a 2D block must give the same answer as filtering each row in turn
+    rng = np.random.default_rng(12345)
+    sampletime = 0.72
+    datablock = rng.standard_normal((5, 500))
+    for transferfunc in ["trapezoidal", "brickwall", "gaussian", "butterworth"]:
+        for filtertype in ["lfo", "lfo_stop", "resp", "arb", "ringstop"]:
+            for cyclic in [False, True]:
+                thefilter = NoncausalFilter(
+                    filtertype=filtertype, transferfunc=transferfunc, cyclic=cyclic
+                )
+                if filtertype == "arb":
+                    thefilter.setfreqs(0.05, 0.06, 0.25, 0.27)
+                blockresult = thefilter.apply(1.0 / sampletime, datablock)
+                rowresult = np.zeros_like(datablock)
+                for i in range(datablock.shape[0]):
+                    rowresult[i, :] = thefilter.apply(1.0 / sampletime, datablock[i, :])
+                if debug:
+                    print(
+                        transferfunc,
+                        filtertype,
+                        cyclic,
+                        np.max(np.fabs(blockresult - rowresult)),
+                    )
+                assert blockresult.shape == datablock.shape
+                np.testing.assert_allclose(blockresult, rowresult, atol=1e-10)
+
+                # the transfer function (or filter coefficients) should only be built once
+                assert len(thefilter.filtercache) == 1
+
+
 def main():
+    test_filterblock(debug=True)
     test_filterprops(display=True)
 
 
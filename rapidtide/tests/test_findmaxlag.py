@@ -316,8 +316,106 @@ def test_findmaxlag(display=False, fittype="gauss", debug=False):
     assert eval_fml_result(absminsigma, absmaxsigma, testsigmas, fmlc_maxsigmas, fmlc_wfailreasons)
 
 
+def test_fitblock(debug=False):
+    # fitting a block of similarity functions at once must match fitting them one at a time
+    xvecs = np.linspace(-30.0, 30.0, 241, endpoint=True)
+    rng = np.random.default_rng(17)
+    numrows = 100
+    testlags = rng.uniform(-18.0, 18.0, numrows)
+    testvals = rng.uniform(0.1, 0.9, numrows)
+    testsigmas = rng.uniform(0.5, 8.0, numrows)
+    theblock = np.zeros((numrows, len(xvecs)), dtype=np.float64)
+    for i in range(numrows):
+        theblock[i, :] = tide_fit.gauss_eval(
+            xvecs, np.array([testvals[i], testlags[i], testsigmas[i]])
+        ) + 0.01 * rng.standard_normal(len(xvecs))
+    theblock[-5:, :] *= -1.0
+    theguesses = testlags + rng.uniform(-0.25, 0.25, numrows)
+
+    for fittype in ["fastquad", "COM", "gauss", "gausslm"]:
+        for bipolar in [False, True]:
+            for maxguesses in [None, theguesses]:
+                thefitter = tide_classes.SimilarityFunctionFitter(
+                    corrtimeaxis=xvecs,
+                    lagmin=-20.0,
+                    lagmax=20.0,
+                    absmaxsigma=10.0,
+                    absminsigma=0.1,
+                    peakfittype=fittype,
+                    bipolar=bipolar,
+                    zerooutbadfit=False,
+                )
+                blockresults = thefitter.fit_block(theblock, maxguesses=maxguesses)
+                for i in range(numrows):
+                    if maxguesses is not None:
+                        thefitter.setguess(True, maxguess=maxguesses[i])
+                    rowresults = thefitter.fit(theblock[i, :])
+                    if debug:
+                        print(fittype, bipolar, i, [thecol[i] for thecol in blockresults])
+                        print(fittype, bipolar, i, rowresults)
+                    # maxindex, maskval, failreason, peakstart and peakend are exact
+                    for j in [0, 4, 5, 6, 7]:
+                        assert blockresults[j][i] == rowresults[j]
+                    # maxlag, maxval and maxsigma of good fits agree to within the fit
+                    # tolerance (failed fits can stop in different places)
+                    if rowresults[4] > 0:
+                        for j in [1, 2, 3]:
+                            np.testing.assert_allclose(
+                                blockresults[j][i], rowresults[j], rtol=1e-4, atol=1e-8
+                            )
+
+
+def test_gausslm(debug=False):
+    # the levenberg-marquardt gaussian fitter must find the same peaks as the leastsq one
+    xvecs = np.linspace(-30.0, 30.0, 241, endpoint=True)
+    rng = np.random.default_rng(18)
+    numrows = 500
+    lagmin = -20.0
+    lagmax = 20.0
+    testlags = rng.uniform(-25.0, 25.0, numrows)
+    testvals = rng.uniform(0.1, 0.9, numrows)
+    testsigmas = rng.uniform(0.5, 8.0, numrows)
+    theblock = np.zeros((numrows, len(xvecs)), dtype=np.float64)
+    for i in range(numrows):
+        theblock[i, :] = tide_fit.gauss_eval(
+            xvecs, np.array([testvals[i], testlags[i], testsigmas[i]])
+        )
+
+    theresults = {}
+    for fittype in ["gauss", "gausslm"]:
+        thefitter = tide_classes.SimilarityFunctionFitter(
+            corrtimeaxis=xvecs,
+            lagmin=lagmin,
+            lagmax=lagmax,
+            absmaxsigma=10.0,
+            absminsigma=0.1,
+            peakfittype=fittype,
+            zerooutbadfit=False,
+        )
+        theresults[fittype] = [thefitter.fit(theblock[i, :]) for i in range(numrows)]
+        maxlags = np.array([theresult[1] for theresult in theresults[fittype]])
+        maxvals = np.array([theresult[2] for theresult in theresults[fittype]])
+        maxsigmas = np.array([theresult[3] for theresult in theresults[fittype]])
+        failreasons = np.array([theresult[5] for theresult in theresults[fittype]])
+        assert eval_fml_result(lagmin, lagmax, testlags, maxlags, failreasons, tolerance=0.05)
+        assert eval_fml_result(0.0, 1.0, testvals, maxvals, failreasons, tolerance=0.02)
+        assert eval_fml_result(0.1, 10.0, testsigmas, maxsigmas, failreasons, tolerance=0.1)
+
+    # the two fitters agree on every peak that fits
+    for i in range(numrows):
+        if debug:
+            print(i, theresults["gauss"][i], theresults["gausslm"][i])
+        assert theresults["gausslm"][i][4] == theresults["gauss"][i][4]
+        if theresults["gauss"][i][4] > 0:
+            np.testing.assert_allclose(
+                theresults["gausslm"][i][1:4], theresults["gauss"][i][1:4], rtol=1e-4, atol=1e-6
+            )
+
+
 def main():
     test_findmaxlag(display=True, debug=True)
+    test_fitblock(debug=True)
+    test_gausslm(debug=True)
 
 
 if __name__ == "__main__":
@@ -22,6 +22,7 @@ import numpy as np
 
 import rapidtide.glmpass as tide_glmpass
 from rapidtide.tests.utils import mse
+from rapidtide.workflows.rapidtide import allocshared
 
 
 def gen2d(xsize=150, xcycles=11, tsize=200, tcycles=13, mean=10.0):
@@ -210,6 +211,46 @@ def test_glmpass(debug=True, display=False):
         print("proc by time, single proc, no mask:", mse(datatoremove, targetarray))
     assert mse(datatoremove, targetarray) < 1e-3
 
+    # block dispatch - the outputs have to be in shared memory
+    for procbyvoxel in [True, False]:
+        if procbyvoxel:
+            numitems = xsize
+            theevs = twaveforms
+        else:
+            numitems = tsize
+            theevs = xwaveforms
+        meanvals_s, dummy, dummy = allocshared(numitems, np.float64)
+        rvals_s, dummy, dummy = allocshared(numitems, np.float64)
+        r2vals_s, dummy, dummy = allocshared(numitems, np.float64)
+        fitcoffs_s, dummy, dummy = allocshared(numitems, np.float64)
+        fitNorm_s, dummy, dummy = allocshared(numitems, np.float64)
+        datatoremove_s, dummy, dummy = allocshared((xsize, tsize), np.float64)
+        filtereddata_s, dummy, dummy = allocshared((xsize, tsize), np.float64)
+        itemsprocessed = tide_glmpass.glmpass(
+            numitems,
+            testarray,
+            threshval,
+            theevs,
+            meanvals_s,
+            rvals_s,
+            r2vals_s,
+            fitcoffs_s,
+            fitNorm_s,
+            datatoremove_s,
+            filtereddata_s,
+            showprogressbar=False,
+            procbyvoxel=procbyvoxel,
+            nprocs=2,
+            mp_chunksize=17,
+            blockmode=True,
+        )
+        if debug:
+            print(
+                "procbyvoxel =", procbyvoxel, "block dispatch:", mse(datatoremove_s, targetarray)
+            )
+        assert itemsprocessed == numitems
+        assert mse(datatoremove_s, targetarray) < 1e-3
+
 
 def main():
     test_glmpass(debug=True, display=True)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2021 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+import os
+import time
+
+import matplotlib as mpl
+import numpy as np
+import pyfftw
+import threadpoolctl
+
+import rapidtide.multiproc as tide_multiproc
+from rapidtide.tests.utils import get_test_temp_path
+from rapidtide.workflows.rapidtide import allocshared
+
+
+def _squareblock(blockstate, startidx, endidx):
+    # uneven work - every tenth item is slow
+    numdone = 0
+    for idx in range(startidx, endidx):
+        if blockstate["themask"] is not None and blockstate["themask"][idx] == 0:
+            continue
+        if idx % 10 == 0:
+            time.sleep(0.002)
+        blockstate["outputdata"][idx] = blockstate["inputdata"][idx] ** 2
+        numdone += 1
+    return numdone
+
+
+def _badblock(blockstate, startidx, endidx):
+    # one item raises an exception, another kills the worker outright
+    numdone = 0
+    for idx in range(startidx, endidx):
+        if idx == blockstate["raiseitem"]:
+            raise ValueError(f"bad item {idx}")
+        if idx == blockstate["killitem"]:
+            os._exit(1)
+        blockstate["outputdata"][idx] = blockstate["inputdata"][idx] ** 2
+        numdone += 1
+    return numdone
+
+
+def _threadinfo(blockstate, startidx, endidx):
+    # report the thread limits and cpus a worker was started with
+    blasthreads = [
+        thepool["num_threads"]
+        for thepool in threadpoolctl.threadpool_info()
+        if thepool["user_api"] == "blas"
+    ]
+    return (
+        blasthreads,
+        pyfftw.config.NUM_THREADS,
+        tide_multiproc.getfftworkers(),
+        sorted(os.sched_getaffinity(0)),
+    )
+
+
+def test_blockscheduler(debug=False):
+    numitems = 1000
+    themask = np.zeros(numitems, dtype=np.int16)
+    themask[100:300] = 1
+    themask[500:900:3] = 1
+    for maskarray in [None, themask]:
+        thescheduler = tide_multiproc.BlockScheduler(
+            numitems, maskarray=maskarray, nprocs=4, maxblocksize=50
+        )
+        covered = np.zeros(numitems, dtype=np.int16)
+        blocklens = []
+        while True:
+            theblock = thescheduler.nextblock()
+            if theblock is None:
+                break
+            startidx, endidx = theblock
+            assert thescheduler.numvalidin(startidx, endidx) <= 50
+            covered[startidx:endidx] += 1
+            blocklens.append(thescheduler.numvalidin(startidx, endidx))
+            thescheduler.update(blocklens[-1], 0.001 * blocklens[-1])
+        if debug:
+            print(blocklens)
+
+        # every valid item is handed out exactly once, and the blocks shrink at the end
+        if maskarray is None:
+            assert np.min(covered) == 1
+            assert np.max(covered) == 1
+        else:
+            assert np.min(covered[np.where(themask > 0)]) == 1
+            assert np.max(covered) == 1
+        assert np.sum(blocklens) == thescheduler.numvalid
+        assert blocklens[-1] <= blocklens[len(blocklens) // 2]
+
+
+def test_multiproc_blocks(debug=False):
+    numitems = 503
+    inputdata, dummy, dummy = allocshared(numitems, np.float64)
+    inputdata[:] = np.random.random(numitems)
+    themask = np.where(np.random.random(numitems) > 0.3, 1, 0)
+    for maskarray in [None, themask]:
+        outputdata, dummy, dummy = allocshared(numitems, np.float64)
+        blockstate = {"inputdata": inputdata, "outputdata": outputdata, "themask": maskarray}
+        data_out = tide_multiproc.run_multiproc_blocks(
+            _squareblock,
+            blockstate,
+            inputdata.shape,
+            maskarray,
+            nprocs=2,
+            showprogressbar=False,
+            blocksize=100,
+        )
+        if maskarray is None:
+            validlocs = np.arange(numitems)
+        else:
+            validlocs = np.where(maskarray > 0)[0]
+        assert np.sum([status for startidx, endidx, status in data_out]) == len(validlocs)
+        assert np.allclose(outputdata[validlocs], inputdata[validlocs] ** 2)
+        thestats = tide_multiproc.getstagestats()[-1]
+        if debug:
+            print(thestats)
+        assert thestats["stage"] == "_squareblock"
+        assert thestats["items"] == len(validlocs)
+        assert 0.0 < thestats["utilization"] <= 1.0
+
+    # the same thing on a persistent pool, with a new input each time
+    outputdata, dummy, dummy = allocshared(numitems, np.float64)
+    thepool = tide_multiproc.WorkerPool(
+        2, sharedarrays={"inputdata": inputdata, "outputdata": outputdata}
+    )
+    for i in range(3):
+        inputdata[:] = np.random.random(numitems)
+        thepool.run_blocks(
+            _squareblock,
+            {"inputdata": inputdata, "outputdata": outputdata, "themask": None},
+            inputdata.shape,
+            None,
+            showprogressbar=False,
+        )
+        assert np.allclose(outputdata, inputdata ** 2)
+    thepool.shutdown()
+    assert thepool.numstarts == 1
+
+
+def test_multiproc_nochunkbarrier(debug=False):
+    # the number of items is an exact multiple of the chunk size
+    numitems = 200
+
+    def square_consumer(inQ, outQ):
+        while True:
+            val = inQ.get()
+            if val is None:
+                break
+            outQ.put((val, val * val))
+
+    data_out = tide_multiproc.run_multiproc(
+        square_consumer, [numitems], None, nprocs=2, showprogressbar=False, chunksize=50,
+    )
+    assert len(data_out) == numitems
+    for val, sq in data_out:
+        assert sq == val * val
+
+
+def test_multiproc_failures(debug=False):
+    numitems = 300
+    raiseitem = 37
+    killitem = 211
+    inputdata, dummy, dummy = allocshared(numitems, np.float64)
+    inputdata[:] = np.random.random(numitems) + 1.0
+    goodlocs = np.ones(numitems, dtype=bool)
+    goodlocs[[raiseitem, killitem]] = False
+
+    # block dispatch - the bad blocks get broken up, so only the bad items are lost
+    outputdata, dummy, dummy = allocshared(numitems, np.float64)
+    blockstate = {
+        "inputdata": inputdata,
+        "outputdata": outputdata,
+        "raiseitem": raiseitem,
+        "killitem": killitem,
+    }
+    data_out = tide_multiproc.run_multiproc_blocks(
+        _badblock, blockstate, inputdata.shape, None, nprocs=2, showprogressbar=False,
+    )
+    if debug:
+        print(tide_multiproc.getstagestats()[-1])
+    assert tide_multiproc.getfaileditems() == [raiseitem, killitem]
+    assert tide_multiproc.getstagestats()[-1]["restarts"] > 0
+    assert np.sum([status for startidx, endidx, status in data_out]) == numitems - 2
+    assert np.allclose(outputdata[goodlocs], inputdata[goodlocs] ** 2)
+    assert outputdata[raiseitem] == 0.0
+    assert outputdata[killitem] == 0.0
+
+    # the pool replaces dead workers and hands them the current state
+    outputdata, dummy, dummy = allocshared(numitems, np.float64)
+    blockstate["outputdata"] = outputdata
+    thepool = tide_multiproc.WorkerPool(
+        2, sharedarrays={"inputdata": inputdata, "outputdata": outputdata}
+    )
+    for i in range(2):
+        outputdata[:] = 0.0
+        thepool.run_blocks(_badblock, blockstate, inputdata.shape, None, showprogressbar=False)
+        assert tide_multiproc.getfaileditems() == [raiseitem, killitem]
+        assert np.allclose(outputdata[goodlocs], inputdata[goodlocs] ** 2)
+    assert thepool.numstarts == 1
+    assert thepool.numrestarts > 0
+    thepool.shutdown()
+
+    # single item dispatch - consumers report failures instead of exiting
+    def bad_consumer(inQ, outQ):
+        while True:
+            try:
+                val = inQ.get()
+                if val is None:
+                    break
+                if val == raiseitem:
+                    raise ValueError(f"bad item {val}")
+                if val == killitem:
+                    os._exit(1)
+                outQ.put((val, val * val))
+            except Exception as e:
+                outQ.put(tide_multiproc.WorkerFailure(val, e))
+
+    data_out = tide_multiproc.run_multiproc(
+        bad_consumer, [numitems], None, nprocs=2, showprogressbar=False,
+    )
+    assert tide_multiproc.getfaileditems() == [raiseitem, killitem]
+    assert sorted([val for val, sq in data_out]) == list(np.where(goodlocs)[0])
+
+
+def test_workerresources(debug=False):
+    numcpus = tide_multiproc.availablecpus()
+    if debug:
+        print("available cpus:", numcpus)
+    assert 1 <= numcpus <= len(os.sched_getaffinity(0))
+    assert 1 <= tide_multiproc.maxcpus() <= numcpus
+
+    # workers share the cpus by default, or use what they are told to
+    for threadsperworker, pincpus in [(None, False), (1, False), (2, True)]:
+        tide_multiproc.configureworkers(threadsperworker=threadsperworker, pincpus=pincpus)
+        data_out = tide_multiproc.run_multiproc_blocks(
+            _threadinfo, {}, (4,), None, nprocs=2, showprogressbar=False, blocksize=1,
+        )
+        if threadsperworker is None:
+            expectedthreads = max(1, numcpus // 2)
+        else:
+            expectedthreads = threadsperworker
+        for startidx, endidx, status in data_out:
+            blasthreads, fftwthreads, fftworkers, workercpus = status
+            if debug:
+                print(threadsperworker, pincpus, status)
+            for numthreads in blasthreads:
+                assert numthreads == expectedthreads
+            assert fftwthreads == expectedthreads
+            assert fftworkers == expectedthreads
+            assert set(workercpus) <= set(os.sched_getaffinity(0))
+            if pincpus:
+                assert len(workercpus) <= max(1, numcpus // 2)
+    tide_multiproc.configureworkers()
+
+
+def test_multiproc_startmethod(debug=False):
+    # closures can only be run by forked workers - otherwise they run in this process
+    numitems = 100
+    raiseitem = 37
+
+    def pid_consumer(inQ, outQ):
+        while True:
+            try:
+                val = inQ.get()
+                if val is None:
+                    break
+                if val == raiseitem:
+                    raise ValueError(f"bad item {val}")
+                outQ.put((val, val * val, os.getpid()))
+            except Exception as e:
+                outQ.put(tide_multiproc.WorkerFailure(val, e))
+
+    for startmethod in ["fork", "spawn", "forkserver"]:
+        tide_multiproc.setstartmethod(startmethod)
+        data_out = tide_multiproc.run_multiproc(
+            pid_consumer, [numitems], None, nprocs=2, showprogressbar=False
+        )
+        thepids = set([thepid for val, sq, thepid in data_out])
+        if debug:
+            print(startmethod, thepids, tide_multiproc.getstagestats()[-1])
+        assert sorted([val for val, sq, thepid in data_out]) == [
+            val for val in range(numitems) if val != raiseitem
+        ]
+        assert all([sq == val * val for val, sq, thepid in data_out])
+        assert tide_multiproc.getfaileditems() == [raiseitem]
+        if startmethod == "fork":
+            assert os.getpid() not in thepids
+        else:
+            assert thepids == set([os.getpid()])
+            assert tide_multiproc.getstagestats()[-1]["workers"] == 1
+    tide_multiproc.setstartmethod("fork")
+    tide_multiproc.releasenamedshared()
+
+
+def test_namedshared(debug=False):
+    numitems = 257
+    for startmethod in ["spawn", "forkserver", "fork"]:
+        tide_multiproc.setstartmethod(startmethod, namedshared=True)
+        assert tide_multiproc.usenamedshared()
+        inputdata, dummy = tide_multiproc.allocnamedshared((numitems, 2), np.float64)
+        outputdata, dummy = tide_multiproc.allocnamedshared((numitems, 2), np.float64)
+        assert np.max(np.fabs(outputdata)) == 0.0
+        inputdata[:, :] = np.random.random((numitems, 2))
+
+        # workers attach to views of the segments (here, a column) by name
+        blockstate = {
+            "inputdata": inputdata[:, 1],
+            "outputdata": outputdata[:, 1],
+            "themask": None,
+        }
+        tide_multiproc.run_multiproc_blocks(
+            _squareblock, blockstate, (numitems,), None, nprocs=2, showprogressbar=False,
+        )
+        if debug:
+            print(startmethod, tide_multiproc.getstagestats()[-1])
+        assert np.allclose(outputdata[:, 1], inputdata[:, 1] ** 2)
+        assert np.max(np.fabs(outputdata[:, 0])) == 0.0
+
+        # memory mapped files are attached to by name as well
+        mapfile = os.path.join(get_test_temp_path(), f"mapped_{startmethod}.dat")
+        mappeddata = np.memmap(mapfile, dtype=np.float64, mode="w+", shape=(numitems, 2))
+        tide_multiproc.run_multiproc_blocks(
+            _squareblock,
+            {"inputdata": inputdata[:, 1], "outputdata": mappeddata[:, 1], "themask": None},
+            (numitems,),
+            None,
+            nprocs=2,
+            showprogressbar=False,
+        )
+        assert np.allclose(mappeddata[:, 1], inputdata[:, 1] ** 2)
+        assert np.max(np.fabs(mappeddata[:, 0])) == 0.0
+        del mappeddata
+        os.remove(mapfile)
+
+        # the pool never needs restarting for new named arrays
+        thepool = tide_multiproc.WorkerPool(2)
+        for i in range(2):
+            newoutput, dummy = tide_multiproc.allocnamedshared(numitems, np.float64)
+            thepool.run_blocks(
+                _squareblock,
+                {"inputdata": inputdata[:, 0], "outputdata": newoutput, "themask": None},
+                (numitems,),
+                None,
+                showprogressbar=False,
+                sharedkeys=["inputdata", "outputdata"],
+            )
+            assert np.allclose(newoutput, inputdata[:, 0] ** 2)
+        assert thepool.numstarts == 1
+        thepool.shutdown()
+    tide_multiproc.setstartmethod("fork")
+    tide_multiproc.releasenamedshared()
+
+
+def main():
+    test_blockscheduler(debug=True)
+    test_multiproc_blocks(debug=True)
+    test_multiproc_nochunkbarrier(debug=True)
+    test_multiproc_failures(debug=True)
+    test_workerresources(debug=True)
+    test_multiproc_startmethod(debug=True)
+    test_namedshared(debug=True)
+
+
+if __name__ == "__main__":
+    mpl.use("TkAgg")
+    main()
@@ -17,6 +17,7 @@
 #
 #
 import os
+import time
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -181,6 +182,235 @@ def test_nullsimfunc(debug=False, display=False):
             assert True
 
 
+def test_nullreproducible(debug=False):
+    # for a given seed, the null distribution should not depend on how the work is split up
+    timestep = 1.5
+    Fs = 1.0 / timestep
+    sourcedata = tide_io.readvecs(os.path.join(get_test_data_path(), "fmri_globalmean.txt"))[0]
+    theCorrelator = tide_classes.Correlator(
+        Fs=Fs, ncprefilter=tide_filt.NoncausalFilter("lfo"), detrendorder=3, windowfunc="hamming"
+    )
+    thefitter = tide_classes.SimilarityFunctionFitter(
+        lagmin=-10.0,
+        lagmax=10.0,
+        absmaxsigma=25.0,
+        absminsigma=0.25,
+        uthreshval=1.0,
+        peakfittype="gauss",
+    )
+    theCorrelator.setlimits(6, 7)
+    theCorrelator.setreftc(sourcedata)
+    numestreps = 600
+    for permutationmethod in ["shuffle", "phaserandom"]:
+        distributions = {}
+        for thenprocs, chunksize, blockmode, seed in [
+            (1, 1000, False, 5),
+            (1, 250, False, 5),
+            (2, 1000, False, 5),
+            (2, 250, True, 5),
+            (1, 1000, False, 6),
+        ]:
+            distributions[(thenprocs, chunksize, blockmode, seed)] = (
+                tide_nullsimfunc.getNullDistributionDatax(
+                    sourcedata,
+                    Fs,
+                    theCorrelator,
+                    thefitter,
+                    numestreps=numestreps,
+                    nprocs=thenprocs,
+                    showprogressbar=False,
+                    chunksize=chunksize,
+                    blockmode=blockmode,
+                    permutationmethod=permutationmethod,
+                    seed=seed,
+                )
+            )
+        reference = distributions[(1, 1000, False, 5)]
+        assert len(reference) == numestreps
+        for thekey, thedistribution in distributions.items():
+            if debug:
+                print(permutationmethod, thekey, np.max(np.fabs(thedistribution - reference)))
+            if thekey[3] == 5:
+                np.testing.assert_allclose(thedistribution, reference, atol=1e-8)
+            else:
+                assert not np.allclose(thedistribution, reference)
+
+    # the cache key should change with the settings, and the cache should keep to its size
+    thekey = tide_nullsimfunc.nullcachekey(theCorrelator, thefitter, numestreps, seed=5)
+    assert thekey == tide_nullsimfunc.nullcachekey(theCorrelator, thefitter, numestreps, seed=5)
+    assert thekey != tide_nullsimfunc.nullcachekey(theCorrelator, thefitter, numestreps, seed=6)
+    assert thekey != tide_nullsimfunc.nullcachekey(
+        theCorrelator, thefitter, numestreps, seed=5, sighistlen=100
+    )
+    theCorrelator.setreftc(sourcedata[::-1])
+    assert thekey != tide_nullsimfunc.nullcachekey(theCorrelator, thefitter, numestreps, seed=5)
+
+    cachedir = os.path.join(get_test_temp_path(), "nullcache")
+    if os.path.isdir(cachedir):
+        for thefile in os.listdir(cachedir):
+            os.remove(os.path.join(cachedir, thefile))
+    assert tide_nullsimfunc.readnullcache(cachedir, thekey) is None
+    tide_nullsimfunc.writenullcache(
+        cachedir, thekey, corrdistdata=reference, pcts=[0.1, 0.2], sigfit=None
+    )
+    cached = tide_nullsimfunc.readnullcache(cachedir, thekey)
+    np.testing.assert_array_equal(cached["corrdistdata"], reference)
+    np.testing.assert_array_equal(cached["pcts"], [0.1, 0.2])
+    assert "sigfit" not in cached
+
+    # each of these entries is about 4.8kB, so only the newest two fit in 0.01MB
+    for i in range(4):
+        tide_nullsimfunc.writenullcache(
+            cachedir, f"entry{i}", maxsize=0.01, corrdistdata=reference
+        )
+    assert sorted(os.listdir(cachedir)) == ["entry2.npz", "entry3.npz"]
+
+
+def test_nullstoptol(debug=False):
+    # stopping early should give the start of the full null distribution
+    timestep = 1.5
+    Fs = 1.0 / timestep
+    sourcedata = tide_io.readvecs(os.path.join(get_test_data_path(), "fmri_globalmean.txt"))[0]
+    theCorrelator = tide_classes.Correlator(
+        Fs=Fs, ncprefilter=tide_filt.NoncausalFilter("lfo"), detrendorder=3, windowfunc="hamming"
+    )
+    thefitter = tide_classes.SimilarityFunctionFitter(
+        lagmin=-10.0,
+        lagmax=10.0,
+        absmaxsigma=25.0,
+        absminsigma=0.25,
+        uthreshval=1.0,
+        peakfittype="gauss",
+    )
+    theCorrelator.setlimits(6, 7)
+    theCorrelator.setreftc(sourcedata)
+    numestreps = 3000
+    thepercentiles = [0.95, 0.99]
+    fulllist = tide_nullsimfunc.getNullDistributionDatax(
+        sourcedata, Fs, theCorrelator, thefitter, numestreps=numestreps, seed=7,
+    )
+    for stoptol, expectedreps in [(1.0, tide_nullsimfunc.NULLSTOPROUND), (1e-6, numestreps)]:
+        thedict = {}
+        corrlist = tide_nullsimfunc.getNullDistributionDatax(
+            sourcedata,
+            Fs,
+            theCorrelator,
+            thefitter,
+            numestreps=numestreps,
+            seed=7,
+            stoptol=stoptol,
+            stoppercentiles=thepercentiles,
+            thedict=thedict,
+        )
+        if debug:
+            print(stoptol, len(corrlist), thedict)
+        assert len(corrlist) == expectedreps
+        assert thedict["null_numreps"] == expectedreps
+        assert len(thedict["null_ciwidths"]) == len(thepercentiles)
+        np.testing.assert_allclose(corrlist, fulllist[:expectedreps], atol=1e-8)
+
+    # the intervals should contain the values, and narrow as the sample grows
+    pcts = tide_stats.getfracvals(fulllist, thepercentiles)
+    lowervals, uppervals = tide_stats.getfracvalcis(fulllist, thepercentiles, seed=1)
+    assert np.all(lowervals <= pcts) and np.all(pcts <= uppervals)
+    rng = np.random.default_rng(21)
+    widths = []
+    for numvals in [1000, 10000, 100000]:
+        lowervals, uppervals = tide_stats.getfracvalcis(
+            rng.standard_normal(numvals), thepercentiles, seed=1
+        )
+        widths.append(uppervals - lowervals)
+    assert np.all(widths[0] > widths[1]) and np.all(widths[1] > widths[2])
+
+
+def test_analyticnull(debug=False):
+    # white noise has about half as many degrees of freedom as points, smoothed noise fewer
+    rng = np.random.default_rng(22)
+    whitenoise = rng.standard_normal(2000)
+    assert 800.0 < tide_stats.effectivedof(whitenoise) < 1200.0
+    smoothnoise = tide_filt.NoncausalFilter("lfo").apply(1.0, whitenoise)
+    assert tide_stats.effectivedof(smoothnoise) < 500.0
+
+    # compare the analytic thresholds to the permutation ones for the bundled regressor
+    timestep = 1.5
+    Fs = 1.0 / timestep
+    sourcedata = tide_io.readvecs(os.path.join(get_test_data_path(), "fmri_globalmean.txt"))[0]
+    theCorrelator = tide_classes.Correlator(
+        Fs=Fs, ncprefilter=tide_filt.NoncausalFilter("lfo"), detrendorder=3, windowfunc="hamming"
+    )
+    thefitter = tide_classes.SimilarityFunctionFitter(
+        lagmin=-10.0,
+        lagmax=10.0,
+        absmaxsigma=25.0,
+        absminsigma=0.25,
+        uthreshval=1.0,
+        peakfittype="gauss",
+    )
+    theCorrelator.setlimits(6, 7)
+    theCorrelator.setreftc(sourcedata)
+    dummy, trimmedcorrscale, dummy = theCorrelator.getfunction()
+    thepercentiles = [0.95, 0.99, 0.995]
+    thresholds = {}
+    runtimes = {}
+    for permutationmethod in ["shuffle", "phaserandom"]:
+        starttime = time.time()
+        corrlist = tide_nullsimfunc.getNullDistributionDatax(
+            sourcedata,
+            Fs,
+            theCorrelator,
+            thefitter,
+            numestreps=2000,
+            permutationmethod=permutationmethod,
+            seed=22,
+        )
+        thresholds[permutationmethod] = np.array(
+            tide_stats.getfracvals(corrlist, thepercentiles, nozero=True)
+        )
+        runtimes[permutationmethod] = time.time() - starttime
+    starttime = time.time()
+    corrlist, dof, numcrossings = tide_stats.autocorrnulldistribution(
+        theCorrelator.prepreftc, Fs, trimmedcorrscale[-1] - trimmedcorrscale[0], numsamples=2000
+    )
+    thresholds["analytic"] = np.array(tide_stats.getfracvals(corrlist, thepercentiles))
+    runtimes["analytic"] = time.time() - starttime
+    if debug:
+        print(f"effective dof: {dof:.1f}, expected crossings: {numcrossings:.2f}")
+        print("method        ", "  ".join([f"p<{1.0 - p:.3f}" for p in thepercentiles]), " time")
+        for themethod in ["shuffle", "phaserandom", "analytic"]:
+            print(
+                f"{themethod:14s}",
+                "  ".join([f"{thethresh:7.3f}" for thethresh in thresholds[themethod]]),
+                f" {runtimes[themethod]:.3f}s",
+            )
+    assert np.all(np.diff(thresholds["analytic"]) > 0.0)
+
+    # the analytic thresholds run low, but not by much
+    assert np.all(thresholds["analytic"] < thresholds["phaserandom"])
+    assert np.all(thresholds["analytic"] > 0.8 * thresholds["phaserandom"])
+
+    # with a wider search range the maximum should be larger
+    widercorrlist = tide_stats.autocorrnulldistribution(
+        theCorrelator.prepreftc, Fs, 4.0 * (trimmedcorrscale[-1] - trimmedcorrscale[0])
+    )[0]
+    assert np.all(tide_stats.getfracvals(widercorrlist, thepercentiles) > thresholds["analytic"])
+
+    # two tailed samples come in both signs, with larger magnitudes
+    twotailcorrlist = tide_stats.autocorrnulldistribution(
+        theCorrelator.prepreftc,
+        Fs,
+        trimmedcorrscale[-1] - trimmedcorrscale[0],
+        numsamples=2000,
+        twotail=True,
+    )[0]
+    assert np.sum(twotailcorrlist < 0.0) == 1000
+    assert np.all(
+        tide_stats.getfracvals(np.fabs(twotailcorrlist), thepercentiles) > thresholds["analytic"]
+    )
+
+
 if __name__ == "__main__":
     mpl.use("TkAgg")
     test_nullsimfunc(debug=True, display=True)
+    test_nullreproducible(debug=True)
+    test_nullstoptol(debug=True)
+    test_analyticnull(debug=True)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2021 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+import numpy as np
+
+import rapidtide.filter as tide_filt
+import rapidtide.fit as tide_fit
+import rapidtide.helper_classes as tide_classes
+import rapidtide.peakeval as tide_peakeval
+
+
+def test_getpeaksblock(debug=False):
+    # the batched peak finder must give exactly what getpeaks gives for each row
+    xvals = np.linspace(-10.0, 10.0, 81)
+    theblock = np.zeros((7, len(xvals)), dtype=np.float64)
+    for i in range(5):
+        theblock[i, :] = np.cos(0.4 * (i + 1) * (xvals - i)) * np.exp(-0.01 * xvals ** 2)
+    theblock[5, 30:35] = 0.5  # a flat topped peak
+    theblock[6, :] = np.nan
+    for bipolar in [False, True]:
+        for xrange in [None, (-4.0, 6.0)]:
+            peaklists = tide_fit.getpeaksblock(xvals, theblock, xrange=xrange, bipolar=bipolar)
+            for i in range(theblock.shape[0]):
+                expected = tide_fit.getpeaks(xvals, theblock[i, :], xrange=xrange, bipolar=bipolar)
+                if debug:
+                    print(bipolar, xrange, i, len(peaklists[i]), len(expected))
+                assert len(peaklists[i]) == len(expected)
+                for thepeak, theexpectedpeak in zip(peaklists[i], expected):
+                    np.testing.assert_allclose(thepeak, theexpectedpeak)
+
+
+def test_peakevalpass(debug=False):
+    # evaluating the peaks a slab at a time must match doing it voxel by voxel
+    oversampfactor = 2
+    numvoxels = 40
+    numtimepoints = 300
+    tr = 1.0
+    Fs = 1.0 / tr
+    fmri_x = np.arange(0.0, numtimepoints) * tr
+    os_fmri_x = np.arange(0.0, numtimepoints * oversampfactor) * (tr / oversampfactor)
+    rng = np.random.default_rng(16)
+    reftc = np.sin(2.0 * np.pi * 0.06 * os_fmri_x) + 0.5 * np.sin(2.0 * np.pi * 0.021 * os_fmri_x)
+    fmridata = np.zeros((numvoxels, numtimepoints), dtype=np.float64)
+    for i in range(numvoxels):
+        fmridata[i, :] = np.sin(2.0 * np.pi * 0.06 * (fmri_x - 0.2 * i))
+        fmridata[i, :] += 0.5 * np.sin(2.0 * np.pi * 0.021 * (fmri_x - 0.2 * i))
+        fmridata[i, :] += 0.5 * rng.standard_normal(numtimepoints)
+
+    lagmininpts = 20
+    lagmaxinpts = 20
+    theCorrelator = tide_classes.Correlator(
+        Fs=oversampfactor * Fs, ncprefilter=tide_filt.NoncausalFilter("lfo")
+    )
+    theCorrelator.setreftc(reftc)
+    theCorrelator.setlimits(lagmininpts, lagmaxinpts)
+    theMutualInformationator = tide_classes.MutualInformationator(
+        Fs=oversampfactor * Fs,
+        ncprefilter=tide_filt.NoncausalFilter("lfo"),
+        lagmininpts=lagmininpts,
+        lagmaxinpts=lagmaxinpts,
+    )
+    theMutualInformationator.setreftc(reftc)
+
+    oversampled = np.zeros((numvoxels, len(os_fmri_x)), dtype=np.float64)
+    for i in range(numvoxels):
+        oversampled[i, :] = np.interp(os_fmri_x, fmri_x, fmridata[i, :])
+    corrout, xcorr_x, dummy = theCorrelator.run_block(oversampled)
+
+    for bipolar in [False, True]:
+        volumetotal, peakdict = tide_peakeval.peakevalpass(
+            fmridata,
+            reftc,
+            fmri_x,
+            os_fmri_x,
+            theMutualInformationator,
+            xcorr_x,
+            corrout,
+            bipolar=bipolar,
+            oversampfactor=oversampfactor,
+            showprogressbar=False,
+            chunksize=16,
+        )
+        assert volumetotal == numvoxels
+        thetc = np.zeros(len(os_fmri_x), dtype=np.float64)
+        for vox in range(numvoxels):
+            dummy, expected = tide_peakeval._procOneVoxelPeaks(
+                vox,
+                thetc,
+                theMutualInformationator,
+                fmri_x,
+                fmridata[vox, :],
+                os_fmri_x,
+                xcorr_x,
+                corrout[vox, :],
+                bipolar=bipolar,
+                oversampfactor=oversampfactor,
+            )
+            if debug:
+                print(bipolar, vox, peakdict[str(vox)], expected)
+            assert len(peakdict[str(vox)]) == len(expected)
+            for thepeak, theexpectedpeak in zip(peakdict[str(vox)], expected):
+                np.testing.assert_allclose(thepeak, theexpectedpeak, rtol=1e-10)
+
+
+def main():
+    test_getpeaksblock(debug=True)
+    test_peakevalpass(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2021 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+import numpy as np
+from sklearn.decomposition import PCA, FastICA
+
+import rapidtide.filter as tide_filt
+import rapidtide.miscmath as tide_math
+import rapidtide.refine as tide_refine
+import rapidtide.workflows.rapidtide as tide_rapidtide
+
+
+def test_blockpca(debug=False):
+    # make some voxels sharing a few time courses, with noise
+    rng = np.random.default_rng(24)
+    numvoxels = 3000
+    numtimepoints = 120
+    thesources = rng.standard_normal((4, numtimepoints))
+    thedata = rng.standard_normal((numvoxels, 4)) @ thesources
+    thedata += 0.3 * rng.standard_normal((numvoxels, numtimepoints)) + 5.0
+    therows = np.sort(rng.choice(numvoxels, 2000, replace=False))
+    thesigns = np.where(rng.uniform(size=len(therows)) < 0.2, -1.0, 1.0)
+    theselection = thedata[therows, :] * thesigns[:, None]
+
+    # make the blocks small, so there are several of them
+    savedmaxpoints = tide_refine.MAXBLOCKPOINTS
+    tide_refine.MAXBLOCKPOINTS = 300 * numtimepoints
+    np.testing.assert_allclose(
+        tide_refine.sumrows(thedata, therows, signs=thesigns), np.sum(theselection, axis=0)
+    )
+
+    # the components and explained variance should match sklearn, whichever way it's done
+    for demeanrows, thesamples, componentlist in [
+        (False, theselection, [0.5, 0.9, 3, "mle"]),
+        (True, theselection.T, [0.5, 0.9, 3]),
+    ]:
+        for pcacomponents in componentlist:
+            thefit = PCA(n_components=pcacomponents).fit(thesamples)
+            thecomponents, thesingularvalues, explainedvarianceratio, themean = (
+                tide_refine.blockpca(
+                    thedata, therows, pcacomponents, signs=thesigns, demeanrows=demeanrows
+                )
+            )
+            if demeanrows:
+                expectedcomponents = thefit.transform(thesamples).T
+                expectedcomponents /= np.linalg.norm(expectedcomponents, axis=1)[:, None]
+            else:
+                expectedcomponents = thefit.components_
+            if debug:
+                print(demeanrows, pcacomponents, len(thecomponents), len(thefit.components_))
+            assert len(thecomponents) == len(thefit.components_)
+            numcomponents = len(thecomponents)
+            np.testing.assert_allclose(
+                explainedvarianceratio[:numcomponents], thefit.explained_variance_ratio_
+            )
+            np.testing.assert_allclose(thesingularvalues, thefit.singular_values_)
+            np.testing.assert_allclose(
+                np.fabs(np.sum(thecomponents * expectedcomponents, axis=1)), 1.0
+            )
+            np.testing.assert_allclose(themean, np.mean(theselection, axis=0))
+
+    # the mle choice of the number of components should match sklearn's
+    for numsources in [1, 2, 6, 15]:
+        thesamples = rng.standard_normal((400, numsources)) @ rng.standard_normal((numsources, 30))
+        thesamples += 0.5 * rng.standard_normal((400, 30))
+        thecomponents = tide_refine.blockpca(thesamples, np.arange(400), "mle")[0]
+        if debug:
+            print(numsources, len(thecomponents))
+        assert len(thecomponents) == PCA(n_components="mle").fit(thesamples).n_components_
+
+    # a single FastICA component is the whitened first principal component
+    thefit = FastICA(n_components=1, random_state=24).fit(theselection)
+    thecomponents, thesingularvalues, dummy, dummy = tide_refine.blockpca(
+        thedata, therows, 1, signs=thesigns
+    )
+    icadata = np.sqrt(len(therows)) * thecomponents[0] / thesingularvalues[0]
+    np.testing.assert_allclose(np.fabs(icadata), np.fabs(thefit.components_[0]), rtol=1e-6)
+
+    # too many components, or mle with too few samples, is an error
+    for pcacomponents, demeanrows in [(numtimepoints + 1, False), ("mle", True)]:
+        try:
+            tide_refine.blockpca(thedata, therows, pcacomponents, demeanrows=demeanrows)
+        except ValueError:
+            pass
+        else:
+            assert False
+    tide_refine.MAXBLOCKPOINTS = savedmaxpoints
+
+
+def test_globalsignalpca(debug=False):
+    # the voxels are the samples, as in PCA().fit(thevoxels), with more voxels than timepoints
+    rng = np.random.default_rng(24)
+    numvoxels = 500
+    numtimepoints = 80
+    thesources = rng.standard_normal((3, numtimepoints))
+    indata = rng.standard_normal((numvoxels, 3)) @ thesources
+    indata += 0.3 * rng.standard_normal((numvoxels, numtimepoints)) + 100.0
+    includemask = np.where(rng.uniform(size=numvoxels) < 0.7, 1.0, 0.0)
+    theselection = indata[includemask > 0, :]
+    tide_rapidtide.rt_floatset = np.float64
+    tide_rapidtide.rt_floattype = "float64"
+    for pcacomponents, sklearncomponents in [(0.5, 0.5), (0.9, 0.9), (2.0, 2), (-1.0, "mle")]:
+        optiondict = {"globalsignalmethod": "pca"}
+        globalsignal, themask = tide_rapidtide.getglobalsignal(
+            indata, optiondict, includemask=includemask, pcacomponents=pcacomponents
+        )
+        thefit = PCA(n_components=sklearncomponents).fit(theselection)
+        if debug:
+            print(pcacomponents, optiondict["globalpcacomponentsused"], thefit.n_components_)
+        assert optiondict["globalpcacomponentsused"] == thefit.n_components_
+        np.testing.assert_allclose(
+            globalsignal,
+            tide_math.stdnormalize(
+                np.mean(thefit.inverse_transform(thefit.transform(theselection)), axis=0)
+            ),
+            atol=1e-8,
+        )
+        assert np.array_equal(themask, includemask)
+
+
+def test_stratifiedorder(debug=False):
+    rng = np.random.default_rng(25)
+    numvoxels = 20000
+    lagtimes = rng.normal(0.0, 3.0, numvoxels)
+    lagstrengths = rng.uniform(0.2, 1.0, numvoxels)
+    theorder = tide_refine.stratifiedorder(lagtimes, lagstrengths, seed=[1, 2])
+    assert np.array_equal(np.sort(theorder), np.arange(numvoxels))
+    assert np.array_equal(
+        theorder, tide_refine.stratifiedorder(lagtimes, lagstrengths, seed=[1, 2])
+    )
+    assert not np.array_equal(
+        theorder, tide_refine.stratifiedorder(lagtimes, lagstrengths, seed=[1, 3])
+    )
+
+    # every leading section should have (almost exactly) the same share of each lag decile and
+    # strength quartile
+    lagedges = np.quantile(lagtimes, np.linspace(0.0, 1.0, 11))
+    strengthedges = np.quantile(lagstrengths, np.linspace(0.0, 1.0, 5))
+    for numsamples in [100, 1000, 5000]:
+        thesample = theorder[:numsamples]
+        lagcounts = np.histogram(lagtimes[thesample], bins=lagedges)[0]
+        strengthcounts = np.histogram(lagstrengths[thesample], bins=strengthedges)[0]
+        if debug:
+            print(numsamples, lagcounts, strengthcounts)
+        assert np.max(np.fabs(lagcounts - numsamples / 10)) <= 4
+        assert np.max(np.fabs(strengthcounts - numsamples / 4)) <= 4
+
+
+def test_refinesubsample(debug=False):
+    # voxels containing a lagged copy of a regressor, with noise
+    rng = np.random.default_rng(25)
+    numvoxels = 2000
+    numtimepoints = 400
+    fmritr = 1.0
+    lfofilter = tide_filt.NoncausalFilter("lfo")
+    theregressor = lfofilter.apply(1.0 / fmritr, rng.standard_normal(numtimepoints + 40))
+    lagtimes = rng.uniform(-4.0, 4.0, numvoxels)
+    lagstrengths = rng.uniform(0.3, 0.9, numvoxels)
+    fmridata = np.zeros((numvoxels, numtimepoints), dtype=np.float64)
+    timeaxis = np.arange(numtimepoints) * fmritr
+    for i in range(numvoxels):
+        fmridata[i, :] = 100.0 + 10.0 * np.interp(
+            timeaxis - lagtimes[i], np.arange(-20, numtimepoints + 20) * fmritr, theregressor
+        )
+    fmridata += 2.0 * rng.standard_normal((numvoxels, numtimepoints))
+
+    optiondict = {
+        "ampthresh": 0.3,
+        "lagmaskside": "both",
+        "offsettime": 0.0,
+        "lagminthresh": 0.0,
+        "lagmaxthresh": 5.0,
+        "sigmathresh": 100.0,
+        "cleanrefined": False,
+        "nprocs": 1,
+        "mp_blockmode": False,
+        "mp_chunksize": 500,
+        "showprogressbar": False,
+        "refineprenorm": "mean",
+        "refineweighting": "R",
+        "detrendorder": 1,
+        "psdfilter": False,
+        "fmrifreq": 1.0 / fmritr,
+        "filterbeforePCA": False,
+        "dodispersioncalc": False,
+        "pcacomponents": 0.8,
+        "refinetype": "unweighted_average",
+        "refinesubsample": None,
+        "refinesubsampletol": None,
+        "refinesubsampleseed": 25,
+    }
+    refinedregressors = {}
+    for refinesubsample, refinesubsampletol in [(None, None), (200, None), (20, 0.001)]:
+        optiondict["refinesubsample"] = refinesubsample
+        optiondict["refinesubsampletol"] = refinesubsampletol
+        shiftedtcs = np.zeros_like(fmridata)
+        weights = np.zeros_like(fmridata)
+        volumetotal, outputdata, refinemask = tide_refine.refineregressor(
+            fmridata,
+            fmritr,
+            shiftedtcs,
+            weights,
+            1,
+            lagstrengths,
+            lagtimes,
+            lagstrengths * 0.0 + 2.0,
+            lagstrengths * 0.0 + 1.0,
+            lagstrengths ** 2,
+            lfofilter,
+            optiondict,
+            padtrs=20,
+        )[:3]
+        refinedregressors[refinesubsample, refinesubsampletol] = tide_math.stdnormalize(
+            lfofilter.apply(1.0 / fmritr, outputdata)
+        )
+        if debug:
+            print(refinesubsample, refinesubsampletol, volumetotal, np.sum(refinemask))
+        if refinesubsample is None:
+            assert volumetotal == numvoxels
+        elif refinesubsampletol is None:
+            # only the sampled voxels are shifted
+            assert volumetotal == refinesubsample == np.sum(refinemask)
+            assert np.sum(np.fabs(shiftedtcs[refinemask == 0, :])) == 0.0
+        else:
+            # the sample grows until the halves agree
+            assert optiondict["refinesubsamplemse_pass1"] <= refinesubsampletol
+            assert volumetotal == optiondict["refinesubsamplesize_pass1"] > refinesubsample
+
+    # the sampled regressors should be very close to the full one
+    fullregressor = refinedregressors[None, None]
+    for thekey, theregressor in refinedregressors.items():
+        themse = np.mean(np.square(theregressor - fullregressor))
+        if debug:
+            print(thekey, themse)
+        assert themse < 0.01
+
+
+def main():
+    test_blockpca(debug=True)
+    test_globalsignalpca(debug=True)
+    test_stratifiedorder(debug=True)
+    test_refinesubsample(debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2016-2021 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+import os
+
+import matplotlib as mpl
+import numpy as np
+
+import rapidtide.correlate as tide_corr
+import rapidtide.filter as tide_filt
+import rapidtide.fit as tide_fit
+import rapidtide.helper_classes as tide_classes
+import rapidtide.io as tide_io
+import rapidtide.miscmath as tide_math
+import rapidtide.resample as tide_resample
+import rapidtide.workflows.rapidtide as rapidtide_workflow
+import rapidtide.workflows.rapidtide_parser as rapidtide_parser
+from rapidtide.tests.utils import get_examples_path, get_test_temp_path
+
+# how far a --spcalculation run may stray from the same run in double precision
+MAXTIMETOL = 0.05  # seconds
+MAXCORRTOL = 0.005
+
+
+def test_singleprecisionkernels(debug=False):
+    # float32 in should mean float32 out
+    rng = np.random.default_rng(14)
+    tclen = 300
+    thetc = rng.standard_normal(tclen).astype(np.float32)
+    datablock = rng.standard_normal((5, tclen)).astype(np.float32)
+
+    thefilter = tide_filt.NoncausalFilter("lfo")
+    for transferfunc in ["trapezoidal", "butterworth"]:
+        thefilter.settransferfunc(transferfunc)
+        assert thefilter.apply(1.0, thetc).dtype == np.float32
+        assert thefilter.apply(1.0, datablock).dtype == np.float32
+
+    assert tide_math.corrnormalize(thetc).dtype == np.float32
+    assert tide_math.corrnormalizeblock(datablock).dtype == np.float32
+    assert tide_fit.detrendblock(datablock, order=1).dtype == np.float32
+    assert tide_corr.fastcorrelate(thetc, thetc).dtype == np.float32
+    for theshifted in tide_resample.timeshift(thetc, 3.3, 30):
+        assert theshifted.dtype == np.float32
+
+    orig_x = np.arange(0.0, tclen)
+    new_x = np.arange(0.0, tclen - 1, 0.25)
+    assert tide_resample.doresample(orig_x, thetc, new_x).dtype == np.float32
+    theoperator = tide_resample.InterpolationOperator(orig_x, new_x)
+    assert theoperator.apply(thetc).dtype == np.float32
+    assert theoperator.apply(datablock).dtype == np.float32
+
+    thefit, R = tide_fit.mlregress(thetc, 2.0 * thetc + datablock[0, :])
+    assert thefit.dtype == np.float32
+    if debug:
+        print("mlregress:", thefit, R)
+
+    theCorrelator = tide_classes.Correlator(
+        Fs=1.0, ncprefilter=thefilter, detrendorder=1, windowfunc="hamming"
+    )
+    theCorrelator.setreftc(thetc)
+    theCorrelator.setlimits(10, 10)
+    assert theCorrelator.run(datablock[0, :])[0].dtype == np.float32
+    assert theCorrelator.run_block(datablock)[0].dtype == np.float32
+
+
+def test_singleprecisionaccuracy(debug=False):
+    # run the same analysis in double and single precision and compare the delay maps
+    outputroots = {}
+    for precision, extraargs in [("dp", []), ("sp", ["--spcalculation"])]:
+        outputroots[precision] = os.path.join(get_test_temp_path(), f"sub-RAPIDTIDESP_{precision}")
+        inputargs = [
+            os.path.join(get_examples_path(), "sub-RAPIDTIDETEST_cifti.ptseries.nii"),
+            outputroots[precision],
+            "--nprocs",
+            "1",
+            "--passes",
+            "2",
+            "--numnull",
+            "0",
+            "--noprogressbar",
+        ] + extraargs
+        rapidtide_workflow.rapidtide_main(rapidtide_parser.process_args(inputargs=inputargs))
+
+    for themap, tolerance in [("maxtime", MAXTIMETOL), ("maxcorr", MAXCORRTOL)]:
+        thedata = {}
+        for precision in ["dp", "sp"]:
+            thedata[precision] = tide_io.readfromcifti(
+                f"{outputroots[precision]}_desc-{themap}_map.pscalar.nii"
+            )[2]
+        maxdiff = np.max(np.fabs(thedata["sp"] - thedata["dp"]))
+        if debug:
+            print(themap, "max difference between single and double precision:", maxdiff)
+        assert maxdiff < tolerance
+
+
+def main():
+    test_singleprecisionkernels(debug=True)
+    test_singleprecisionaccuracy(debug=True)
+
+
+if __name__ == "__main__":
+    mpl.use("TkAgg")
+    main()
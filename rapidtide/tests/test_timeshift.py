@@ -21,7 +21,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from rapidtide.filter import dolpfiltfilt
-from rapidtide.resample import timeshift
+from rapidtide.resample import timeshift, timeshiftblock
 from rapidtide.tests.utils import mse
 
 
@@ -88,8 +88,52 @@ def test_timeshift(debug=False):
         plt.show()
 
 
+def test_timeshiftblock(debug=False):
+    # shifting a block should match shifting each row with timeshift
+    rng = np.random.default_rng(23)
+    numrows = 20
+    padtrs = 30
+    for testlen in [300, 1200]:
+        theblock = rng.standard_normal((numrows, testlen))
+        theshifts = rng.uniform(-15.0, 15.0, numrows)
+        theshifts[:3] = [0.0, 3.0, -2.9996]
+        for thedtype in [np.float64, np.float32]:
+            shiftedblock, shiftedweights = timeshiftblock(
+                theblock.astype(thedtype), theshifts, padtrs
+            )
+            assert shiftedblock.dtype == thedtype
+            assert shiftedweights.dtype == thedtype
+            for i in range(numrows):
+                tcshifted, weights, alltc, allweights = timeshift(
+                    theblock[i, :].astype(thedtype), theshifts[i], padtrs
+                )
+                if debug:
+                    print(
+                        testlen,
+                        thedtype,
+                        i,
+                        np.max(np.fabs(shiftedblock[i, :] - tcshifted)),
+                        np.max(np.fabs(shiftedweights[i, :] - weights)),
+                    )
+                if thedtype == np.float64:
+                    np.testing.assert_allclose(shiftedblock[i, :], tcshifted, atol=1e-10)
+                else:
+                    np.testing.assert_allclose(shiftedblock[i, :], tcshifted, atol=1e-4)
+
+                # the weights are calculated for the nearest multiple of weightstepsize
+                np.testing.assert_allclose(shiftedweights[i, :], weights, atol=2e-3)
+
+    # an integer shift of an odd length timecourse is a roll
+    thetc = rng.standard_normal(261)
+    shiftedblock, shiftedweights = timeshiftblock(thetc[np.newaxis, :], [3.0], 20)
+    np.testing.assert_allclose(shiftedblock[0, 3:], thetc[:-3], atol=1e-10)
+    np.testing.assert_allclose(shiftedweights[0, 3:], 1.0, atol=1e-10)
+    np.testing.assert_allclose(shiftedweights[0, :3], 0.0, atol=1e-10)
+
+
 def main():
     test_timeshift(debug=True)
+    test_timeshiftblock(debug=True)
 
 
 if __name__ == "__main__":
@@ -86,8 +86,7 @@ def wienerpass(
                     )
 
                 except Exception as e:
-                    print("error!", e)
-                    break
+                    outQ.put(tide_multiproc.WorkerFailure(val, e))
 
         data_out = tide_multiproc.run_multiproc(
             Wiener_consumer,
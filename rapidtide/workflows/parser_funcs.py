@@ -558,6 +558,23 @@ def addpermutationopts(parser, numreps=10000):
         ),
         default=numreps,
     )
+    parser.add_argument(
+        "--significancemethod",
+        dest="significancemethod",
+        action="store",
+        type=str,
+        choices=["permutation", "analytic"],
+        help=(
+            "How to find the significance thresholds.  \"permutation\" correlates permuted "
+            "copies of the regressor.  \"analytic\" calculates the null distribution from the "
+            "autocorrelation of the regressor instead, which is much faster, but approximate - "
+            "NREPS from --numnull is then the number of points used to describe it.  NOTE: the "
+            "analytic thresholds run lower than the permutation ones (by 10-20%% in testing), "
+            "so the resulting significance masks are more permissive.  "
+            'Default is "permutation".'
+        ),
+        default="permutation",
+    )
     parser.add_argument(
         "--skipsighistfit",
         dest="dosighistfit",
@@ -565,6 +582,59 @@ def addpermutationopts(parser, numreps=10000):
         help=("Do not fit significance histogram with a Johnson SB function."),
         default=True,
     )
+    parser.add_argument(
+        "--nullstoptol",
+        dest="nullstoptol",
+        action="store",
+        type=float,
+        metavar="TOL",
+        help=(
+            "Calculate the null correlations in rounds, and stop once the bootstrap 95%% "
+            "confidence intervals of all the significance thresholds are narrower than TOL. "
+            "NREPS from --numnull is then the maximum number to calculate.  The number used "
+            "and the interval widths are saved in the options file, and passes that stop early "
+            "are padded out to NREPS with empty values in the corrdistdata output."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--nullseed",
+        dest="nullseed",
+        action="store",
+        type=int,
+        metavar="SEED",
+        help=(
+            "Seed for the null correlation permutations.  The null distribution for a "
+            "given seed is the same however many processes are used.  By default a random "
+            "seed is chosen (and saved in the options file)."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--nullcachedir",
+        dest="nullcachedir",
+        action="store",
+        type=str,
+        metavar="DIR",
+        help=(
+            "Keep null distributions (and their significance fits) in DIR, keyed by the "
+            "regressor and the analysis settings, and reuse them rather than recalculating "
+            "them when they match.  To reuse them between runs, also set --nullseed."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--nullcachesize",
+        dest="nullcachesize",
+        action="store",
+        type=float,
+        metavar="MB",
+        help=(
+            "Maximum size of the null distribution cache - the least recently used entries "
+            "are removed to stay under it.  Default is 1000.0."
+        ),
+        default=1000.0,
+    )
 
 
 def addsearchrangeopts(parser, details=False, defaultmin=-30.0, defaultmax=30.0):
@@ -23,18 +23,19 @@ import logging
 import multiprocessing as mp
 import os
 import platform
+import tempfile
 import warnings
 
 import numpy as np
 from matplotlib.pyplot import figure, plot, show
 from nilearn import masking
 from scipy import ndimage
-from sklearn.decomposition import PCA
 
 import rapidtide.calccoherence as tide_calccoherence
 import rapidtide.calcnullsimfunc as tide_nullsimfunc
 import rapidtide.calcsimfunc as tide_calcsimfunc
 import rapidtide.correlate as tide_corr
+import rapidtide.fftbackend as tide_fft
 import rapidtide.filter as tide_filt
 import rapidtide.fit as tide_fit
 import rapidtide.glmpass as tide_glmpass
@@ -110,6 +111,10 @@ def maketmask(filename, timeaxis, maskvector, debug=False):
 def numpy2shared(inarray, thetype):
     thesize = inarray.size
     theshape = inarray.shape
+    if tide_multiproc.usenamedshared():
+        outarray, dummy = tide_multiproc.allocnamedshared(theshape, thetype)
+        outarray[...] = inarray
+        return outarray
     if thetype == np.float64:
         inarray_shared = mp.RawArray("d", inarray.reshape(thesize))
     else:
@@ -126,15 +131,47 @@ def allocshared(theshape, thetype):
     else:
         for element in theshape:
             thesize *= int(element)
+    if tide_multiproc.usenamedshared():
+        outarray, outarray_shared = tide_multiproc.allocnamedshared(theshape, thetype)
+        return outarray, outarray_shared, theshape
     if thetype == np.float64:
         outarray_shared = mp.RawArray("d", thesize)
-    else:
+    elif thetype == np.float32:
         outarray_shared = mp.RawArray("f", thesize)
+    else:
+        outarray_shared = mp.RawArray(np.ctypeslib.as_ctypes_type(np.dtype(thetype)), thesize)
     outarray = np.frombuffer(outarray_shared, dtype=thetype, count=thesize)
     outarray.shape = theshape
     return outarray, outarray_shared, theshape
 
 
+def allocprepcache(theshape, thetype, maxgb, shared=True, cachedir=None, prefix="rapidtide"):
+    """Allocate the array that holds the prepped voxel timecourses between passes.
+
+    The cache is kept in memory (in shared memory if shared is True) if it fits in maxgb
+    gigabytes, and otherwise goes in a memory mapped scratch file in cachedir.
+
+    Returns
+    -------
+    prepcache : ndarray
+    storage : str
+        "ram", "shared", or "memmap"
+    cachefile : str
+        The name of the scratch file (None unless storage is "memmap")
+    """
+    cachegb = np.prod(theshape) * np.dtype(thetype).itemsize / 1024.0 ** 3
+    if cachegb <= maxgb:
+        if shared:
+            prepcache, dummy, dummy = allocshared(theshape, thetype)
+            return prepcache, "shared", None
+        else:
+            return np.zeros(theshape, dtype=thetype), "ram", None
+    filedesc, cachefile = tempfile.mkstemp(prefix=prefix + "_prepcache_", dir=cachedir)
+    os.close(filedesc)
+    prepcache = np.memmap(cachefile, dtype=thetype, mode="w+", shape=theshape)
+    return prepcache, "memmap", cachefile
+
+
 def readamask(maskfilename, nim_hdr, xsize, istext=False, valslist=None, maskname="the"):
     LGR.verbose(f"readamask called with filename: {maskfilename} vals: {valslist}")
     if istext:
@@ -175,10 +212,10 @@ def getglobalsignal(indata, optiondict, includemask=None, excludemask=None, pcac
     globalmean = rt_floatset(indata[0, :])
     thesize = np.shape(themask)
     numvoxelsused = int(np.sum(np.where(themask > 0.0, 1, 0)))
-    selectedvoxels = indata[np.where(themask > 0.0), :][0]
+    selectedvoxels = np.where(themask > 0.0)[0]
     LGR.info(f"constructing global mean signal using {optiondict['globalsignalmethod']}")
     if optiondict["globalsignalmethod"] == "sum":
-        globalmean = np.sum(selectedvoxels, axis=0)
+        globalmean = tide_refine.sumrows(indata, selectedvoxels)
     elif optiondict["globalsignalmethod"] == "meanscale":
         themean = np.mean(indata, axis=1)
         for vox in range(0, thesize[0]):
@@ -186,20 +223,34 @@ def getglobalsignal(indata, optiondict, includemask=None, excludemask=None, pcac
                 if themean[vox] != 0.0:
                     globalmean += indata[vox, :] / themean[vox] - 1.0
     elif optiondict["globalsignalmethod"] == "pca":
+        if pcacomponents < 0.0:
+            pcacomponents = "mle"
+        elif pcacomponents >= 1.0:
+            pcacomponents = int(np.round(pcacomponents))
         try:
-            thefit = PCA(n_components=pcacomponents).fit(selectedvoxels)
+            thecomponents, dummy, explainedvarianceratio, themean = tide_refine.blockpca(
+                indata, selectedvoxels, pcacomponents
+            )
         except ValueError:
             if pcacomponents == "mle":
                 LGR.warning("mle estimation failed - falling back to pcacomponents=0.8")
-                thefit = PCA(n_components=0.8).fit(selectedvoxels)
+                thecomponents, dummy, explainedvarianceratio, themean = tide_refine.blockpca(
+                    indata, selectedvoxels, 0.8
+                )
             else:
                 raise ValueError("unhandled math exception in PCA refinement - exiting")
 
-        varex = 100.0 * np.cumsum(thefit.explained_variance_ratio_)[len(thefit.components_) - 1]
+        varex = 100.0 * np.cumsum(explainedvarianceratio)[len(thecomponents) - 1]
         LGR.info(
-            f"Using {len(thefit.components_)} component(s), accounting for "
+            f"Using {len(thecomponents)} component(s), accounting for "
             f"{varex:.2f}% of the variance"
         )
+        optiondict["globalpcacomponentsused"] = len(thecomponents)
+
+        # this is the average of the voxels reconstructed from the retained components - the
+        # reconstruction only changes how each voxel differs from the mean voxel, so the
+        # average is the mean voxel
+        globalmean = 1.0 * themean
     else:
         dummy = optiondict["globalsignalmethod"]
         raise ValueError(f"illegal globalsignalmethod: {dummy}")
@@ -292,6 +343,30 @@ def rapidtide_main(argparsingfunc):
         optiondict["sharedmem"] = False
         LGR.info("running single process - disabled shared memory use")
 
+    # workers that are not forked can only get at the data through named shared memory
+    # segments, and can't run the consumer functions (which are closures), so they need
+    # block dispatch
+    tide_multiproc.setstartmethod(
+        optiondict["mp_startmethod"], namedshared=optiondict["namedsharedmem"]
+    )
+    if (
+        optiondict["sharedmem"]
+        and (optiondict["mp_startmethod"] != "fork")
+        and not (optiondict["mp_blockmode"] or optiondict["mp_workerpool"])
+    ):
+        optiondict["mp_blockmode"] = True
+        LGR.info(f"{optiondict['mp_startmethod']} start method - enabled block dispatch")
+
+    # block dispatch and the worker pool write results directly into the output arrays, so
+    # they must be shared
+    if not optiondict["sharedmem"]:
+        if optiondict["mp_blockmode"]:
+            optiondict["mp_blockmode"] = False
+            LGR.info("shared memory is disabled - disabled block dispatch")
+        if optiondict["mp_workerpool"]:
+            optiondict["mp_workerpool"] = False
+            LGR.info("shared memory is disabled - disabled persistent worker pool")
+
     # disable numba now if we're going to do it (before any jits)
     if optiondict["nonumba"]:
         tide_util.disablenumba()
@@ -320,12 +395,34 @@ def rapidtide_main(argparsingfunc):
     # set set the number of worker processes if multiprocessing
     if optiondict["nprocs"] < 1:
         optiondict["nprocs"] = tide_multiproc.maxcpus()
+    optiondict["availablecpus"] = tide_multiproc.availablecpus()
+
+    # share the cpus between the worker processes and the thread pools of the numerical
+    # libraries they call, so that nprocs workers don't each start a full set of threads
+    tide_multiproc.configureworkers(
+        threadsperworker=optiondict["workerthreads"], pincpus=optiondict["pincpus"]
+    )
+
+    # the main process has the cpus to itself between the multiprocessing stages
+    tide_fft.setbackend(optiondict["fftbackend"])
+    if optiondict["workerthreads"] is None:
+        tide_fft.setworkers(optiondict["availablecpus"])
+    else:
+        tide_fft.setworkers(optiondict["workerthreads"])
 
     if optiondict["singleproc_getNullDist"]:
         optiondict["nprocs_getNullDist"] = 1
     else:
         optiondict["nprocs_getNullDist"] = optiondict["nprocs"]
 
+    # pick (and record) a seed for the null distributions so the run can be repeated
+    if optiondict["nullseed"] is None:
+        optiondict["nullseed"] = int(np.random.default_rng().integers(2 ** 31))
+
+    # likewise for the refinement voxel sample
+    if optiondict["refinesubsample"] is not None and optiondict["refinesubsampleseed"] is None:
+        optiondict["refinesubsampleseed"] = int(np.random.default_rng().integers(2 ** 31))
+
     if optiondict["singleproc_calcsimilarity"]:
         optiondict["nprocs_calcsimilarity"] = 1
     else:
@@ -400,7 +497,9 @@ def rapidtide_main(argparsingfunc):
             slicesize = numspatiallocs
         else:
             LGR.info("input file is NIFTI")
-            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename)
+            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(
+                fmrifilename, dtype=rt_floatset
+            )
             optiondict["isgrayordinate"] = False
             xsize, ysize, numslices, timepoints = tide_io.parseniftidims(thedims)
             numspatiallocs = int(xsize) * int(ysize) * int(numslices)
@@ -638,7 +737,7 @@ def rapidtide_main(argparsingfunc):
     validvoxels = np.where(corrmask > 0)[0]
     numvalidspatiallocs = np.shape(validvoxels)[0]
     LGR.info(f"validvoxels shape = {numvalidspatiallocs}")
-    fmri_data_valid = fmri_data[validvoxels, :] + 0.0
+    fmri_data_valid = fmri_data[validvoxels, :].astype(rt_floattype)
     LGR.info(f"original size = {np.shape(fmri_data)}, trimmed size = {np.shape(fmri_data_valid)}")
     if internalglobalmeanincludemask is not None:
         internalglobalmeanincludemask_valid = 1.0 * internalglobalmeanincludemask[validvoxels]
@@ -1081,6 +1180,7 @@ def rapidtide_main(argparsingfunc):
         windowfunc=optiondict["windowfunc"],
         corrweighting=optiondict["corrweighting"],
         corrpadding=optiondict["zeropadding"],
+        lagmethod=optiondict["corrlagmethod"],
     )
     theCorrelator.setreftc(
         np.zeros((optiondict["oversampfactor"] * validtimepoints), dtype=np.float64)
@@ -1146,13 +1246,22 @@ def rapidtide_main(argparsingfunc):
             nativespaceshape = (xsize, ysize, numslices)
     internalspaceshape = numspatiallocs
     internalvalidspaceshape = numvalidspatiallocs
-    meanval = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
-    lagtimes = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
-    lagstrengths = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
-    lagsigma = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
-    fitmask = np.zeros(internalvalidspaceshape, dtype="uint16")
-    failreason = np.zeros(internalvalidspaceshape, dtype="uint32")
-    R2 = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+    if optiondict["sharedmem"]:
+        meanval, dummy, dummy = allocshared(internalvalidspaceshape, rt_floatset)
+        lagtimes, dummy, dummy = allocshared(internalvalidspaceshape, rt_floatset)
+        lagstrengths, dummy, dummy = allocshared(internalvalidspaceshape, rt_floatset)
+        lagsigma, dummy, dummy = allocshared(internalvalidspaceshape, rt_floatset)
+        fitmask, dummy, dummy = allocshared(internalvalidspaceshape, np.uint16)
+        failreason, dummy, dummy = allocshared(internalvalidspaceshape, np.uint32)
+        R2, dummy, dummy = allocshared(internalvalidspaceshape, rt_floatset)
+    else:
+        meanval = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+        lagtimes = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+        lagstrengths = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+        lagsigma = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
+        fitmask = np.zeros(internalvalidspaceshape, dtype="uint16")
+        failreason = np.zeros(internalvalidspaceshape, dtype="uint32")
+        R2 = np.zeros(internalvalidspaceshape, dtype=rt_floattype)
     outmaparray = np.zeros(internalspaceshape, dtype=rt_floattype)
     tide_util.logmem("after main array allocation")
 
@@ -1209,6 +1318,53 @@ def rapidtide_main(argparsingfunc):
     else:
         outfmriarray = np.zeros(internalfmrishape, dtype=rt_floattype)
 
+    # the prepped (oversampled, filtered, normalized and windowed) voxel timecourses don't
+    # depend on the regressor, so if we are going to correlate more than once, they can be
+    # calculated once and reused
+    prepcache = None
+    prepcachefile = None
+    prepcachevalid = False
+    if optiondict["prepcache"]:
+        if optiondict["similaritymetric"] == "mutualinfo":
+            LGR.info("the prep cache is not used with the mutualinfo similarity metric")
+        elif (
+            optiondict["passes"] == 1
+            and optiondict["convergencethresh"] is None
+            and not optiondict["echocancel"]
+        ):
+            LGR.info("only one correlation pass - not using the prep cache")
+        else:
+            internalprepcacheshape = (numvalidspatiallocs, len(os_fmri_x))
+            prepcache, optiondict["prepcachestorage"], prepcachefile = allocprepcache(
+                internalprepcacheshape,
+                rt_floatset,
+                optiondict["prepcachemem"],
+                shared=(
+                    optiondict["sharedmem"]
+                    and (optiondict["nprocs_calcsimilarity"] > 1 or optiondict["alwaysmultiproc"])
+                ),
+                cachedir=optiondict["prepcachedir"],
+                prefix=os.path.basename(outputname),
+            )
+            if (
+                optiondict["prepcachestorage"] == "ram"
+                and (optiondict["nprocs_calcsimilarity"] > 1 or optiondict["alwaysmultiproc"])
+            ):
+                # worker processes can only fill the cache if it is shared, so use a file
+                del prepcache
+                prepcache, optiondict["prepcachestorage"], prepcachefile = allocprepcache(
+                    internalprepcacheshape,
+                    rt_floatset,
+                    0.0,
+                    cachedir=optiondict["prepcachedir"],
+                    prefix=os.path.basename(outputname),
+                )
+            LGR.info(
+                f"caching prepped voxel timecourses {internalprepcacheshape} "
+                f"({optiondict['prepcachestorage']})"
+            )
+            tide_util.logmem("after prep cache allocation")
+
     # prepare for fast resampling
     padtime = (
         max((-optiondict["lagmin"], optiondict["lagmax"]))
@@ -1245,6 +1401,33 @@ def rapidtide_main(argparsingfunc):
         hardlimit=optiondict["hardlimit"],
     )
 
+    # start up the persistent worker pool, if we're using one
+    if optiondict["mp_workerpool"]:
+        LGR.info(f"starting persistent pool of {optiondict['nprocs']} workers")
+        thepool = tide_multiproc.WorkerPool(
+            optiondict["nprocs"],
+            sharedarrays={
+                "fmri_data_valid": fmri_data_valid,
+                "corrout": corrout,
+                "gaussout": gaussout,
+                "windowout": windowout,
+                "lagtc": lagtc,
+                "meanval": meanval,
+                "lagtimes": lagtimes,
+                "lagstrengths": lagstrengths,
+                "lagsigma": lagsigma,
+                "fitmask": fitmask,
+                "failreason": failreason,
+                "R2": R2,
+            },
+        )
+        if optiondict["passes"] > 1 or optiondict["convergencethresh"] is not None:
+            thepool.register(shiftedtcs=shiftedtcs, weights=weights)
+        if prepcache is not None:
+            thepool.register(prepcache=prepcache)
+    else:
+        thepool = None
+
     # Preprocessing - echo cancellation
     if optiondict["echocancel"]:
         LGR.info("\n\nEcho cancellation")
@@ -1259,6 +1442,8 @@ def rapidtide_main(argparsingfunc):
             windowfunc=optiondict["windowfunc"],
         )
 
+        # the echo is located from the maximum over all lags, not just the search range
+        theCorrelator.setlagmethod("fft")
         (voxelsprocessed_echo, theglobalmaxlist, trimmedcorrscale,) = calcsimilaritypass_func(
             fmri_data_valid[:, :],
             referencetc,
@@ -1275,9 +1460,15 @@ def rapidtide_main(argparsingfunc):
             interptype=optiondict["interptype"],
             showprogressbar=optiondict["showprogressbar"],
             chunksize=optiondict["mp_chunksize"],
+            blockmode=optiondict["mp_blockmode"],
+            pool=thepool,
+            prepcache=prepcache,
+            prepcachevalid=prepcachevalid,
             rt_floatset=rt_floatset,
             rt_floattype=rt_floattype,
         )
+        prepcachevalid = prepcache is not None
+        theCorrelator.setlagmethod(optiondict["corrlagmethod"])
         for i in range(len(theglobalmaxlist)):
             theglobalmaxlist[i] = corrscale[theglobalmaxlist[i]]
         if optiondict["bidsoutput"]:
@@ -1521,6 +1712,9 @@ def rapidtide_main(argparsingfunc):
             cleaned_referencetc = 1.0 * referencetc
             cleaned_nonosreferencetc = 1.0 * resampnonosref_y
 
+        # the similarity functions work in the internal precision
+        cleaned_resampref_y = rt_floatset(cleaned_resampref_y)
+
         # Step 0 - estimate significance
         if optiondict["numestreps"] > 0:
             TimingLGR.info(f"Significance estimation start, pass {thepass}")
@@ -1562,26 +1756,136 @@ def rapidtide_main(argparsingfunc):
             theMutualInformationator.setreftc(cleaned_resampref_y)
             dummy, trimmedcorrscale, dummy = theCorrelator.getfunction()
             thefitter.setcorrtimeaxis(trimmedcorrscale)
-            corrdistdata = getNullDistributionData_func(
-                cleaned_resampref_y,
-                oversampfreq,
-                theCorrelator,
-                thefitter,
-                numestreps=optiondict["numestreps"],
-                nprocs=optiondict["nprocs_getNullDist"],
-                alwaysmultiproc=optiondict["alwaysmultiproc"],
-                showprogressbar=optiondict["showprogressbar"],
-                chunksize=optiondict["mp_chunksize"],
-                permutationmethod=optiondict["permutationmethod"],
-                fixdelay=optiondict["fixdelay"],
-                fixeddelayvalue=optiondict["fixeddelayvalue"],
-                rt_floatset=np.float64,
-                rt_floattype="float64",
+
+            # calculate percentiles for the crosscorrelation from the distribution data
+            thepercentiles = np.array([0.95, 0.99, 0.995, 0.999])
+            thepvalnames = []
+            for thispercentile in thepercentiles:
+                thepvalnames.append("{:.3f}".format(1.0 - thispercentile).replace(".", "p"))
+
+            # if this null distribution has been calculated before, reuse it
+            nullcached = None
+            usenullcache = (optiondict["nullcachedir"] is not None) and (
+                optiondict["significancemethod"] == "permutation"
             )
+            if usenullcache:
+                nullcachekey = tide_nullsimfunc.nullcachekey(
+                    theCorrelator,
+                    thefitter,
+                    optiondict["numestreps"],
+                    permutationmethod=optiondict["permutationmethod"],
+                    seed=optiondict["nullseed"],
+                    stoptol=optiondict["nullstoptol"],
+                    sighistlen=optiondict["sighistlen"],
+                    thepercentiles=list(thepercentiles),
+                    twotail=optiondict["bipolar"],
+                    nozero=optiondict["nohistzero"],
+                    dosighistfit=optiondict["dosighistfit"],
+                )
+                nullcached = tide_nullsimfunc.readnullcache(
+                    optiondict["nullcachedir"], nullcachekey
+                )
+                optiondict["nullcachehit_pass" + str(thepass)] = nullcached is not None
+            if nullcached is not None:
+                LGR.info(f"using the cached null distribution {nullcachekey}")
+                corrdistdata = nullcached["corrdistdata"]
+                if "pcts" in nullcached:
+                    pcts = list(nullcached["pcts"])
+                else:
+                    pcts = None
+                pcts_fit = nullcached["pcts_fit"]
+                sigfit = nullcached["sigfit"]
+                if optiondict["nullstoptol"] is not None:
+                    optiondict["null_pass" + str(thepass) + "_numreps"] = len(corrdistdata)
+                    optiondict["null_pass" + str(thepass) + "_ciwidths"] = [
+                        float(thewidth) for thewidth in nullcached["ciwidths"]
+                    ]
+            elif optiondict["significancemethod"] == "analytic":
+                # model the null distribution from the autocorrelation of the prepared regressor
+                if optiondict["fixdelay"]:
+                    searchwidth = 0.0
+                else:
+                    searchwidth = trimmedcorrscale[-1] - trimmedcorrscale[0]
+                (
+                    corrdistdata,
+                    optiondict["nulleffectivedof_pass" + str(thepass)],
+                    optiondict["nullnumcrossings_pass" + str(thepass)],
+                ) = tide_stats.autocorrnulldistribution(
+                    theCorrelator.prepreftc,
+                    oversampfreq,
+                    searchwidth,
+                    numsamples=optiondict["numestreps"],
+                    twotail=optiondict["bipolar"],
+                )
+                LGR.info(
+                    "analytic null distribution: "
+                    f"{optiondict['nulleffectivedof_pass' + str(thepass)]:.1f} effective degrees "
+                    f"of freedom, {optiondict['nullnumcrossings_pass' + str(thepass)]:.1f} "
+                    "expected crossings in the search range"
+                )
+                pcts, pcts_fit, sigfit = tide_stats.sigFromDistributionData(
+                    corrdistdata,
+                    optiondict["sighistlen"],
+                    thepercentiles,
+                    twotail=optiondict["bipolar"],
+                    nozero=optiondict["nohistzero"],
+                    dosighistfit=optiondict["dosighistfit"],
+                )
+            else:
+                corrdistdata = getNullDistributionData_func(
+                    cleaned_resampref_y,
+                    oversampfreq,
+                    theCorrelator,
+                    thefitter,
+                    numestreps=optiondict["numestreps"],
+                    nprocs=optiondict["nprocs_getNullDist"],
+                    alwaysmultiproc=optiondict["alwaysmultiproc"],
+                    showprogressbar=optiondict["showprogressbar"],
+                    chunksize=optiondict["mp_chunksize"],
+                    blockmode=optiondict["mp_blockmode"],
+                    pool=thepool,
+                    permutationmethod=optiondict["permutationmethod"],
+                    fixdelay=optiondict["fixdelay"],
+                    fixeddelayvalue=optiondict["fixeddelayvalue"],
+                    seed=optiondict["nullseed"],
+                    stoptol=optiondict["nullstoptol"],
+                    stoppercentiles=thepercentiles,
+                    twotail=optiondict["bipolar"],
+                    nozero=optiondict["nohistzero"],
+                    thedict=optiondict,
+                    dictvarname="null_pass" + str(thepass),
+                    rt_floatset=np.float64,
+                    rt_floattype="float64",
+                )
+                pcts, pcts_fit, sigfit = tide_stats.sigFromDistributionData(
+                    corrdistdata,
+                    optiondict["sighistlen"],
+                    thepercentiles,
+                    twotail=optiondict["bipolar"],
+                    nozero=optiondict["nohistzero"],
+                    dosighistfit=optiondict["dosighistfit"],
+                )
+                if usenullcache:
+                    tide_nullsimfunc.writenullcache(
+                        optiondict["nullcachedir"],
+                        nullcachekey,
+                        maxsize=optiondict["nullcachesize"],
+                        corrdistdata=corrdistdata,
+                        pcts=pcts,
+                        pcts_fit=pcts_fit,
+                        sigfit=sigfit,
+                        ciwidths=optiondict.get("null_pass" + str(thepass) + "_ciwidths"),
+                    )
             if optiondict["bidsoutput"]:
+                # with nullstoptol, a pass can stop before numestreps null correlations, so pad
+                # it out with NaNs to share the file with the other passes
+                outcorrdistdata = corrdistdata
+                if len(corrdistdata) < optiondict["numestreps"]:
+                    outcorrdistdata = np.full(optiondict["numestreps"], np.nan)
+                    outcorrdistdata[: len(corrdistdata)] = corrdistdata
                 tide_io.writebidstsv(
                     f"{outputname}_desc-corrdistdata_info",
-                    corrdistdata,
+                    outcorrdistdata,
                     1.0,
                     columns=["pass" + str(thepass)],
                     append=(thepass > 1),
@@ -1591,20 +1895,6 @@ def rapidtide_main(argparsingfunc):
                     corrdistdata, f"{outputname}_corrdistdata_pass" + str(thepass) + ".txt",
                 )
 
-            # calculate percentiles for the crosscorrelation from the distribution data
-            thepercentiles = np.array([0.95, 0.99, 0.995, 0.999])
-            thepvalnames = []
-            for thispercentile in thepercentiles:
-                thepvalnames.append("{:.3f}".format(1.0 - thispercentile).replace(".", "p"))
-
-            pcts, pcts_fit, sigfit = tide_stats.sigFromDistributionData(
-                corrdistdata,
-                optiondict["sighistlen"],
-                thepercentiles,
-                twotail=optiondict["bipolar"],
-                nozero=optiondict["nohistzero"],
-                dosighistfit=optiondict["dosighistfit"],
-            )
             for i in range(len(thepvalnames)):
                 optiondict[
                     "p_lt_" + thepvalnames[i] + "_pass" + str(thepass) + "_thresh.txt"
@@ -1651,10 +1941,11 @@ def rapidtide_main(argparsingfunc):
                 else:
                     LGR.info("leaving ampthresh unchanged")
 
+            numnullreps = len(corrdistdata)
             del corrdistdata
             TimingLGR.info(
                 f"Significance estimation end, pass {thepass}",
-                {"message2": optiondict["numestreps"], "message3": "repetitions",},
+                {"message2": numnullreps, "message3": "repetitions",},
             )
 
         # Step 1 - Correlation step
@@ -1670,6 +1961,29 @@ def rapidtide_main(argparsingfunc):
             tide_calcsimfunc.correlationpass, optiondict["memprofile"], "before correlationpass",
         )
 
+        # on later passes, only look for each peak near where it was last time
+        if (
+            optiondict["lagwarmstart"]
+            and (thepass > 1)
+            and (optiondict["similaritymetric"] == "correlation")
+            and not optiondict["fixdelay"]
+        ):
+            lagwindows = tide_calcsimfunc.warmstartwindows(
+                lagtimes,
+                lagsigma,
+                fitmask,
+                trimmedcorrscale,
+                minhalfwidth=optiondict["lagwarmstartwidth"],
+            )
+            lastlagstrengths = lagstrengths + 0.0
+            LGR.info(
+                "Warm started lag search - mean window is "
+                f"{np.mean(lagwindows[:, 1] - lagwindows[:, 0]):.1f} of "
+                f"{len(trimmedcorrscale)} lags"
+            )
+        else:
+            lagwindows = None
+
         if optiondict["similaritymetric"] == "mutualinfo":
             theMutualInformationator.setlimits(lagmininpts, lagmaxinpts)
             (voxelsprocessed_cp, theglobalmaxlist, trimmedcorrscale,) = calcsimilaritypass_func(
@@ -1688,6 +2002,8 @@ def rapidtide_main(argparsingfunc):
                 interptype=optiondict["interptype"],
                 showprogressbar=optiondict["showprogressbar"],
                 chunksize=optiondict["mp_chunksize"],
+                blockmode=optiondict["mp_blockmode"],
+                pool=thepool,
                 rt_floatset=rt_floatset,
                 rt_floattype=rt_floattype,
             )
@@ -1708,9 +2024,15 @@ def rapidtide_main(argparsingfunc):
                 interptype=optiondict["interptype"],
                 showprogressbar=optiondict["showprogressbar"],
                 chunksize=optiondict["mp_chunksize"],
+                blockmode=optiondict["mp_blockmode"],
+                pool=thepool,
+                prepcache=prepcache,
+                prepcachevalid=prepcachevalid,
+                lagwindows=lagwindows,
                 rt_floatset=rt_floatset,
                 rt_floattype=rt_floattype,
             )
+            prepcachevalid = prepcache is not None
         for i in range(len(theglobalmaxlist)):
             theglobalmaxlist[i] = corrscale[theglobalmaxlist[i]]
         if optiondict["bidsoutput"]:
@@ -1774,6 +2096,8 @@ def rapidtide_main(argparsingfunc):
                 interptype=optiondict["interptype"],
                 showprogressbar=optiondict["showprogressbar"],
                 chunksize=optiondict["mp_chunksize"],
+                blockmode=optiondict["mp_blockmode"],
+                pool=thepool,
                 rt_floatset=rt_floatset,
                 rt_floattype=rt_floattype,
             )
@@ -1825,12 +2149,78 @@ def rapidtide_main(argparsingfunc):
             fixdelay=optiondict["fixdelay"],
             showprogressbar=optiondict["showprogressbar"],
             chunksize=optiondict["mp_chunksize"],
+            blockmode=optiondict["mp_blockmode"],
+            pool=thepool,
             despeckle_thresh=optiondict["despeckle_thresh"],
             initiallags=initlags,
             rt_floatset=rt_floatset,
             rt_floattype=rt_floattype,
         )
 
+        # redo any warm started voxels that did not find their peak in the window
+        if lagwindows is not None:
+            fallbacks = tide_calcsimfunc.warmstartfallbacks(
+                lagwindows,
+                lagtimes,
+                fitmask,
+                trimmedcorrscale,
+                lagstrengths=lagstrengths,
+                lastlagstrengths=lastlagstrengths,
+                corrout=corrout,
+                bipolar=optiondict["bipolar"],
+                searchfrac=optiondict["searchfrac"],
+            )
+            LGR.info(f"\n\nRedoing {len(fallbacks)} voxels over the full lag range")
+            optiondict["lagwarmstartfallbacks_pass" + str(thepass)] = len(fallbacks)
+            if len(fallbacks) > 0:
+                tide_calcsimfunc.correlatevoxels(
+                    fallbacks,
+                    fmri_data_valid,
+                    cleaned_referencetc,
+                    theCorrelator,
+                    initial_fmri_x,
+                    os_fmri_x,
+                    lagmininpts,
+                    lagmaxinpts,
+                    corrout,
+                    oversampfactor=optiondict["oversampfactor"],
+                    interptype=optiondict["interptype"],
+                    prepcache=prepcache,
+                    prepcachevalid=prepcachevalid,
+                    lagwindows=lagwindows,
+                    rt_floatset=rt_floatset,
+                    rt_floattype=rt_floattype,
+                )
+                fallbackmask = np.zeros(numvalidspatiallocs, dtype="uint16")
+                fallbackmask[fallbacks] = 1
+                fitcorr_func(
+                    genlagtc,
+                    initial_fmri_x,
+                    lagtc,
+                    trimmedcorrscale,
+                    thefitter,
+                    corrout,
+                    fitmask,
+                    failreason,
+                    lagtimes,
+                    lagstrengths,
+                    lagsigma,
+                    gaussout,
+                    windowout,
+                    R2,
+                    nprocs=optiondict["nprocs_fitcorr"],
+                    alwaysmultiproc=optiondict["alwaysmultiproc"],
+                    fixdelay=optiondict["fixdelay"],
+                    showprogressbar=optiondict["showprogressbar"],
+                    chunksize=optiondict["mp_chunksize"],
+                    blockmode=optiondict["mp_blockmode"],
+                    pool=thepool,
+                    despeckle_thresh=optiondict["despeckle_thresh"],
+                    voxelmask=fallbackmask,
+                    rt_floatset=rt_floatset,
+                    rt_floattype=rt_floattype,
+                )
+
         TimingLGR.info(
             f"Time lag estimation end, pass {thepass}",
             {"message2": voxelsprocessed_fc, "message3": "voxels",},
@@ -1859,6 +2249,32 @@ def rapidtide_main(argparsingfunc):
                 )[validvoxels]
                 if len(initlags) > 0:
                     if len(np.where(initlags != -1000000.0)[0]) > 0:
+                        if lagwindows is not None:
+                            # the new starting lags may be outside the warm start windows
+                            tide_calcsimfunc.correlatevoxels(
+                                np.where(
+                                    (initlags != -1000000.0)
+                                    & (
+                                        (lagwindows[:, 0] > 0)
+                                        | (lagwindows[:, 1] < len(trimmedcorrscale))
+                                    )
+                                )[0],
+                                fmri_data_valid,
+                                cleaned_referencetc,
+                                theCorrelator,
+                                initial_fmri_x,
+                                os_fmri_x,
+                                lagmininpts,
+                                lagmaxinpts,
+                                corrout,
+                                oversampfactor=optiondict["oversampfactor"],
+                                interptype=optiondict["interptype"],
+                                prepcache=prepcache,
+                                prepcachevalid=prepcachevalid,
+                                lagwindows=lagwindows,
+                                rt_floatset=rt_floatset,
+                                rt_floattype=rt_floattype,
+                            )
                         voxelsprocessed_thispass = fitcorr_func(
                             genlagtc,
                             initial_fmri_x,
@@ -1880,6 +2296,8 @@ def rapidtide_main(argparsingfunc):
                             fixdelay=optiondict["fixdelay"],
                             showprogressbar=optiondict["showprogressbar"],
                             chunksize=optiondict["mp_chunksize"],
+                            blockmode=optiondict["mp_blockmode"],
+                            pool=thepool,
                             despeckle_thresh=optiondict["despeckle_thresh"],
                             initiallags=initlags,
                             rt_floatset=rt_floatset,
@@ -1995,6 +2413,7 @@ def rapidtide_main(argparsingfunc):
                 padtrs=numpadtrs,
                 includemask=internalrefineincludemask_valid,
                 excludemask=internalrefineexcludemask_valid,
+                pool=thepool,
                 rt_floatset=rt_floatset,
                 rt_floattype=rt_floattype,
             )
@@ -2177,6 +2596,10 @@ def rapidtide_main(argparsingfunc):
                         savename = f"{outputname}_{mapname}" + passsuffix
                     tide_io.savetonifti(outmaparray.reshape(nativespaceshape), theheader, savename)
     # We are done with refinement.
+    if prepcache is not None:
+        del prepcache
+        if prepcachefile is not None:
+            os.remove(prepcachefile)
     if optiondict["convergencethresh"] is None:
         optiondict["actual_passes"] = optiondict["passes"]
     else:
@@ -2335,14 +2758,16 @@ def rapidtide_main(argparsingfunc):
                     nim_data = tide_io.readvecs(optiondict["glmsourcefile"])
                 else:
                     nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(
-                        optiondict["glmsourcefile"]
+                        optiondict["glmsourcefile"], dtype=rt_floatset
                     )
             else:
                 LGR.info(f"rereading {fmrifilename} for GLM filter, please wait")
                 if optiondict["textio"]:
                     nim_data = tide_io.readvecs(fmrifilename)
                 else:
-                    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename)
+                    nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(
+                        fmrifilename, dtype=rt_floatset
+                    )
 
             """meanvalue = np.mean(
                 nim_data.reshape((numspatiallocs, timepoints))[:, validstart : validend + 1],
@@ -2350,7 +2775,7 @@ def rapidtide_main(argparsingfunc):
             )"""
             fmri_data_valid = (
                 nim_data.reshape((numspatiallocs, timepoints))[:, validstart : validend + 1]
-            )[validvoxels, :] + 0.0
+            )[validvoxels, :].astype(rt_floattype)
 
             # move fmri_data_valid into shared memory
             if optiondict["sharedmem"]:
@@ -2387,8 +2812,12 @@ def rapidtide_main(argparsingfunc):
             tide_util.logmem("before glm")
 
         if optiondict["preservefiltering"]:
-            for i in range(len(validvoxels)):
-                fmri_data_valid[i] = theprefilter.apply(optiondict["fmrifreq"], fmri_data_valid[i])
+            # filter a chunk of voxels at a time to bound the size of the padded spectra
+            for startvox in range(0, len(validvoxels), optiondict["mp_chunksize"]):
+                endvox = min(startvox + optiondict["mp_chunksize"], len(validvoxels))
+                fmri_data_valid[startvox:endvox, :] = theprefilter.apply(
+                    optiondict["fmrifreq"], fmri_data_valid[startvox:endvox, :]
+                )
         glmpass_func = addmemprofiling(
             tide_glmpass.glmpass, optiondict["memprofile"], "before glmpass"
         )
@@ -2409,6 +2838,8 @@ def rapidtide_main(argparsingfunc):
             alwaysmultiproc=optiondict["alwaysmultiproc"],
             showprogressbar=optiondict["showprogressbar"],
             mp_chunksize=optiondict["mp_chunksize"],
+            blockmode=optiondict["mp_blockmode"],
+            pool=thepool,
             rt_floatset=rt_floatset,
             rt_floattype=rt_floattype,
         )
@@ -2428,11 +2859,23 @@ def rapidtide_main(argparsingfunc):
         if optiondict["textio"]:
             nim_data = tide_io.readvecs(fmrifilename)
         else:
-            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(fmrifilename)
+            nim, nim_data, nim_hdr, thedims, thesizes = tide_io.readfromnifti(
+                fmrifilename, dtype=rt_floatset
+            )
         """meanvalue = np.mean(
             nim_data.reshape((numspatiallocs, timepoints))[:, validstart : validend + 1], axis=1
         )"""
 
+    # shut down the worker pool
+    if thepool is not None:
+        thepool.shutdown()
+        optiondict["workerpool_starts"] = thepool.numstarts
+        optiondict["workerpool_stages"] = thepool.numstages
+        LGR.info(
+            f"worker pool ran {thepool.numstages} stages with {thepool.numstarts} worker start(s)"
+        )
+        thepool = None
+
     # Post refinement step 2 - make and save interesting histograms
     TimingLGR.info("Start saving histograms")
     if optiondict["bidsoutput"]:
@@ -2906,6 +3349,7 @@ def rapidtide_main(argparsingfunc):
         del filtereddata
 
     TimingLGR.info("Finished saving maps")
+    tide_multiproc.releasenamedshared()
     LGR.info("done")
 
     TimingLGR.info("Done")
@@ -2923,6 +3367,7 @@ def rapidtide_main(argparsingfunc):
     )
 
     optiondict["platform_information"] = nodeline
+    optiondict["mp_stagestats"] = tide_multiproc.getstagestats()
     tide_util.logmem("status")
 
     # do a final save of the options file
@@ -525,6 +525,20 @@ def _get_parser():
         ),
         default=DEFAULT_CORRWEIGHTING,
     )
+    corr.add_argument(
+        "--corrlagmethod",
+        dest="corrlagmethod",
+        action="store",
+        type=str,
+        choices=["auto", "fft", "direct"],
+        help=(
+            "How to calculate the correlation over the search range.  fft calculates the "
+            "full correlation function and keeps the search range, direct calculates only "
+            "the lags in the search range (unweighted correlation only), and auto uses "
+            'whichever is faster.  Default is "auto".'
+        ),
+        default="auto",
+    )
 
     mask_group = corr.add_mutually_exclusive_group()
     mask_group.add_argument(
@@ -636,10 +650,12 @@ def _get_parser():
         dest="peakfittype",
         action="store",
         type=str,
-        choices=["gauss", "fastgauss", "quad", "fastquad", "COM", "None"],
+        choices=["gauss", "gausslm", "fastgauss", "quad", "fastquad", "COM", "None"],
         help=(
             "Method for fitting the peak of the similarity function "
             '"gauss" performs a Gaussian fit, and is most accurate. '
+            '"gausslm" does the same fit with a bounded Levenberg-Marquardt fitter, which is '
+            "faster when numba is enabled. "
             '"quad" and "fastquad" use a quadratic fit, '
             "which is faster, but not as well tested. "
             f'Default is "{DEFAULT_PEAKFIT_TYPE}".'
@@ -673,6 +689,35 @@ def _get_parser():
         ),
         default=DEFAULT_DESPECKLE_THRESH,
     )
+    corr_fit.add_argument(
+        "--lagwarmstart",
+        dest="lagwarmstart",
+        action="store_true",
+        help=(
+            "In passes after the first, only calculate and search the similarity function "
+            "of each voxel near the lag it had in the previous pass (within "
+            "LAGWARMSTARTWIDTH seconds or two peak widths, whichever is larger).  Voxels "
+            "whose fit fails or lands on the edge of the window, or whose peak has the wrong "
+            "sign, is less than 3/4 of its strength in the previous pass, or is still above "
+            "half height at the edge of the window, are redone over the full search range.  "
+            "NOTE: this can change the results - in weak voxels with several similar peaks, "
+            "a stronger peak outside the window can still be missed.  Correlation similarity "
+            "metric only."
+        ),
+        default=False,
+    )
+    corr_fit.add_argument(
+        "--lagwarmstartwidth",
+        dest="lagwarmstartwidth",
+        action="store",
+        type=lambda x: pf.is_float(parser, x),
+        metavar="LAGWARMSTARTWIDTH",
+        help=(
+            "The smallest distance, in seconds, to search on either side of the previous "
+            "lag with --lagwarmstart.  Default is 3.0."
+        ),
+        default=3.0,
+    )
 
     # Regressor refinement options
     reg_ref = parser.add_argument_group("Regressor refinement options")
@@ -884,6 +929,44 @@ def _get_parser():
         ),
         default=DEFAULT_MAXPASSES,
     )
+    reg_ref.add_argument(
+        "--refinesubsample",
+        dest="refinesubsample",
+        action="store",
+        type=int,
+        metavar="NVOXELS",
+        help=(
+            "Only time shift and use a sample of NVOXELS voxels from the refine mask, drawn "
+            "so that it covers the range of lags and correlation strengths in the mask.  "
+            "By default all the voxels in the mask are used."
+        ),
+        default=None,
+    )
+    reg_ref.add_argument(
+        "--refinesubsampletol",
+        dest="refinesubsampletol",
+        action="store",
+        type=float,
+        metavar="TOL",
+        help=(
+            "With --refinesubsample, split the sample in two and make an average regressor "
+            "from each half.  Keep doubling the sample until the MSE between the two is <= TOL "
+            "(or the whole refine mask is used)."
+        ),
+        default=None,
+    )
+    reg_ref.add_argument(
+        "--refinesubsampleseed",
+        dest="refinesubsampleseed",
+        action="store",
+        type=int,
+        metavar="SEED",
+        help=(
+            "Seed for drawing the --refinesubsample sample.  By default a random seed is "
+            "chosen (and saved in the options file)."
+        ),
+        default=None,
+    )
 
     # Output options
     output = parser.add_argument_group("Output options")
@@ -1043,6 +1126,86 @@ def _get_parser():
         help=("Disable use of shared memory for large array storage."),
         default=True,
     )
+    misc.add_argument(
+        "--blockdispatch",
+        dest="mp_blockmode",
+        action="store_true",
+        help=(
+            "Send contiguous ranges of voxels to each worker process, and have the workers "
+            "write their results directly into shared memory, rather than passing every "
+            "voxel through a queue.  Requires shared memory."
+        ),
+        default=False,
+    )
+    misc.add_argument(
+        "--workerpool",
+        dest="mp_workerpool",
+        action="store_true",
+        help=(
+            "Start one set of worker processes at the beginning of the run and reuse it for "
+            "every multiprocessing stage, rather than starting new processes each time.  "
+            "Requires shared memory."
+        ),
+        default=False,
+    )
+    misc.add_argument(
+        "--mpstartmethod",
+        dest="mp_startmethod",
+        action="store",
+        type=str,
+        choices=["fork", "forkserver", "spawn"],
+        help=(
+            "How to start worker processes.  forkserver and spawn avoid forking a process "
+            "that already has library threads running, at the cost of slower startup.  They "
+            "put all shared arrays in named shared memory and use block dispatch.  Stages "
+            "that have no block dispatch (or every stage, if shared memory is disabled) run "
+            'in a single process instead.  Default is "fork".'
+        ),
+        default="fork",
+    )
+    misc.add_argument(
+        "--namedsharedmem",
+        dest="namedsharedmem",
+        action="store_true",
+        help=(
+            "Put shared arrays in named shared memory segments, which workers attach to by "
+            "name, even when forking."
+        ),
+        default=False,
+    )
+    misc.add_argument(
+        "--prepcache",
+        dest="prepcache",
+        action="store_true",
+        help=(
+            "Oversample, filter, normalize and window each voxel timecourse once, and reuse "
+            "the result in every correlation pass, rather than redoing it each pass.  The "
+            "cache is kept in memory if it fits in PREPCACHEMEM, and in a scratch file "
+            "otherwise."
+        ),
+        default=False,
+    )
+    misc.add_argument(
+        "--prepcachemem",
+        dest="prepcachemem",
+        action="store",
+        type=lambda x: pf.is_float(parser, x),
+        metavar="GB",
+        help=("Memory budget for the prep cache, in gigabytes.  Default is 2.0."),
+        default=2.0,
+    )
+    misc.add_argument(
+        "--prepcachedir",
+        dest="prepcachedir",
+        action="store",
+        type=str,
+        metavar="DIR",
+        help=(
+            "Directory for the prep cache scratch file, if one is needed.  Default is the "
+            "system temporary directory."
+        ),
+        default=None,
+    )
     misc.add_argument(
         "--memprofile",
         dest="memprofile",
@@ -1068,10 +1231,43 @@ def _get_parser():
         help=(
             "Use NPROCS worker processes for multiprocessing. "
             "Setting NPROCS to less than 1 sets the number of "
-            "worker processes to n_cpus - 1."
+            "worker processes to n_cpus - 1, where n_cpus is the number of cpus "
+            "this job is allowed to use (respecting cpu affinity and container quotas)."
         ),
         default=1,
     )
+    misc.add_argument(
+        "--workerthreads",
+        dest="workerthreads",
+        action="store",
+        type=int,
+        metavar="NTHREADS",
+        help=(
+            "Allow each worker process to use NTHREADS threads in BLAS and FFT calls.  By "
+            "default the available cpus are divided evenly between the worker processes."
+        ),
+        default=None,
+    )
+    misc.add_argument(
+        "--pincpus",
+        dest="pincpus",
+        action="store_true",
+        help=("Pin each worker process to its own subset of the available cpus."),
+        default=False,
+    )
+    misc.add_argument(
+        "--fftbackend",
+        dest="fftbackend",
+        action="store",
+        type=str,
+        choices=["scipy", "pyfftw", "numpy"],
+        help=(
+            "The FFT implementation to use.  scipy (the default) uses multiple threads per "
+            "transform, pyfftw reuses FFTW plans for repeated transforms (if pyfftw is "
+            "installed), numpy is single threaded."
+        ),
+        default="scipy",
+    )
     misc.add_argument(
         "--version",
         dest="printversion",
@@ -179,6 +179,7 @@ setup(
         "pyqtgraph>=0.11.0",
         "statsmodels",
         "numba",
+        "threadpoolctl",
     ],
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,